@@ -17,6 +17,7 @@
 
 
 from stringbuffer import StringBuffer
+from metrics import Metrics, Counter, Gauge, Histogram, default_metrics
 from sm import StateMachine
 from eventsrc import EventSource
 from socketsrc import (SocketError, NewConnection, ListeningSocketEventSource,
@@ -28,9 +29,17 @@ from mainloop import MainLoop
 from sockserv import ListenServer
 from jm import JsonMachine, JsonNewMessage, JsonEof
 
-from serialise import serialise_artifact, deserialise_artifact
+from serialise import (serialise_artifact, deserialise_artifact,
+                       serialise_job, deserialise_job)
+from graph_cache import GraphCache, is_commit_sha1, is_graph_pinned
 from idgen import IdentifierGenerator
 from route_map import RouteMap
+from resource_history import ResourceHistory
+from step_log import StepLog, StepLogs
+from build_trace import BuildTrace
+from journal import Journal
+from proctree import read_processes, tree_memory, MemorySampler
+from job_table import JobTable
 from timer_event_source import TimerEventSource, Timer
 from proxy_event_source import ProxyEventSource
 from json_router import JsonRouter
@@ -40,6 +49,7 @@ from initiator_connection import (InitiatorConnection, InitiatorDisconnect)
 from connection_machine import (ConnectionMachine, InitiatorConnectionMachine,
                                 Reconnect, StopConnecting)
 from worker_build_scheduler import (WorkerBuildQueuer, 
+                                    WorkerCapacity,
                                     WorkerConnection, 
                                     WorkerBuildRequest,
                                     WorkerCancelPending,
@@ -57,6 +67,7 @@ from build_controller import (BuildController, BuildFailed, BuildProgress,
                               BuildFinished, BuildCancel,
                               build_step_name, map_build_graph)
 from initiator import Initiator
+from metrics_connection import MetricsConnection
 from protocol import message
 
 from crashpoint import (crash_point, add_crash_condition, add_crash_conditions,
@@ -64,4 +75,8 @@ from crashpoint import (crash_point, add_crash_condition, add_crash_conditions,
 
 from distbuild_socket import create_socket
 
+from cache_maintainer import CacheMaintainer
+
+from forkserver import ForkServer, ForkServerClient, ForkedProcess
+
 __all__ = locals()
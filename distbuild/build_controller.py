@@ -18,6 +18,8 @@
 
 import logging
 import httplib
+import os
+import time
 import traceback
 import urllib
 import urlparse
@@ -90,24 +92,26 @@ class BuildSteps(object):
 
 class BuildStepStarted(object):
 
-    def __init__(self, request_id, step_name, worker_name):
+    def __init__(self, request_id, step_name, worker_name, log=None):
         self.id = request_id
         self.step_name = step_name
         self.worker_name = worker_name
+        self.log = log
 
 class BuildStepAlreadyStarted(BuildStepStarted):
 
-    def __init__(self, request_id, step_name, worker_name):
+    def __init__(self, request_id, step_name, worker_name, log=None):
         super(BuildStepAlreadyStarted, self).__init__(
-            request_id, step_name, worker_name)
+            request_id, step_name, worker_name, log)
 
 class BuildOutput(object):
 
-    def __init__(self, request_id, step_name, stdout, stderr):
+    '''There is new output in the StepLog of a build step.'''
+
+    def __init__(self, request_id, step_name, log):
         self.id = request_id
         self.step_name = step_name
-        self.stdout = stdout
-        self.stderr = stderr
+        self.log = log
 
 
 class BuildStepFinished(object):
@@ -157,19 +161,43 @@ class BuildController(distbuild.StateMachine):
     build graph to determine all the artifacts that need building, then
     builds anything that is not cached.
 
+    How many artifacts are in each state is kept in the metrics of this
+    process while the build runs. If ``trace_dir`` is given, a
+    BuildTrace of when each step waited, built and was cached is written
+    there once the build is over.
+
+    The request and its build graph are recorded in ``journal``, if
+    given, so that the build can carry on if the controller restarts,
+    when the initiator asks for it again.
+
     '''
     
     _idgen = distbuild.IdentifierGenerator('BuildController')
+
+    graph_buckets = (0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600)
+
+    # Artifacts that are ready to build are queued for a worker at once,
+    # so they are counted as waiting.
+    artifact_states = ('unbuilt', 'waiting', 'building', 'built')
     
     def __init__(self, initiator_connection, build_request_message,
-                 artifact_cache_server, morph_instance):
+                 artifact_cache_server, morph_instance, graph_cache=None,
+                 trace_dir=None, journal=None):
         distbuild.crash_point()
         distbuild.StateMachine.__init__(self, 'init')
         self._initiator_connection = initiator_connection
         self._request = build_request_message
         self._artifact_cache_server = artifact_cache_server
         self._morph_instance = morph_instance
+        self._graph_cache = graph_cache
+        self._graph_key = None
         self._helper_id = None
+        self._created = time.time()
+        self._trace_dir = trace_dir
+        self._journal = journal
+        self._trace = distbuild.BuildTrace(
+            'build request %s' % self._request['id'])
+        self._started_steps = set()
         self.debug_transitions = False
         self.debug_graph_state = False
 
@@ -184,7 +212,7 @@ class BuildController(distbuild.StateMachine):
             # state, source, event_class, new_state, callback
             ('init', self, _Start, 'graphing', self._start_graphing),
             ('init', self._initiator_connection,
-                distbuild.InitiatorDisconnect, None, None),
+                distbuild.InitiatorDisconnect, None, self._cancelled),
 
             ('graphing', distbuild.HelperRouter, distbuild.HelperOutput,
                 'graphing', self._maybe_collect_graph),
@@ -192,18 +220,18 @@ class BuildController(distbuild.StateMachine):
                 'graphing', self._maybe_finish_graph),
             ('graphing', self, _GotGraph,
                 'annotating', self._start_annotating),
-            ('graphing', self, _GraphFailed, None, None),
+            ('graphing', self, _GraphFailed, None, self._graph_failed),
             ('graphing', self._initiator_connection,
-                distbuild.InitiatorDisconnect, None, None),
+                distbuild.InitiatorDisconnect, None, self._cancelled),
 
             ('annotating', distbuild.HelperRouter, distbuild.HelperResult,
                 'annotating', self._maybe_handle_cache_response),
             ('annotating', self, _AnnotationFailed, None,
                 self._notify_annotation_failed),
             ('annotating', self, _Annotated, 'building', 
-                self._queue_worker_builds),
+                self._start_building),
             ('annotating', self._initiator_connection,
-                distbuild.InitiatorDisconnect, None, None),
+                distbuild.InitiatorDisconnect, None, self._cancelled),
 
             # The exact WorkerConnection that is doing our building changes
             # from build to build. We must listen to all messages from all
@@ -234,7 +262,7 @@ class BuildController(distbuild.StateMachine):
             ('building', distbuild.WorkerConnection,
                 distbuild.WorkerBuildFailed, 'building',
                 self._maybe_notify_build_failed),
-            ('building', self, _Abort, None, None),
+            ('building', self, _Abort, None, self._build_over),
             ('building', self, _Built, None, self._notify_build_done),
             ('building', distbuild.InitiatorConnection,
                 distbuild.InitiatorDisconnect, 'building',
@@ -247,7 +275,30 @@ class BuildController(distbuild.StateMachine):
     def _start_graphing(self, event_source, event):
         distbuild.crash_point()
 
+        if self._journal is not None:
+            self._journal.start_request(self._request['id'], self._request)
+            text = self._journal.claim_request(
+                self._request['id'], self._request)
+            if text is not None:
+                logging.info('Carrying on with build from before restart')
+                progress = BuildProgress(
+                    self._request['id'],
+                    'Carrying on with build from before controller restart')
+                self.mainloop.queue_event(BuildController, progress)
+                self._graph_ready(distbuild.deserialise_artifact(text))
+                return
+
+        if self._graph_cache is not None:
+            self._graph_key = self._graph_cache.key(self._request)
+        if self._graph_key is not None:
+            text = self._graph_cache.get(self._graph_key)
+            if text is not None:
+                logging.info('Using remembered build graph')
+                self._graph_ready(distbuild.deserialise_artifact(text), text)
+                return
+
         logging.info('Start constructing build graph')
+        self._trace.begin('build graph', 'computing')
         self._artifact_data = distbuild.StringBuffer()
         self._artifact_error = distbuild.StringBuffer()
         argv = [
@@ -291,18 +342,6 @@ class BuildController(distbuild.StateMachine):
             
             self.mainloop.queue_event(self, _GraphFailed())
 
-        def notify_success(artifact):
-            logging.debug('Graph is finished')
-
-            progress = BuildProgress(
-                self._request['id'], 'Finished computing build graph')
-            self.mainloop.queue_event(BuildController, progress)
-            
-            build_steps = BuildSteps(self._request['id'], artifact)
-            self.mainloop.queue_event(BuildController, build_steps)
-
-            self.mainloop.queue_event(self, _GotGraph(artifact))
-
         if event.msg['id'] == self._helper_id:
             self._helper_id = None
 
@@ -322,18 +361,51 @@ class BuildController(distbuild.StateMachine):
                 notify_failure(str(e))
                 return
 
-            notify_success(artifact)
+            if (self._graph_key is not None and not error_text and
+                    distbuild.is_graph_pinned(artifact, self._request['ref'])):
+                self._graph_cache.put(self._graph_key, text)
+
+            self._graph_ready(artifact, text)
+
+    def _graph_ready(self, artifact, text=None):
+        '''Start on the build graph, saving its text if it is given.'''
+
+        logging.debug('Graph is finished')
+        if self._journal is not None and text is not None:
+            self._journal.save_graph(
+                self._request['id'], text,
+                distbuild.is_graph_pinned(artifact, self._request['ref']))
+        distbuild.default_metrics.histogram(
+            'distbuild_build_graph_seconds',
+            'Time taken to compute the build graph of a request',
+            self.graph_buckets).observe(time.time() - self._created)
+
+        progress = BuildProgress(
+            self._request['id'], 'Finished computing build graph')
+        self.mainloop.queue_event(BuildController, progress)
+
+        build_steps = BuildSteps(self._request['id'], artifact)
+        self.mainloop.queue_event(BuildController, build_steps)
+
+        self.mainloop.queue_event(self, _GotGraph(artifact))
 
     def _start_annotating(self, event_source, event):
         distbuild.crash_point()
 
         self._artifact = event.artifact
         self._helper_id = self._idgen.next()
+        self._trace.begin('build graph', 'annotating')
         artifact_names = []
 
+        # Events about every build step of every build come to every
+        # BuildController, so they must be quick to look up.
+        self._artifacts_by_cache_key = {}
+
         def set_state_and_append(artifact):
             artifact.state = UNKNOWN
             artifact_names.append(artifact.basename())
+            self._artifacts_by_cache_key.setdefault(
+                artifact.source.cache_key, artifact)
 
         map_build_graph(self._artifact, set_state_and_append)
 
@@ -359,7 +431,7 @@ class BuildController(distbuild.StateMachine):
         if self._helper_id != event.msg['id']:
             return    # this event is not for us
 
-        logging.debug('Got cache response: %s' % repr(event.msg))
+        logging.debug('Got cache response: %r', event.msg)
 
         http_status_code = event.msg['status']
         error_msg = event.msg['body']
@@ -387,6 +459,36 @@ class BuildController(distbuild.StateMachine):
             logging.info('There seems to be nothing to build')
             self.mainloop.queue_event(self, _Built())
 
+    def _start_building(self, event_source, event):
+        self._trace.end('build graph')
+        distbuild.default_metrics.add_collector(self._collect_metrics)
+        self._queue_worker_builds(event_source, event)
+
+    def _collect_metrics(self):
+        counts = dict.fromkeys(self.artifact_states, 0)
+
+        def count(artifact):
+            if artifact.state == BUILDING:
+                if artifact.source.cache_key in self._started_steps:
+                    counts['building'] += 1
+                else:
+                    counts['waiting'] += 1
+            elif artifact.state == BUILT:
+                counts['built'] += 1
+            else:
+                counts['unbuilt'] += 1
+
+        map_build_graph(self._artifact, count)
+        gauge = self._artifacts_gauge()
+        for state, n in counts.iteritems():
+            gauge.set(n, request=self._request['id'], state=state)
+
+    def _artifacts_gauge(self):
+        return distbuild.default_metrics.gauge(
+            'distbuild_request_artifacts',
+            'Artifacts of a build request in each state',
+            labels=('request', 'state'))
+
     def _find_artifacts_that_are_ready_to_build(self):
         def is_ready_to_build(artifact):
             return (artifact.state == UNBUILT and
@@ -431,6 +533,7 @@ class BuildController(distbuild.StateMachine):
             request = distbuild.WorkerBuildRequest(artifact,
                                                    self._request['id'])
             self.mainloop.queue_event(distbuild.WorkerBuildQueuer, request)
+            self._trace.begin(build_step_name(artifact), 'waiting')
 
             artifact.state = BUILDING
             if artifact.source.morphology['kind'] == 'chunk':
@@ -459,7 +562,8 @@ class BuildController(distbuild.StateMachine):
         cancel = BuildCancel(event.id)
         self.mainloop.queue_event(BuildController, cancel)
 
-        self.mainloop.queue_event(self, _Abort)
+        self._count_request('cancelled')
+        self.mainloop.queue_event(self, _Abort())
 
     def _maybe_relay_build_waiting_for_worker(self, event_source, event):
         if event.initiator_id != self._request['id']:
@@ -490,10 +594,17 @@ class BuildController(distbuild.StateMachine):
             return
 
         logging.debug('BC: got build step started: %s' % artifact.name)
+        self._step_started(artifact, event.worker_name)
         started = BuildStepStarted(
-            self._request['id'], build_step_name(artifact), event.worker_name)
+            self._request['id'], build_step_name(artifact), event.worker_name,
+            event.log)
         self.mainloop.queue_event(BuildController, started)
-        logging.debug('BC: emitted %s' % repr(started))
+        logging.debug('BC: emitted %r', started)
+
+    def _step_started(self, artifact, worker_name):
+        self._started_steps.add(artifact.source.cache_key)
+        self._trace.begin(
+            build_step_name(artifact), 'building', worker=worker_name)
 
     def _maybe_relay_build_step_already_started(self, event_source, event):
         if event.initiator_id != self._request['id']:
@@ -502,28 +613,26 @@ class BuildController(distbuild.StateMachine):
         artifact = self._find_artifact(event.artifact_cache_key)
 
         logging.debug('BC: got build step already started: %s' % artifact.name)
+        self._step_started(artifact, event.worker_name)
         started = BuildStepAlreadyStarted(
-            self._request['id'], build_step_name(artifact), event.worker_name)
+            self._request['id'], build_step_name(artifact), event.worker_name,
+            event.log)
         self.mainloop.queue_event(BuildController, started)
-        logging.debug('BC: emitted %s' % repr(started))
+        logging.debug('BC: emitted %r', started)
 
     def _maybe_relay_build_output(self, event_source, event):
         distbuild.crash_point()
-        if self._request['id'] not in event.msg['ids']:
+        if self._request['id'] not in event.initiators:
             return # not for us
 
-        logging.debug('BC: got output: %s' % repr(event.msg))
         artifact = self._find_artifact(event.artifact_cache_key)
-        logging.debug('BC: got artifact: %s' % repr(artifact))
         if artifact is None:
             # This is not the event you are looking for.
             return
 
         output = BuildOutput(
-            self._request['id'], build_step_name(artifact),
-            event.msg['stdout'], event.msg['stderr'])
+            self._request['id'], build_step_name(artifact), event.log)
         self.mainloop.queue_event(BuildController, output)
-        logging.debug('BC: queued %s' % repr(output))
 
     def _maybe_relay_build_caching(self, event_source, event):
         distbuild.crash_point()
@@ -536,18 +645,14 @@ class BuildController(distbuild.StateMachine):
             # This is not the event you are looking for.
             return
 
+        self._trace.begin(build_step_name(artifact), 'caching')
         progress = BuildProgress(
             self._request['id'],
             'Transferring %s to shared artifact cache' % artifact.name)
         self.mainloop.queue_event(BuildController, progress)
 
     def _find_artifact(self, cache_key):
-        artifacts = map_build_graph(self._artifact, lambda a: a)
-        wanted = [a for a in artifacts if a.source.cache_key == cache_key]
-        if wanted:
-            return wanted[0]
-        else:
-            return None
+        return self._artifacts_by_cache_key.get(cache_key)
             
     def _maybe_check_result_and_queue_more_builds(self, event_source, event):
         distbuild.crash_point()
@@ -560,11 +665,12 @@ class BuildController(distbuild.StateMachine):
             return
 
         logging.debug(
-            'Got build result for %s: %s', artifact.name, repr(event.msg))
+            'Got build result for %s: %r', artifact.name, event.msg)
 
         finished = BuildStepFinished(
             self._request['id'], build_step_name(artifact))
         self.mainloop.queue_event(BuildController, finished)
+        self._trace.end(build_step_name(artifact))
 
         artifact.state = BUILT
 
@@ -588,6 +694,8 @@ class BuildController(distbuild.StateMachine):
         logging.error(errmsg)
         failed = BuildFailed(self._request['id'], errmsg)
         self.mainloop.queue_event(BuildController, failed)
+        self._count_request('failed')
+        self._build_over(event_source, event)
 
     def _maybe_notify_build_failed(self, event_source, event):
         distbuild.crash_point()
@@ -607,7 +715,9 @@ class BuildController(distbuild.StateMachine):
             self.mainloop.queue_event(self, _Abort())
 
         logging.info(
-            'Build step failed for %s: %s', artifact.name, repr(event.msg))
+            'Build step failed for %s: %r', artifact.name, event.msg)
+        self._trace.end(build_step_name(artifact), failed=True)
+        self._count_request('failed')
 
         step_failed = BuildStepFailed(
             self._request['id'], build_step_name(artifact))
@@ -646,3 +756,40 @@ class BuildController(distbuild.StateMachine):
         url = '%s?filename=%s' % (baseurl, urllib.quote(filename))
         finished = BuildFinished(self._request['id'], [url])
         self.mainloop.queue_event(BuildController, finished)
+        self._count_request('finished')
+        self._build_over(event_source, event)
+
+    def _count_request(self, result):
+        distbuild.default_metrics.counter(
+            'distbuild_requests_total', 'Build requests, by how they ended',
+            labels=('result',)).inc(result=result)
+
+    def _graph_failed(self, event_source, event):
+        self._count_request('failed')
+        self._build_over(event_source, event)
+
+    def _cancelled(self, event_source, event):
+        self._count_request('cancelled')
+        self._build_over(event_source, event)
+
+    def _build_over(self, event_source, event):
+        '''Tidy up once the build has finished, failed or been cancelled.'''
+
+        if self._journal is not None:
+            self._journal.finish_request(self._request['id'])
+
+        distbuild.default_metrics.remove_collector(self._collect_metrics)
+        gauge = self._artifacts_gauge()
+        for state in self.artifact_states:
+            gauge.remove(request=self._request['id'], state=state)
+
+        if self._trace_dir:
+            filename = os.path.join(self._trace_dir, '%s-%s.json' % (
+                time.strftime('%Y%m%dT%H%M%S',
+                              time.gmtime(self._created)),
+                self._request['id']))
+            try:
+                self._trace.write(filename)
+            except (IOError, OSError) as e:
+                logging.warning('Could not write build trace %s: %s',
+                                filename, e)
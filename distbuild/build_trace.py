@@ -0,0 +1,110 @@
+# distbuild/build_trace.py -- timeline of the steps of a build
+#
+# Copyright (C) 2014  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA..
+
+
+import json
+import os
+import tempfile
+import time
+
+
+class BuildTrace(object):
+
+    '''Record when each step of a build was in each phase.
+
+    A step goes through phases such as waiting for a worker, building
+    and caching. Starting a phase ends the one before it. The trace is
+    written in the JSON format of the Trace Event Profiling Tool, with
+    a row for each step, and can be looked at with chrome://tracing or
+    any other viewer that reads that format.
+
+    ``clock`` returns the current time in seconds.
+
+    '''
+
+    def __init__(self, name, clock=time.time):
+        self.name = name
+        self._clock = clock
+        self._started = clock()
+        self._rows = {}
+        self._phases = {}
+        self._events = []
+
+    def begin(self, step_name, phase, **args):
+        '''Start a phase of a step, ending the one it was in.'''
+
+        self.end(step_name)
+        if step_name not in self._rows:
+            self._rows[step_name] = len(self._rows) + 1
+        self._phases[step_name] = (phase, self._clock(), args)
+
+    def end(self, step_name, **args):
+        '''End the phase a step is in, if any.'''
+
+        if step_name not in self._phases:
+            return
+        phase, started, phase_args = self._phases.pop(step_name)
+        phase_args.update(args)
+        self._events.append({
+            'name': phase,
+            'cat': 'build-step',
+            'ph': 'X',
+            'ts': self._microseconds(started),
+            'dur': self._microseconds(self._clock()) -
+                   self._microseconds(started),
+            'pid': 1,
+            'tid': self._rows[step_name],
+            'args': phase_args,
+        })
+
+    def _microseconds(self, t):
+        return int((t - self._started) * 1000000)
+
+    def as_dict(self):
+        '''Return the trace, ending the phases steps are in now.'''
+
+        for step_name in self._phases.keys():
+            self.end(step_name)
+        metadata = [{
+            'name': 'process_name',
+            'ph': 'M',
+            'pid': 1,
+            'args': {'name': self.name},
+        }]
+        for step_name, row in sorted(self._rows.iteritems(),
+                                     key=lambda item: item[1]):
+            metadata.append({
+                'name': 'thread_name',
+                'ph': 'M',
+                'pid': 1,
+                'tid': row,
+                'args': {'name': step_name},
+            })
+        return {'traceEvents': metadata + self._events}
+
+    def write(self, filename):
+        '''Write the trace to a file.'''
+
+        dirname = os.path.dirname(filename) or '.'
+        fd, tempname = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.as_dict(), f)
+            os.rename(tempname, filename)
+        except BaseException:
+            os.remove(tempname)
+            raise
@@ -0,0 +1,86 @@
+# distbuild/build_trace_tests.py -- unit tests for BuildTrace
+#
+# Copyright (C) 2014  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA..
+
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import distbuild
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class BuildTraceTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.trace = distbuild.BuildTrace('build', clock=self.clock)
+
+    def events(self):
+        return [e for e in self.trace.as_dict()['traceEvents']
+                if e['ph'] == 'X']
+
+    def test_is_empty_initially(self):
+        self.assertEqual(self.events(), [])
+
+    def test_records_phases_of_a_step(self):
+        self.trace.begin('gcc', 'waiting')
+        self.clock.now += 1
+        self.trace.begin('gcc', 'building', worker='w1')
+        self.clock.now += 2
+        self.trace.end('gcc', failed=True)
+        self.trace.end('gcc')
+        events = self.events()
+        self.assertEqual([(e['name'], e['ts'], e['dur'], e['tid'])
+                          for e in events],
+                         [('waiting', 0, 1000000, 1),
+                          ('building', 1000000, 2000000, 1)])
+        self.assertEqual(events[1]['args'],
+                         {'worker': 'w1', 'failed': True})
+
+    def test_names_a_row_for_each_step(self):
+        self.trace.begin('gcc', 'waiting')
+        self.trace.begin('glibc', 'waiting')
+        metadata = [e for e in self.trace.as_dict()['traceEvents']
+                    if e['ph'] == 'M']
+        self.assertEqual([(e['name'], e.get('tid'), e['args']['name'])
+                          for e in metadata],
+                         [('process_name', None, 'build'),
+                          ('thread_name', 1, 'gcc'),
+                          ('thread_name', 2, 'glibc')])
+
+    def test_writes_trace(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tempdir, 'trace.json')
+            self.trace.begin('gcc', 'waiting')
+            self.trace.write(filename)
+            with open(filename) as f:
+                self.assertEqual(json.load(f), self.trace.as_dict())
+            self.assertEqual(os.listdir(tempdir), ['trace.json'])
+        finally:
+            shutil.rmtree(tempdir)
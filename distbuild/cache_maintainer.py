@@ -0,0 +1,113 @@
+# distbuild/cache_maintainer.py -- keep space free in a worker's cache
+#
+# Copyright (C) 2014  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA..
+
+
+import logging
+import os
+import subprocess
+
+import distbuild
+
+
+class _CollectGarbage(object):
+
+    pass
+
+
+class _GarbageCollected(object):
+
+    def __init__(self, returncode):
+        self.returncode = returncode
+
+
+class CacheMaintainer(distbuild.StateMachine):
+
+    '''Keep enough space free in the cache directory of a worker.
+
+    Every ``interval`` seconds, the free space on the filesystem holding
+    ``path`` is checked. When it has dropped below ``low_water`` bytes,
+    ``gc_argv`` is run to free space until there are ``high_water``
+    bytes free, which is passed to it as ``--cachedir-min-space``.
+
+    The garbage collector runs as a separate process, so neither the
+    worker daemon nor the builds wait for it, and it is not started
+    again while it is still running. Having two watermarks means it
+    frees a good amount of space when it runs, rather than running
+    again as soon as the next build has written a few files.
+
+    '''
+
+    def __init__(self, path, low_water, high_water, interval, gc_argv):
+        distbuild.StateMachine.__init__(self, 'idle')
+        self._path = path
+        self._low_water = low_water
+        self._high_water = high_water
+        self._interval = interval
+        self._gc_argv = gc_argv
+        self._process = None
+
+    def setup(self):
+        self._timer = distbuild.TimerEventSource(self._interval)
+        self.mainloop.add_event_source(self._timer)
+        self._timer.start()
+
+        spec = [
+            # state, source, event_class, new_state, callback
+            ('idle', self._timer, distbuild.Timer, 'idle',
+                self._check_space),
+            ('idle', self, _CollectGarbage, 'collecting',
+                self._start_gc),
+            ('collecting', self._timer, distbuild.Timer, 'collecting',
+                self._poll_gc),
+            ('collecting', self, _GarbageCollected, 'idle',
+                self._gc_finished),
+        ]
+        self.add_transitions(spec)
+
+    def _bytes_free(self):
+        fsinfo = os.statvfs(self._path)
+        return fsinfo.f_bavail * fsinfo.f_bsize
+
+    def _check_space(self, event_source, event):
+        free = self._bytes_free()
+        if free < self._low_water:
+            logging.info(
+                'CacheMaintainer: %d bytes free in %s, below %d, '
+                'collecting garbage' % (free, self._path, self._low_water))
+            self.mainloop.queue_event(self, _CollectGarbage())
+
+    def _start_gc(self, event_source, event):
+        argv = self._gc_argv + ['--cachedir-min-space=%d' % self._high_water]
+        logging.debug('CacheMaintainer: running %s' % repr(argv))
+        with open(os.devnull) as devnull:
+            self._process = subprocess.Popen(argv, stdin=devnull,
+                                             close_fds=True)
+
+    def _poll_gc(self, event_source, event):
+        returncode = self._process.poll()
+        if returncode is not None:
+            self.mainloop.queue_event(self, _GarbageCollected(returncode))
+
+    def _gc_finished(self, event_source, event):
+        self._process = None
+        if event.returncode != 0:
+            logging.error('CacheMaintainer: garbage collection failed '
+                          'with exit code %d' % event.returncode)
+        else:
+            logging.info('CacheMaintainer: %d bytes free in %s after '
+                         'collecting garbage' %
+                         (self._bytes_free(), self._path))
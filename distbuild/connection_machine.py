@@ -89,7 +89,7 @@ class ConnectionMachine(distbuild.StateMachine):
             ('connecting', self._sock_proxy, distbuild.SocketWriteable,
                 'connected', self._connect),
             ('connecting', self, StopConnecting, None, self._stop),
-            ('connected', self, Reconnect, 'connecting', self._reconnect),
+            ('connected', self, Reconnect, 'timeout', self._wait_to_reconnect),
             ('connected', self, ConnectError, 'timeout', self._start_timer),
             ('connected', self, StopConnecting, None, self._stop),
             ('timeout', self._timer, distbuild.Timer, 'connecting',
@@ -130,6 +130,7 @@ class ConnectionMachine(distbuild.StateMachine):
 
             return
         self._sock_proxy.event_source = None
+        self._numof_retries = 0
         logging.info('Connected to %s:%s' % (self._addr, self._port))
         m = self._machine(self, self._socket, *self._extra_args)
         self.mainloop.add_state_machine(m)
@@ -144,6 +145,11 @@ class ConnectionMachine(distbuild.StateMachine):
         self._timer.stop()
         self._start_connect()
 
+    def _wait_to_reconnect(self, event_source, event):
+        # If the other end has gone away, it may be a while before it
+        # is back.
+        self._timer.start()
+
     def _stop(self, event_source, event):
         logging.info(
             'Stopping connection attempts to %s:%s' % (self._addr, self._port))
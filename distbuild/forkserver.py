@@ -0,0 +1,358 @@
+# distbuild/forkserver.py -- run jobs in processes forked from a warm one
+#
+# Copyright (C) 2014  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA..
+
+
+import errno
+import fcntl
+import logging
+import os
+import select
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import traceback
+
+try:
+    import _multiprocessing
+except ImportError: # pragma: no cover
+    _multiprocessing = None
+
+
+def _set_cloexec(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+
+def send_fd(sock, fd):
+    '''Send a file descriptor over a Unix domain socket.
+
+    Python 2 can only do this with the private functions that
+    multiprocessing uses, so these are kept to this function and
+    recv_fd, and socket.sendmsg is used where there is one. Either way,
+    one byte of data is sent with the descriptor.
+
+    '''
+
+    if hasattr(sock, 'sendmsg'): # pragma: no cover
+        sock.sendmsg([b'\0'], [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                                struct.pack('i', fd))])
+    else:
+        _multiprocessing.sendfd(sock.fileno(), fd)
+
+
+def recv_fd(sock):
+    '''Receive a file descriptor sent by send_fd.
+
+    Raise EOFError if the other end has closed the socket.
+
+    '''
+
+    if hasattr(sock, 'recvmsg'): # pragma: no cover
+        size = struct.calcsize('i')
+        data, ancdata, flags, address = sock.recvmsg(
+            1, socket.CMSG_LEN(size))
+        for level, kind, fd_data in ancdata:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                return struct.unpack('i', fd_data[:size])[0]
+        raise EOFError('no file descriptor received')
+    try:
+        return _multiprocessing.recvfd(sock.fileno())
+    except RuntimeError, e:
+        # recvfd raises RuntimeError when the other end has gone.
+        raise EOFError(str(e))
+
+
+def _returncode(status):
+    '''Turn a status from os.waitpid into a subprocess.Popen returncode.'''
+
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+class ForkServer(object):
+
+    '''Run each job in a process forked from this one.
+
+    Starting Morph takes a while: it imports its modules, loads its
+    plugins, reads its settings and sets up its caches. A process that
+    has done all that once can fork a copy of itself for each job, which
+    can start work straight away, while jobs are still kept apart from
+    each other and from the server.
+
+    Jobs are requested by a ForkServerClient over ``sock``, a Unix domain
+    socket. A request is the standard input, output and error for the
+    job, as file descriptors. The server replies with the process id of
+    the job, and later with its exit code and the most memory it used.
+    ``run_job`` is called in the forked process to do the job, and
+    returns its exit code.
+
+    '''
+
+    def __init__(self, sock, run_job):
+        self.sock = sock
+        self.run_job = run_job
+        self.jobs = set()
+
+    def serve(self):
+        '''Run jobs until the client closes its end of the socket.
+
+        Jobs still running then are left to finish on their own.
+
+        '''
+
+        # Finished jobs are noticed by SIGCHLD waking up the select.
+        wakeup_r, wakeup_w = os.pipe()
+        for fd in (wakeup_r, wakeup_w):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        old_wakeup_fd = signal.set_wakeup_fd(wakeup_w)
+
+        try:
+            while True:
+                try:
+                    r, w, x = select.select([self.sock, wakeup_r], [], [])
+                except select.error, e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+                if wakeup_r in r:
+                    while True:
+                        try:
+                            os.read(wakeup_r, 1024)
+                        except OSError:
+                            break
+                    self._reap()
+                if self.sock in r:
+                    fds = self._receive_fds()
+                    if fds is None:
+                        break
+                    self._fork(fds, [wakeup_r, wakeup_w])
+        finally:
+            signal.set_wakeup_fd(old_wakeup_fd)
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            os.close(wakeup_r)
+            os.close(wakeup_w)
+
+    def _receive_fds(self):
+        fds = []
+        try:
+            for i in xrange(3):
+                fds.append(recv_fd(self.sock))
+        except (OSError, EOFError):
+            for fd in fds:
+                os.close(fd)
+            return None
+        return fds
+
+    def _fork(self, fds, other_fds):
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            self._run_child(fds, other_fds)
+        for fd in fds:
+            os.close(fd)
+        self.jobs.add(pid)
+        logging.debug('ForkServer: started job %d', pid)
+        self.sock.sendall('started %d\n' % pid)
+
+    def _run_child(self, fds, other_fds):
+        code = 1
+        try:
+            signal.set_wakeup_fd(-1)
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            for i, fd in enumerate(fds):
+                os.dup2(fd, i)
+            for fd in fds + other_fds:
+                os.close(fd)
+            self.sock.close()
+            code = self.run_job()
+        except SystemExit, e:
+            code = e.code
+        except BaseException:
+            logging.error(traceback.format_exc())
+            traceback.print_exc()
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            if code is None:
+                code = 0
+            elif type(code) is not int:
+                code = 1
+            os._exit(code)
+
+    def _reap(self):
+        while self.jobs:
+            try:
+                pid, status, rusage = os.wait4(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+            if pid == 0:
+                return
+            if pid in self.jobs:
+                self.jobs.remove(pid)
+                returncode = _returncode(status)
+                max_rss = rusage.ru_maxrss * 1024
+                logging.debug('ForkServer: job %d exited with %d',
+                              pid, returncode)
+                self.sock.sendall(
+                    'exited %d %d %d\n' % (pid, returncode, max_rss))
+
+
+class ForkedProcess(object):
+
+    '''A job run by a ForkServer, used like a subprocess.Popen.
+
+    Once the job has finished, ``max_rss`` is the most memory, in bytes,
+    used at one time by the largest of its processes, or None if not
+    known. The processes together may have used more.
+
+    '''
+
+    def __init__(self, client, pid, stdin, stdout, stderr):
+        self.client = client
+        self.pid = pid
+        self.stdin = stdin
+        self.stdout = stdout
+        self.stderr = stderr
+        self.returncode = None
+        self.max_rss = None
+
+    def kill(self):
+        if self.returncode is None:
+            try:
+                os.kill(self.pid, signal.SIGKILL)
+            except OSError, e:
+                if e.errno != errno.ESRCH:
+                    raise
+
+    def wait(self):
+        if self.returncode is None:
+            try:
+                self.returncode, self.max_rss = self.client.wait(self.pid)
+            except (IOError, OSError), e:
+                logging.error(
+                    'Lost exit code of job %d: %s', self.pid, e)
+                self.returncode = 1
+        return self.returncode
+
+
+class ForkServerClient(object):
+
+    '''Start a ForkServer and have it run jobs.
+
+    ``argv`` is the command to start the server, which must serve
+    requests from a Unix domain socket given as its standard input.
+
+    Raise IOError or OSError if the server cannot be reached.
+
+    '''
+
+    def __init__(self, argv):
+        self.argv = argv
+        self.sock, theirs = socket.socketpair(
+            socket.AF_UNIX, socket.SOCK_STREAM)
+        _set_cloexec(self.sock.fileno())
+        try:
+            self.process = subprocess.Popen(argv, stdin=theirs,
+                                            close_fds=True)
+        finally:
+            theirs.close()
+        self.jobs_started = 0
+        self._buf = ''
+        self._exited = {}
+
+    def is_alive(self):
+        return self.sock is not None and self.process.poll() is None
+
+    def start(self):
+        '''Start a job, returning a ForkedProcess for it.
+
+        The standard input, output and error of the job are pipes, as if
+        it had been started by subprocess.Popen with each set to PIPE.
+
+        '''
+
+        if self.sock is None:
+            raise IOError('fork server %r has gone' % self.argv)
+        stdin_r, stdin_w = os.pipe()
+        stdout_r, stdout_w = os.pipe()
+        stderr_r, stderr_w = os.pipe()
+        ours = [stdin_w, stdout_r, stderr_r]
+        theirs = [stdin_r, stdout_w, stderr_w]
+        try:
+            for fd in ours:
+                _set_cloexec(fd)
+            for fd in theirs:
+                send_fd(self.sock, fd)
+            words = self._read_message()
+            while words[0] == 'exited':
+                self._add_exited(words)
+                words = self._read_message()
+            pid = int(words[1])
+        except BaseException:
+            for fd in ours:
+                os.close(fd)
+            raise
+        finally:
+            for fd in theirs:
+                os.close(fd)
+        self.jobs_started += 1
+        return ForkedProcess(self, pid, os.fdopen(stdin_w, 'wb'),
+                             os.fdopen(stdout_r, 'rb'),
+                             os.fdopen(stderr_r, 'rb'))
+
+    def wait(self, pid):
+        '''Wait for a job to finish.
+
+        Return its exit code, and the most memory it used in bytes.
+
+        '''
+
+        while pid not in self._exited:
+            self._add_exited(self._read_message())
+        return self._exited.pop(pid)
+
+    def _add_exited(self, words):
+        pid, returncode, max_rss = [int(word) for word in words[1:]]
+        self._exited[pid] = (returncode, max_rss)
+
+    def _read_message(self):
+        while '\n' not in self._buf:
+            if self.sock is None:
+                raise IOError('fork server %r has gone' % self.argv)
+            data = self.sock.recv(4096)
+            if not data:
+                self.close()
+                raise IOError('fork server %r has gone' % self.argv)
+            self._buf += data
+        line, self._buf = self._buf.split('\n', 1)
+        return line.split()
+
+    def close(self):
+        '''Stop the server, leaving jobs still running to finish.'''
+
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
@@ -0,0 +1,137 @@
+# distbuild/forkserver_tests.py -- unit tests for the fork server
+#
+# Copyright (C) 2014  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA..
+
+
+import os
+import socket
+import sys
+import unittest
+
+import distbuild
+
+
+# Each job reads a command from its standard input: an exit code to
+# exit with, 'exit CODE' to raise SystemExit, 'crash' to raise an
+# exception, or 'big MIB' to use that much memory first.
+SERVER = '''
+import os
+import socket
+import sys
+sys.path.insert(0, %(path)r)
+import distbuild
+
+def run_job():
+    words = sys.stdin.read().split()
+    sys.stdout.write('job %%d\\n' %% os.getpid())
+    if words[0] == 'exit':
+        sys.exit(int(words[1]))
+    elif words[0] == 'crash':
+        raise Exception('crashed')
+    elif words[0] == 'big':
+        data = 'x' * (int(words[1]) * 1024**2)
+        return 0
+    return int(words[0])
+
+sock = socket.fromfd(0, socket.AF_UNIX, socket.SOCK_STREAM)
+distbuild.ForkServer(sock, run_job).serve()
+'''
+
+
+class ForkServerTests(unittest.TestCase):
+
+    def setUp(self):
+        path = os.path.dirname(os.path.dirname(
+            os.path.abspath(distbuild.__file__)))
+        self.client = distbuild.ForkServerClient(
+            [sys.executable, '-c', SERVER % {'path': path}])
+
+    def tearDown(self):
+        self.client.close()
+        self.client.process.wait()
+
+    def run_job(self, command):
+        process = self.client.start()
+        process.stdin.write(command)
+        process.stdin.close()
+        output = process.stdout.read()
+        process.wait()
+        process.stdout.close()
+        process.stderr.close()
+        return process, output
+
+    def test_runs_job_in_forked_process(self):
+        process, output = self.run_job('3')
+        self.assertEqual(output, 'job %d\n' % process.pid)
+        self.assertNotEqual(process.pid, self.client.process.pid)
+        self.assertEqual(process.returncode, 3)
+        self.assertEqual(self.client.jobs_started, 1)
+
+    def test_reports_exit_code_of_system_exit(self):
+        process, output = self.run_job('exit 5')
+        self.assertEqual(process.returncode, 5)
+
+    def test_reports_failure_when_job_crashes(self):
+        process, output = self.run_job('crash')
+        self.assertEqual(process.returncode, 1)
+
+    def test_reports_most_memory_used(self):
+        process, output = self.run_job('big 64')
+        self.assertEqual(process.returncode, 0)
+        self.assertTrue(process.max_rss >= 64 * 1024**2)
+
+    def test_reports_killed_job(self):
+        process = self.client.start()
+        process.kill()
+        self.assertEqual(process.wait(), -9)
+        for f in (process.stdin, process.stdout, process.stderr):
+            f.close()
+
+    def test_runs_several_jobs_at_once(self):
+        processes = [self.client.start() for i in xrange(3)]
+        for i, process in enumerate(processes):
+            process.stdin.write(str(i))
+            process.stdin.close()
+        for i, process in reversed(list(enumerate(processes))):
+            self.assertEqual(process.wait(), i)
+            process.stdout.close()
+            process.stderr.close()
+
+    def test_stops_when_client_closes(self):
+        self.assertTrue(self.client.is_alive())
+        self.client.close()
+        self.assertEqual(self.client.process.wait(), 0)
+        self.assertFalse(self.client.is_alive())
+        self.assertRaises(IOError, self.client.start)
+
+
+class FdPassingTests(unittest.TestCase):
+
+    def test_passes_file_descriptor(self):
+        a, b = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        r, w = os.pipe()
+        try:
+            distbuild.forkserver.send_fd(a, w)
+            received = distbuild.forkserver.recv_fd(b)
+            os.write(received, 'hello')
+            os.close(received)
+            self.assertEqual(os.read(r, 5), 'hello')
+            a.close()
+            self.assertRaises(EOFError, distbuild.forkserver.recv_fd, b)
+        finally:
+            b.close()
+            os.close(r)
+            os.close(w)
@@ -0,0 +1,146 @@
+# distbuild/graph_cache.py -- remember build graphs between build requests
+#
+# Copyright (C) 2014  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA..
+
+
+import collections
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+
+
+_sha1_pattern = re.compile('^[0-9a-f]{40}$')
+
+
+def is_commit_sha1(ref):
+    '''Is ref the SHA-1 of a commit, rather than a branch or tag?'''
+
+    return bool(_sha1_pattern.match(ref))
+
+
+def is_graph_pinned(artifact, ref):
+    '''Is the build graph of artifact fixed by the definitions commit?
+
+    It is if every source in it either comes from the definitions commit
+    ``ref`` itself, or was given by a commit rather than a branch or tag
+    that might move.
+
+    '''
+
+    sources = set(a.source for a in artifact.walk())
+    return all(s.sha1 == ref or s.original_ref == s.sha1 for s in sources)
+
+
+class GraphCache(object):
+
+    '''Remember serialised build graphs by what they were computed from.
+
+    Computing the build graph of a system takes minutes, and the same
+    system is often requested to be built many times. The graph is the
+    same every time if the definitions are given by commit, and the
+    definitions give every chunk by commit too, so it is only computed
+    once and then remembered here.
+
+    The most recently used ``memory_entries`` graphs are kept in memory.
+    If ``dirname`` is given, graphs are also kept in files there, so
+    they survive a restart of the controller, up to ``disk_entries`` of
+    them. ``version`` is the version of Morph computing the graphs,
+    since a different version may compute a different graph.
+
+    '''
+
+    def __init__(self, dirname=None, memory_entries=32, disk_entries=1000,
+                 version=''):
+        self.dirname = dirname
+        self.memory_entries = memory_entries
+        self.disk_entries = disk_entries
+        self.version = version
+        self._graphs = collections.OrderedDict()
+        if dirname is not None and not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+    def key(self, request):
+        '''Return the key for the graph of a build request.
+
+        Return None if the graph cannot be remembered, because the
+        request gives the definitions by a ref that might move.
+
+        '''
+
+        if not is_commit_sha1(request['ref']):
+            return None
+        parts = [self.version, request['repo'], request['ref'],
+                 request['morphology'], request.get('original_ref')]
+        return hashlib.sha1(json.dumps(parts)).hexdigest()
+
+    def _filename(self, key):
+        return os.path.join(self.dirname, '%s.graph' % key)
+
+    def _remember(self, key, text):
+        self._graphs.pop(key, None)
+        self._graphs[key] = text
+        while len(self._graphs) > self.memory_entries:
+            self._graphs.popitem(last=False)
+
+    def get(self, key):
+        '''Return the graph remembered for key, or None.'''
+
+        if key in self._graphs:
+            text = self._graphs.pop(key)
+            self._graphs[key] = text
+            return text
+        if self.dirname is None:
+            return None
+        filename = self._filename(key)
+        try:
+            with open(filename) as f:
+                text = f.read()
+            # The least recently used files are removed first.
+            os.utime(filename, None)
+        except (IOError, OSError):
+            return None
+        self._remember(key, text)
+        return text
+
+    def put(self, key, text):
+        '''Remember the graph for key.'''
+
+        self._remember(key, text)
+        if self.dirname is None:
+            return
+        fd, tempname = tempfile.mkstemp(dir=self.dirname, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(text)
+            os.rename(tempname, self._filename(key))
+        except (IOError, OSError), e:
+            logging.warning('Could not save build graph: %s' % e)
+            os.remove(tempname)
+            return
+        self._remove_old_files()
+
+    def _remove_old_files(self):
+        filenames = [os.path.join(self.dirname, basename)
+                     for basename in os.listdir(self.dirname)
+                     if basename.endswith('.graph')]
+        if len(filenames) <= self.disk_entries:
+            return
+        filenames.sort(key=lambda filename: os.stat(filename).st_mtime)
+        for filename in filenames[:len(filenames) - self.disk_entries]:
+            os.remove(filename)
@@ -0,0 +1,143 @@
+# distbuild/graph_cache_tests.py -- unit tests for the build graph cache
+#
+# Copyright (C) 2014  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA..
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import distbuild
+
+
+SHA1 = 'a' * 40
+OTHER_SHA1 = 'b' * 40
+
+
+class FakeSource(object):
+
+    def __init__(self, original_ref, sha1):
+        self.original_ref = original_ref
+        self.sha1 = sha1
+
+
+class FakeArtifact(object):
+
+    def __init__(self, *sources):
+        self.sources = sources
+
+    def walk(self):
+        for source in self.sources:
+            artifact = FakeArtifact()
+            artifact.source = source
+            yield artifact
+
+
+def request(ref=SHA1, morphology='system.morph'):
+    return {
+        'repo': 'baserock:baserock/definitions',
+        'ref': ref,
+        'morphology': morphology,
+        'original_ref': 'master',
+    }
+
+
+class IsGraphPinnedTests(unittest.TestCase):
+
+    def test_graph_of_commits_is_pinned(self):
+        artifact = FakeArtifact(FakeSource('master', SHA1),
+                                FakeSource(OTHER_SHA1, OTHER_SHA1))
+        self.assertTrue(distbuild.is_graph_pinned(artifact, SHA1))
+
+    def test_graph_with_a_branch_is_not_pinned(self):
+        artifact = FakeArtifact(FakeSource('master', SHA1),
+                                FakeSource('master', OTHER_SHA1))
+        self.assertFalse(distbuild.is_graph_pinned(artifact, SHA1))
+
+    def test_only_full_sha1_is_a_commit(self):
+        self.assertTrue(distbuild.is_commit_sha1(SHA1))
+        self.assertFalse(distbuild.is_commit_sha1('master'))
+        self.assertFalse(distbuild.is_commit_sha1(SHA1[:7]))
+
+
+class GraphCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.dirname = os.path.join(self.tempdir, 'graphs')
+        self.cache = distbuild.GraphCache(self.dirname)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_has_no_key_for_a_ref_that_might_move(self):
+        self.assertEqual(self.cache.key(request(ref='master')), None)
+
+    def test_has_different_keys_for_different_requests(self):
+        self.assertNotEqual(self.cache.key(request()),
+                            self.cache.key(request(ref=OTHER_SHA1)))
+        self.assertNotEqual(
+            self.cache.key(request()),
+            self.cache.key(request(morphology='other.morph')))
+
+    def test_has_different_keys_for_different_versions(self):
+        other = distbuild.GraphCache(version='other')
+        self.assertNotEqual(self.cache.key(request()),
+                            other.key(request()))
+
+    def test_returns_none_for_unknown_graph(self):
+        self.assertEqual(self.cache.get(self.cache.key(request())), None)
+
+    def test_returns_remembered_graph(self):
+        key = self.cache.key(request())
+        self.cache.put(key, 'graph')
+        self.assertEqual(self.cache.get(key), 'graph')
+
+    def test_returns_graph_remembered_on_disk(self):
+        key = self.cache.key(request())
+        self.cache.put(key, 'graph')
+        cache = distbuild.GraphCache(self.dirname)
+        self.assertEqual(cache.get(key), 'graph')
+        os.remove(os.path.join(self.dirname, '%s.graph' % key))
+        self.assertEqual(cache.get(key), 'graph')
+
+    def test_forgets_least_recently_used_graphs_in_memory(self):
+        cache = distbuild.GraphCache(memory_entries=2)
+        cache.put('1', 'one')
+        cache.put('2', 'two')
+        cache.get('1')
+        cache.put('3', 'three')
+        self.assertEqual(cache.get('1'), 'one')
+        self.assertEqual(cache.get('2'), None)
+        self.assertEqual(cache.get('3'), 'three')
+
+    def test_removes_least_recently_used_files(self):
+        cache = distbuild.GraphCache(self.dirname, memory_entries=0,
+                                     disk_entries=2)
+        cache.put('1', 'one')
+        cache.put('2', 'two')
+        os.utime(os.path.join(self.dirname, '1.graph'), (0, 0))
+        cache.put('3', 'three')
+        self.assertEqual(sorted(os.listdir(self.dirname)),
+                         ['2.graph', '3.graph'])
+
+    def test_keeps_graph_in_memory_if_it_cannot_be_saved(self):
+        cache = distbuild.GraphCache(self.dirname)
+        os.mkdir(os.path.join(self.dirname, '1.graph'))
+        cache.put('1', 'one')
+        self.assertEqual(os.listdir(self.dirname), ['1.graph'])
+        self.assertEqual(cache.get('1'), 'one')
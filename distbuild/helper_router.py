@@ -59,6 +59,10 @@ class HelperRouter(distbuild.StateMachine):
     The message must be a Pythondict that the distbuild-helper understands.
     
     HelperRouter will send the msg to the next available helper process.
+    A helper process says it is available by sending a ``helper-ready``
+    message, once for each request it can run at the same time as the
+    ones it is already running, so several requests may be sent to it
+    before any of them finishes.
     When the helper sends back the result, HelperRouter will emit a
     HelperResult event, using the same ``request_id`` as the request had.
     
@@ -80,6 +84,7 @@ class HelperRouter(distbuild.StateMachine):
     def setup(self):
         jm = distbuild.JsonMachine(self.conn)
         self.mainloop.add_state_machine(jm)
+        distbuild.default_metrics.add_collector(HelperRouter._collect_metrics)
         
         spec = [
             # state, source, event_class, new_state, callback
@@ -90,9 +95,22 @@ class HelperRouter(distbuild.StateMachine):
         ]
         self.add_transitions(spec)
 
+    @classmethod
+    def _collect_metrics(cls):
+        requests = distbuild.default_metrics.gauge(
+            'distbuild_helper_requests',
+            'Requests queued for or running on helper processes',
+            labels=('state',))
+        requests.set(len(cls._pending_requests), state='queued')
+        requests.set(len(cls._running_requests), state='running')
+        distbuild.default_metrics.gauge(
+            'distbuild_helpers_idle',
+            'Requests helper processes could be running but are not').set(
+                len(cls._pending_helpers))
+
     def _handle_request(self, event_source, event):
         '''Send request received via mainloop, or put in queue.'''
-        logging.debug('HelperRouter: received request: %s', repr(event.msg))
+        logging.debug('HelperRouter: received request: %r', event.msg)
         self._enqueue_request(event.msg)
         if self._pending_helpers:
             self._send_request()
@@ -160,11 +178,12 @@ class HelperRouter(distbuild.StateMachine):
             self.mainloop.queue_event(HelperRouter, HelperResult(new_msg))
 
     def _close(self, event_source, event):
-        logging.debug('HelperRouter: closing: %s', repr(event_source))
+        logging.debug('HelperRouter: closing: %r', event_source)
         event_source.close()
 
-        # Remove from pending helpers.
-        if event_source in self._pending_helpers:
+        # Remove from pending helpers. A helper that can run several
+        # requests at once is in the list once for each of them.
+        while event_source in self._pending_helpers:
             self._pending_helpers.remove(event_source)
 
         # Re-queue any requests running on the hlper that just quit.
@@ -31,3 +31,14 @@ class IdentifierGenerator(object):
         self._counter += 1
         return '%s-%d' % (self._series, self._counter)
 
+    def skip_past(self, identifier):
+        '''Make sure identifier, if from this series, is not given again.'''
+
+        prefix = '%s-' % self._series
+        if identifier.startswith(prefix):
+            try:
+                counter = int(identifier[len(prefix):])
+            except ValueError:
+                return
+            self._counter = max(self._counter, counter)
+
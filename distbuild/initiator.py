@@ -63,7 +63,7 @@ class Initiator(distbuild.StateMachine):
         
         spec = [
             # state, source, event_class, new_state, callback
-            ('waiting', self._jm, distbuild.JsonEof, None, self._terminate),
+            ('waiting', self._jm, distbuild.JsonEof, None, self._reconnect),
             ('waiting', self._jm, distbuild.JsonNewMessage, 'waiting',
                 self._handle_json_message),
             ('waiting', self, _Finished, None, self._succeed),
@@ -86,12 +86,21 @@ class Initiator(distbuild.StateMachine):
             original_ref=self._original_ref
         )
         self._jm.send(msg)
-        logging.debug('Initiator: sent to controller: %s', repr(msg))
+        logging.debug('Initiator: sent to controller: %r', msg)
+
+        if not self._step_output_dir:
+            # The output would only be thrown away, so do not have the
+            # controller send it.
+            msg = distbuild.message('output-detach', id=random_id)
+            self._jm.send(msg)
+            logging.debug('Initiator: sent to controller: %r', msg)
         
     def _handle_json_message(self, event_source, event):
         distbuild.crash_point()
 
-        logging.debug('Initiator: from controller: %s' % repr(event.msg))
+        # Step output can be big, so log only what the message is about.
+        logging.debug('Initiator: %s message from controller for %s',
+                      event.msg.get('type'), event.msg.get('step_name'))
 
         handlers = {
             'build-finished': self._handle_build_finished_message,
@@ -204,7 +213,12 @@ class Initiator(distbuild.StateMachine):
                 (self._repo_name, self._ref, self._morphology, 
                  event.msg['reason']))
 
-    def _terminate(self, event_source, event):
-        self.mainloop.queue_event(self._cm, distbuild.StopConnecting())
+    def _reconnect(self, event_source, event):
+        # The controller carries on with the build if it has restarted
+        # and we ask for it again.
+        self._app.status(msg='Lost connection to controller')
+        for f in self._step_outputs.itervalues():
+            f.close()
+        self.mainloop.queue_event(self._cm, distbuild.Reconnect())
         self._jm.close()
 
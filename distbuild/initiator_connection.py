@@ -33,6 +33,15 @@ class _Close(object):
         self.event_source = event_source
 
 
+class _OutputStream(object):
+
+    '''How much of the StepLog of a build step has been sent.'''
+
+    def __init__(self, log):
+        self.log = log
+        self.offset = 0
+
+
 class InitiatorConnection(distbuild.StateMachine):
 
     '''Communicate with a single initiator.
@@ -44,16 +53,32 @@ class InitiatorConnection(distbuild.StateMachine):
     translating messages from the initiator to the rest of the controller's
     state machines, and vice versa.
 
+    The output of build steps is sent from their StepLogs, in messages of
+    up to ``max_output_message`` bytes. If the initiator does not keep
+    up, so that more than ``max_unsent_output`` bytes are waiting to be
+    sent to it, no more output is sent until it has caught up, rather
+    than keeping it all in memory. The initiator may also detach from
+    the output of a build, and later attach again to carry on from where
+    it left off, for the steps that are still running.
+
     '''
     
     _idgen = distbuild.IdentifierGenerator('InitiatorConnection')
     _route_map = distbuild.RouteMap()
 
-    def __init__(self, conn, artifact_cache_server, morph_instance):
+    max_output_message = 256 * 1024
+    max_unsent_output = 1024**2
+    output_retry_interval = 1
+
+    def __init__(self, conn, artifact_cache_server, morph_instance,
+                 graph_cache=None, trace_dir=None, journal=None):
         distbuild.StateMachine.__init__(self, 'idle')
         self.conn = conn
         self.artifact_cache_server = artifact_cache_server
         self.morph_instance = morph_instance
+        self.graph_cache = graph_cache
+        self.trace_dir = trace_dir
+        self.journal = journal
         self.initiator_name = conn.remotename()
 
     def __repr__(self):
@@ -65,6 +90,16 @@ class InitiatorConnection(distbuild.StateMachine):
         self.mainloop.add_state_machine(self.jm)
 
         self.our_ids = set()
+        self._streams = {}
+        self._detached = set()
+
+        if self.journal is not None:
+            # Requests from before a restart may be carried on with.
+            for identifier in self.journal.identifiers():
+                self._idgen.skip_past(identifier)
+
+        self._timer = distbuild.TimerEventSource(self.output_retry_interval)
+        self.mainloop.add_event_source(self._timer)
         
         spec = [
             # state, source, event_class, new_state, callback
@@ -90,6 +125,8 @@ class InitiatorConnection(distbuild.StateMachine):
                 'idle', self._send_build_step_finished_message),
             ('idle', distbuild.BuildController, distbuild.BuildStepFailed, 
                 'idle', self._send_build_step_failed_message),
+            ('idle', self._timer, distbuild.Timer, 'idle',
+                self._send_waiting_output),
             ('closing', self, _Close, None, self._close),
         ]
         self.add_transitions(spec)
@@ -107,8 +144,21 @@ class InitiatorConnection(distbuild.StateMachine):
             event.msg['id'] = new_id
             build_controller = distbuild.BuildController(
                 self, event.msg, self.artifact_cache_server,
-                self.morph_instance)
+                self.morph_instance, graph_cache=self.graph_cache,
+                trace_dir=self.trace_dir, journal=self.journal)
             self.mainloop.add_state_machine(build_controller)
+        elif event.msg['type'] in ('output-detach', 'output-attach'):
+            ids = [id for id in self._route_map.get_outgoing_ids(
+                       event.msg['id']) if id in self.our_ids]
+            for id in ids:
+                if event.msg['type'] == 'output-detach':
+                    self._detached.add(id)
+                else:
+                    self._detached.discard(id)
+                    for (stream_id, step_name), stream in \
+                            self._streams.iteritems():
+                        if stream_id == id:
+                            self._send_output(id, step_name, stream)
 
     def _disconnect(self, event_source, event):
         for id in self.our_ids:
@@ -123,13 +173,14 @@ class InitiatorConnection(distbuild.StateMachine):
                       self.initiator_name, repr(event.event_source))
 
         event.event_source.close()
+        self.mainloop.remove_event_source(self._timer)
 
     def _handle_result(self, event_source, event):
         '''Handle result from helper.'''
 
         if event.msg['id'] in self.our_ids:
             logging.debug(
-                'InitiatorConnection: received result: %s', repr(event.msg))
+                'InitiatorConnection: received result: %r', event.msg)
             self.jm.send(event.msg)
 
     def _log_send(self, msg):
@@ -141,8 +192,7 @@ class InitiatorConnection(distbuild.StateMachine):
             msg = distbuild.message('build-finished',
                 id=self._route_map.get_incoming_id(event.id),
                 urls=event.urls)
-            self._route_map.remove(event.id)
-            self.our_ids.remove(event.id)
+            self._forget_build(event.id)
             self.jm.send(msg)
             self._log_send(msg)
 
@@ -151,11 +201,18 @@ class InitiatorConnection(distbuild.StateMachine):
             msg = distbuild.message('build-failed',
                 id=self._route_map.get_incoming_id(event.id),
                 reason=event.reason)
-            self._route_map.remove(event.id)
-            self.our_ids.remove(event.id)
+            self._forget_build(event.id)
             self.jm.send(msg)
             self._log_send(msg)
 
+    def _forget_build(self, id):
+        self._route_map.remove(id)
+        self.our_ids.remove(id)
+        self._detached.discard(id)
+        for key in self._streams.keys():
+            if key[0] == id:
+                del self._streams[key]
+
     def _send_build_progress_message(self, event_source, event):
         if event.id in self.our_ids:
             msg = distbuild.message('build-progress',
@@ -195,6 +252,7 @@ class InitiatorConnection(distbuild.StateMachine):
                 worker_name=event.worker_name)
             self.jm.send(msg)
             self._log_send(msg)
+            self._start_output(event)
 
     def _send_build_step_already_started_message(self, event_source, event):
         logging.debug('InitiatorConnection: build_step_already_started: '
@@ -208,24 +266,74 @@ class InitiatorConnection(distbuild.StateMachine):
                 worker_name=event.worker_name)
             self.jm.send(msg)
             self._log_send(msg)
+            # The output so far is sent too, from the start of the log.
+            self._start_output(event)
+
+    def _start_output(self, event):
+        if event.log is not None:
+            stream = _OutputStream(event.log)
+            self._streams[(event.id, event.step_name)] = stream
+            self._send_output(event.id, event.step_name, stream)
 
     def _send_build_output_message(self, event_source, event):
-        logging.debug('InitiatorConnection: build_output: '
-            'id=%s stdout=%s stderr=%s' % 
-            (repr(event.id), repr(event.stdout), repr(event.stderr)))
         if event.id in self.our_ids:
+            key = (event.id, event.step_name)
+            if key not in self._streams:
+                self._streams[key] = _OutputStream(event.log)
+            self._send_output(event.id, event.step_name, self._streams[key])
+
+    def _finish_output(self, id, step_name):
+        # The initiator closes its file for the output of a step when it
+        # hears the step has finished, so the rest of the output is sent
+        # first, however far behind the initiator is.
+        stream = self._streams.pop((id, step_name), None)
+        if stream is not None:
+            self._send_output(id, step_name, stream, finished=True)
+
+    def _send_output(self, id, step_name, stream, finished=False):
+        '''Send what the initiator has not had yet of the output of a step.
+
+        Return True if there is nothing left to send, or the initiator
+        does not want it.
+
+        '''
+
+        if id in self._detached:
+            return True
+        while stream.offset < stream.log.size:
+            if (not finished and
+                    self.jm.unsent_bytes() >= self.max_unsent_output):
+                if not self._timer.enabled:
+                    self._timer.start()
+                return False
+            data = stream.log.read(stream.offset, self.max_output_message)
+            if not data:
+                break
+            stream.offset += len(data)
             msg = distbuild.message('step-output',
-                id=self._route_map.get_incoming_id(event.id),
-                step_name=event.step_name,
-                stdout=event.stdout,
-                stderr=event.stderr)
+                id=self._route_map.get_incoming_id(id),
+                step_name=step_name,
+                stdout=data,
+                stderr='')
             self.jm.send(msg)
-            self._log_send(msg)
+            logging.debug(
+                'InitiatorConnection: sent to %s: %d bytes of output of %s',
+                self.initiator_name, len(data), step_name)
+        return True
+
+    def _send_waiting_output(self, event_source, event):
+        done = True
+        for (id, step_name), stream in self._streams.items():
+            if not self._send_output(id, step_name, stream):
+                done = False
+        if done:
+            self._timer.stop()
 
     def _send_build_step_finished_message(self, event_source, event):
         logging.debug('heard built step finished: event.id: %s our_ids: %s'
             % (str(event.id), str(self.our_ids)))
         if event.id in self.our_ids:
+            self._finish_output(event.id, event.step_name)
             msg = distbuild.message('step-finished',
                 id=self._route_map.get_incoming_id(event.id),
                 step_name=event.step_name)
@@ -234,6 +342,7 @@ class InitiatorConnection(distbuild.StateMachine):
 
     def _send_build_step_failed_message(self, event_source, event):
         if event.id in self.our_ids:
+            self._finish_output(event.id, event.step_name)
             msg = distbuild.message('step-failed',
                 id=self._route_map.get_incoming_id(event.id),
                 step_name=event.step_name)
@@ -30,6 +30,12 @@ from sockbuf import (SocketBuffer, SocketBufferNewData,
                      SocketBufferEof, SocketError)
 
 
+# The messages are YAML inside JSON. PyYAML is much faster at YAML if it
+# was built with libyaml, and relaying build output is mostly YAML.
+_yaml_dumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+_yaml_loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
 class JsonNewMessage(object):
 
     def __init__(self, msg):
@@ -82,11 +88,21 @@ class JsonMachine(StateMachine):
         '''Send a message to the other side.'''
         if self.debug_json:
             logging.debug('JsonMachine: Sending message %s' % repr(msg))
-        s = json.dumps(yaml.safe_dump(msg))
+        s = json.dumps(yaml.dump(msg, Dumper=_yaml_dumper))
         if self.debug_json:
             logging.debug('JsonMachine: As %s' % repr(s))
         self.sockbuf.write('%s\n' % s)
     
+    def unsent_bytes(self):
+        '''Return how much of the sent messages is still to be written.
+
+        This grows if the other side does not read messages as quickly as
+        they are sent.
+
+        '''
+
+        return self.sockbuf.unsent_bytes()
+
     def close(self):
         '''Tell state machine it should shut down.
         
@@ -109,7 +125,7 @@ class JsonMachine(StateMachine):
             line = line.rstrip()
             if self.debug_json:
                 logging.debug('JsonMachine: line: %s' % repr(line))
-            msg = yaml.load(json.loads(line))
+            msg = yaml.load(json.loads(line), Loader=_yaml_loader)
             self.mainloop.queue_event(self, JsonNewMessage(msg))
 
     def _send_eof(self, event_source, event):
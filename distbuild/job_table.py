@@ -0,0 +1,252 @@
+# distbuild/job_table.py -- jobs shared by the controllers on a host
+#
+# Copyright (C) 2014  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA..
+
+
+import contextlib
+import errno
+import fcntl
+import json
+import os
+import tempfile
+import time
+
+
+class JobTable(object):
+
+    '''Share jobs between the controllers on a host.
+
+    Several controllers may give jobs to the same workers, and put what
+    is built in the same artifact cache. If they share a job table, an
+    artifact is built by only one of them at a time: the first to
+    ``claim`` it builds it, and the others wait for it to be built, just
+    as the build requests of one controller share a job.
+
+    The table is the directory ``dirname``, with a file of JSON for each
+    artifact being built, saying which controller has it, which worker
+    is building it, and whether it has been built or has failed. The
+    directory is locked while it is changed, so it must be on a file
+    system where flock works, such as a local one.
+
+    Each controller has a ``name``, which must be different from those
+    of the other controllers, and the same when it restarts. It says it
+    is still there with ``heartbeat``, which must be called more often
+    than every ``stale_after`` seconds; the jobs of a controller that
+    has not done so may be claimed by the others. Jobs that have
+    finished are kept for ``keep_finished`` seconds, for the controllers
+    waiting for them to see how they went; they are looked for by
+    ``heartbeat`` only every tenth of that time, since it means reading
+    every job in the table. ``clock`` returns the current time in
+    seconds.
+
+    '''
+
+    finished_states = ('built', 'failed')
+
+    def __init__(self, dirname, name, stale_after=60, keep_finished=3600,
+                 clock=time.time):
+        self.dirname = dirname
+        self.name = name
+        self.stale_after = stale_after
+        self.keep_finished = keep_finished
+        self._clock = clock
+        self._last_tidied = None
+        self._jobs_dir = os.path.join(dirname, 'jobs')
+        self._controllers_dir = os.path.join(dirname, 'controllers')
+        for path in [self._jobs_dir, self._controllers_dir]:
+            try:
+                os.makedirs(path)
+            except OSError, e:
+                # Another controller may have just made it.
+                if e.errno != errno.EEXIST:
+                    raise
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with open(os.path.join(self.dirname, 'lock'), 'a') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def _job_filename(self, artifact_basename):
+        return os.path.join(self._jobs_dir, artifact_basename)
+
+    def _controller_filename(self, name):
+        return os.path.join(self._controllers_dir, name)
+
+    def _read(self, filename):
+        try:
+            with open(filename) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _write(self, filename, record):
+        # Files are replaced whole, so that they can be read without
+        # taking the lock.
+        fd, tempname = tempfile.mkstemp(dir=self.dirname, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(record, f)
+            os.rename(tempname, filename)
+        except BaseException:
+            os.remove(tempname)
+            raise
+
+    def _remove(self, filename):
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
+    def _is_alive(self, name):
+        if name == self.name:
+            return True
+        record = self._read(self._controller_filename(name))
+        return (record is not None and
+                self._clock() - record['time'] <= self.stale_after)
+
+    def _is_abandoned(self, record):
+        return (record['state'] not in self.finished_states and
+                not self._is_alive(record['controller']))
+
+    def _update(self, artifact_basename, **fields):
+        filename = self._job_filename(artifact_basename)
+        with self._locked():
+            record = self._read(filename)
+            if record is None or record['controller'] != self.name:
+                return  # another controller has taken it over
+            record.update(fields, time=self._clock())
+            self._write(filename, record)
+
+    def heartbeat(self):
+        '''Say this controller is still there, and now and then tidy up.'''
+
+        now = self._clock()
+        self._write(self._controller_filename(self.name), {'time': now})
+        if (self._last_tidied is None or
+                now - self._last_tidied >= self.keep_finished / 10.0):
+            self.tidy()
+
+    def tidy(self):
+        '''Forget old finished jobs, and those of stopped controllers.'''
+
+        now = self._last_tidied = self._clock()
+        too_old = now - self.keep_finished
+        with self._locked():
+            for basename in os.listdir(self._jobs_dir):
+                filename = self._job_filename(basename)
+                record = self._read(filename)
+                if (record is not None and record['time'] < too_old and
+                        (record['state'] in self.finished_states or
+                         self._is_abandoned(record))):
+                    self._remove(filename)
+            for basename in os.listdir(self._controllers_dir):
+                filename = self._controller_filename(basename)
+                record = self._read(filename)
+                if record is not None and record['time'] < too_old:
+                    self._remove(filename)
+
+    def claim(self, artifact_basename):
+        '''Try to become the controller that builds an artifact.
+
+        Return True if this controller should build it, or False if
+        another controller is already doing so.
+
+        '''
+
+        filename = self._job_filename(artifact_basename)
+        with self._locked():
+            record = self._read(filename)
+            if (record is not None and
+                    record['controller'] != self.name and
+                    record['state'] not in self.finished_states and
+                    not self._is_abandoned(record)):
+                return False
+            self._write(filename, {
+                'controller': self.name,
+                'state': 'waiting',
+                'time': self._clock(),
+            })
+            return True
+
+    def start(self, artifact_basename, worker_name, cores=0, memory=0):
+        '''Record that a claimed artifact is being built on a worker.
+
+        ``cores`` and ``memory`` are what the build is expected to use
+        of the worker, for the other controllers to take into account
+        when they give it jobs.
+
+        '''
+
+        self._update(artifact_basename, state='running', worker=worker_name,
+                     cores=cores, memory=memory)
+
+    def finish(self, artifact_basename, built):
+        '''Record that a claimed artifact has been built, or has failed.'''
+
+        self._update(artifact_basename,
+                     state='built' if built else 'failed')
+
+    def release(self, artifact_basename):
+        '''Give up a claimed artifact without building it.'''
+
+        filename = self._job_filename(artifact_basename)
+        with self._locked():
+            record = self._read(filename)
+            if record is not None and record['controller'] == self.name:
+                self._remove(filename)
+
+    def get(self, artifact_basename):
+        '''Return what the table says about an artifact.
+
+        This is a dict, with the ``controller`` that has the artifact,
+        and its ``state``, which is 'waiting', 'running', 'built' or
+        'failed'. If it is running, ``worker`` is the name of the worker
+        building it. None is returned if no controller has the artifact,
+        or the one that had it stopped before it was built.
+
+        '''
+
+        record = self._read(self._job_filename(artifact_basename))
+        if record is None or self._is_abandoned(record):
+            return None
+        return record
+
+    def running_elsewhere(self):
+        '''Return what the jobs of the other controllers use of workers.
+
+        The result is a dict of a list of the cores and memory used by
+        each job running on a worker, by the name of the worker.
+
+        '''
+
+        alive = {}
+        running = {}
+        for basename in os.listdir(self._jobs_dir):
+            record = self._read(self._job_filename(basename))
+            if (record is None or record['state'] != 'running' or
+                    record['controller'] == self.name):
+                continue
+            name = record['controller']
+            if name not in alive:
+                alive[name] = self._is_alive(name)
+            if alive[name]:
+                running.setdefault(record['worker'], []).append(
+                    (record.get('cores', 0), record.get('memory', 0)))
+        return running
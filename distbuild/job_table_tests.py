@@ -0,0 +1,120 @@
+# distbuild/job_table_tests.py -- unit tests for the shared job table
+#
+# Copyright (C) 2014  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA..
+
+
+import shutil
+import tempfile
+import unittest
+
+import distbuild
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000
+
+    def __call__(self):
+        return self.now
+
+
+class JobTableTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.clock = FakeClock()
+        self.a = self.controller('a')
+        self.b = self.controller('b')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def controller(self, name):
+        table = distbuild.JobTable(self.tempdir, name, stale_after=10,
+                                   keep_finished=100, clock=self.clock)
+        table.heartbeat()
+        return table
+
+    def test_only_first_controller_claims_job(self):
+        self.assertEqual(self.a.get('foo'), None)
+        self.assertTrue(self.a.claim('foo'))
+        self.assertFalse(self.b.claim('foo'))
+        self.assertTrue(self.a.claim('foo'))
+        self.assertEqual(self.b.get('foo')['controller'], 'a')
+        self.assertEqual(self.b.get('foo')['state'], 'waiting')
+
+    def test_shares_running_jobs(self):
+        self.a.claim('foo')
+        self.a.start('foo', 'worker:3434', cores=4, memory=100)
+        self.assertEqual(self.b.get('foo')['state'], 'running')
+        self.assertEqual(self.b.get('foo')['worker'], 'worker:3434')
+        self.assertEqual(self.a.running_elsewhere(), {})
+        self.assertEqual(self.b.running_elsewhere(),
+                         {'worker:3434': [(4, 100)]})
+
+    def test_shares_results(self):
+        self.a.claim('foo')
+        self.a.claim('bar')
+        self.a.finish('foo', built=True)
+        self.a.finish('bar', built=False)
+        self.assertEqual(self.b.get('foo')['state'], 'built')
+        self.assertEqual(self.b.get('bar')['state'], 'failed')
+        # They may be built again.
+        self.assertTrue(self.b.claim('foo'))
+        self.assertTrue(self.b.claim('bar'))
+
+    def test_released_job_may_be_claimed(self):
+        self.a.claim('foo')
+        self.b.release('foo')
+        self.assertFalse(self.b.claim('foo'))
+        self.a.release('foo')
+        self.assertEqual(self.b.get('foo'), None)
+        self.assertTrue(self.b.claim('foo'))
+
+    def test_jobs_of_stopped_controller_may_be_claimed(self):
+        self.a.claim('foo')
+        self.a.start('foo', 'worker:3434')
+        self.clock.now += 11
+        self.b.heartbeat()
+        self.assertEqual(self.b.get('foo'), None)
+        self.assertEqual(self.b.running_elsewhere(), {})
+        self.assertTrue(self.b.claim('foo'))
+        # The controller cannot change it once it has been taken over.
+        self.a.finish('foo', built=True)
+        self.assertEqual(self.a.get('foo')['state'], 'waiting')
+
+    def test_forgets_old_jobs(self):
+        self.a.claim('foo')
+        self.a.finish('foo', built=True)
+        self.b.claim('bar')
+        self.clock.now += 101
+        self.a.heartbeat()
+        self.assertEqual(self.a.get('foo'), None)
+        self.assertEqual(self.a.get('bar'), None)
+        self.assertTrue(self.a.claim('bar'))
+
+    def test_tidies_up_only_now_and_then(self):
+        self.a.claim('foo')
+        self.a.finish('foo', built=True)
+        self.clock.now += 95
+        self.b.heartbeat()
+        self.clock.now += 6
+        self.b.heartbeat()
+        self.assertEqual(self.b.get('foo')['state'], 'built')
+        self.clock.now += 4
+        self.b.heartbeat()
+        self.assertEqual(self.b.get('foo'), None)
@@ -0,0 +1,299 @@
+# distbuild/journal.py -- record controller state to carry on after a restart
+#
+# Copyright (C) 2014  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA..
+
+
+import json
+import logging
+import os
+import tempfile
+import time
+
+import distbuild
+
+
+class Journal(object):
+
+    '''Record what the controller is doing, to carry on after a restart.
+
+    Build requests and the jobs running for them on workers are
+    recorded as they start and finish, a line of JSON for each, in a
+    file in ``dirname``. The build graph of each request is kept in a
+    file beside it.
+
+    When the controller starts again, ``recover`` reads what the one
+    before it left. An initiator asking for a build that had not
+    finished may then claim it with ``claim_request``, to get its build
+    graph back rather than compute it again, and a job that was running
+    on a worker may be adopted with ``adopt_job``, rather than built
+    again.
+
+    Requests and jobs that are more than ``max_age`` seconds old when
+    the controller starts are forgotten, since nobody is waiting for
+    them any more, as are those nobody has carried on with within
+    ``claim_within`` seconds of the start. ``clock`` returns the current
+    time in seconds.
+
+    '''
+
+    # The journal is rewritten with only what is still going on once it
+    # has this many records, or four times as many as that, if more.
+    min_compact_records = 1000
+
+    def __init__(self, dirname, max_age=24 * 3600, claim_within=3600,
+                 clock=time.time):
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        self.dirname = dirname
+        self.max_age = max_age
+        self.claim_within = claim_within
+        self._clock = clock
+        self._filename = os.path.join(dirname, 'journal')
+        self._file = None
+        self._records = 0
+        self._requests = {}
+        self._jobs = {}
+        self._recovered_requests = {}
+        self._recovered_jobs = {}
+        self._recovered_at = None
+
+    def _graph_filename(self, request_id):
+        return os.path.join(self.dirname, '%s.graph' % request_id)
+
+    def recover(self):
+        '''Read what the controller that ran before left in the journal.'''
+
+        for record in self._read():
+            self._apply(record)
+
+        too_old = self._clock() - self.max_age
+        for request_id, record in self._requests.items():
+            if record['time'] < too_old:
+                del self._requests[request_id]
+        for job_id, record in self._jobs.items():
+            if record['time'] < too_old:
+                del self._jobs[job_id]
+
+        self._recovered_requests = dict(self._requests)
+        self._recovered_jobs = dict(
+            (record['artifact'], record) for record in self._jobs.itervalues())
+        self._recovered_at = self._clock()
+        logging.info('Recovered %d unfinished build requests and %d '
+                     'running jobs from %s', len(self._requests),
+                     len(self._jobs), self._filename)
+
+        self._compact()
+        self._remove_stray_graphs()
+
+    def _read(self):
+        try:
+            f = open(self._filename)
+        except IOError:
+            return []
+        records = []
+        with f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # The controller stopped while writing this record.
+                    logging.warning('Ignoring the rest of %s after a bad '
+                                    'record', self._filename)
+                    break
+        return records
+
+    def _apply(self, record):
+        if record['type'] == 'request-started':
+            self._requests[record['id']] = record
+        elif record['type'] == 'request-finished':
+            self._requests.pop(record['id'], None)
+        elif record['type'] == 'graph-saved':
+            if record['id'] in self._requests:
+                self._requests[record['id']]['pinned'] = record['pinned']
+        elif record['type'] == 'job-started':
+            self._jobs[record['id']] = record
+        elif record['type'] == 'job-finished':
+            self._jobs.pop(record['id'], None)
+
+    def _append(self, record_type, **fields):
+        record = dict(fields, type=record_type, time=self._clock())
+        self._apply(record)
+        if self._file is None:
+            self._file = open(self._filename, 'a')
+        self._file.write('%s\n' % json.dumps(record))
+        self._file.flush()
+        self._records += 1
+
+        going_on = len(self._requests) + len(self._jobs)
+        if self._records > max(self.min_compact_records, 4 * going_on):
+            self._compact()
+
+    def _compact(self):
+        records = sorted(self._requests.values() + self._jobs.values(),
+                         key=lambda record: record['time'])
+        fd, tempname = tempfile.mkstemp(dir=self.dirname, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                for record in records:
+                    f.write('%s\n' % json.dumps(record))
+            os.rename(tempname, self._filename)
+        except BaseException:
+            os.remove(tempname)
+            raise
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._records = len(records)
+
+    def _remove_stray_graphs(self):
+        for basename in os.listdir(self.dirname):
+            if (basename.endswith('.graph') and
+                    basename[:-len('.graph')] not in self._requests):
+                os.remove(os.path.join(self.dirname, basename))
+
+    def _expire_recovered(self):
+        if (self._recovered_at is None or
+                self._clock() - self._recovered_at <= self.claim_within):
+            return
+        if self._recovered_requests or self._recovered_jobs:
+            logging.info('Forgetting %d build requests and %d jobs from '
+                         'before the restart that were not carried on with',
+                         len(self._recovered_requests),
+                         len(self._recovered_jobs))
+        for request_id in self._recovered_requests.keys():
+            self.finish_request(request_id)
+        for record in self._recovered_jobs.values():
+            self.finish_job(record['id'])
+        self._recovered_requests = {}
+        self._recovered_jobs = {}
+        self._recovered_at = None
+
+    def identifiers(self):
+        '''Return the ids of the requests and jobs in the journal.
+
+        They must not be given to new requests and jobs.
+
+        '''
+
+        return self._requests.keys() + self._jobs.keys()
+
+    def start_request(self, request_id, request):
+        '''Record that a build request has been started.'''
+
+        self._expire_recovered()
+        fields = dict((name, request.get(name)) for name in
+                      ['repo', 'ref', 'morphology', 'original_ref'])
+        self._append('request-started', id=request_id, request=fields)
+
+    def save_graph(self, request_id, text, pinned=False):
+        '''Keep the serialised build graph of a request.
+
+        ``pinned`` says whether the graph is fixed by the definitions
+        commit, as is_graph_pinned tells.
+
+        '''
+
+        fd, tempname = tempfile.mkstemp(dir=self.dirname, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(text)
+            os.rename(tempname, self._graph_filename(request_id))
+        except (IOError, OSError), e:
+            logging.warning('Could not save build graph of %s: %s',
+                            request_id, e)
+            os.remove(tempname)
+        else:
+            self._append('graph-saved', id=request_id, pinned=pinned)
+
+    def finish_request(self, request_id):
+        '''Record that a build request has finished, failed or gone away.'''
+
+        if request_id not in self._requests:
+            return
+        self._append('request-finished', id=request_id)
+        try:
+            os.remove(self._graph_filename(request_id))
+        except OSError:
+            pass
+
+    def claim_request(self, request_id, request):
+        '''Carry on with an unfinished build from before a restart.
+
+        If a build request for the same thing as ``request`` had not
+        finished when the controller stopped, it becomes the build
+        request ``request_id``, which must have been started, and its
+        build graph is returned. Otherwise None is returned.
+
+        If the definitions are given by a branch or tag rather than a
+        commit, the build is only carried on with if its graph is pinned,
+        since the branch may have moved since.
+
+        '''
+
+        self._expire_recovered()
+        key = [request.get(name) for name in
+               ['repo', 'ref', 'morphology', 'original_ref']]
+        for old_id, record in self._recovered_requests.iteritems():
+            old_key = [record['request'][name] for name in
+                       ['repo', 'ref', 'morphology', 'original_ref']]
+            if old_key == key and (distbuild.is_commit_sha1(key[1]) or
+                                   record.get('pinned', False)):
+                break
+        else:
+            return None
+
+        del self._recovered_requests[old_id]
+        try:
+            with open(self._graph_filename(old_id)) as f:
+                text = f.read()
+        except IOError:
+            text = None
+        else:
+            os.rename(self._graph_filename(old_id),
+                      self._graph_filename(request_id))
+            self._append('graph-saved', id=request_id,
+                         pinned=record.get('pinned', False))
+        self.finish_request(old_id)
+        return text
+
+    def start_job(self, job_id, artifact_basename, worker_name):
+        '''Record that a job has been started on a worker.'''
+
+        self._expire_recovered()
+        self._append('job-started', id=job_id, artifact=artifact_basename,
+                     worker=worker_name)
+
+    def finish_job(self, job_id):
+        '''Record that a job is no longer running on a worker.'''
+
+        if job_id in self._jobs:
+            self._append('job-finished', id=job_id)
+
+    def adopt_job(self, artifact_basename):
+        '''Find a job that was running before a restart.
+
+        If a job building ``artifact_basename`` was running on a worker
+        when the controller stopped, return its id and the name of the
+        worker, and forget about it, so that it is only adopted once.
+        Otherwise return None.
+
+        '''
+
+        self._expire_recovered()
+        record = self._recovered_jobs.pop(artifact_basename, None)
+        if record is None:
+            return None
+        return record['id'], record['worker']
@@ -0,0 +1,173 @@
+# distbuild/journal_tests.py -- unit tests for the controller journal
+#
+# Copyright (C) 2014  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA..
+
+
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+import distbuild
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000
+
+    def __call__(self):
+        return self.now
+
+
+SHA1 = 'e' * 40
+OTHER_SHA1 = 'f' * 40
+
+
+def request(ref=SHA1):
+    return {
+        'type': 'build-request',
+        'id': 'whatever',
+        'repo': 'baserock:baserock/definitions',
+        'ref': ref,
+        'morphology': 'system.morph',
+        'original_ref': 'master',
+    }
+
+
+class JournalTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.dirname = os.path.join(self.tempdir, 'journal')
+        self.clock = FakeClock()
+        self.journal = self.restart()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def restart(self):
+        journal = distbuild.Journal(self.dirname, max_age=100,
+                                    claim_within=10, clock=self.clock)
+        journal.recover()
+        return journal
+
+    def test_starts_empty(self):
+        self.assertEqual(self.journal.identifiers(), [])
+        self.assertEqual(self.journal.claim_request('r-1', request()), None)
+        self.assertEqual(self.journal.adopt_job('foo'), None)
+
+    def test_gives_back_unfinished_request_with_its_graph(self):
+        self.journal.start_request('r-1', request())
+        self.journal.save_graph('r-1', 'graph')
+        self.journal.start_request('r-2', request(OTHER_SHA1))
+        self.journal.finish_request('r-2')
+
+        journal = self.restart()
+        self.assertEqual(journal.identifiers(), ['r-1'])
+        self.assertEqual(journal.claim_request('r-2', request(OTHER_SHA1)),
+                         None)
+        journal.start_request('r-3', request())
+        self.assertEqual(journal.claim_request('r-3', request()), 'graph')
+        self.assertEqual(journal.claim_request('r-4', request()), None)
+
+        journal = self.restart()
+        self.assertEqual(journal.identifiers(), ['r-3'])
+        journal.start_request('r-5', request())
+        self.assertEqual(journal.claim_request('r-5', request()), 'graph')
+
+    def test_gives_back_request_for_branch_only_if_graph_is_pinned(self):
+        self.journal.start_request('r-1', request('master'))
+        self.journal.save_graph('r-1', 'graph')
+        self.journal.start_request('r-2', request('pinned'))
+        self.journal.save_graph('r-2', 'pinned graph', pinned=True)
+
+        journal = self.restart()
+        journal.start_request('r-3', request('master'))
+        self.assertEqual(journal.claim_request('r-3', request('master')),
+                         None)
+        journal.start_request('r-4', request('pinned'))
+        self.assertEqual(journal.claim_request('r-4', request('pinned')),
+                         'pinned graph')
+
+        journal = self.restart()
+        journal.start_request('r-5', request('pinned'))
+        self.assertEqual(journal.claim_request('r-5', request('pinned')),
+                         'pinned graph')
+
+    def test_forgets_requests_and_jobs_not_carried_on_with(self):
+        self.journal.start_request('r-1', request())
+        self.journal.save_graph('r-1', 'graph')
+        self.journal.start_job('j-1', 'foo', 'worker:3434')
+
+        journal = self.restart()
+        self.clock.now += 11
+        journal.start_request('r-2', request(OTHER_SHA1))
+        self.assertEqual(journal.identifiers(), ['r-2'])
+        self.assertEqual(journal.adopt_job('foo'), None)
+        self.assertEqual(journal.claim_request('r-2', request()), None)
+        self.assertEqual(os.listdir(self.dirname), ['journal'])
+
+    def test_removes_graph_of_finished_request(self):
+        self.journal.start_request('r-1', request())
+        self.journal.save_graph('r-1', 'graph')
+        self.journal.finish_request('r-1')
+        self.assertEqual(os.listdir(self.dirname), ['journal'])
+
+    def test_gives_back_running_jobs_once(self):
+        self.journal.start_job('j-1', 'foo', 'worker:3434')
+        self.journal.start_job('j-2', 'bar', 'worker:3434')
+        self.journal.finish_job('j-2')
+
+        journal = self.restart()
+        self.assertEqual(journal.identifiers(), ['j-1'])
+        self.assertEqual(journal.adopt_job('bar'), None)
+        self.assertEqual(journal.adopt_job('foo'), ('j-1', 'worker:3434'))
+        self.assertEqual(journal.adopt_job('foo'), None)
+
+    def test_forgets_old_requests_and_jobs(self):
+        self.journal.start_request('r-1', request())
+        self.journal.save_graph('r-1', 'graph')
+        self.journal.start_job('j-1', 'foo', 'worker:3434')
+        self.clock.now += 101
+
+        journal = self.restart()
+        self.assertEqual(journal.identifiers(), [])
+        self.assertEqual(os.listdir(self.dirname), ['journal'])
+
+    def test_compacts_journal(self):
+        self.journal.min_compact_records = 10
+        self.journal.start_job('j-0', 'foo', 'worker:3434')
+        for i in range(1, 20):
+            self.journal.start_job('j-%d' % i, 'bar', 'worker:3434')
+            self.journal.finish_job('j-%d' % i)
+        with open(os.path.join(self.dirname, 'journal')) as f:
+            self.assertTrue(len(f.readlines()) <= 10)
+        self.assertEqual(self.restart().identifiers(), ['j-0'])
+
+    def test_ignores_partly_written_record(self):
+        self.journal.start_job('j-1', 'foo', 'worker:3434')
+        with open(os.path.join(self.dirname, 'journal'), 'a') as f:
+            f.write('{"type": "job-fin')
+        logging.disable(logging.WARNING)
+        try:
+            journal = self.restart()
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertEqual(journal.identifiers(), ['j-1'])
+        journal.finish_job('j-1')
+        self.assertEqual(self.restart().identifiers(), [])
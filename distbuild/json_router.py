@@ -16,6 +16,7 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA..
 
 
+import collections
 import logging
 
 import distbuild
@@ -32,24 +33,43 @@ class JsonRouter(distbuild.StateMachine):
     sent to the next free helper. The helper's response will retain
     the unique id, so that the response can be routed to the right
     client.
+
+    If ``capacity`` is given, it is sent to every new connection in a
+    worker-capacity message, so that a controller knows how many builds
+    it can give this worker at a time. It is a dict with the number of
+    ``slots``, and the ``cores`` and bytes of ``memory`` of the worker.
+
+    If a client goes away, the requests it had running are left to
+    finish, and the client may adopt them again, after it reconnects,
+    with an exec-adopt message giving the id of the request. The last
+    ``max_orphaned_responses`` responses to requests whose client had
+    gone away are kept for that.
     
     '''
 
     pending_requests = []
     running_requests = {}
     pending_helpers = []
+    orphaned_responses = collections.OrderedDict()
+    max_orphaned_responses = 100
     request_counter = distbuild.IdentifierGenerator('JsonRouter')
     route_map = distbuild.RouteMap()
 
-    def __init__(self, conn):
+    def __init__(self, conn, capacity=None):
         distbuild.StateMachine.__init__(self, 'idle')
         self.conn = conn
+        self.capacity = capacity
         logging.debug('JsonMachine: connection from %s', conn.getpeername())
 
     def setup(self):
         jm = distbuild.JsonMachine(self.conn)
         jm.debug_json = True
         self.mainloop.add_state_machine(jm)
+
+        if self.capacity is not None:
+            msg = dict(self.capacity)
+            msg['type'] = 'worker-capacity'
+            jm.send(msg)
         
         spec = [
             # state, source, event_class, new_state, callback
@@ -65,12 +85,15 @@ class JsonRouter(distbuild.StateMachine):
             return None
         
     def bloop(self, event_source, event):
-        logging.debug('JsonRouter: got msg: %s', repr(event.msg))
+        # Messages carry build output, so log only what they are about.
+        logging.debug('JsonRouter: got %s message for %s',
+                      event.msg.get('type'), event.msg.get('id'))
         handlers = {
             'http-request': self.do_request,
             'http-response': self.do_response,
             'exec-request': self.do_request,
             'exec-cancel': self.do_cancel,
+            'exec-adopt': self.do_adopt,
             'exec-output': self.do_exec_output,
             'exec-response': self.do_response,
             'helper-ready': self.do_helper_ready,
@@ -87,12 +110,36 @@ class JsonRouter(distbuild.StateMachine):
         for id in self.route_map.get_outgoing_ids(event.msg['id']):
             logging.debug('JsonRouter: looking up request for id %s', id)
             t = self._lookup_request(id)
-            if t:
+            if t and t[0] == client:
                 helper = t[2]
                 new = dict(event.msg)
                 new['id'] = id
                 helper.send(new)
-                logging.debug('JsonRouter: sent to helper: %s', repr(new))
+                logging.debug('JsonRouter: sent to helper: %r', new)
+
+    def do_adopt(self, client, event):
+        client_id = event.msg['id']
+        for id in self.route_map.get_outgoing_ids(client_id):
+            t = self._lookup_request(id)
+            if t and t[0] is None:
+                orphan, msg, helper = t
+                self.running_requests[id] = (client, msg, helper)
+                logging.info('JsonRouter: request %s adopted', client_id)
+                client.send(distbuild.message(
+                    'exec-adopted', id=client_id, running=True))
+                return
+
+        response = self.orphaned_responses.pop(client_id, None)
+        if response is not None:
+            logging.info('JsonRouter: finished request %s adopted',
+                         client_id)
+            client.send(distbuild.message(
+                'exec-adopted', id=client_id, running=True))
+            client.send(response)
+        else:
+            logging.info('JsonRouter: no request %s to adopt', client_id)
+            client.send(distbuild.message(
+                'exec-adopted', id=client_id, running=False))
 
     def do_response(self, helper, event):
         t = self._lookup_request(event.msg['id'])
@@ -100,8 +147,18 @@ class JsonRouter(distbuild.StateMachine):
             client, msg, helper = t
             new = dict(event.msg)
             new['id'] = self.route_map.get_incoming_id(msg['id'])
-            client.send(new)
-            logging.debug('JsonRouter: sent to client: %s', repr(new))
+            # The request is over, so it cannot be adopted any more.
+            del self.running_requests[msg['id']]
+            self.route_map.remove(msg['id'])
+            if client is not None:
+                client.send(new)
+                logging.debug('JsonRouter: sent %s to client', new['type'])
+            else:
+                # Keep the response for the client to adopt.
+                self.orphaned_responses[new['id']] = new
+                while (len(self.orphaned_responses) >
+                       self.max_orphaned_responses):
+                    self.orphaned_responses.popitem(last=False)
 
     def do_helper_ready(self, helper, event):
         self.pending_helpers.append(helper)
@@ -112,26 +169,28 @@ class JsonRouter(distbuild.StateMachine):
         t = self._lookup_request(event.msg['id'])
         if t:
             client, msg, helper = t
+            if client is None:
+                return  # nobody wants the output of an orphan
             new = dict(event.msg)
             new['id'] = self.route_map.get_incoming_id(msg['id'])
             client.send(new)
-            logging.debug('JsonRouter: sent to client: %s', repr(new))
 
     def close(self, event_source, event):
-        logging.debug('closing: %s', repr(event_source))
+        logging.debug('closing: %r', event_source)
         event_source.close()
 
-        # Remove from pending helpers.
-        if event_source in self.pending_helpers:
+        # Remove from pending helpers. A helper that can run several
+        # requests at once is in the list once for each of them.
+        while event_source in self.pending_helpers:
             self.pending_helpers.remove(event_source)
 
-        # Remove from running requests, and put the request back in the
-        # pending requests queue if the helper quit (but not if the
-        # client quit).
+        # Leave running requests to finish if the client quit, so that
+        # it may adopt them when it comes back, and put the request back
+        # in the pending requests queue if the helper quit.
         for request_id in self.running_requests.keys():
             client, msg, helper = self.running_requests[request_id]
             if event_source == client:
-                del self.running_requests[request_id]
+                self.running_requests[request_id] = (None, msg, helper)
             elif event_source == helper:
                 del self.running_requests[request_id]
                 self._enqueue_request(client, msg)
@@ -161,5 +220,5 @@ class JsonRouter(distbuild.StateMachine):
         helper = self.pending_helpers.pop()
         self.running_requests[msg['id']] = (client, msg, helper)
         helper.send(msg)
-        logging.debug('JsonRouter: sent to helper: %s', repr(msg))
+        logging.debug('JsonRouter: sent to helper: %r', msg)
 
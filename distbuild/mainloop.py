@@ -20,6 +20,9 @@ import fcntl
 import logging
 import os
 import select
+import time
+
+import distbuild
 
 
 class MainLoop(object):
@@ -34,14 +37,28 @@ class MainLoop(object):
     
     When nothing is happening, the main loop sleeps in the
     select.select call.
+
+    How long it takes to handle what happens each time it wakes up is
+    recorded in ``metrics``, by default the metrics of this process.
     
     '''
 
-    def __init__(self):
+    iteration_buckets = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1,
+                         0.5, 1, 5)
+
+    def __init__(self, metrics=None):
         self._machines = []
         self._sources = []
         self._events = []
         self.dump_filename = None
+        metrics = metrics or distbuild.default_metrics
+        self._iteration_seconds = metrics.histogram(
+            'distbuild_mainloop_iteration_seconds',
+            'Time spent handling events each time the main loop wakes up',
+            self.iteration_buckets)
+        self._events_total = metrics.counter(
+            'distbuild_mainloop_events_total',
+            'Events handled by the main loop')
         
     def add_state_machine(self, machine):
         logging.debug('MainLoop.add_state_machine: %s' % machine)
@@ -89,6 +106,7 @@ class MainLoop(object):
         r, w, x, timeout = self._setup_select()
         assert r or w or x or timeout is not None
         r, w, x = select.select(r, w, x, timeout)
+        started = time.time()
 
         for event_source in self._sources:
             if event_source.is_finished():
@@ -97,13 +115,18 @@ class MainLoop(object):
                 for event in event_source.get_events(r, w, x):
                     self.queue_event(event_source, event)
 
+        handled = 0
         for event_source, event in self._dequeue_events():
+            handled += 1
             for machine in self._machines[:]:
                 for new_event in machine.handle_event(event_source, event):
                     self.queue_event(event_source, new_event)
                 if machine.state is None:
                     self.remove_state_machine(machine)
 
+        self._events_total.inc(handled)
+        self._iteration_seconds.observe(time.time() - started)
+
     def run(self):
         '''Run the main loop.
         
@@ -0,0 +1,223 @@
+# distbuild/metrics.py -- measure what the distbuild controller is doing
+#
+# Copyright (C) 2014  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA..
+
+
+'''Metrics of a distbuild process, in the Prometheus text format.
+
+State machines record what they are doing in metrics from
+``default_metrics``: counters of things that have happened, gauges of
+how things are now, and histograms of how long things took. Each
+metric may have labels, such as the name of a worker, and has a value
+for each combination of their values. MetricsConnection serves them
+over HTTP, for Prometheus or anything else that reads its text format.
+
+Gauges of things that are easier to look at than to keep track of,
+such as how many jobs are queued, are set by collectors, which are
+called just before the metrics are rendered.
+
+'''
+
+
+import bisect
+import logging
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if value == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value):
+    return (str(value).replace('\\', r'\\').replace('"', r'\"').
+            replace('\n', r'\n'))
+
+
+class _Metric(object):
+
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+
+    def _key(self, labels):
+        assert sorted(labels) == sorted(self.labels), \
+            'metric %s has labels %s' % (self.name, self.labels)
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def _format_labels(self, key, extra=()):
+        pairs = zip(self.labels, key) + list(extra)
+        if not pairs:
+            return ''
+        return '{%s}' % ','.join(
+            '%s="%s"' % (name, _escape(value)) for name, value in pairs)
+
+    def remove(self, **labels):
+        '''Forget the value for some label values.'''
+        self._values.pop(self._key(labels), None)
+
+    def clear(self):
+        '''Forget the values for all label values.'''
+        self._values.clear()
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s %s' % (self.name, self.type)]
+        for key in sorted(self._values):
+            lines.extend(self._render_value(key, self._values[key]))
+        return lines
+
+    def _render_value(self, key, value):
+        return ['%s%s %s' % (self.name, self._format_labels(key),
+                             _format_value(value))]
+
+
+class Counter(_Metric):
+
+    '''Count things that have happened.'''
+
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+
+    '''Measure how something is at the moment.'''
+
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Histogram(_Metric):
+
+    '''Count how many measurements fell into each of a set of buckets.
+
+    ``buckets`` are the upper bounds of the buckets, in increasing order.
+
+    '''
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labels, buckets):
+        _Metric.__init__(self, name, help, labels)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        if key not in self._values:
+            self._values[key] = [[0] * len(self.buckets), 0, 0]
+        entry = self._values[key]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def get_count(self, **labels):
+        return self._values.get(self._key(labels), [None, 0, 0])[2]
+
+    def get_sum(self, **labels):
+        return self._values.get(self._key(labels), [None, 0, 0])[1]
+
+    def _render_value(self, key, value):
+        counts, total, count = value
+        lines = []
+        cumulative = 0
+        for bound, n in zip(self.buckets, counts):
+            cumulative += n
+            lines.append('%s_bucket%s %d' % (
+                self.name,
+                self._format_labels(key, [('le', _format_value(bound))]),
+                cumulative))
+        labels = self._format_labels(key)
+        lines.append('%s_sum%s %s' % (self.name, labels,
+                                      _format_value(total)))
+        lines.append('%s_count%s %d' % (self.name, labels, count))
+        return lines
+
+
+class Metrics(object):
+
+    '''A set of metrics, by name.
+
+    The same metric is returned each time it is asked for by name, so
+    that every instance of a state machine can record in it.
+
+    '''
+
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+
+    def _get(self, cls, name, help, labels, *args):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = cls(name, help, labels, *args)
+        assert isinstance(metric, cls), \
+            'metric %s is a %s' % (name, metric.type)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name, help, labels=()):
+        return self._get(Gauge, name, help, labels)
+
+    def histogram(self, name, help, buckets, labels=()):
+        return self._get(Histogram, name, help, labels, buckets)
+
+    def add_collector(self, collector):
+        '''Have collector called to update gauges before rendering.
+
+        Adding the same collector again does nothing.
+
+        '''
+        if collector not in self._collectors:
+            self._collectors.append(collector)
+
+    def remove_collector(self, collector):
+        if collector in self._collectors:
+            self._collectors.remove(collector)
+
+    def render(self):
+        '''Return the metrics in the Prometheus text format.'''
+
+        for collector in self._collectors:
+            try:
+                collector()
+            except Exception:
+                logging.exception('Metrics collector %r failed', collector)
+        lines = []
+        for name in sorted(self._metrics):
+            lines.extend(self._metrics[name].render())
+        return ''.join('%s\n' % line for line in lines)
+
+
+# The metrics of this process.
+default_metrics = Metrics()
@@ -0,0 +1,138 @@
+# distbuild/metrics_connection.py -- serve metrics and traces over HTTP
+#
+# Copyright (C) 2014  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA..
+
+
+import httplib
+import logging
+import os
+import re
+
+import distbuild
+
+
+_trace_name_pattern = re.compile(r'^[A-Za-z0-9_.-]+\.json$')
+
+
+class _Answered(object):
+
+    pass
+
+
+class MetricsConnection(distbuild.StateMachine):
+
+    '''Answer one HTTP request for metrics or build traces.
+
+    ``GET /metrics`` returns ``metrics``, by default the metrics of this
+    process, in the Prometheus text format. If ``trace_dir`` is given,
+    ``GET /traces/`` lists the build traces written there, newest first,
+    and ``GET /traces/NAME`` returns one of them.
+
+    The connection is closed once the request has been answered.
+
+    '''
+
+    max_request = 8 * 1024
+
+    def __init__(self, conn, metrics=None, trace_dir=None):
+        distbuild.StateMachine.__init__(self, 'reading')
+        self.conn = conn
+        self.metrics = metrics or distbuild.default_metrics
+        self.trace_dir = trace_dir
+
+    def setup(self):
+        self._sockbuf = distbuild.SocketBuffer(self.conn, self.max_request)
+        self.mainloop.add_state_machine(self._sockbuf)
+        self._request = ''
+
+        spec = [
+            # state, source, event_class, new_state, callback
+            ('reading', self._sockbuf, distbuild.SocketBufferNewData,
+                'reading', self._read),
+            ('reading', self._sockbuf, distbuild.SocketBufferEof, None,
+                self._close),
+            ('reading', self, _Answered, None, None),
+        ]
+        self.add_transitions(spec)
+
+    def _read(self, event_source, event):
+        if self._request is None:
+            return  # already answered
+        self._request += event.data
+        end = self._request.find('\n\n')
+        if end == -1:
+            end = self._request.find('\r\n\r\n')
+        if end != -1:
+            self._answer(self._request[:end].splitlines()[0])
+        elif len(self._request) > self.max_request:
+            self._respond(httplib.BAD_REQUEST, 'Request is too long\n')
+
+    def _answer(self, request_line):
+        logging.debug('MetricsConnection: %s', request_line)
+        words = request_line.split()
+        if len(words) != 3:
+            self._respond(httplib.BAD_REQUEST, 'Bad request\n')
+            return
+        method, path = words[:2]
+        path = path.split('?', 1)[0]
+        if method != 'GET':
+            self._respond(httplib.METHOD_NOT_ALLOWED, 'Only GET works\n')
+        elif path == '/metrics':
+            self._respond(httplib.OK, self.metrics.render(),
+                          'text/plain; version=0.0.4')
+        elif path == '/traces/' and self.trace_dir:
+            self._respond(httplib.OK, ''.join(
+                '%s\n' % name for name in self._list_traces()))
+        elif path.startswith('/traces/') and self.trace_dir:
+            self._send_trace(path[len('/traces/'):])
+        else:
+            self._respond(httplib.NOT_FOUND, 'Not found\n')
+
+    def _list_traces(self):
+        try:
+            names = [name for name in os.listdir(self.trace_dir)
+                     if _trace_name_pattern.match(name)]
+        except OSError:
+            return []
+        # Trace names start with the time the build was requested.
+        return sorted(names, reverse=True)
+
+    def _send_trace(self, name):
+        if not _trace_name_pattern.match(name):
+            self._respond(httplib.NOT_FOUND, 'Not found\n')
+            return
+        try:
+            with open(os.path.join(self.trace_dir, name)) as f:
+                body = f.read()
+        except IOError:
+            self._respond(httplib.NOT_FOUND, 'Not found\n')
+            return
+        self._respond(httplib.OK, body, 'application/json')
+
+    def _respond(self, status, body, content_type='text/plain'):
+        header = ('HTTP/1.0 %d %s\r\n'
+                  'Content-Type: %s\r\n'
+                  'Content-Length: %d\r\n'
+                  'Connection: close\r\n'
+                  '\r\n' % (status, httplib.responses[status],
+                            content_type, len(body)))
+        self._sockbuf.write(header + body)
+        self._sockbuf.close()
+        self._request = None
+        self.mainloop.queue_event(self, _Answered())
+
+    def _close(self, event_source, event):
+        self._sockbuf.close()
@@ -0,0 +1,112 @@
+# distbuild/metrics_tests.py -- unit tests for distbuild metrics
+#
+# Copyright (C) 2014  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA..
+
+
+import logging
+import unittest
+
+import distbuild
+
+
+class MetricsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = distbuild.Metrics()
+
+    def test_is_empty_initially(self):
+        self.assertEqual(self.metrics.render(), '')
+
+    def test_returns_same_metric_for_same_name(self):
+        counter = self.metrics.counter('foo_total', 'Foos.')
+        self.assertEqual(self.metrics.counter('foo_total', 'Foos.'), counter)
+
+    def test_renders_counter(self):
+        counter = self.metrics.counter('foo_total', 'Foos.', ['kind'])
+        counter.inc(kind='a')
+        counter.inc(2, kind='a')
+        counter.inc(kind='b "c"')
+        self.assertEqual(counter.get(kind='a'), 3)
+        self.assertEqual(
+            self.metrics.render(),
+            '# HELP foo_total Foos.\n'
+            '# TYPE foo_total counter\n'
+            'foo_total{kind="a"} 3\n'
+            'foo_total{kind="b \\"c\\""} 1\n')
+
+    def test_renders_gauge(self):
+        gauge = self.metrics.gauge('foo', 'Foo.')
+        gauge.set(0.5)
+        self.assertEqual(gauge.get(), 0.5)
+        self.assertEqual(
+            self.metrics.render(),
+            '# HELP foo Foo.\n'
+            '# TYPE foo gauge\n'
+            'foo 0.5\n')
+
+    def test_forgets_values(self):
+        gauge = self.metrics.gauge('foo', 'Foo.', ['kind'])
+        gauge.set(1, kind='a')
+        gauge.set(1, kind='b')
+        gauge.remove(kind='a')
+        self.assertEqual(gauge.get(kind='a'), 0)
+        self.assertEqual(gauge.get(kind='b'), 1)
+        gauge.clear()
+        self.assertEqual(gauge.get(kind='b'), 0)
+
+    def test_renders_histogram(self):
+        histogram = self.metrics.histogram('foo_seconds', 'Foo.', [1, 10])
+        histogram.observe(1)
+        histogram.observe(5)
+        histogram.observe(50)
+        self.assertEqual(histogram.get_count(), 3)
+        self.assertEqual(histogram.get_sum(), 56)
+        self.assertEqual(
+            self.metrics.render(),
+            '# HELP foo_seconds Foo.\n'
+            '# TYPE foo_seconds histogram\n'
+            'foo_seconds_bucket{le="1"} 1\n'
+            'foo_seconds_bucket{le="10"} 2\n'
+            'foo_seconds_bucket{le="+Inf"} 3\n'
+            'foo_seconds_sum 56\n'
+            'foo_seconds_count 3\n')
+
+    def test_calls_collectors_before_rendering(self):
+        gauge = self.metrics.gauge('foo', 'Foo.')
+        collector = lambda: gauge.set(gauge.get() + 1)
+        self.metrics.add_collector(collector)
+        self.assertTrue('foo 1\n' in self.metrics.render())
+        self.metrics.remove_collector(collector)
+        self.assertTrue('foo 1\n' in self.metrics.render())
+
+    def test_calls_collector_added_twice_once(self):
+        gauge = self.metrics.gauge('foo', 'Foo.')
+        collector = lambda: gauge.set(gauge.get() + 1)
+        self.metrics.add_collector(collector)
+        self.metrics.add_collector(collector)
+        self.assertTrue('foo 1\n' in self.metrics.render())
+        self.metrics.remove_collector(collector)
+        self.metrics.remove_collector(collector)
+
+    def test_survives_broken_collector(self):
+        def collector():
+            raise Exception('broken')
+        self.metrics.add_collector(collector)
+        logging.disable(logging.ERROR)
+        try:
+            self.assertEqual(self.metrics.render(), '')
+        finally:
+            logging.disable(logging.NOTSET)
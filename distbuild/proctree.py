@@ -0,0 +1,95 @@
+# distbuild/proctree.py -- memory used by trees of processes
+#
+# Copyright (C) 2014  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA..
+
+
+import os
+
+
+def read_processes(proc='/proc'):
+    '''Return the parent and resident memory of every process.
+
+    The result is a dict of (parent pid, resident bytes) by pid, read
+    from ``proc``. Processes that exit while it is being read are left
+    out.
+
+    '''
+
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    processes = {}
+    for name in os.listdir(proc):
+        if not name.isdigit():
+            continue
+        try:
+            with open(os.path.join(proc, name, 'stat')) as f:
+                stat = f.read()
+        except IOError:
+            continue
+        # The command name is in brackets, and may contain anything.
+        fields = stat[stat.rindex(')') + 2:].split()
+        processes[int(name)] = (int(fields[1]), int(fields[21]) * page_size)
+    return processes
+
+
+def tree_memory(processes, pid):
+    '''Return the resident memory of a process and all its descendants.
+
+    ``processes`` is what read_processes returns. Memory shared by
+    several processes is counted for each of them, so this is more than
+    the tree really uses, but never less.
+
+    '''
+
+    children = {}
+    for child, (parent, rss) in processes.iteritems():
+        children.setdefault(parent, []).append(child)
+    total = 0
+    todo = [pid]
+    while todo:
+        p = todo.pop()
+        if p in processes:
+            total += processes[p][1]
+        todo.extend(children.get(p, []))
+    return total
+
+
+class MemorySampler(object):
+
+    '''Find the most memory trees of processes use at once.
+
+    The processes are looked at each time ``sample`` is called, so the
+    result is the peak of the samples, which may miss short peaks.
+
+    '''
+
+    def __init__(self, proc='/proc'):
+        self.proc = proc
+        self._peaks = {}
+
+    def add(self, pid):
+        self._peaks[pid] = 0
+
+    def sample(self):
+        if not self._peaks:
+            return
+        processes = read_processes(self.proc)
+        for pid in self._peaks:
+            self._peaks[pid] = max(self._peaks[pid],
+                                   tree_memory(processes, pid))
+
+    def remove(self, pid):
+        '''Stop sampling a tree, returning its peak memory in bytes.'''
+        return self._peaks.pop(pid, 0)
@@ -0,0 +1,68 @@
+# distbuild/proctree_tests.py -- unit tests for process tree memory
+#
+# Copyright (C) 2014  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA..
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import distbuild
+
+
+class ProcTreeTests(unittest.TestCase):
+
+    def setUp(self):
+        self.proc = tempfile.mkdtemp()
+        self.page_size = os.sysconf('SC_PAGE_SIZE')
+
+    def tearDown(self):
+        shutil.rmtree(self.proc)
+
+    def add_process(self, pid, ppid, pages, comm='make'):
+        os.mkdir(os.path.join(self.proc, str(pid)))
+        fields = ['S', str(ppid)] + ['0'] * 19 + [str(pages)] + ['0'] * 20
+        with open(os.path.join(self.proc, str(pid), 'stat'), 'w') as f:
+            f.write('%d (%s) %s\n' % (pid, comm, ' '.join(fields)))
+
+    def test_reads_processes(self):
+        self.add_process(10, 1, 3, comm='odd) name')
+        os.mkdir(os.path.join(self.proc, 'self'))
+        self.assertEqual(distbuild.read_processes(self.proc),
+                         {10: (1, 3 * self.page_size)})
+
+    def test_adds_up_memory_of_descendants(self):
+        self.add_process(10, 1, 1)
+        self.add_process(11, 10, 2)
+        self.add_process(12, 11, 4)
+        self.add_process(13, 10, 8)
+        self.add_process(20, 1, 16)
+        processes = distbuild.read_processes(self.proc)
+        self.assertEqual(distbuild.tree_memory(processes, 10),
+                         15 * self.page_size)
+        self.assertEqual(distbuild.tree_memory(processes, 99), 0)
+
+    def test_sampler_keeps_peak(self):
+        sampler = distbuild.MemorySampler(self.proc)
+        sampler.add(10)
+        self.add_process(10, 1, 1)
+        self.add_process(11, 10, 2)
+        sampler.sample()
+        shutil.rmtree(os.path.join(self.proc, '11'))
+        sampler.sample()
+        self.assertEqual(sampler.remove(10), 3 * self.page_size)
+        self.assertEqual(sampler.remove(10), 0)
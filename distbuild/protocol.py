@@ -58,6 +58,12 @@ _required_fields = {
         'id',
         'step_name',
     ],
+    'output-detach': [
+        'id',
+    ],
+    'output-attach': [
+        'id',
+    ],
     'build-finished': [
         'id',
         'urls',
@@ -74,6 +80,13 @@ _required_fields = {
     'exec-cancel': [
         'id',
     ],
+    'exec-adopt': [
+        'id',
+    ],
+    'exec-adopted': [
+        'id',
+        'running',
+    ],
     'http-request': [
         'id',
         'url',
@@ -0,0 +1,78 @@
+# distbuild/resource_history.py -- remember what builds needed to run
+#
+# Copyright (C) 2014  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA..
+
+
+import json
+import logging
+import os
+import tempfile
+
+
+class ResourceHistory(object):
+
+    '''Remember how much memory building each source needed.
+
+    The controller uses this to avoid running builds on a worker at the
+    same time that together need more memory than the worker has. Only
+    the latest build of each source is remembered, since its memory use
+    changes along with the source.
+
+    If ``filename`` is given, the history is kept in that file too, so
+    that it survives a restart of the controller.
+
+    '''
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self._memory = {}
+        if filename is not None and os.path.exists(filename):
+            try:
+                with open(filename) as f:
+                    self._memory = json.load(f)
+            except (IOError, ValueError), e:
+                logging.warning('Could not load resource history: %s' % e)
+
+    def memory(self, name):
+        '''Return the bytes of memory building name needed, or 0.'''
+
+        return self._memory.get(name, 0)
+
+    def record(self, name, memory):
+        '''Remember that building name needed memory bytes.'''
+
+        if self._memory.get(name) == memory:
+            return
+        self._memory[name] = memory
+        if self.filename is not None:
+            self._save()
+
+    def _save(self):
+        dirname = os.path.dirname(self.filename) or '.'
+        try:
+            if not os.path.exists(dirname):
+                os.makedirs(dirname)
+            fd, tempname = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+        except (IOError, OSError), e:
+            logging.warning('Could not save resource history: %s' % e)
+            return
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self._memory, f)
+            os.rename(tempname, self.filename)
+        except (IOError, OSError), e:
+            logging.warning('Could not save resource history: %s' % e)
+            os.remove(tempname)
@@ -0,0 +1,72 @@
+# distbuild/resource_history_tests.py -- unit tests for ResourceHistory
+#
+# Copyright (C) 2014  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA..
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import distbuild
+
+
+class ResourceHistoryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tempdir, 'history', 'memory.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_needs_no_memory_for_unknown_source(self):
+        history = distbuild.ResourceHistory()
+        self.assertEqual(history.memory('gcc'), 0)
+
+    def test_remembers_latest_memory_use(self):
+        history = distbuild.ResourceHistory()
+        history.record('gcc', 2048)
+        history.record('gcc', 1024)
+        self.assertEqual(history.memory('gcc'), 1024)
+
+    def test_remembers_memory_use_in_file(self):
+        history = distbuild.ResourceHistory(self.filename)
+        history.record('gcc', 1024)
+        history.record('gcc', 1024)
+        history = distbuild.ResourceHistory(self.filename)
+        self.assertEqual(history.memory('gcc'), 1024)
+
+    def test_ignores_broken_file(self):
+        os.mkdir(os.path.dirname(self.filename))
+        with open(self.filename, 'w') as f:
+            f.write('{')
+        history = distbuild.ResourceHistory(self.filename)
+        self.assertEqual(history.memory('gcc'), 0)
+
+    def test_keeps_memory_use_if_file_cannot_be_written(self):
+        os.makedirs(self.filename)
+        history = distbuild.ResourceHistory(self.filename)
+        history.record('gcc', 1024)
+        self.assertEqual(history.memory('gcc'), 1024)
+        self.assertEqual(os.listdir(self.filename), [])
+
+    def test_keeps_memory_use_if_directory_cannot_be_made(self):
+        with open(os.path.join(self.tempdir, 'history'), 'w'):
+            pass
+        history = distbuild.ResourceHistory(self.filename)
+        history.record('gcc', 1024)
+        self.assertEqual(history.memory('gcc'), 1024)
@@ -215,3 +215,170 @@ def deserialise_artifact(encoded):
                                for sid in artifact_dict['dependents']]
 
     return artifacts[root_artifact]
+
+
+def _utf8(obj):
+    '''Turn the unicode strings that json.loads returns into str.
+
+    Morph expects morphologies to have str values, as loaded from YAML.
+
+    '''
+
+    if isinstance(obj, unicode):
+        return obj.encode('utf-8')
+    elif isinstance(obj, list):
+        return [_utf8(x) for x in obj]
+    elif isinstance(obj, dict):
+        return dict((_utf8(k), _utf8(v)) for k, v in obj.iteritems())
+    return obj
+
+
+def serialise_job(artifact):
+    '''Serialise what a worker needs to build an artifact into a string.
+
+    Unlike ``serialise_artifact``, only the source of the artifact
+    itself is included in full. Of each source it depends on, only what
+    is needed to fetch and install its artifacts is kept: its name,
+    kind and cache key, how a chunk is built, and which strata a chunk
+    is in. Their morphologies are left out, which is most of the size
+    of a build graph.
+
+    '''
+
+    indexes = {}
+    encoded_sources = []
+
+    def source_index(source):
+        if id(source) not in indexes:
+            indexes[id(source)] = len(encoded_sources)
+            encoded_sources.append(encode_source(source))
+        return indexes[id(source)]
+
+    def encode_source(source):
+        kind = source.morphology['kind']
+        source_dic = {
+            'name': source.name,
+            'kind': kind,
+            'cache_key': source.cache_key,
+            'dependencies': [],
+        }
+        if kind == 'chunk':
+            source_dic['build_mode'] = source.build_mode
+            source_dic['prefix'] = source.prefix
+            source_dic['strata'] = sorted(set(
+                s.cache_key for a in source.artifacts.itervalues()
+                for s in a.dependents if s.morphology['kind'] == 'stratum'))
+        return source_dic
+
+    root = artifact.source
+    source_index(root)
+    encoded_sources[0].update({
+        'repo_name': root.repo_name,
+        'original_ref': root.original_ref,
+        'sha1': root.sha1,
+        'tree': root.tree,
+        'filename': root.filename,
+        'cache_id': root.cache_id,
+        'morphology': dict((key, root.morphology[key])
+                           for key in root.morphology.keys()),
+        'artifacts': sorted(root.artifacts.iterkeys()),
+    })
+
+    queue = [root]
+    done = set()
+    while queue:
+        source = queue.pop()
+        if id(source) in done:
+            continue
+        done.add(id(source))
+        encoded_sources[source_index(source)]['dependencies'] = [
+            (source_index(dep.source), dep.name)
+            for dep in source.dependencies]
+        queue.extend(dep.source for dep in source.dependencies)
+
+    kind = root.morphology['kind']
+    content = {
+        'sources': encoded_sources,
+        'artifact': artifact.name,
+        'arch': artifact.arch,
+        'default_split_rules': {
+            'chunk': morphlib.artifactsplitrule.DEFAULT_CHUNK_RULES,
+            'stratum': morphlib.artifactsplitrule.DEFAULT_STRATUM_RULES,
+        }.get(kind),
+    }
+    return json.dumps(content)
+
+
+def deserialise_job(encoded):
+    '''Re-construct an Artifact from a string made by ``serialise_job``.
+
+    Only the source of the artifact has a full morphology and split
+    rules. The sources it depends on have just enough to fetch and
+    install their artifacts in a staging area.
+
+    '''
+
+    content = _utf8(json.loads(encoded))
+    strata = {}
+    chunk_strata = {}
+
+    def stratum(cache_key):
+        '''Stand in for a stratum that a chunk is in.'''
+        if cache_key not in strata:
+            morphology = morphlib.morphology.Morphology(
+                {'kind': 'stratum', 'name': cache_key})
+            strata[cache_key] = morphlib.source.Source(
+                cache_key, None, None, None, None, morphology, None, None)
+        return strata[cache_key]
+
+    def decode_source(le_dict, split_rules):
+        if 'morphology' in le_dict:
+            morphology = morphlib.morphology.Morphology(le_dict['morphology'])
+            kind = morphology['kind']
+            ruler = getattr(morphlib.artifactsplitrule,
+                            'unify_%s_matches' % kind)
+            if split_rules is not None:
+                rules = ruler(morphology, split_rules)
+            else: # pragma: no cover
+                rules = ruler(morphology)
+        else:
+            morphology = morphlib.morphology.Morphology(
+                {'kind': le_dict['kind'], 'name': le_dict['name']})
+            rules = None
+        source = morphlib.source.Source(le_dict['name'],
+                                        le_dict.get('repo_name'),
+                                        le_dict.get('original_ref'),
+                                        le_dict.get('sha1'),
+                                        le_dict.get('tree'),
+                                        morphology,
+                                        le_dict.get('filename'),
+                                        rules)
+        if le_dict['kind'] == 'chunk':
+            source.build_mode = le_dict['build_mode']
+            source.prefix = le_dict['prefix']
+            chunk_strata[source] = [stratum(k) for k in le_dict['strata']]
+        source.cache_id = le_dict.get('cache_id')
+        source.cache_key = le_dict['cache_key']
+        source.artifacts = {}
+        return source
+
+    sources = [decode_source(le_dict, content['default_split_rules'])
+               for le_dict in content['sources']]
+
+    def get_artifact(source, name):
+        if name not in source.artifacts:
+            artifact = morphlib.artifact.Artifact(source, name)
+            artifact.dependents = list(chunk_strata.get(source, []))
+            source.artifacts[name] = artifact
+        return source.artifacts[name]
+
+    for source, le_dict in zip(sources, content['sources']):
+        source.dependencies = [get_artifact(sources[index], name)
+                               for index, name in le_dict['dependencies']]
+
+    root = sources[0]
+    for name in content['sources'][0]['artifacts']:
+        get_artifact(root, name)
+    artifact = root.artifacts[content['artifact']]
+    artifact.arch = content['arch']
+    return artifact
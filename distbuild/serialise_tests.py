@@ -172,3 +172,78 @@ class SerialisationTests(unittest.TestCase):
         self.art1.source.dependencies = [self.art2, self.art3]
         self.verify_round_trip(self.art1)
 
+
+
+class JobSerialisationTests(unittest.TestCase):
+
+    def setUp(self):
+        self.chunk = MockArtifact('chunk', 'chunk')
+        self.dep = MockArtifact('dep', 'chunk')
+        self.dep_of_dep = MockArtifact('dep-of-dep', 'chunk')
+        self.stratum = MockArtifact('stratum', 'stratum')
+        self.chunk.source.dependencies = [self.dep]
+        self.dep.source.dependencies = [self.dep_of_dep]
+        self.chunk.dependents = [self.stratum.source]
+        self.dep.dependents = [self.stratum.source, self.chunk.source]
+
+    def round_trip(self, artifact):
+        encoded = distbuild.serialise_job(artifact)
+        self.assertEqual(type(encoded), str)
+        return distbuild.deserialise_job(encoded)
+
+    def test_includes_source_of_artifact_in_full(self):
+        decoded = self.round_trip(self.chunk)
+        self.assertEqual(decoded.name, 'chunk')
+        self.assertEqual(decoded.arch, 'testarch')
+        source = decoded.source
+        for attr in ('name', 'repo_name', 'original_ref', 'sha1', 'tree',
+                     'filename', 'cache_key', 'cache_id', 'build_mode',
+                     'prefix'):
+            self.assertEqual(getattr(source, attr),
+                             getattr(self.chunk.source, attr))
+        self.assertEqual(dict(source.morphology),
+                         self.chunk.source.morphology.dict)
+        self.assertEqual(source.split_rules.artifacts[0], 'chunk')
+        self.assertEqual(source.artifacts.keys(), ['chunk'])
+
+    def test_includes_only_what_is_needed_of_dependencies(self):
+        decoded = self.round_trip(self.chunk)
+        dep, = decoded.source.dependencies
+        self.assertEqual(dep.name, 'dep')
+        self.assertEqual(dep.basename(), 'dep.cache_key.chunk.dep')
+        self.assertEqual(dep.source.build_mode, 'staging')
+        self.assertEqual(dep.source.prefix, '/usr')
+        self.assertEqual(sorted(dep.source.morphology.keys()),
+                         ['kind', 'name'])
+        self.assertEqual(dep.source.split_rules, None)
+        dep_of_dep, = dep.source.dependencies
+        self.assertEqual(dep_of_dep.name, 'dep-of-dep')
+        self.assertEqual(dep_of_dep.source.dependencies, [])
+
+    def test_keeps_which_chunks_are_in_the_same_stratum(self):
+        decoded = self.round_trip(self.chunk)
+        dep, = decoded.source.dependencies
+        stratum, = decoded.dependents
+        self.assertEqual(dep.dependents, [stratum])
+        self.assertEqual(stratum.morphology['kind'], 'stratum')
+        self.assertTrue(stratum.morphology.needs_artifact_metadata_cached)
+        dep_of_dep, = dep.source.dependencies
+        self.assertEqual(dep_of_dep.dependents, [])
+
+    def test_shares_dependencies(self):
+        self.chunk.source.dependencies = [self.dep, self.dep_of_dep]
+        decoded = self.round_trip(self.chunk)
+        dep, dep_of_dep = decoded.source.dependencies
+        self.assertTrue(dep.source.dependencies[0] is dep_of_dep)
+
+    def test_serialises_stratum(self):
+        self.stratum.source.dependencies = [self.chunk]
+        decoded = self.round_trip(self.stratum)
+        self.assertEqual(decoded.source.morphology['kind'], 'stratum')
+        chunk, = decoded.source.dependencies
+        self.assertEqual(chunk.basename(), 'chunk.cache_key.chunk.chunk')
+
+    def test_is_smaller_than_whole_graph(self):
+        self.stratum.source.dependencies = [self.chunk, self.dep]
+        self.assertTrue(len(distbuild.serialise_job(self.stratum)) <
+                        len(distbuild.serialise_artifact(self.stratum)))
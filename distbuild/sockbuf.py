@@ -16,6 +16,7 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA..
 
 
+import errno
 import logging
 
 
@@ -134,6 +135,10 @@ class SocketBuffer(StateMachine):
             self._start_writing(None, None)
             self.mainloop.queue_event(self, _WriteBufferNotEmpty())
 
+    def unsent_bytes(self):
+        '''Return how much data is in the write queue.'''
+        return len(self._wbuf)
+
     def close(self):
         '''Tell state machine to terminate.'''
         self.mainloop.queue_event(self, _Close())
@@ -160,15 +165,25 @@ class SocketBuffer(StateMachine):
         self.mainloop.queue_event(self, SocketBufferClosed())
 
     def _flush(self, event_source, event):
+        # The buffer hands out its data a piece at a time, without
+        # copying it, so write pieces until the socket is full or enough
+        # has been written for one go.
         max_write = 1024**2
-        data = self._wbuf.read(max_write)
-        try:
-            n = event.sock.write(data)
-        except (IOError, OSError), e:
-            logging.debug(
-                '%s: _flush(): Exception %s from sock.write()', self, e)
-            return [SocketError(event.sock, e)]
-        self._wbuf.remove(n)
+        written = 0
+        while written < max_write and len(self._wbuf) > 0:
+            data = self._wbuf.view(max_write - written)
+            try:
+                n = event.sock.write(data)
+            except (IOError, OSError), e:
+                if written > 0 and e.errno == errno.EAGAIN:
+                    break
+                logging.debug(
+                    '%s: _flush(): Exception %s from sock.write()', self, e)
+                return [SocketError(event.sock, e)]
+            self._wbuf.remove(n)
+            written += n
+            if n < len(data):
+                break
         if len(self._wbuf) == 0:
             self.mainloop.queue_event(self, _WriteBufferIsEmpty())
 
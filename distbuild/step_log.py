@@ -0,0 +1,119 @@
+# distbuild/step_log.py -- keep the output of build steps on the controller
+#
+# Copyright (C) 2014  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA..
+
+
+import os
+import tempfile
+
+
+class StepLog(object):
+
+    '''The output of one build step, kept in a file.
+
+    Output is added with ``write`` while the step runs, and read back
+    from any offset with ``read``, so that each initiator can be sent
+    the output at its own pace. ``size`` is how much output there is.
+
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.size = 0
+        self._file = open(filename, 'w+b')
+
+    def is_finished(self):
+        return self._file is None
+
+    def write(self, data):
+        '''Add data to the end of the log.'''
+
+        if data:
+            self._file.seek(0, os.SEEK_END)
+            self._file.write(data)
+            self.size += len(data)
+
+    def read(self, offset, max_bytes):
+        '''Return up to max_bytes of the log, starting at offset.'''
+
+        max_bytes = min(max_bytes, self.size - offset)
+        if max_bytes <= 0:
+            return ''
+        if self._file is None:
+            try:
+                with open(self.filename, 'rb') as f:
+                    f.seek(offset)
+                    return f.read(max_bytes)
+            except IOError:
+                # The log has been removed to make room for newer ones.
+                return ''
+        self._file.seek(offset)
+        return self._file.read(max_bytes)
+
+    def finish(self):
+        '''Close the log once the step has finished.
+
+        The log can still be read, but nothing more can be written.
+
+        '''
+
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class StepLogs(object):
+
+    '''Keep the output of build steps in files in a directory.
+
+    Each log is named by the artifact the step builds. The most
+    recently started ``max_files`` logs are kept, as well as the logs of
+    steps that are still running. If ``dirname`` is not given, a
+    temporary directory is used.
+
+    '''
+
+    def __init__(self, dirname=None, max_files=1000):
+        if dirname is None:
+            dirname = tempfile.mkdtemp(prefix='step-logs-')
+        elif not os.path.exists(dirname):
+            os.makedirs(dirname)
+        self.dirname = dirname
+        self.max_files = max_files
+        self._running = {}
+
+    def start(self, name):
+        '''Return a new StepLog for a step called name.'''
+
+        self._running = dict((n, log) for n, log in self._running.iteritems()
+                             if not log.is_finished())
+        log = self._running[name] = StepLog(
+            os.path.join(self.dirname, '%s.log' % name))
+        self._remove_old_files()
+        return log
+
+    def _remove_old_files(self):
+        running = set(log.filename for log in self._running.itervalues())
+        filenames = [os.path.join(self.dirname, basename)
+                     for basename in os.listdir(self.dirname)
+                     if basename.endswith('.log')]
+        filenames = [f for f in filenames if f not in running]
+        excess = len(filenames) + len(running) - self.max_files
+        if excess <= 0:
+            return
+        filenames.sort(key=lambda filename: os.stat(filename).st_mtime)
+        for filename in filenames[:excess]:
+            os.remove(filename)
@@ -0,0 +1,101 @@
+# distbuild/step_log_tests.py -- unit tests for StepLog and StepLogs
+#
+# Copyright (C) 2014  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA..
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import distbuild
+
+
+class StepLogTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.log = distbuild.StepLog(os.path.join(self.tempdir, 'step.log'))
+
+    def tearDown(self):
+        self.log.finish()
+        shutil.rmtree(self.tempdir)
+
+    def test_is_empty_initially(self):
+        self.assertEqual(self.log.size, 0)
+        self.assertEqual(self.log.read(0, 100), '')
+
+    def test_reads_what_was_written(self):
+        self.log.write('foo')
+        self.log.write('bar')
+        self.assertEqual(self.log.size, 6)
+        self.assertEqual(self.log.read(0, 100), 'foobar')
+        self.assertEqual(self.log.read(2, 3), 'oba')
+
+    def test_writes_after_reading(self):
+        self.log.write('foo')
+        self.assertEqual(self.log.read(0, 1), 'f')
+        self.log.write('bar')
+        self.assertEqual(self.log.read(1, 100), 'oobar')
+
+    def test_reads_finished_log(self):
+        self.log.write('foo')
+        self.log.finish()
+        self.assertTrue(self.log.is_finished())
+        self.assertEqual(self.log.read(1, 100), 'oo')
+
+    def test_reads_nothing_from_removed_log(self):
+        self.log.write('foo')
+        self.log.finish()
+        os.remove(self.log.filename)
+        self.assertEqual(self.log.read(0, 100), '')
+
+
+class StepLogsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.dirname = os.path.join(self.tempdir, 'logs')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_uses_temporary_directory_by_default(self):
+        logs = distbuild.StepLogs()
+        try:
+            self.assertTrue(os.path.isdir(logs.dirname))
+        finally:
+            shutil.rmtree(logs.dirname)
+
+    def test_starts_new_log(self):
+        logs = distbuild.StepLogs(self.dirname)
+        log = logs.start('step')
+        log.write('foo')
+        log.finish()
+        log = logs.start('step')
+        self.assertEqual(log.size, 0)
+        self.assertEqual(log.read(0, 100), '')
+        log.finish()
+
+    def test_removes_oldest_finished_logs(self):
+        logs = distbuild.StepLogs(self.dirname, max_files=2)
+        logs.start('1').finish()
+        os.utime(os.path.join(self.dirname, '1.log'), (0, 0))
+        running = logs.start('2')
+        os.utime(running.filename, (0, 0))
+        logs.start('3').finish()
+        self.assertEqual(sorted(os.listdir(self.dirname)),
+                         ['2.log', '3.log'])
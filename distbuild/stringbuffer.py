@@ -16,47 +16,80 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA..
 
 
+import collections
+
+
 class StringBuffer(object):
 
     '''Buffer data for a file descriptor.
     
     The data may arrive in small pieces, and it is buffered in a way that
     avoids excessive string catenation or splitting.
+
+    The pieces are kept as they were added. Data is removed from the
+    first piece by moving an offset into it rather than by slicing it,
+    and ``view`` lets data be written out without copying it, so that
+    data passing through the buffer is copied as little as possible.
     
     '''
 
+    # Pieces smaller than this are joined up with what follows them by
+    # ``view``, so that writing them out does not take a system call each.
+    min_view = 64 * 1024
+
     def __init__(self):
-        self.strings = []
+        self.strings = collections.deque()
         self.len = 0
+        # How much of the first piece has been removed already.
+        self._offset = 0
+        # How many of the first pieces are known to have no newline.
+        self._scanned = 0
         
     def add(self, data):
         '''Add data to buffer.'''
-        self.strings.append(data)
-        self.len += len(data)
+        if data:
+            self.strings.append(data)
+            self.len += len(data)
         
     def remove(self, num_bytes):
         '''Remove specified number of bytes from buffer.'''
-        while num_bytes > 0 and self.strings:
-            first = self.strings[0]
-            if len(first) <= num_bytes:
-                num_bytes -= len(first)
-                del self.strings[0]
-                self.len -= len(first)
+        num_bytes = min(num_bytes, self.len)
+        self.len -= num_bytes
+        while num_bytes > 0:
+            left = len(self.strings[0]) - self._offset
+            if left <= num_bytes:
+                num_bytes -= left
+                self._pop()
             else:
-                self.strings[0] = first[num_bytes:]
-                self.len -= num_bytes
+                self._offset += num_bytes
                 num_bytes = 0
 
+    def _pop(self):
+        self.strings.popleft()
+        self._offset = 0
+        self._scanned = max(0, self._scanned - 1)
+
+    def _pieces(self, max_bytes):
+        '''Yield the pieces holding the first max_bytes of the buffer.'''
+        offset = self._offset
+        for s in self.strings:
+            if max_bytes <= 0:
+                break
+            piece = s[offset:offset + max_bytes]
+            offset = 0
+            max_bytes -= len(piece)
+            yield piece
+
     def peek(self):
         '''Return contents of buffer as one string.'''
         
         if len(self.strings) == 0:
             return ''
-        elif len(self.strings) == 1:
-            return self.strings[0]
-        else:
-            self.strings = [''.join(self.strings)]
-            return self.strings[0]
+        elif len(self.strings) > 1 or self._offset > 0:
+            self.strings = collections.deque([''.join(self._pieces(self.len))])
+            self._offset = 0
+            self._scanned = 0
+        return self.strings[0]
 
     def read(self, max_bytes):
         '''Return up to max_bytes from the buffer.
@@ -67,36 +100,51 @@ class StringBuffer(object):
         
         '''
         
-        use = []
-        size = 0
-        for s in self.strings:
-            n = max_bytes - size
-            if len(s) <= n:
-                use.append(s)
-                size += len(s)
-            else:
-                use.append(s[:n])
-                size += n
-                break
-        return ''.join(use)
+        return ''.join(self._pieces(max_bytes))
+
+    def view(self, max_bytes):
+        '''Return up to max_bytes from the start of the buffer.
+
+        This is like ``read``, but returns a memoryview, and without
+        copying big pieces of data: if the first piece in the buffer is
+        big, only what is left of it is returned, even if the buffer
+        holds more. Small pieces are joined up with what follows them.
+        Call it again after removing what was returned to get more.
+
+        '''
+
+        if len(self.strings) == 0:
+            return memoryview('')
+        first = self.strings[0]
+        if len(first) - self._offset >= min(self.min_view, max_bytes):
+            return memoryview(first)[self._offset:self._offset + max_bytes]
+        return memoryview(self.read(max_bytes))
 
     def readline(self):
         '''Return a complete line (ends with '\n') or None.'''
 
-        for i, s in enumerate(self.strings):
-            newline = s.find('\n')
+        # Only pieces that have not been looked at already are scanned,
+        # so that a long line arriving in many pieces is scanned once.
+        for i in xrange(self._scanned, len(self.strings)):
+            s = self.strings[i]
+            newline = s.find('\n', self._offset if i == 0 else 0)
             if newline != -1:
-                if newline+1 == len(s):
-                    use = self.strings[:i+1]
-                    del self.strings[:i+1]
-                else:
-                    pre = s[:newline+1]
-                    use = self.strings[:i] + [pre]
-                    del self.strings[:i]
-                    self.strings[0] = s[newline+1:]
-                return ''.join(use)
-        return None
+                break
+            self._scanned = i + 1
+        else:
+            return None
+
+        pieces = []
+        for j in xrange(i):
+            pieces.append(self.strings[0][self._offset:])
+            self._pop()
+        pieces.append(s[self._offset:newline + 1])
+        self._offset = newline + 1
+        if self._offset == len(s):
+            self._pop()
+        line = ''.join(pieces)
+        self.len -= len(line)
+        return line
             
     def __len__(self):
         return self.len
-
@@ -150,3 +150,48 @@ class StringBufferReadlineTests(unittest.TestCase):
         self.assertEqual(self.buf.readline(), 'foo\n')
         self.assertEqual(self.buf.peek(), 'bar')
 
+
+    def test_extracts_line_spread_over_many_pieces(self):
+        self.buf.add('foo')
+        self.assertEqual(self.buf.readline(), None)
+        self.buf.add('bar')
+        self.assertEqual(self.buf.readline(), None)
+        self.buf.add('\nbaz')
+        self.assertEqual(self.buf.readline(), 'foobar\n')
+        self.assertEqual(self.buf.peek(), 'baz')
+        self.assertEqual(len(self.buf), 3)
+
+    def test_extracts_lines_after_removing_part_of_buffer(self):
+        self.buf.add('foo')
+        self.assertEqual(self.buf.readline(), None)
+        self.buf.add('\nbar')
+        self.buf.remove(4)
+        self.assertEqual(self.buf.readline(), None)
+        self.buf.add('\n')
+        self.assertEqual(self.buf.readline(), 'bar\n')
+        self.assertEqual(len(self.buf), 0)
+
+
+class StringBufferViewTests(unittest.TestCase):
+
+    def setUp(self):
+        self.buf = distbuild.StringBuffer()
+        self.buf.min_view = 4
+
+    def test_returns_empty_string_for_empty_buffer(self):
+        self.assertEqual(self.buf.view(100).tobytes(), '')
+
+    def test_returns_rest_of_big_first_piece(self):
+        self.buf.add('foobar')
+        self.buf.add('baz')
+        self.buf.remove(1)
+        self.assertEqual(self.buf.view(100).tobytes(), 'oobar')
+        self.assertEqual(self.buf.view(2).tobytes(), 'oo')
+        self.assertEqual(self.buf.peek(), 'oobarbaz')
+
+    def test_joins_small_pieces(self):
+        self.buf.add('a')
+        self.buf.add('b')
+        self.buf.add('cdefgh')
+        self.assertEqual(self.buf.view(100).tobytes(), 'abcdefgh')
+        self.assertEqual(self.buf.view(3).tobytes(), 'abc')
@@ -20,12 +20,26 @@ import collections
 import httplib
 import logging
 import socket
+import time
 import urllib
 import urlparse
 
+import morphlib
 import distbuild
 
 
+# Upper bounds, in seconds, of the buckets of the histograms of how long
+# jobs wait and run for, and of how long their artifacts take to cache.
+_job_buckets = (1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200)
+_caching_buckets = (0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300)
+
+
+def _observe_job_time(name, help, job, seconds):
+    distbuild.default_metrics.histogram(
+        name, help, _job_buckets, labels=('kind',)).observe(
+            seconds, kind=job.artifact.source.morphology['kind'])
+
+
 class WorkerBuildRequest(object):
 
     def __init__(self, artifact, initiator_id):
@@ -39,17 +53,19 @@ class WorkerCancelPending(object):
 
 class WorkerBuildStepStarted(object):
 
-    def __init__(self, initiators, cache_key, worker_name):
+    def __init__(self, initiators, cache_key, worker_name, log=None):
         self.initiators = initiators
         self.artifact_cache_key = cache_key
         self.worker_name = worker_name
+        self.log = log
 
 class WorkerBuildStepAlreadyStarted(object):
 
-    def __init__(self, initiator_id, cache_key, worker_name):
+    def __init__(self, initiator_id, cache_key, worker_name, log=None):
         self.initiator_id = initiator_id
         self.artifact_cache_key = cache_key
         self.worker_name = worker_name
+        self.log = log
 
 class WorkerBuildWaiting(object):
 
@@ -59,9 +75,12 @@ class WorkerBuildWaiting(object):
 
 class WorkerBuildOutput(object):
 
-    def __init__(self, msg, cache_key):
-        self.msg = msg
+    '''There is new output in the StepLog of a running job.'''
+
+    def __init__(self, initiators, cache_key, log):
+        self.initiators = initiators
         self.artifact_cache_key = cache_key
+        self.log = log
 
 class WorkerBuildCaching(object):
 
@@ -82,17 +101,105 @@ class WorkerBuildFailed(object):
         self.artifact_cache_key = cache_key
 
 
+class WorkerCapacity(object):
+
+    '''How many jobs a worker can run at a time, and what they can use.
+
+    ``slots`` is the most jobs the worker runs at once. The jobs share
+    its ``cores`` CPU cores and ``memory`` bytes of memory. Either may
+    be 0 if it is not known, and is then not taken into account.
+
+    '''
+
+    def __init__(self, slots=1, cores=0, memory=0):
+        self.slots = max(1, slots)
+        self.cores = max(0, cores)
+        self.memory = max(0, memory)
+
+    def default_cores(self):
+        '''Return the cores a job may use if its morphology does not say.'''
+        return max(1, self.cores // self.slots)
+
+    def job_cores(self, job):
+        '''Return how many cores job will use on this worker.'''
+        cores = (job.artifact.source.morphology.get('max-jobs') or
+                 self.default_cores())
+        if self.cores:
+            cores = min(cores, self.cores)
+        return cores
+
+    def spare_cores_with(self, running, job, elsewhere=()):
+        '''Return how many cores would be spare with job running too.
+
+        ``running`` is the list of jobs the worker is already running.
+        ``elsewhere`` is a list of the cores and memory used by jobs
+        other controllers have given the worker. If the worker does not
+        know how many cores it has, the number of spare slots is
+        returned instead. Return None if the job does not fit on the
+        worker at the moment.
+
+        A job always fits on a worker that is not running anything else,
+        however much it needs, since otherwise it would never be run.
+
+        '''
+
+        busy = len(running) + len(elsewhere)
+        if busy >= self.slots:
+            return None
+        jobs = running + [job]
+        cores = (sum(self.job_cores(j) for j in jobs) +
+                 sum(c for c, m in elsewhere))
+        memory = sum(j.memory for j in jobs) + sum(m for c, m in elsewhere)
+        if busy:
+            if self.cores and cores > self.cores:
+                return None
+            if self.memory and memory > self.memory:
+                return None
+        if self.cores:
+            return self.cores - cores
+        return self.slots - busy - 1
+
+
 class _NeedJob(object):
 
+    '''A worker can take on more jobs.
+
+    ``last_job`` is the job the worker has just finished with, if any.
+
+    '''
+
+    def __init__(self, who, last_job=None):
+        self.who = who
+        self.last_job = last_job
+
+
+class _WorkerGone(object):
+
     def __init__(self, who):
         self.who = who
-        
+
 
 class _HaveAJob(object):
 
     def __init__(self, job):
         self.job = job
 
+
+class _AdoptJob(object):
+
+    '''Carry on with a job a worker was running before a restart.'''
+
+    def __init__(self, job):
+        self.job = job
+
+
+class _AdoptionFailed(object):
+
+    '''The worker was no longer running the job, so it must be built.'''
+
+    def __init__(self, job):
+        self.job = job
+
 class Job(object):
 
     def __init__(self, job_id, artifact, initiator_id):
@@ -102,20 +209,29 @@ class Job(object):
         self.who = None  # we don't know who's going to do this yet
         self.running = False
         self.failed = False
+        self.memory = 0  # how much memory we expect the build to need
+        self.max_rss = None  # how much memory it did need, once built
+        self.log = None  # the StepLog of its output, once it has started
+        self.created = time.time()
+        self.started = None  # when it was started on a worker
+        self.built = False  # whether it has been built and cached
+        self.elsewhere = False  # whether another controller is doing it
+        self.elsewhere_worker = None  # the worker it is running on, if so
 
 
 class Jobs(object):
 
     def __init__(self, idgen):
         self._idgen = idgen
-        self._jobs = {}
+        # Jobs are given to workers in the order they were created.
+        self._jobs = collections.OrderedDict()
 
     def get(self, artifact_basename):
         return (self._jobs[artifact_basename]
             if artifact_basename in self._jobs else None)
 
-    def create(self, artifact, initiator_id):
-        job = Job(self._idgen.next(), artifact, initiator_id)
+    def create(self, artifact, initiator_id, job_id=None):
+        job = Job(job_id or self._idgen.next(), artifact, initiator_id)
         self._jobs[job.artifact.basename()] = job
         return job
 
@@ -136,38 +252,18 @@ class Jobs(object):
     def exists(self, artifact_basename):
         return artifact_basename in self._jobs
 
-    def get_next_job(self):
-        # for now just return the first thing we find that's not being built
-        waiting = [job for (_, job) in
-            self._jobs.iteritems() if job.who == None]
+    def get_waiting_jobs(self):
+        return [job for job in self._jobs.itervalues()
+                if job.who is None and not job.elsewhere]
 
-        return waiting.pop() if len(waiting) > 0 else None
+    def get_jobs_elsewhere(self):
+        return [job for job in self._jobs.itervalues() if job.elsewhere]
 
     def __repr__(self):
         return str([job.artifact.basename()
             for (_, job) in self._jobs.iteritems()])
 
 
-class _BuildFinished(object):
-
-    pass
-
-
-class _BuildFailed(object):
-
-    pass
-
-
-class _BuildCancelled(object):
-
-    pass
-
-        
-class _Cached(object):
-
-    pass
-
-
 class _JobStarted(object):
 
     def __init__(self, job):
@@ -193,19 +289,59 @@ class WorkerBuildQueuer(distbuild.StateMachine):
     into a queue. It also catches _NeedJob events, from a
     WorkerConnection, and responds to them with _HaveAJob events,
     when it has an outstanding request.
+
+    A worker may run several jobs at once, as long as it has the slots,
+    cores and memory for them. The cores a job uses are given by the
+    max-jobs of its morphology, and the memory it needs is what it used
+    the last time it was built, from ``resource_history``. Each job is
+    given to the worker it fits best: the one with the fewest cores to
+    spare once the job is running, so that big workers are kept free for
+    big jobs. A job that does not fit anywhere waits for other jobs to
+    finish.
+
+    If the controller has restarted, a job that ``journal`` says was
+    running on a worker before is adopted from that worker, if it is
+    connected, rather than started again.
+
+    Several controllers may share workers, and a ``job_table``. A job
+    is then only made for an artifact that no other controller is
+    building already. The artifacts other controllers are building are
+    looked up in the table every ``poll_interval`` seconds, to tell the
+    initiators waiting for them how they are getting on, and the jobs
+    other controllers are running on each worker are taken into account
+    when giving jobs to it. The output of those jobs is not sent to the
+    initiators, since it is kept by the controller running them.
     
     '''
+
+    poll_interval = 2
     
-    def __init__(self):
+    def __init__(self, resource_history=None, journal=None, job_table=None):
         distbuild.StateMachine.__init__(self, 'idle')
+        if resource_history is None:
+            resource_history = distbuild.ResourceHistory()
+        self._history = resource_history
+        self._journal = journal
+        self._job_table = job_table
 
     def setup(self):
         distbuild.crash_point()
 
         logging.debug('WBQ: Setting up %s' % self)
-        self._available_workers = []
-        self._jobs = Jobs(
-            distbuild.IdentifierGenerator('WorkerBuildQueuerJob'))
+        self._workers = []
+        self._elsewhere = {}
+        series = 'WorkerBuildQueuerJob'
+        if self._job_table is not None:
+            # Workers get jobs from the other controllers too, and job
+            # ids must not be the same as theirs.
+            series = '%s-%s' % (series, self._job_table.name)
+        idgen = distbuild.IdentifierGenerator(series)
+        if self._journal is not None:
+            # Workers may still be running jobs from before a restart.
+            for identifier in self._journal.identifiers():
+                idgen.skip_past(identifier)
+        self._jobs = Jobs(idgen)
+        distbuild.default_metrics.add_collector(self._collect_metrics)
         
         spec = [
             # state, source, event_class, new_state, callback
@@ -215,21 +351,39 @@ class WorkerBuildQueuer(distbuild.StateMachine):
                 self._handle_cancel),
 
             ('idle', WorkerConnection, _NeedJob, 'idle', self._handle_worker),
+            ('idle', WorkerConnection, _WorkerGone, 'idle',
+                self._handle_worker_gone),
             ('idle', WorkerConnection, _JobStarted, 'idle',
                 self._set_job_started),
             ('idle', WorkerConnection, _JobFinished, 'idle',
                 self._set_job_finished),
             ('idle', WorkerConnection, _JobFailed, 'idle',
-                self._set_job_failed)
+                self._set_job_failed),
+            ('idle', WorkerConnection, _AdoptionFailed, 'idle',
+                self._handle_adoption_failed),
         ]
         self.add_transitions(spec)
 
+        if self._job_table is not None:
+            self._job_table.heartbeat()
+            self._timer = distbuild.TimerEventSource(self.poll_interval)
+            self.mainloop.add_event_source(self._timer)
+            self._timer.start()
+            self.add_transition(
+                'idle', self._timer, distbuild.Timer, 'idle',
+                self._poll_job_table)
+
     def _set_job_started(self, event_source, event):
         logging.debug('Setting job state for job %s with id %s: '
                       'Job is running',
                       event.job.artifact.basename(), event.job.id)
 
         event.job.running = True
+        if self._job_table is not None:
+            who = event.job.who
+            self._job_table.start(
+                event.job.artifact.basename(), who.name(),
+                who.capacity().job_cores(event.job), event.job.memory)
 
     def _set_job_finished(self, event_source, event):
         logging.debug('Setting job state for job %s with id %s: '
@@ -246,9 +400,9 @@ class WorkerBuildQueuer(distbuild.StateMachine):
     def _handle_request(self, event_source, event):
         distbuild.crash_point()
 
-        logging.debug('Handling build request for %s' % event.initiator_id)
-        logging.debug('Current jobs: %s' % self._jobs)
-        logging.debug('Workers available: %d' % len(self._available_workers))
+        logging.debug('Handling build request for %s', event.initiator_id)
+        logging.debug('Current jobs: %s', self._jobs)
+        logging.debug('Workers available: %d', len(self._workers))
 
         # Have we already made a job for this thing?
         # If so, add our initiator id to the existing job
@@ -262,7 +416,13 @@ class WorkerBuildQueuer(distbuild.StateMachine):
                 logging.debug('Worker build step already started: %s' %
                     event.artifact.basename())
                 progress = WorkerBuildStepAlreadyStarted(event.initiator_id,
-                    event.artifact.source.cache_key, job.who.name())
+                    event.artifact.source.cache_key, job.who.name(), job.log)
+            elif job.elsewhere_worker is not None:
+                logging.debug('Worker build step already started by another '
+                    'controller: %s' % event.artifact.basename())
+                progress = WorkerBuildStepAlreadyStarted(event.initiator_id,
+                    event.artifact.source.cache_key, job.elsewhere_worker,
+                    None)
             else:
                 logging.debug('Job created but not building yet '
                     '(waiting for a worker to become available): %s' %
@@ -273,14 +433,75 @@ class WorkerBuildQueuer(distbuild.StateMachine):
             self.mainloop.queue_event(WorkerConnection, progress)
         else:
             logging.debug('WBQ: Creating job for: %s' % event.artifact.name)
-            job = self._jobs.create(event.artifact, event.initiator_id)
-
-            if self._available_workers:
-                self._give_job(job)
+            adoptable = self._find_adoptable_job(event.artifact)
+            if adoptable is None:
+                job = self._jobs.create(event.artifact, event.initiator_id)
             else:
+                job_id, who = adoptable
+                job = self._jobs.create(
+                    event.artifact, event.initiator_id, job_id)
+            job.memory = self._history.memory(event.artifact.source.name)
+
+            if adoptable is not None:
+                logging.info('WBQ: Adopting %s, still running on %s',
+                             event.artifact.name, who.name())
+                job.who = who
+                self.mainloop.queue_event(who, _AdoptJob(job))
+            elif not self._claim(job):
+                logging.info('WBQ: %s is being built by another controller',
+                             event.artifact.name)
                 progress = WorkerBuildWaiting(event.initiator_id,
                     event.artifact.source.cache_key)
                 self.mainloop.queue_event(WorkerConnection, progress)
+            elif not self._give_job(job, self._running_jobs()):
+                progress = WorkerBuildWaiting(event.initiator_id,
+                    event.artifact.source.cache_key)
+                self.mainloop.queue_event(WorkerConnection, progress)
+
+    def _claim(self, job):
+        '''Return whether this controller should build job.'''
+
+        if (self._job_table is None or
+                self._job_table.claim(job.artifact.basename())):
+            return True
+        job.elsewhere = True
+        return False
+
+    def _find_adoptable_job(self, artifact):
+        '''Return the id and worker of a job running since a restart.'''
+
+        if self._journal is None:
+            return None
+        adoptable = self._journal.adopt_job(artifact.basename())
+        if adoptable is None:
+            return None
+        job_id, worker_name = adoptable
+        for who in self._workers:
+            if who.name() == worker_name:
+                # It was ours before the restart, but another controller
+                # may have taken it over while this one was gone.
+                if (self._job_table is None or
+                        self._job_table.claim(artifact.basename())):
+                    return job_id, who
+                logging.info('WBQ: Not adopting %s, since another '
+                             'controller has taken it over', artifact.name)
+                break
+        else:
+            logging.info('WBQ: Not adopting %s, since %s is not connected',
+                         artifact.name, worker_name)
+        self._journal.finish_job(job_id)
+        return None
+
+    def _handle_adoption_failed(self, event_source, event):
+        job = event.job
+        job.who = None
+        if self._jobs.get(job.artifact.basename()) is not job:
+            return  # it has been cancelled
+        if not self._give_job(job, self._running_jobs()):
+            for initiator_id in job.initiators:
+                progress = WorkerBuildWaiting(initiator_id,
+                    job.artifact.source.cache_key)
+                self.mainloop.queue_event(WorkerConnection, progress)
 
     def _handle_cancel(self, event_source, event):
 
@@ -315,15 +536,19 @@ class WorkerBuildQueuer(distbuild.StateMachine):
 
             return False
 
-        self._jobs.remove_jobs(
-            [job for (_, job) in self._jobs.get_jobs().iteritems()
-                if cancel_this(job)])
+        cancelled = [job for (_, job) in self._jobs.get_jobs().iteritems()
+                     if cancel_this(job)]
+        self._jobs.remove_jobs(cancelled)
+        if self._job_table is not None:
+            for job in cancelled:
+                if not job.elsewhere:
+                    self._job_table.release(job.artifact.basename())
 
     def _handle_worker(self, event_source, event):
         distbuild.crash_point()
 
         who = event.who
-        last_job = who.job()  # the job this worker's just completed
+        last_job = event.last_job  # the job this worker's just completed
 
         if last_job:
             logging.debug('%s wants new job, just did %s',
@@ -332,49 +557,197 @@ class WorkerBuildQueuer(distbuild.StateMachine):
             logging.debug('Removing job %s with job id %s',
                           last_job.artifact.basename(), last_job.id)
             self._jobs.remove(last_job)
-        else:
+            if self._job_table is not None:
+                if last_job.built or last_job.failed:
+                    self._job_table.finish(
+                        last_job.artifact.basename(), last_job.built)
+                else:
+                    self._job_table.release(last_job.artifact.basename())
+
+            if last_job.max_rss is not None:
+                self._history.record(last_job.artifact.source.name,
+                                     last_job.max_rss)
+        elif who not in self._workers:
             logging.debug('%s wants its first job', who.name())
 
-        logging.debug('WBQ: Adding worker to queue: %s', event.who.name())
-        self._available_workers.append(event)
+        if who not in self._workers:
+            logging.debug('WBQ: Adding worker to queue: %s', who.name())
+            self._workers.append(who)
 
         logging.debug('Current jobs: %s', self._jobs)
-        logging.debug('Workers available: %d', len(self._available_workers))
-
-        job = self._jobs.get_next_job()
+        logging.debug('Workers available: %d', len(self._workers))
+
+        self._give_waiting_jobs()
+
+    def _give_waiting_jobs(self):
+        running = self._running_jobs()
+        for job in self._jobs.get_waiting_jobs():
+            if not any(len(running[w]) +
+                           len(self._elsewhere.get(w.name(), [])) <
+                           w.capacity().slots
+                       for w in self._workers):
+                break
+            self._give_job(job, running)
+
+    def _handle_worker_gone(self, event_source, event):
+        logging.debug('WBQ: Removing worker from queue: %s',
+                      event.who.name())
+        if event.who in self._workers:
+            self._workers.remove(event.who)
+
+    def _poll_job_table(self, event_source, event):
+        self._job_table.heartbeat()
+        self._elsewhere = self._job_table.running_elsewhere()
+        for job in self._jobs.get_jobs_elsewhere():
+            self._check_elsewhere(job)
+        # Workers may have room now that other controllers' jobs are done.
+        self._give_waiting_jobs()
+
+    def _check_elsewhere(self, job):
+        '''See how another controller is getting on with job.'''
+
+        basename = job.artifact.basename()
+        cache_key = job.artifact.source.cache_key
+        record = self._job_table.get(basename)
+
+        if record is None or record['controller'] == self._job_table.name:
+            # Nobody is building it any more, so it is built here.
+            if self._job_table.claim(basename):
+                logging.info('WBQ: Taking over %s from another controller',
+                             job.artifact.name)
+                job.elsewhere = False
+                job.elsewhere_worker = None
+        elif record['state'] in self._job_table.finished_states:
+            logging.info('WBQ: %s %s for %s', job.artifact.name,
+                         record['state'], record['controller'])
+            self._jobs.remove(job)
+            msg = {'ids': job.initiators, 'controller': record['controller']}
+            if record['state'] == 'built':
+                result = WorkerBuildFinished(msg, cache_key)
+            else:
+                result = WorkerBuildFailed(msg, cache_key)
+            self.mainloop.queue_event(WorkerConnection, result)
+        elif (record['state'] == 'running' and
+                record['worker'] != job.elsewhere_worker):
+            job.elsewhere_worker = record['worker']
+            started = WorkerBuildStepStarted(
+                job.initiators, cache_key, job.elsewhere_worker, None)
+            self.mainloop.queue_event(WorkerConnection, started)
+
+    def _collect_metrics(self):
+        metrics = distbuild.default_metrics
+        jobs = metrics.gauge(
+            'distbuild_jobs', 'Jobs waiting for a worker or running',
+            labels=('state',))
+        waiting = len(self._jobs.get_waiting_jobs())
+        elsewhere = len(self._jobs.get_jobs_elsewhere())
+        jobs.set(waiting, state='waiting')
+        jobs.set(len(self._jobs.get_jobs()) - waiting - elsewhere,
+                 state='running')
+        if self._job_table is not None:
+            jobs.set(elsewhere, state='elsewhere')
+        metrics.gauge(
+            'distbuild_workers', 'Workers connected').set(len(self._workers))
+
+        per_worker = [
+            metrics.gauge(name, help, labels=('worker',))
+            for name, help in [
+                ('distbuild_worker_jobs', 'Jobs given to a worker'),
+                ('distbuild_worker_slots', 'Most jobs a worker runs at once'),
+                ('distbuild_worker_cores', 'CPU cores of a worker'),
+                ('distbuild_worker_cores_used',
+                    'CPU cores used by the jobs given to a worker'),
+            ]]
+        for gauge in per_worker:
+            gauge.clear()
+        worker_jobs, slots, cores, cores_used = per_worker
+        for who, running in self._running_jobs().iteritems():
+            capacity = who.capacity()
+            worker_jobs.set(len(running), worker=who.name())
+            slots.set(capacity.slots, worker=who.name())
+            cores.set(capacity.cores, worker=who.name())
+            cores_used.set(sum(capacity.job_cores(job) for job in running),
+                           worker=who.name())
+
+    def _running_jobs(self):
+        '''Return a dict of the jobs given to each worker.'''
+
+        running = dict((who, []) for who in self._workers)
+        for job in self._jobs.get_jobs().itervalues():
+            if job.who in running:
+                running[job.who].append(job)
+        return running
+
+    def _give_job(self, job, running):
+        '''Give job to the worker it fits best, if it fits on any.
+
+        ``running`` is the dict from _running_jobs, which is updated if
+        the job is given to a worker.
+
+        '''
+
+        best = None
+        best_spare = None
+        for who in self._workers:
+            spare = who.capacity().spare_cores_with(
+                running[who], job, self._elsewhere.get(who.name(), []))
+            if spare is not None and (best is None or spare < best_spare):
+                best = who
+                best_spare = spare
+
+        if best is None:
+            return False
 
-        if job:
-            self._give_job(job)
-            
-    def _give_job(self, job):
-        worker = self._available_workers.pop(0)
-        job.who = worker.who
+        job.who = best
+        running[best].append(job)
+        _observe_job_time(
+            'distbuild_job_wait_seconds',
+            'Time jobs waited for a worker', job, time.time() - job.created)
 
         logging.debug(
             'WBQ: Giving %s to %s' %
-                (job.artifact.name, worker.who.name()))
+                (job.artifact.name, best.name()))
 
-        self.mainloop.queue_event(worker.who, _HaveAJob(job))
+        self.mainloop.queue_event(best, _HaveAJob(job))
+        return True
     
     
 class WorkerConnection(distbuild.StateMachine):
 
-    '''Communicate with a single worker.'''
+    '''Communicate with a single worker.
+
+    The worker may run several jobs at once. It says how many, and what
+    resources they share, in a worker-capacity message when we connect.
+    Older workers do not, and run one job at a time.
+
+    The output of each job is kept in a StepLog from ``step_logs``, for
+    InitiatorConnection to send on to initiators as they can take it.
+
+    Jobs are recorded in ``journal``, if given, while they run, so that
+    they can be adopted from the worker if the controller restarts.
+
+    '''
     
     _request_ids = distbuild.IdentifierGenerator('WorkerConnection')
-    _initiator_request_map = collections.defaultdict(set)
 
     def __init__(self, cm, conn, writeable_cache_server, 
-                 worker_cache_server_port, morph_instance):
+                 worker_cache_server_port, morph_instance, step_logs=None,
+                 journal=None):
         distbuild.StateMachine.__init__(self, 'idle')
         self._cm = cm
         self._conn = conn
         self._writeable_cache_server = writeable_cache_server
         self._worker_cache_server_port = worker_cache_server_port
         self._morph_instance = morph_instance
-        self._helper_id = None
-        self._job = None
-        self._exec_response_msg = None
+        if step_logs is None:
+            step_logs = distbuild.StepLogs()
+        self._step_logs = step_logs
+        self._journal = journal
+        self._capacity = WorkerCapacity()
+        self._jobs = {}
+        self._helper_requests = {}
+        self._caching_started = {}
+        self._exec_response_msgs = {}
         self._debug_json = False
 
         addr, port = self._conn.getpeername()
@@ -384,8 +757,8 @@ class WorkerConnection(distbuild.StateMachine):
     def name(self):
         return self._worker_name
 
-    def job(self):
-        return self._job
+    def capacity(self):
+        return self._capacity
 
     def setup(self):
         distbuild.crash_point()
@@ -398,83 +771,83 @@ class WorkerConnection(distbuild.StateMachine):
         spec = [
             # state, source, event_class, new_state, callback
             ('idle', self._jm, distbuild.JsonEof, None,  self._reconnect),
-            ('idle', self, _HaveAJob, 'building', self._start_build),
-            
-            ('building', distbuild.BuildController,
-                distbuild.BuildCancel, 'building',
-                self._maybe_cancel),
-
-            ('building', self._jm, distbuild.JsonEof, None, self._reconnect),
-            ('building', self._jm, distbuild.JsonNewMessage, 'building',
+            ('idle', self._jm, distbuild.JsonNewMessage, 'idle',
                 self._handle_json_message),
-            ('building', self, _BuildFailed, 'idle', self._request_job),
-            ('building', self, _BuildCancelled, 'idle', self._request_job),
-            ('building', self, _BuildFinished, 'caching',
-                self._request_caching),
-
-            ('caching', distbuild.HelperRouter, distbuild.HelperResult,
-                'caching', self._maybe_handle_helper_result),
-            ('caching', self, _Cached, 'idle', self._request_job),
-            ('caching', self, _BuildFailed, 'idle', self._request_job),
+            ('idle', self, _HaveAJob, 'idle', self._start_build),
+            ('idle', self, _AdoptJob, 'idle', self._adopt_build),
+            ('idle', distbuild.BuildController, distbuild.BuildCancel,
+                'idle', self._maybe_cancel),
+            ('idle', distbuild.HelperRouter, distbuild.HelperResult,
+                'idle', self._maybe_handle_helper_result),
         ]
         self.add_transitions(spec)
         
-        self._request_job(None, None)
+        self._request_job(None)
 
     def _maybe_cancel(self, event_source, build_cancel):
+        # Jobs that have been built are left to be cached.
+        for job in self._jobs.values():
+            if (build_cancel.id in job.initiators and
+                    job.id not in self._exec_response_msgs):
+                self._cancel(event_source, build_cancel, job)
 
-        if build_cancel.id not in self._job.initiators:
-            return  # event not relevant
-
+    def _cancel(self, event_source, build_cancel, job):
         logging.debug('WC: BuildController %r requested a cancel',
                       event_source)
 
-        if (len(self._job.initiators) == 1):
+        if (len(job.initiators) == 1):
             logging.debug('WC: Cancelling running job %s '
                           'with job id %s running on %s',
-                           self._job.artifact.basename(),
-                           self._job.id,
+                           job.artifact.basename(),
+                           job.id,
                            self.name())
 
-            msg = distbuild.message('exec-cancel', id=self._job.id)
+            msg = distbuild.message('exec-cancel', id=job.id)
             self._jm.send(msg)
-            self.mainloop.queue_event(self, _BuildCancelled())
+            self._finish_job(job)
         else:
             logging.debug('WC: Not cancelling running job %s with job id %s, '
                           'other initiators want it done: %s',
-                          self._job.artifact.basename(),
-                          self._job.id,
-                          [i for i in self._job.initiators
+                          job.artifact.basename(),
+                          job.id,
+                          [i for i in job.initiators
                             if i != build_cancel.id])
 
-        self._job.initiators.remove(build_cancel.id)
+        job.initiators.remove(build_cancel.id)
 
     def _reconnect(self, event_source, event):
         distbuild.crash_point()
 
         logging.debug('WC: Triggering reconnect')
+        self.mainloop.queue_event(WorkerConnection, _WorkerGone(self))
         self.mainloop.queue_event(self._cm, distbuild.Reconnect())
 
     def _start_build(self, event_source, event):
         distbuild.crash_point()
 
-        self._job = event.job
-        self._helper_id = None
-        self._exec_response_msg = None
+        job = event.job
+        self._jobs[job.id] = job
 
         logging.debug('WC: starting build: %s for %s' %
-                      (self._job.artifact.name, self._job.initiators))
+                      (job.artifact.name, job.initiators))
 
         argv = [
             self._morph_instance,
             'worker-build',
             '--build-log-on-stdout',
-            self._job.artifact.name,
         ]
+        if self._capacity.cores:
+            # Jobs that do not set max-jobs share the cores of the
+            # worker, with as many jobs each as Morph would use for that
+            # many cores, rather than each using all of them.
+            argv.append('--max-jobs=%d' % morphlib.util.make_concurrency(
+                self._capacity.default_cores()))
+        argv.append(job.artifact.name)
+
         msg = distbuild.message('exec-request',
-            id=self._job.id,
+            id=job.id,
             argv=argv,
-            stdin_contents=distbuild.serialise_artifact(self._job.artifact),
+            stdin_contents=distbuild.serialise_job(job.artifact),
         )
         self._jm.send(msg)
 
@@ -482,10 +855,26 @@ class WorkerConnection(distbuild.StateMachine):
             logging.debug('WC: sent to worker %s: %r'
                 % (self._worker_name, msg))
 
-        started = WorkerBuildStepStarted(self._job.initiators,
-            self._job.artifact.source.cache_key, self.name())
+        self._job_started(job)
+
+    def _adopt_build(self, event_source, event):
+        job = event.job
+        self._jobs[job.id] = job
+        logging.debug('WC: adopting build: %s for %s',
+                      job.artifact.name, job.initiators)
+        self._jm.send(distbuild.message('exec-adopt', id=job.id))
+
+    def _job_started(self, job):
+        job.log = self._step_logs.start(job.artifact.basename())
+        job.started = time.time()
+        if self._journal is not None:
+            self._journal.start_job(
+                job.id, job.artifact.basename(), self.name())
+
+        started = WorkerBuildStepStarted(job.initiators,
+            job.artifact.source.cache_key, self.name(), job.log)
 
-        self.mainloop.queue_event(WorkerConnection, _JobStarted(self._job))
+        self.mainloop.queue_event(WorkerConnection, _JobStarted(job))
         self.mainloop.queue_event(WorkerConnection, started)
 
     def _handle_json_message(self, event_source, event):
@@ -493,50 +882,106 @@ class WorkerConnection(distbuild.StateMachine):
 
         distbuild.crash_point()
 
-        logging.debug(
-            'WC: from worker %s: %r' % (self._worker_name, event.msg))
+        if event.msg['type'] == 'exec-output':
+            # Build output is too much to log.
+            logging.debug('WC: from worker %s: output for %s',
+                          self._worker_name, event.msg['id'])
+        else:
+            logging.debug(
+                'WC: from worker %s: %r', self._worker_name, event.msg)
+
+        if event.msg['type'] == 'worker-capacity':
+            self._handle_worker_capacity(event.msg)
+            return
 
         handlers = {
+            'exec-adopted': self._handle_exec_adopted,
             'exec-output': self._handle_exec_output,
             'exec-response': self._handle_exec_response,
         }
-        
-        handler = handlers[event.msg['type']]
-        handler(event.msg)
 
-    def _handle_exec_output(self, msg):
-        new = dict(msg)
-        new['ids'] = self._job.initiators
-        logging.debug('WC: emitting: %s', repr(new))
+        job = self._jobs.get(event.msg['id'])
+        if job is None:
+            # Output from a job we have cancelled.
+            logging.debug('WC: ignoring message for job %s',
+                          event.msg['id'])
+            return
+
+        handler = handlers[event.msg['type']]
+        handler(event.msg, job)
+
+    def _handle_worker_capacity(self, msg):
+        self._capacity = WorkerCapacity(
+            msg.get('slots', 1), msg.get('cores', 0), msg.get('memory', 0))
+        logging.info('WC: %s can run %d jobs, with %d cores and %d bytes '
+                     'of memory', self.name(), self._capacity.slots,
+                     self._capacity.cores, self._capacity.memory)
+        # It may have room for more jobs now.
+        self._request_job(None)
+
+    def _handle_exec_adopted(self, msg, job):
+        if msg['running']:
+            logging.info('WC: %s is still building %s',
+                         self.name(), job.artifact.name)
+            self._job_started(job)
+        else:
+            logging.info('WC: %s is no longer building %s',
+                         self.name(), job.artifact.name)
+            del self._jobs[job.id]
+            if self._journal is not None:
+                self._journal.finish_job(job.id)
+            self.mainloop.queue_event(WorkerConnection, _AdoptionFailed(job))
+
+    def _handle_exec_output(self, msg, job):
+        job.log.write(msg['stdout'])
+        job.log.write(msg['stderr'])
         self.mainloop.queue_event(
             WorkerConnection,
-            WorkerBuildOutput(new, self._job.artifact.source.cache_key))
+            WorkerBuildOutput(job.initiators, job.artifact.source.cache_key,
+                              job.log))
 
-    def _handle_exec_response(self, msg):
-        logging.debug('WC: finished building: %s' % self._job.artifact.name)
+    def _handle_exec_response(self, msg, job):
+        logging.debug('WC: finished building: %s' % job.artifact.name)
         logging.debug('initiators that need to know: %s'
-            % self._job.initiators)
+            % job.initiators)
 
         new = dict(msg)
-        new['ids'] = self._job.initiators
+        new['ids'] = job.initiators
+        job.max_rss = msg.get('max_rss')
+        job.log.finish()
+        _observe_job_time(
+            'distbuild_job_run_seconds',
+            'Time jobs took to run on a worker', job,
+            time.time() - job.started)
 
         if new['exit'] != 0:
             # Build failed.
             new_event = WorkerBuildFailed(new,
-                                          self._job.artifact.source.cache_key)
+                                          job.artifact.source.cache_key)
             self.mainloop.queue_event(WorkerConnection, new_event)
-            self.mainloop.queue_event(WorkerConnection, _JobFailed(self._job))
-            self.mainloop.queue_event(self, _BuildFailed())
+            self.mainloop.queue_event(WorkerConnection, _JobFailed(job))
+            self._finish_job(job)
         else:
             # Build succeeded. We have more work to do: caching the result.
-            self.mainloop.queue_event(self, _BuildFinished())
-            self._exec_response_msg = new
+            self._exec_response_msgs[job.id] = new
+            self._request_caching(job)
 
-    def _request_job(self, event_source, event):
+    def _request_job(self, job):
         distbuild.crash_point()
-        self.mainloop.queue_event(WorkerConnection, _NeedJob(self))
+        self.mainloop.queue_event(WorkerConnection, _NeedJob(self, job))
 
-    def _request_caching(self, event_source, event):
+    def _finish_job(self, job):
+        '''Forget about job, and ask for another in its place.'''
+
+        del self._jobs[job.id]
+        self._exec_response_msgs.pop(job.id, None)
+        if job.log is not None:
+            job.log.finish()
+        if self._journal is not None:
+            self._journal.finish_job(job.id)
+        self._request_job(job)
+
+    def _request_caching(self, job):
         # This code should be moved into the morphlib.remoteartifactcache
         # module. It would be good to share it with morphlib.buildcommand,
         # which also wants to fetch artifacts from a remote cache.
@@ -544,15 +989,15 @@ class WorkerConnection(distbuild.StateMachine):
 
         logging.debug('Requesting shared artifact cache to get artifacts')
 
-        kind = self._job.artifact.source.morphology['kind']
+        kind = job.artifact.source.morphology['kind']
 
         if kind == 'chunk':
-            source_artifacts = self._job.artifact.source.artifacts
+            source_artifacts = job.artifact.source.artifacts
 
             suffixes = ['%s.%s' % (kind, name) for name in source_artifacts]
             suffixes.append('build-log')
         else:
-            filename = '%s.%s' % (kind, self._job.artifact.name)
+            filename = '%s.%s' % (kind, job.artifact.name)
             suffixes = [filename]
 
             if kind == 'stratum':
@@ -568,52 +1013,60 @@ class WorkerConnection(distbuild.StateMachine):
             '/1.0/fetch?host=%s:%d&cacheid=%s&artifacts=%s' %
                 (urllib.quote(worker_host),
                  self._worker_cache_server_port,
-                 urllib.quote(self._job.artifact.source.cache_key),
+                 urllib.quote(job.artifact.source.cache_key),
                  suffixes))
 
         msg = distbuild.message(
             'http-request', id=self._request_ids.next(), url=url,
             method='GET', body=None, headers=None)
-        self._helper_id = msg['id']
+        self._helper_requests[msg['id']] = job
+        self._caching_started[msg['id']] = time.time()
         req = distbuild.HelperRequest(msg)
         self.mainloop.queue_event(distbuild.HelperRouter, req)
         
-        progress = WorkerBuildCaching(self._job.initiators,
-            self._job.artifact.source.cache_key)
+        progress = WorkerBuildCaching(job.initiators,
+            job.artifact.source.cache_key)
         self.mainloop.queue_event(WorkerConnection, progress)
 
     def _maybe_handle_helper_result(self, event_source, event):
-        if event.msg['id'] == self._helper_id:
-            distbuild.crash_point()
-
-            logging.debug('caching: event.msg: %s' % repr(event.msg))
-            if event.msg['status'] == httplib.OK:
-                logging.debug('Shared artifact cache population done')
-
-                new_event = WorkerBuildFinished(
-                    self._exec_response_msg,
-                    self._job.artifact.source.cache_key)
-                self.mainloop.queue_event(WorkerConnection, new_event)
-                self.mainloop.queue_event(self, _Cached())
-            else:
-                logging.error(
-                    'Failed to populate artifact cache: %s %s' %
-                        (event.msg['status'], event.msg['body']))
-
-                # We will attempt to remove this job twice
-                # unless we mark it as failed before the BuildController
-                # processes the WorkerBuildFailed event.
-                #
-                # The BuildController will not try to cancel jobs that have
-                # been marked as failed.
-                self.mainloop.queue_event(WorkerConnection,
-                                          _JobFailed(self._job))
-
-                new_event = WorkerBuildFailed(
-                    self._exec_response_msg,
-                    self._job.artifact.source.cache_key)
-                self.mainloop.queue_event(WorkerConnection, new_event)
-
-                self.mainloop.queue_event(self, _BuildFailed())
-
-        self.mainloop.queue_event(WorkerConnection, _JobFinished(self._job))
+        job = self._helper_requests.pop(event.msg['id'], None)
+        if job is None:
+            return
+        started = self._caching_started.pop(event.msg['id'])
+        distbuild.default_metrics.histogram(
+            'distbuild_caching_seconds',
+            'Time taken to copy artifacts from workers to the shared cache',
+            _caching_buckets).observe(time.time() - started)
+
+        distbuild.crash_point()
+
+        exec_response_msg = self._exec_response_msgs.get(job.id)
+
+        logging.debug('caching: event.msg: %r', event.msg)
+        if event.msg['status'] == httplib.OK:
+            logging.debug('Shared artifact cache population done')
+
+            job.built = True
+            new_event = WorkerBuildFinished(
+                exec_response_msg, job.artifact.source.cache_key)
+            self.mainloop.queue_event(WorkerConnection, new_event)
+        else:
+            logging.error(
+                'Failed to populate artifact cache: %s %s' %
+                    (event.msg['status'], event.msg['body']))
+
+            # We will attempt to remove this job twice
+            # unless we mark it as failed before the BuildController
+            # processes the WorkerBuildFailed event.
+            #
+            # The BuildController will not try to cancel jobs that have
+            # been marked as failed.
+            self.mainloop.queue_event(WorkerConnection, _JobFailed(job))
+
+            new_event = WorkerBuildFailed(
+                exec_response_msg, job.artifact.source.cache_key)
+            self.mainloop.queue_event(WorkerConnection, new_event)
+
+        self.mainloop.queue_event(WorkerConnection, _JobFinished(job))
+        if job.id in self._jobs:
+            self._finish_job(job)
@@ -47,9 +47,12 @@ class Error(cliapp.AppException):
 
 
 import artifact
+import artifactcacheindex
 import artifactcachereference
+import artifactdigest
 import artifactresolver
 import artifactsplitrule
+import artifactstore
 import branchmanager
 import bins
 import buildbranch
@@ -58,8 +61,11 @@ import buildenvironment
 import buildsystem
 import builder2
 import cachedrepo
+import cacheevictionplanner
 import cachekeycomputer
+import deployscheduler
 import extensions
+import extentcopy
 import extractedtarball
 import fsutils
 import git
@@ -77,14 +83,20 @@ import remoteartifactcache
 import remoterepocache
 import repoaliasresolver
 import savefile
+import sharedartifactcache
 import source
 import sourcepool
 import sourceresolver
+import sparsetransfer
 import stagingarea
 import stopwatch
 import sysbranchdir
 import systemmetadatadir
+import tarstream
+import unpackedchunkstore
+import upgradeplanner
 import util
+import versionguesser
 import workspace
 
 import yamlparse
@@ -18,6 +18,7 @@ import cliapp
 import logging
 import os
 import sys
+import threading
 import time
 import urlparse
 import extensions
@@ -155,6 +156,15 @@ class Morph(cliapp.Application):
                              metavar='DIR',
                              group=group_storage,
                              default=defaults['cachedir'])
+        self.settings.string(['shared-artifact-cache'],
+                             'look for artifacts in DIR, a directory shared '
+                             'with other hosts such as an NFS mount, before '
+                             'asking the artifact cache server; artifacts '
+                             'on the same filesystem as cachedir are linked '
+                             'rather than copied',
+                             metavar='DIR',
+                             group=group_storage,
+                             default='')
         self.settings.string(['compiler-cache-dir'],
                              'cache compiled objects in DIR/REPO. If not '
                              'provided, defaults to CACHEDIR/ccache/',
@@ -197,6 +207,9 @@ class Morph(cliapp.Application):
                 'System time is far in the past, please set your system clock')
 
     def setup(self):
+        self._thread_state = threading.local()
+        self._output_lock = threading.Lock()
+        self._env_lock = threading.Lock()
         self.status_prefix = ''
 
         self.add_subcommand('help-extensions', self.help_extensions)
@@ -308,6 +321,20 @@ class Morph(cliapp.Application):
                     if (submod.url, submod.commit) not in done:
                         subs_to_process.add((submod.url, submod.commit))
 
+    @property
+    def status_prefix(self):
+        '''The prefix for status messages from the current thread.
+
+        Every thread has a prefix of its own, so that jobs running at the
+        same time, such as deployments, can each label their output.
+
+        '''
+        return getattr(self._thread_state, 'status_prefix', '')
+
+    @status_prefix.setter
+    def status_prefix(self, prefix):
+        self._thread_state.status_prefix = prefix
+
     def status(self, **kwargs):
         '''Show user a status update.
 
@@ -322,8 +349,8 @@ class Morph(cliapp.Application):
 
         All other keywords are ignored unless embedded in ``msg``.
         
-        The ``self.status_prefix`` string is prepended to the output.
-        It is set to the empty string by default.
+        The ``self.status_prefix`` string of the calling thread is
+        prepended to the output. It is set to the empty string by default.
 
         '''
 
@@ -345,8 +372,9 @@ class Morph(cliapp.Application):
         ok = verbose or error or (not quiet and not chatty)
         if ok:
             timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
-            self.output.write('%s %s\n' % (timestamp, text))
-            self.output.flush()
+            with self._output_lock:
+                self.output.write('%s %s\n' % (timestamp, text))
+                self.output.flush()
 
     def runcmd(self, argv, *args, **kwargs):
         if 'env' not in kwargs:
@@ -372,10 +400,12 @@ class Morph(cliapp.Application):
                         cmdline=' | '.join(commands),
                         chatty=True)
 
-        # Log the environment.
-        prev = getattr(self, 'prev_env', {})
-        morphlib.util.log_environment_changes(self, kwargs['env'], prev)
-        self.prev_env = kwargs['env']
+        # Log the environment. Commands may be run from several threads,
+        # so each is compared with the one logged just before it.
+        with self._env_lock:
+            prev = getattr(self, 'prev_env', {})
+            morphlib.util.log_environment_changes(self, kwargs['env'], prev)
+            self.prev_env = kwargs['env']
 
         # run the command line
         return cliapp.Application.runcmd(self, argv, *args, **kwargs)
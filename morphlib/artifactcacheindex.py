@@ -0,0 +1,304 @@
+# Copyright (C) 2014  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import atexit
+import collections
+import errno
+import logging
+import os
+import re
+import sqlite3
+import time
+import weakref
+
+
+CacheKeyInfo = collections.namedtuple(
+    'CacheKeyInfo', ('cachekey', 'basenames', 'size', 'last_used'))
+
+
+# Indexes with uses of files that have not been written yet, which are
+# written when the process exits.
+_unflushed = weakref.WeakSet()
+
+
+def flush_all():
+    '''Write the uses of files recorded by every open index.
+
+    This is done when the process exits normally. Processes which leave
+    with os._exit, such as forked children, must call it themselves.
+
+    '''
+
+    for index in list(_unflushed):
+        try:
+            index.flush()
+        except sqlite3.Error, e:
+            logging.warning('Could not record uses of artifacts in %s: %s',
+                            index.dirname, e)
+
+atexit.register(flush_all)
+
+
+class ArtifactCacheIndex(object):
+
+    '''Index of the files in an artifact cache directory.
+
+    For every file in the directory, the index records the cache key it
+    belongs to, its size, the disk space it uses and when it was last
+    used. This lets the cache be listed and cleaned up without walking
+    the whole directory and calling stat on every file.
+
+    The index is an SQLite database kept in the directory itself, under
+    a name starting with a dot. It only ever holds information that can
+    be recovered from the directory, so it is written without waiting
+    for the data to reach the disk, and it is rebuilt from the directory
+    if it is missing.
+
+    Files may be added to or removed from the directory by others, such
+    as an older Morph. Before the index is read, it catches up with any
+    files added or removed since the directory last changed: only the
+    names in the directory are compared, so a file replaced by another
+    of the same name keeps the size it was indexed with.
+
+    Files whose names don't start with a cache key are not indexed.
+
+    Files kept next to an artifact, such as its digest, have names
+    ending in one of ``sidecar_suffixes``. They are indexed so that the
+    disk space they use is counted, but they are not listed themselves:
+    the space is counted as part of the file they belong to instead.
+
+    Uses of files are recorded in batches, since they are far more
+    common than anything else done to the index, and are written when
+    the index is next read, once ``touch_batch_size`` files have been
+    used, when ``flush`` or ``close`` is called, or when the process
+    exits.
+
+    An SQLite connection must not be used in a process forked from the
+    one that opened it, so a forked process opens its own the first
+    time it uses the index.
+
+    '''
+
+    index_basename = '.index.sqlite3'
+
+    cachekey_pattern = re.compile(r'^[0-9a-fA-F]{64}\.')
+
+    touch_batch_size = 100
+
+    def __init__(self, dirname, sidecar_suffixes=()):
+        self.dirname = dirname
+        self.sidecar_suffixes = tuple(sidecar_suffixes)
+        self._path = os.path.join(dirname, self.index_basename)
+        self._inherited = []
+        self._touched = {}
+        new = not os.path.exists(self._path)
+        self._connect()
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS files ('
+                            'filename TEXT PRIMARY KEY, '
+                            'cachekey TEXT NOT NULL, '
+                            'size INTEGER NOT NULL, '
+                            'used INTEGER NOT NULL, '
+                            'last_used REAL NOT NULL)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS files_cachekey '
+                            'ON files (cachekey)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS state ('
+                            'name TEXT PRIMARY KEY, '
+                            'value)')
+        if new:
+            self.rebuild()
+
+    def _connect(self):
+        self._db = sqlite3.connect(self._path, timeout=60)
+        self._db.text_factory = str
+        self._db.execute('PRAGMA synchronous = OFF')
+        # The journal is kept rather than deleted after every write, so
+        # that writing the index does not change the directory.
+        self._db.execute('PRAGMA journal_mode = TRUNCATE')
+        self._pid = os.getpid()
+
+    @property
+    def db(self):
+        if self._pid != os.getpid():
+            # The connection of the parent process is kept, rather than
+            # closed, since closing it here could disturb the parent's
+            # use of the database.
+            self._inherited.append(self._db)
+            self._connect()
+        return self._db
+
+    def _cachekey(self, basename):
+        if self.cachekey_pattern.match(basename):
+            return basename[:64]
+        return None
+
+    def _rows(self, basenames):
+        for basename in basenames:
+            cachekey = self._cachekey(basename)
+            if cachekey is None:
+                continue
+            try:
+                st = os.stat(os.path.join(self.dirname, basename))
+            except OSError, e:
+                # Someone else removed it already.
+                if e.errno != errno.ENOENT:  # pragma: no cover
+                    raise
+                continue
+            yield (basename, cachekey, st.st_size, st.st_blocks * 512,
+                   st.st_mtime)
+
+    def add(self, basenames):
+        '''Record files that have been written to the directory.'''
+        rows = list(self._rows(basenames))
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO files '
+                                'VALUES (?, ?, ?, ?, ?)', rows)
+
+    def touch(self, basenames, when=None):
+        '''Record that files have been used.'''
+        if when is None:
+            when = time.time()
+        for basename in basenames:
+            self._touched[basename] = when
+        _unflushed.add(self)
+        if len(self._touched) >= self.touch_batch_size:
+            self.flush()
+
+    def flush(self):
+        '''Write the uses of files recorded so far to the index.'''
+        if not self._touched:
+            return
+        touched, self._touched = self._touched, {}
+        _unflushed.discard(self)
+        with self.db:
+            self.db.executemany('UPDATE files SET last_used = ? '
+                                'WHERE filename = ?',
+                                ((when, f) for f, when in touched.iteritems()))
+
+    def remove(self, basenames):
+        '''Forget files that have been removed from the directory.'''
+        with self.db:
+            self.db.executemany('DELETE FROM files WHERE filename = ?',
+                                ((f,) for f in basenames))
+
+    def remove_cachekey(self, cachekey):
+        '''Forget all files of a cache key, returning their names.'''
+        with self.db:
+            basenames = [row[0] for row in self.db.execute(
+                'SELECT filename FROM files WHERE cachekey = ?',
+                (cachekey,))]
+            self.db.execute('DELETE FROM files WHERE cachekey = ?',
+                            (cachekey,))
+        return basenames
+
+    def _is_sidecar(self, basename):
+        return basename.endswith(self.sidecar_suffixes)
+
+    def _owner(self, sidecar):
+        for suffix in self.sidecar_suffixes:
+            if sidecar.endswith(suffix):
+                return sidecar[:-len(suffix)]
+
+    def _catch_up(self):
+        '''Index files added to or removed from the directory by others.'''
+        self.flush()
+        # The time is looked at before the names, so that anything that
+        # changes while they are read is caught up with next time.
+        mtime = os.stat(self.dirname).st_mtime
+        row = self.db.execute(
+            "SELECT value FROM state WHERE name = 'mtime'").fetchone()
+        if row is not None and row[0] == mtime:
+            return
+        basenames = set(f for f in os.listdir(self.dirname)
+                        if not f.startswith('.'))
+        indexed = set(row[0] for row in
+                      self.db.execute('SELECT filename FROM files'))
+        self.add(basenames - indexed)
+        self.remove(indexed - basenames)
+        self._record_mtime(mtime)
+
+    def _record_mtime(self, mtime):
+        # The directory may change again within the same tick of the
+        # clock without its time changing, so a time that recent is not
+        # trusted, and the directory is looked at again next time.
+        if time.time() - mtime < 2:
+            mtime = None
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO state '
+                            "VALUES ('mtime', ?)", (mtime,))
+
+    def files(self):
+        '''Return (filename, size, used, last_used) for every file.
+
+        The disk space used by the sidecar files of a file is counted in
+        its ``used``, and they are not returned themselves.
+
+        '''
+        self._catch_up()
+        files = {}
+        sidecars = []
+        for row in self.db.execute(
+                'SELECT filename, size, used, last_used FROM files'):
+            if self._is_sidecar(row[0]):
+                sidecars.append(row)
+            else:
+                files[row[0]] = list(row)
+        for filename, size, used, last_used in sidecars:
+            owner = files.get(self._owner(filename))
+            if owner is not None:
+                owner[2] += used
+        return [tuple(row) for row in files.itervalues()]
+
+    def cachekeys(self):
+        '''Return (cachekey, basenames, size, last_used) for every key.
+
+        ``size`` is the disk space used by all files of the key, and
+        ``last_used`` is the most recent use of any of them. Sidecar
+        files are counted in ``size``, but are not in ``basenames``.
+
+        '''
+        self._catch_up()
+        keys = {}
+        for filename, cachekey, used, last_used in self.db.execute(
+                'SELECT filename, cachekey, used, last_used FROM files'):
+            if cachekey not in keys:
+                keys[cachekey] = CacheKeyInfo(cachekey, set(), 0, last_used)
+            info = keys[cachekey]
+            if not self._is_sidecar(filename):
+                info.basenames.add(filename)
+            keys[cachekey] = info._replace(
+                size=info.size + used,
+                last_used=max(info.last_used, last_used))
+        return keys.values()
+
+    def clear(self):
+        with self.db:
+            self.db.execute('DELETE FROM files')
+
+    def rebuild(self):
+        '''Index every file in the directory from scratch.'''
+        logging.debug('Rebuilding artifact cache index of %s' % self.dirname)
+        mtime = os.stat(self.dirname).st_mtime
+        basenames = [f for f in os.listdir(self.dirname)
+                     if not f.startswith('.')]
+        self.clear()
+        self.add(basenames)
+        self._record_mtime(mtime)
+
+    def close(self):
+        if self._pid == os.getpid():
+            self.flush()
+            self._db.close()
@@ -0,0 +1,176 @@
+# Copyright (C) 2014  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import morphlib
+
+
+class ArtifactCacheIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.key = '0' * 64
+        self.other_key = '1' * 64
+        self.index = morphlib.artifactcacheindex.ArtifactCacheIndex(
+            self.tempdir)
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.tempdir)
+
+    def create(self, basename, data='data'):
+        with open(os.path.join(self.tempdir, basename), 'w') as f:
+            f.write(data)
+        return basename
+
+    def filenames(self):
+        return sorted(row[0] for row in self.index.files())
+
+    def test_is_empty_initially(self):
+        self.assertEqual(self.index.files(), [])
+        self.assertEqual(self.index.cachekeys(), [])
+
+    def test_adds_files_with_their_size(self):
+        filename = self.create('%s.chunk.foo' % self.key, 'foo')
+        self.index.add([filename])
+        (name, size, used, last_used), = self.index.files()
+        self.assertEqual(name, filename)
+        self.assertEqual(size, 3)
+
+    def test_ignores_files_not_named_by_cache_key(self):
+        self.index.add([self.create('foo.chunk.bar')])
+        self.assertEqual(self.index.files(), [])
+
+    def test_ignores_files_that_are_gone(self):
+        self.index.add(['%s.chunk.foo' % self.key])
+        self.assertEqual(self.index.files(), [])
+
+    def test_touch_updates_last_used(self):
+        filename = self.create('%s.chunk.foo' % self.key)
+        self.index.add([filename])
+        self.index.touch([filename], when=12345)
+        self.assertEqual(self.index.files()[0][3], 12345)
+
+    def test_touch_is_written_in_batches(self):
+        filename = self.create('%s.chunk.foo' % self.key)
+        self.index.add([filename])
+        self.index.touch_batch_size = 2
+        self.index.touch([filename], when=12345)
+        self.assertNotEqual(self.index.db.execute(
+            'SELECT last_used FROM files').fetchone()[0], 12345)
+        self.index.touch(['%s.chunk.bar' % self.key], when=12345)
+        self.assertEqual(self.index.db.execute(
+            'SELECT last_used FROM files').fetchone()[0], 12345)
+
+    def test_removes_files(self):
+        filename = self.create('%s.chunk.foo' % self.key)
+        self.index.add([filename])
+        os.remove(os.path.join(self.tempdir, filename))
+        self.index.remove([filename])
+        self.assertEqual(self.index.files(), [])
+
+    def test_groups_files_by_cache_key(self):
+        names = [self.create('%s.chunk.foo' % self.key),
+                 self.create('%s.chunk.foo.meta' % self.key),
+                 self.create('%s.chunk.bar' % self.other_key)]
+        self.index.add(names)
+        self.index.touch([names[0]], when=1)
+        self.index.touch([names[1]], when=2)
+        keys = dict((info.cachekey, info)
+                    for info in self.index.cachekeys())
+        self.assertEqual(sorted(keys), [self.key, self.other_key])
+        self.assertEqual(keys[self.key].basenames, set(names[:2]))
+        self.assertEqual(keys[self.key].last_used, 2)
+
+    def test_removes_all_files_of_cache_key(self):
+        names = [self.create('%s.chunk.foo' % self.key),
+                 self.create('%s.build-log' % self.key),
+                 self.create('%s.chunk.bar' % self.other_key)]
+        self.index.add(names)
+        self.assertEqual(sorted(self.index.remove_cachekey(self.key)),
+                         sorted(names[:2]))
+        for name in names[:2]:
+            os.remove(os.path.join(self.tempdir, name))
+        self.assertEqual(self.filenames(), [names[2]])
+
+    def test_clears_index(self):
+        filename = self.create('%s.chunk.foo' % self.key)
+        self.index.add([filename])
+        os.remove(os.path.join(self.tempdir, filename))
+        self.index.clear()
+        self.assertEqual(self.index.files(), [])
+
+    def test_catches_up_with_files_added_and_removed_by_others(self):
+        foo = self.create('%s.chunk.foo' % self.key)
+        self.assertEqual(self.filenames(), [foo])
+        os.remove(os.path.join(self.tempdir, foo))
+        bar = self.create('%s.chunk.bar' % self.key)
+        self.assertEqual(self.filenames(), [bar])
+
+    def test_only_looks_at_directory_when_it_has_changed(self):
+        foo = self.create('%s.chunk.foo' % self.key)
+        os.utime(self.tempdir, (1000, 1000))
+        self.assertEqual(self.filenames(), [foo])
+        os.remove(os.path.join(self.tempdir, foo))
+        os.utime(self.tempdir, (1000, 1000))
+        self.assertEqual(self.filenames(), [foo])
+        os.utime(self.tempdir, (2000, 2000))
+        self.assertEqual(self.filenames(), [])
+
+    def test_counts_sidecar_files_with_the_file_they_belong_to(self):
+        self.index.close()
+        self.index = morphlib.artifactcacheindex.ArtifactCacheIndex(
+            self.tempdir, sidecar_suffixes=['.sha256'])
+        foo = self.create('%s.chunk.foo' % self.key)
+        self.create('%s.chunk.foo.sha256' % self.key)
+        self.create('%s.chunk.bar.sha256' % self.key)
+        (name, size, used, last_used), = self.index.files()
+        self.assertEqual(name, foo)
+        self.assertEqual(size, 4)
+        self.assertEqual(used, 2 * os.stat(
+            os.path.join(self.tempdir, foo)).st_blocks * 512)
+        info, = self.index.cachekeys()
+        self.assertEqual(info.basenames, set([foo]))
+        self.assertEqual(info.size, 3 * used / 2)
+
+    def test_new_index_is_built_from_directory(self):
+        self.index.close()
+        os.remove(os.path.join(self.tempdir, self.index.index_basename))
+        filename = self.create('%s.chunk.foo' % self.key)
+        self.create('.dl.%s.chunk.bar' % self.key)
+        self.index = morphlib.artifactcacheindex.ArtifactCacheIndex(
+            self.tempdir)
+        self.assertEqual(self.filenames(), [filename])
+
+    def test_forked_process_uses_its_own_connection(self):
+        filename = self.create('%s.chunk.foo' % self.key)
+        parent_db = self.index.db
+        pid = os.fork()
+        if pid == 0:  # pragma: no cover
+            ok = False
+            try:
+                self.index.add([filename])
+                ok = self.index.db is not parent_db
+            finally:
+                os._exit(0 if ok else 1)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(status, 0)
+        self.assertTrue(self.index.db is parent_db)
+        self.assertEqual(self.filenames(), [filename])
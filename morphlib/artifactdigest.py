@@ -0,0 +1,198 @@
+# Copyright (C) 2014  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+'''Content digests of artifacts.
+
+The digest of an artifact is computed while the artifact is being
+written to the local artifact cache, so no extra pass over the data
+is needed. It is stored in a small file next to the artifact, named
+after the artifact with a ``.sha256`` suffix, and morph-cache-server
+sends it to clients in the ``X-Artifact-SHA256`` header.
+
+Readers check the digest as the data goes past, and raise
+DigestMismatchError once they reach the end of a corrupt artifact.
+
+'''
+
+
+import errno
+import hashlib
+import os
+
+import morphlib
+from morphlib.savefile import SaveFile
+
+
+suffix = 'sha256'
+header = 'X-Artifact-SHA256'
+
+
+def new_checksum():
+    return hashlib.sha256()
+
+
+def digest_filename(filename):
+    '''Return the name of the file holding the digest of ``filename``.'''
+    return '%s.%s' % (filename, suffix)
+
+
+def read_digest(filename):
+    '''Return the stored digest of ``filename``, or None if there is none.'''
+
+    try:
+        with open(digest_filename(filename)) as f:
+            return f.read().strip() or None
+    except IOError, e:
+        if e.errno != errno.ENOENT:  # pragma: no cover
+            raise
+        return None
+
+
+def write_digest(filename, digest):
+    '''Store ``digest`` as the digest of ``filename``.'''
+
+    with SaveFile(digest_filename(filename), 'w') as f:
+        f.write('%s\n' % digest)
+
+
+def digest_from_headers(response):
+    '''Return the digest sent with an HTTP response, or None.
+
+    Objects which have no headers, such as plain files, have no digest.
+
+    '''
+
+    info = getattr(response, 'info', None)
+    if info is None:
+        return None
+    return info().getheader(header)
+
+
+class DigestMismatchError(morphlib.Error):
+
+    def __init__(self, name, expected, actual):
+        self.msg = ('Content of %s is corrupt: expected %s digest %s, '
+                    'got %s' % (name, suffix, expected, actual))
+        self.name = name
+        self.expected = expected
+        self.actual = actual
+
+
+class DigestSaveFile(SaveFile):
+
+    '''A SaveFile which records the digest of what is written to it.
+
+    When the file is closed, the digest is saved next to it, as described
+    by ``digest_filename``. Aborting the file does not create a digest.
+
+    '''
+
+    def __init__(self, filename, *args, **kwargs):
+        SaveFile.__init__(self, filename, *args, **kwargs)
+        self.checksum = new_checksum()
+
+    def write(self, data):
+        self.checksum.update(data)
+        return SaveFile.write(self, data)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def hexdigest(self):
+        return self.checksum.hexdigest()
+
+    def close(self):
+        # A digest left over from an earlier copy of the file must not
+        # be seen next to the new contents.
+        digest_file = digest_filename(self.real_filename)
+        if os.path.exists(digest_file):
+            os.remove(digest_file)
+        ret = SaveFile.close(self)
+        write_digest(self.real_filename, self.hexdigest())
+        return ret
+
+
+class VerifyingReader(object):
+
+    '''Wrap a readable file object, verifying its digest while reading.
+
+    The digest is checked when the end of the data is reached, so the
+    last ``read`` or ``readline`` call, or iteration over the lines,
+    raises DigestMismatchError if the data is corrupt or truncated.
+    Ways of reading or moving around in the data that are not verified
+    raise AttributeError; other attributes are passed through to the
+    wrapped object.
+
+    '''
+
+    unverified = ('readinto', 'seek', 'xreadlines')
+
+    def __init__(self, f, expected, name):
+        self._f = f
+        self._expected = expected
+        self._name = name
+        self._checksum = new_checksum()
+        self._checked = False
+
+    def read(self, size=-1):
+        if size < 0:
+            data = self._f.read()
+        else:
+            data = self._f.read(size)
+        self._checksum.update(data)
+        if size < 0 or not data:
+            self._check()
+        return data
+
+    def readline(self, size=-1):
+        if size < 0:
+            line = self._f.readline()
+        else:
+            line = self._f.readline(size)
+        self._checksum.update(line)
+        if not line:
+            self._check()
+        return line
+
+    def readlines(self, sizehint=-1):
+        return list(self)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def _check(self):
+        if self._checked:
+            return
+        self._checked = True
+        actual = self._checksum.hexdigest()
+        if actual != self._expected:
+            raise DigestMismatchError(self._name, self._expected, actual)
+
+    def close(self):
+        self._f.close()
+
+    def __getattr__(self, name):
+        if name in self.unverified:
+            raise AttributeError(
+                '%s of %s would not be verified' % (name, self._name))
+        return getattr(self._f, name)
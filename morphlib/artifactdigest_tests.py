@@ -0,0 +1,147 @@
+# Copyright (C) 2014  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import hashlib
+import mimetools
+import os
+import shutil
+import StringIO
+import tempfile
+import unittest
+
+import morphlib
+from morphlib import artifactdigest
+
+
+class FakeResponse(StringIO.StringIO):
+
+    def __init__(self, data, headers):
+        StringIO.StringIO.__init__(self, data)
+        self.headers = mimetools.Message(StringIO.StringIO(headers + '\n'))
+
+    def info(self):
+        return self.headers
+
+
+class DigestSaveFileTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tempdir, 'artifact')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_saves_digest_of_written_data(self):
+        f = artifactdigest.DigestSaveFile(self.filename, 'w')
+        f.write('foo')
+        f.writelines(['bar\n', 'baz\n'])
+        f.close()
+        self.assertEqual(artifactdigest.read_digest(self.filename),
+                         hashlib.sha256('foobar\nbaz\n').hexdigest())
+
+    def test_abort_does_not_save_digest(self):
+        f = artifactdigest.DigestSaveFile(self.filename, 'w')
+        f.write('foo')
+        f.abort()
+        self.assertEqual(os.listdir(self.tempdir), [])
+
+    def test_replaces_digest_of_previous_contents(self):
+        for data in ('foo', 'bar'):
+            with artifactdigest.DigestSaveFile(self.filename, 'w') as f:
+                f.write(data)
+        self.assertEqual(artifactdigest.read_digest(self.filename),
+                         hashlib.sha256('bar').hexdigest())
+
+    def test_read_digest_returns_none_without_digest_file(self):
+        self.assertEqual(artifactdigest.read_digest(self.filename), None)
+
+
+class DigestFromHeadersTests(unittest.TestCase):
+
+    def test_returns_none_for_objects_without_headers(self):
+        self.assertEqual(
+            artifactdigest.digest_from_headers(StringIO.StringIO('foo')),
+            None)
+
+    def test_returns_none_if_header_is_missing(self):
+        response = FakeResponse('foo', 'Content-Type: text/plain\n')
+        self.assertEqual(artifactdigest.digest_from_headers(response), None)
+
+    def test_returns_digest_from_header(self):
+        response = FakeResponse('foo', 'X-Artifact-SHA256: abc\n')
+        self.assertEqual(artifactdigest.digest_from_headers(response), 'abc')
+
+
+class VerifyingReaderTests(unittest.TestCase):
+
+    def setUp(self):
+        self.data = 'x' * 1000
+        self.digest = hashlib.sha256(self.data).hexdigest()
+
+    def test_reads_correct_data_in_pieces(self):
+        reader = artifactdigest.VerifyingReader(
+            StringIO.StringIO(self.data), self.digest, 'artifact')
+        output = StringIO.StringIO()
+        shutil.copyfileobj(reader, output, 64)
+        self.assertEqual(output.getvalue(), self.data)
+
+    def test_reads_correct_data_at_once(self):
+        reader = artifactdigest.VerifyingReader(
+            StringIO.StringIO(self.data), self.digest, 'artifact')
+        self.assertEqual(reader.read(), self.data)
+
+    def test_raises_error_at_end_of_truncated_data(self):
+        reader = artifactdigest.VerifyingReader(
+            StringIO.StringIO(self.data[:-1]), self.digest, 'artifact')
+        self.assertEqual(reader.read(500), self.data[:500])
+        self.assertRaises(artifactdigest.DigestMismatchError,
+                          shutil.copyfileobj, reader, StringIO.StringIO())
+
+    def test_raises_error_for_corrupt_data(self):
+        reader = artifactdigest.VerifyingReader(
+            StringIO.StringIO('y' * 1000), self.digest, 'artifact')
+        self.assertRaises(artifactdigest.DigestMismatchError, reader.read)
+
+    def test_reads_correct_data_by_line(self):
+        data = 'foo\nbar\n'
+        reader = artifactdigest.VerifyingReader(
+            StringIO.StringIO(data), hashlib.sha256(data).hexdigest(),
+            'artifact')
+        self.assertEqual(reader.readline(2), 'fo')
+        self.assertEqual(list(reader), ['o\n', 'bar\n'])
+
+    def test_raises_error_at_end_of_corrupt_lines(self):
+        reader = artifactdigest.VerifyingReader(
+            StringIO.StringIO('foo\n'), self.digest, 'artifact')
+        self.assertRaises(artifactdigest.DigestMismatchError,
+                          reader.readlines)
+
+    def test_rejects_unverified_reads(self):
+        reader = artifactdigest.VerifyingReader(
+            StringIO.StringIO(self.data), self.digest, 'artifact')
+        self.assertRaises(AttributeError, getattr, reader, 'seek')
+
+    def test_error_is_a_morph_error(self):
+        self.assertTrue(issubclass(artifactdigest.DigestMismatchError,
+                                   morphlib.Error))
+
+    def test_passes_other_attributes_through(self):
+        f = StringIO.StringIO(self.data)
+        reader = artifactdigest.VerifyingReader(f, self.digest, 'artifact')
+        reader.close()
+        self.assertTrue(f.closed)
+        self.assertTrue(reader.closed)
@@ -0,0 +1,162 @@
+# Copyright (C) 2014  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import logging
+
+import morphlib
+
+
+class ArtifactStore(object):
+
+    '''Interface to a place artifacts are stored in.
+
+    Everything in a store is a file named by its basename: artifacts
+    (``Artifact.basename()``), artifact metadata
+    (``Artifact.metadata_basename()``) and source metadata
+    (``CACHEKEY.NAME``).
+
+    A store implements ``has_many``, ``open``, ``put`` and ``list``.
+    The artifact level methods used by the build code, such as ``has``
+    and ``get``, are provided here in terms of those, but stores may
+    override them.
+
+    Stores that keep files on a locally mounted filesystem also implement
+    ``local_path``, so that files can be linked from them instead of
+    being copied.
+
+    '''
+
+    def has_many(self, filenames):
+        '''Return the set of ``filenames`` that are in the store.'''
+        raise NotImplementedError()  # pragma: no cover
+
+    def open(self, filename):
+        '''Return a file object for reading a file in the store.
+
+        Raises an EnvironmentError if the file can't be read.
+
+        '''
+        raise NotImplementedError()  # pragma: no cover
+
+    def put(self, artifact):
+        '''Return a file object for writing an artifact into the store.
+
+        The artifact appears in the store when the file object is closed,
+        calling its ``abort`` method discards it.
+
+        '''
+        raise NotImplementedError()  # pragma: no cover
+
+    def list(self):
+        '''Iterate over the names of all files in the store.'''
+        raise NotImplementedError()  # pragma: no cover
+
+    def local_path(self, filename):
+        '''Return the path to a file on a local filesystem, or None.
+
+        None is also returned if the store does not have the file.
+
+        '''
+        return None
+
+    def _has_file(self, filename):
+        return filename in self.has_many([filename])
+
+    def has(self, artifact):
+        return self._has_file(artifact.basename())
+
+    def has_artifact_metadata(self, artifact, name):
+        return self._has_file(artifact.metadata_basename(name))
+
+    def has_source_metadata(self, source, cachekey, name):
+        return self._has_file('%s.%s' % (cachekey, name))
+
+    def get(self, artifact, log=logging.error):
+        try:
+            return self.open(artifact.basename())
+        except EnvironmentError, e:
+            log(str(e))
+            raise morphlib.remoteartifactcache.GetError(self, artifact)
+
+    def get_artifact_metadata(self, artifact, name, log=logging.error):
+        try:
+            return self.open(artifact.metadata_basename(name))
+        except EnvironmentError, e:
+            log(str(e))
+            raise morphlib.remoteartifactcache.GetArtifactMetadataError(
+                self, artifact, name)
+
+    def get_source_metadata(self, source, cachekey, name):
+        try:
+            return self.open('%s.%s' % (cachekey, name))
+        except EnvironmentError:
+            raise morphlib.remoteartifactcache.GetSourceMetadataError(
+                self, source, cachekey, name)
+
+
+class LayeredArtifactStore(ArtifactStore):
+
+    '''Look files up in several artifact stores, in order.
+
+    This is used to look in a shared artifact directory before asking
+    the artifact cache server. New artifacts are put into the first
+    store.
+
+    '''
+
+    def __init__(self, stores):
+        self.stores = stores
+
+    def has_many(self, filenames):
+        found = set()
+        remaining = list(filenames)
+        for store in self.stores:
+            if not remaining:
+                break
+            found.update(store.has_many(remaining))
+            remaining = [f for f in remaining if f not in found]
+        return found
+
+    def open(self, filename):
+        error = None
+        for store in self.stores:
+            try:
+                return store.open(filename)
+            except EnvironmentError, e:
+                logging.debug('%s not in %s: %s' % (filename, store, e))
+                error = e
+        raise error
+
+    def put(self, artifact):
+        return self.stores[0].put(artifact)
+
+    def list(self):
+        seen = set()
+        for store in self.stores:
+            for filename in store.list():
+                if filename not in seen:
+                    seen.add(filename)
+                    yield filename
+
+    def local_path(self, filename):
+        for store in self.stores:
+            path = store.local_path(filename)
+            if path is not None:
+                return path
+        return None
+
+    def __str__(self):  # pragma: no cover
+        return ', '.join(str(store) for store in self.stores)
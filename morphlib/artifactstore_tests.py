@@ -0,0 +1,142 @@
+# Copyright (C) 2014  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import StringIO
+import unittest
+
+import morphlib
+
+
+class FakeArtifact(object):
+
+    def __init__(self, basename):
+        self._basename = basename
+
+    def basename(self):
+        return self._basename
+
+    def metadata_basename(self, name):
+        return '%s.%s' % (self._basename, name)
+
+
+class FakeStore(morphlib.artifactstore.ArtifactStore):
+
+    def __init__(self, files, local_dir=None):
+        self.files = files
+        self.local_dir = local_dir
+        self.put_artifacts = []
+
+    def has_many(self, filenames):
+        return set(f for f in filenames if f in self.files)
+
+    def open(self, filename):
+        if filename not in self.files:
+            raise IOError('%s not found' % filename)
+        return StringIO.StringIO(self.files[filename])
+
+    def put(self, artifact):
+        self.put_artifacts.append(artifact)
+
+    def list(self):
+        return iter(self.files)
+
+    def local_path(self, filename):
+        if self.local_dir is None or filename not in self.files:
+            return None
+        return '%s/%s' % (self.local_dir, filename)
+
+
+class ArtifactStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self.artifact = FakeArtifact('key.chunk.foo')
+        self.store = FakeStore({
+            'key.chunk.foo': 'artifact',
+            'key.chunk.foo.meta': 'artifact metadata',
+            'key.build-log': 'source metadata',
+        })
+
+    def test_has_artifacts_and_metadata(self):
+        self.assertTrue(self.store.has(self.artifact))
+        self.assertTrue(self.store.has_artifact_metadata(self.artifact,
+                                                         'meta'))
+        self.assertTrue(self.store.has_source_metadata(None, 'key',
+                                                       'build-log'))
+
+    def test_does_not_have_missing_files(self):
+        self.assertFalse(self.store.has(FakeArtifact('key.chunk.bar')))
+        self.assertFalse(self.store.has_artifact_metadata(self.artifact,
+                                                          'other'))
+        self.assertFalse(self.store.has_source_metadata(None, 'key',
+                                                        'meta'))
+
+    def test_gets_artifacts_and_metadata(self):
+        self.assertEqual(self.store.get(self.artifact).read(), 'artifact')
+        self.assertEqual(
+            self.store.get_artifact_metadata(self.artifact, 'meta').read(),
+            'artifact metadata')
+        self.assertEqual(
+            self.store.get_source_metadata(None, 'key', 'build-log').read(),
+            'source metadata')
+
+    def test_get_raises_get_errors_for_missing_files(self):
+        self.assertRaises(morphlib.remoteartifactcache.GetError,
+                          self.store.get, FakeArtifact('key.chunk.bar'),
+                          log=lambda *args: None)
+        self.assertRaises(
+            morphlib.remoteartifactcache.GetArtifactMetadataError,
+            self.store.get_artifact_metadata, self.artifact, 'other',
+            log=lambda *args: None)
+        self.assertRaises(
+            morphlib.remoteartifactcache.GetSourceMetadataError,
+            self.store.get_source_metadata, None, 'key', 'meta')
+
+    def test_has_no_local_paths_by_default(self):
+        self.assertEqual(
+            morphlib.artifactstore.ArtifactStore().local_path('foo'), None)
+
+
+class LayeredArtifactStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self.shared = FakeStore({'a': 'shared a'}, local_dir='/shared')
+        self.remote = FakeStore({'a': 'remote a', 'b': 'remote b'})
+        self.store = morphlib.artifactstore.LayeredArtifactStore(
+            [self.shared, self.remote])
+
+    def test_has_files_from_all_stores(self):
+        self.assertEqual(self.store.has_many(['a', 'b', 'c']),
+                         set(['a', 'b']))
+
+    def test_opens_file_from_first_store_that_has_it(self):
+        self.assertEqual(self.store.open('a').read(), 'shared a')
+        self.assertEqual(self.store.open('b').read(), 'remote b')
+
+    def test_open_raises_error_if_no_store_has_file(self):
+        self.assertRaises(IOError, self.store.open, 'c')
+
+    def test_puts_into_first_store(self):
+        artifact = FakeArtifact('a')
+        self.store.put(artifact)
+        self.assertEqual(self.shared.put_artifacts, [artifact])
+        self.assertEqual(self.remote.put_artifacts, [])
+
+    def test_lists_each_file_once(self):
+        self.assertEqual(sorted(self.store.list()), ['a', 'b'])
+
+    def test_local_path_comes_from_store_with_local_files(self):
+        self.assertEqual(self.store.local_path('a'), '/shared/a')
+        self.assertEqual(self.store.local_path('b'), None)
@@ -23,12 +23,14 @@ Binaries are chunks, strata, and system images.
 
 import cliapp
 import logging
+import json
 import os
 import sys
 import re
 import errno
 import stat
 import shutil
+import StringIO
 import tarfile
 
 import morphlib
@@ -215,6 +217,178 @@ def unpack_binary(filename, dirname):
         unpack_binary_from_file(f, dirname)
 
 
+member_index_suffix = 'members'
+
+
+def member_index_filename(filename):
+    '''Return the name of the member index of the tarball ``filename``.'''
+    return '%s.%s' % (filename, member_index_suffix)
+
+
+def index_members(f):
+    '''Return an index of the members of an uncompressed tarball.
+
+    The index maps the normalised path of each member to a tuple of
+    the offset of its data in the tarball, its size, mode, type and
+    link target. Only the headers of the members are read; the data
+    is skipped over by seeking.
+
+    '''
+
+    members = {}
+    tar = tarfile.open(fileobj=f, mode='r:')
+    try:
+        for member in tar:
+            kind = member.type
+            if kind == tarfile.AREGTYPE:
+                kind = tarfile.REGTYPE
+            elif getattr(member, 'sparse', None) is not None:
+                # The data of a sparse file is not stored in one piece.
+                kind = tarfile.GNUTYPE_SPARSE
+            members[os.path.normpath(member.name)] = (
+                member.offset_data, member.size, member.mode, kind,
+                member.linkname)
+    finally:
+        tar.close()
+    return members
+
+
+def write_member_index(filename):
+    '''Write the index of the members of a tarball next to it.
+
+    The index starts with a line giving the size of the tarball, so
+    that an index left over from a different tarball can be spotted,
+    followed by the fields of each member, separated by NUL bytes since
+    paths can contain anything else.
+
+    '''
+
+    with open(filename, 'rb') as f:
+        members = index_members(f)
+        size = os.fstat(f.fileno()).st_size
+    with morphlib.savefile.SaveFile(member_index_filename(filename),
+                                    'wb') as f:
+        f.write('morph-member-index %d\n' % size)
+        for path, (offset, length, mode, kind, linkname) in \
+                sorted(members.iteritems()):
+            f.write('%s\0%d\0%d\0%d\0%s\0%s\0' %
+                    (path, offset, length, mode, kind, linkname))
+
+
+def _read_member_index(filename, size):
+    '''Read the member index of a tarball, or return None if there is none.'''
+
+    try:
+        with open(member_index_filename(filename), 'rb') as f:
+            header = f.readline().split()
+            if header != ['morph-member-index', str(size)]:
+                logging.debug('Ignoring out of date member index of %s' %
+                              filename)
+                return None
+            fields = f.read().split('\0')
+    except IOError, e:
+        if e.errno != errno.ENOENT: # pragma: no cover
+            raise
+        return None
+    members = {}
+    for i in xrange(0, len(fields) - 1, 6):
+        path, offset, length, mode, kind, linkname = fields[i:i + 6]
+        members[path] = (int(offset), int(length), int(mode), kind, linkname)
+    return members
+
+
+class TarballMembers(object):
+
+    '''Random access to the members of an uncompressed tarball.
+
+    Members are read by seeking to them, using the member index written
+    next to the tarball by ``write_member_index``. If there is no index,
+    one is made by reading just the headers of the tarball, which is
+    still much quicker than extracting it.
+
+    Raises tarfile.TarError if the file is not an uncompressed tarball.
+
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.f = open(filename, 'rb')
+        try:
+            size = os.fstat(self.f.fileno()).st_size
+            self.members = _read_member_index(filename, size)
+            if self.members is None:
+                self.members = index_members(self.f)
+        except BaseException:
+            self.f.close()
+            raise
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exctype, excvalue, exctraceback):
+        self.close()
+
+    def names(self):
+        '''Return the paths of all members, sorted.'''
+        return sorted(self.members)
+
+    def listdir(self, dirname):
+        '''Return the paths of the members directly inside dirname, sorted.'''
+        dirname = os.path.normpath(dirname)
+        return sorted(path for path in self.members
+                      if os.path.dirname(path) == dirname)
+
+    def _regular_member(self, path):
+        offset, size, mode, kind, linkname = self.members[
+            os.path.normpath(path)]
+        if kind == tarfile.LNKTYPE:
+            return self._regular_member(linkname)
+        if kind not in (tarfile.REGTYPE, tarfile.CONTTYPE):
+            raise KeyError('%s in %s is not a regular file' %
+                           (path, self.filename))
+        return offset, size
+
+    def read(self, path):
+        '''Return the contents of the regular file at path.
+
+        Raises KeyError if there is no such file.
+
+        '''
+
+        offset, size = self._regular_member(path)
+        self.f.seek(offset)
+        return self.f.read(size)
+
+    def open(self, path):
+        '''Return a file object with the contents of the file at path.'''
+        return StringIO.StringIO(self.read(path))
+
+
+def read_system_metadata(filename):
+    '''Return the metadata in a system artifact, by artifact name.
+
+    The ``baserock/*.meta`` files are read straight out of the tarball,
+    without extracting it. Corrupt metadata is skipped with a warning.
+
+    '''
+
+    metadata = {}
+    with TarballMembers(filename) as members:
+        for path in members.listdir('baserock'):
+            if not path.endswith('.meta'):
+                continue
+            try:
+                metadata[os.path.basename(path)[:-len('.meta')]] = \
+                    json.loads(members.read(path))
+            except (KeyError, ValueError):
+                logging.warning('Ignoring corrupt %s in %s' %
+                                (path, filename))
+    return metadata
+
+
 class ArtifactNotMountableError(cliapp.AppException): # pragma: no cover
 
     def __init__(self, filename):
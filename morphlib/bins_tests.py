@@ -215,3 +215,87 @@ class ExtractTests(unittest.TestCase):
         morphlib.bins.unpack_binary_from_file(dirtar, self.unpacked)
         mode = os.lstat(os.path.join(self.unpacked, 'foo')).st_mode
         self.assertTrue(stat.S_ISREG(mode))
+
+
+class MemberIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.tarball = os.path.join(self.tempdir, 'system')
+        self.index = morphlib.bins.member_index_filename(self.tarball)
+        with tarfile.open(self.tarball, 'w') as tar:
+            self.add(tar, './baserock/foo.meta', '{"kind": "chunk"}')
+            self.add(tar, './baserock/bar.meta', '{')
+            self.add(tar, './baserock/notes', 'not metadata')
+            self.add(tar, './baserock/sub/baz.meta', '{}')
+            self.add(tar, './usr/bin/foo', 'foo', type=tarfile.AREGTYPE)
+            self.add(tar, './usr/bin/foo-link', linkname='./usr/bin/foo',
+                     type=tarfile.LNKTYPE)
+            self.add(tar, './usr/bin/sym', linkname='foo',
+                     type=tarfile.SYMTYPE)
+            self.add(tar, './usr/sparse', type=tarfile.GNUTYPE_SPARSE)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def add(self, tar, name, data='', **kwargs):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        for key, value in kwargs.iteritems():
+            setattr(info, key, value)
+        tar.addfile(info, StringIO.StringIO(data))
+
+    def open_members(self):
+        return morphlib.bins.TarballMembers(self.tarball)
+
+    def test_lists_members(self):
+        with self.open_members() as members:
+            self.assertEqual(members.listdir('./baserock'),
+                             ['baserock/bar.meta', 'baserock/foo.meta',
+                              'baserock/notes'])
+            self.assertTrue('usr/bin/foo' in members.names())
+
+    def test_reads_members(self):
+        with self.open_members() as members:
+            self.assertEqual(members.read('usr/bin/foo'), 'foo')
+            self.assertEqual(members.open('./baserock/notes').read(),
+                             'not metadata')
+
+    def test_reads_hard_links(self):
+        with self.open_members() as members:
+            self.assertEqual(members.read('usr/bin/foo-link'), 'foo')
+
+    def test_refuses_to_read_missing_or_irregular_members(self):
+        with self.open_members() as members:
+            self.assertRaises(KeyError, members.read, 'usr/bin/missing')
+            self.assertRaises(KeyError, members.read, 'usr/bin/sym')
+            self.assertRaises(KeyError, members.read, 'usr/sparse')
+            self.assertRaises(KeyError, members.read, 'usr')
+
+    def test_reads_members_through_saved_index(self):
+        morphlib.bins.write_member_index(self.tarball)
+        with open(self.index) as f:
+            self.assertTrue(f.readline().startswith('morph-member-index'))
+        with self.open_members() as members:
+            expected = morphlib.bins.index_members(members.f)
+            self.assertEqual(members.members, expected)
+            self.assertEqual(members.read('usr/bin/foo-link'), 'foo')
+
+    def test_ignores_index_of_another_tarball(self):
+        with open(self.index, 'w') as f:
+            f.write('morph-member-index 1\nusr/bin/foo\x000\x003\x00'
+                    '420\x000\x00\x00')
+        with self.open_members() as members:
+            self.assertEqual(members.read('usr/bin/foo'), 'foo')
+
+    def test_rejects_compressed_tarballs(self):
+        with open(self.tarball, 'rb') as f:
+            data = f.read()
+        with gzip.open(self.tarball, 'wb') as f:
+            f.write(data)
+        self.assertRaises(tarfile.TarError, self.open_members)
+
+    def test_reads_system_metadata_skipping_corrupt_files(self):
+        self.assertEqual(
+            morphlib.bins.read_system_metadata(self.tarball),
+            {'foo': {'kind': 'chunk'}})
@@ -14,6 +14,7 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 
+import collections
 import itertools
 import os
 import shutil
@@ -149,7 +150,16 @@ class BuildCommand(object):
             raise morphlib.Error('No non-bootstrap chunks found.')
 
     def _compute_cache_keys(self, root_artifact):
-        arch = root_artifact.source.morphology['arch']
+        self._compute_cache_keys_for_roots([root_artifact])
+
+    def _compute_cache_keys_for_roots(self, root_artifacts):
+        '''Compute cache keys for root artifacts of the same architecture.
+
+        Sources that the root artifacts share have their cache key
+        computed only once.
+
+        '''
+        arch = root_artifacts[0].source.morphology['arch']
         self.app.status(msg='Creating build environment for %(arch)s',
                         arch=arch, chatty=True)
         build_env = self.new_build_env(arch)
@@ -157,11 +167,14 @@ class BuildCommand(object):
         self.app.status(msg='Computing cache keys', chatty=True)
         ckc = morphlib.cachekeycomputer.CacheKeyComputer(build_env)
 
-        for source in set(a.source for a in root_artifact.walk()):
+        sources = set(a.source for root_artifact in root_artifacts
+                      for a in root_artifact.walk())
+        for source in sources:
             source.cache_key = ckc.compute_key(source)
             source.cache_id = ckc.get_cache_id(source)
 
-        root_artifact.build_env = build_env
+        for root_artifact in root_artifacts:
+            root_artifact.build_env = build_env
 
     def resolve_artifacts(self, srcpool):
         '''Resolve the artifacts that will be built for a set of sources'''
@@ -186,6 +199,53 @@ class BuildCommand(object):
 
         return root_artifact
 
+    def resolve_systems(self, repo_name, ref, filenames, original_ref=None):
+        '''Resolve the root artifacts of several systems at once.
+
+        Returns a dict mapping each filename to the root artifact of
+        that system, with its cache keys computed, as resolve_artifacts
+        would. The build graph is only created once for all of the
+        systems, so the strata and chunks they have in common are only
+        looked up, resolved and given a cache key once.
+
+        '''
+        self.app.status(msg='Creating source pool for %(count)d systems',
+                        count=len(filenames), chatty=True)
+        roots = morphlib.sourceresolver.resolve_systems(
+            self.lrc, self.rrc, repo_name, ref, filenames,
+            original_ref=original_ref,
+            update_repos=not self.app.settings['no-git-update'],
+            status_cb=self.app.status)
+
+        self.app.status(msg='Validating root artifacts', chatty=True)
+        root_artifacts = {}
+        for filename in filenames:
+            artifacts = roots[filename]
+            for root_artifact in artifacts:
+                self._validate_root_artifact(root_artifact)
+            if len(artifacts) > 1:
+                raise MultipleRootArtifactsError(artifacts)
+            root_artifacts[filename] = artifacts[0]
+
+        self.compute_cache_keys_for_systems(root_artifacts.values())
+
+        return root_artifacts
+
+    def compute_cache_keys_for_systems(self, root_artifacts):
+        '''Compute the cache keys of the build graphs of several systems.
+
+        The systems may be of different architectures. Those of the same
+        architecture share a build environment, and the cache key of each
+        source they share is computed only once.
+
+        '''
+        by_arch = collections.defaultdict(list)
+        for root_artifact in root_artifacts:
+            by_arch[root_artifact.source.morphology['arch']].append(
+                root_artifact)
+        for artifacts in by_arch.itervalues():
+            self._compute_cache_keys_for_roots(artifacts)
+
     def _validate_cross_morphology_references(self, srcpool):
         '''Perform validation across all morphologies involved in the build'''
 
@@ -291,6 +351,10 @@ class BuildCommand(object):
             except morphlib.remoteartifactcache.GetError:
                 # Error is logged by the RemoteArtifactCache object.
                 pass
+            except morphlib.artifactdigest.DigestMismatchError, e:
+                # The partial download has been discarded, so the
+                # source gets rebuilt rather than trusting the copy.
+                logging.warning(str(e))
 
         if any(not self.lac.has(artifact) for artifact in artifacts):
             self.build_source(source, build_env)
@@ -417,7 +481,10 @@ class BuildCommand(object):
             '''Fetch a set of files atomically.
 
             If an error occurs during the transfer of any files, all downloaded
-            data is deleted, to ensure integrity of the local cache.
+            data is deleted, to ensure integrity of the local cache. This
+            includes the content of an artifact not matching the digest
+            sent by the remote artifact cache, which is checked as the
+            artifact is copied.
 
             '''
             try:
@@ -433,6 +500,22 @@ class BuildCommand(object):
                     local.close()
 
         for artifact in artifacts:
+            # Artifacts in a shared artifact directory on the same
+            # filesystem are linked rather than copied. The metadata goes
+            # first, so a half-done link never leaves an artifact without
+            # its metadata.
+            to_link = []
+            if artifact.source.morphology.needs_artifact_metadata_cached:
+                if not self.lac.has_artifact_metadata(artifact, 'meta'):
+                    to_link.append(artifact.metadata_basename('meta'))
+            if not self.lac.has(artifact):
+                to_link.append(artifact.basename())
+            if to_link and self.lac.link_from(self.rac, to_link):
+                self.app.status(
+                    msg='Linked into local cache: artifact %(name)s',
+                    name=artifact.name, chatty=True)
+                continue
+
             # This block should fetch all artifact files in one go, using the
             # 1.0/artifacts method of morph-cache-server. The code to do that
             # needs bringing in from the distbuild.worker_build_connection
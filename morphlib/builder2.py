@@ -20,7 +20,6 @@ import errno
 import json
 import logging
 import os
-from os.path import relpath
 import shutil
 import stat
 import tarfile
@@ -128,12 +127,19 @@ def ldconfig(runcmd, rootdir):  # pragma: no cover
 
 def download_depends(constituents, lac, rac, metadatas=None):
     for constituent in constituents:
-        if not lac.has(constituent):
+        if (not lac.has(constituent) and
+                not lac.link_from(rac, [constituent.basename()])):
             source = rac.get(constituent)
             target = lac.put(constituent)
-            shutil.copyfileobj(source, target)
+            try:
+                shutil.copyfileobj(source, target)
+            except BaseException:
+                # Don't leave a truncated or corrupt artifact in the cache
+                target.abort()
+                raise
+            finally:
+                source.close()
             target.close()
-            source.close()
         if metadatas is not None:
             for metadata in metadatas:
                 if not lac.has_artifact_metadata(constituent, metadata):
@@ -310,6 +316,7 @@ class ChunkBuilder(BuilderBase):
                 self.create_devices(destdir)
 
                 os.rename(temppath, logpath)
+                cache.register(logpath)
             except BaseException, e:
                 logging.error('Caught exception: %s' % str(e))
                 logging.info('Cleaning up staging area')
@@ -321,6 +328,7 @@ class ChunkBuilder(BuilderBase):
                                           line.rstrip('\n'))
 
                     os.rename(temppath, logpath)
+                    cache.register(logpath)
                 else:
                     logging.error("Couldn't find build log at %s", temppath)
 
@@ -487,6 +495,7 @@ class ChunkBuilder(BuilderBase):
                     self.app.status(msg='Creating chunk artifact %(name)s',
                                     name=chunk_artifact_name)
                     morphlib.bins.create_chunk(destdir, f, parented_paths)
+                self.local_artifact_cache.put_member_index(chunk_artifact)
                 built_artifacts.append(chunk_artifact)
 
         for dirname, subdirs, files in os.walk(destdir):
@@ -560,18 +569,7 @@ class SystemBuilder(BuilderBase):  # pragma: no cover
                     self.unpack_strata(fs_root)
                     self.write_metadata(fs_root, a_name)
                     self.run_system_integration_commands(fs_root)
-                    unslashy_root = fs_root[1:]
-                    def uproot_info(info):
-                        info.name = relpath(info.name, unslashy_root)
-                        if info.islnk():
-                            info.linkname = relpath(info.linkname,
-                                                    unslashy_root)
-                        return info
-                    tar = tarfile.open(fileobj=handle, mode="w", name=a_name)
-                    self.app.status(msg='Constructing tarball of rootfs',
-                                    chatty=True)
-                    tar.add(fs_root, recursive=True, filter=uproot_info)
-                    tar.close()
+                    self.write_rootfs_tarball(fs_root, handle)
                 except BaseException as e:
                     logging.error(traceback.format_exc())
                     self.app.status(msg='Error while building system',
@@ -580,10 +578,33 @@ class SystemBuilder(BuilderBase):  # pragma: no cover
                     raise
                 else:
                     handle.close()
+                    self.local_artifact_cache.put_member_index(artifact)
 
         self.save_build_times()
         return self.source.artifacts.itervalues()
 
+    def write_rootfs_tarball(self, fs_root, handle):
+        '''Write a tarball of the root filesystem to an open file.
+
+        GNU tar walks the tree and writes the tarball, which is streamed
+        into ``handle`` as it is produced, rather than walking the tree
+        again with Python's tarfile module.
+
+        '''
+        self.app.status(msg='Constructing tarball of rootfs', chatty=True)
+        with self.build_watch('create-rootfs-tarball'):
+            p = subprocess.Popen(['tar', '-C', fs_root, '-cf', '-', '.'],
+                                 stdout=subprocess.PIPE)
+            try:
+                shutil.copyfileobj(p.stdout, handle, 1024**2)
+            finally:
+                p.stdout.close()
+                returncode = p.wait()
+            if returncode != 0:
+                raise cliapp.AppException(
+                    'tar failed with exit code %d while creating the '
+                    'tarball of %s' % (returncode, fs_root))
+
     def unpack_one_stratum(self, stratum_artifact, target):
         '''Unpack a single stratum into a target directory'''
 
@@ -591,10 +612,12 @@ class SystemBuilder(BuilderBase):  # pragma: no cover
         with cache.get(stratum_artifact) as stratum_file:
             artifact_list = json.load(stratum_file, encoding='unicode-escape')
             for chunk in (ArtifactCacheReference(a) for a in artifact_list):
-                self.app.status(msg='Unpacking chunk %(basename)s',
+                self.app.status(msg='Linking chunk %(basename)s',
                                 basename=chunk.basename(), chatty=True)
-                with cache.get(chunk) as chunk_file:
-                    morphlib.bins.unpack_binary_from_file(chunk_file, target)
+                # The system integration commands change files in place,
+                # so they must not be hard links to the store.
+                self.chunk_store.link_into(chunk.basename(), target,
+                                           hard_link=False)
 
         target_metadata = os.path.join(
                 target, 'baserock', '%s.meta' % stratum_artifact.name)
@@ -616,15 +639,27 @@ class SystemBuilder(BuilderBase):  # pragma: no cover
                                  ('meta',))
 
                 # download the chunk artifacts if necessary
+                chunks = []
                 for stratum_artifact in self.source.dependencies:
                     f = self.local_artifact_cache.get(stratum_artifact)
-                    chunks = [ArtifactCacheReference(c) for c in json.load(f)]
-                    download_depends(chunks,
-                                     self.local_artifact_cache,
-                                     self.remote_artifact_cache)
+                    chunks += [ArtifactCacheReference(c) for c in json.load(f)]
                     f.close()
-
-                # unpack it from the local artifact cache
+                download_depends(chunks,
+                                 self.local_artifact_cache,
+                                 self.remote_artifact_cache)
+
+                # unpack each chunk once, into the store of unpacked chunks
+                # that staging areas are also made from, several at a time
+                self.chunk_store = morphlib.unpackedchunkstore.\
+                    UnpackedChunkStore(os.path.join(
+                        self.app.settings['tempdir'], 'chunks'))
+                self.chunk_store.unpack_many(
+                    [(c.basename(),
+                      self.local_artifact_cache.artifact_filename(c))
+                     for c in chunks],
+                    self.max_jobs)
+
+                # link the chunks into the root filesystem
                 for stratum_artifact in self.source.dependencies:
                     self.unpack_one_stratum(stratum_artifact, path)
 
@@ -66,6 +66,9 @@ class FakeArtifact(object):
         self.cache_key = 'blahblah'
         self.cache_id = {}
 
+    def basename(self):
+        return '%s.%s' % (self.cache_key, self.name)
+
 
 class FakeBuildEnv(object):
 
@@ -133,6 +136,9 @@ class FakeArtifactCache(object):
     def has_source_metadata(self, source, cachekey, name):
         return (cachekey, name) in self._cached
 
+    def link_from(self, store, filenames):
+        return False
+
 
 class BuilderBaseTests(unittest.TestCase):
 
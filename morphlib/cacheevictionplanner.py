@@ -0,0 +1,209 @@
+# Copyright (C) 2014  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import collections
+import json
+import logging
+import os
+import re
+
+import morphlib
+
+
+CacheEntry = collections.namedtuple(
+    'CacheEntry', ('cachekey', 'artifacts', 'size', 'last_used',
+                   'build_time'))
+
+
+def read_build_time(lac, cachekey):
+    '''Return how long the source of a cache key took to build, or None.
+
+    This is the ``overall-build`` time that the builders record in the
+    ``CACHEKEY.meta`` source metadata. The file is read directly, so that
+    looking at it does not count as using the cached source.
+
+    '''
+    path = lac.local_path('%s.meta' % cachekey)
+    if path is None:
+        return None
+    try:
+        with open(path) as f:
+            meta = json.load(f)
+        return float(meta['build-times']['overall-build']['delta'])
+    except (EnvironmentError, ValueError, KeyError, TypeError), e:
+        logging.debug('No build time for %s: %s' % (cachekey, e))
+        return None
+
+
+def cache_entries(lac):
+    '''Return a CacheEntry for every cache key in a local artifact cache.'''
+    return [CacheEntry(cachekey, artifacts, size, last_used,
+                       read_build_time(lac, cachekey))
+            for cachekey, artifacts, size, last_used in lac.list_sizes()]
+
+
+cachekey_pattern = re.compile(r'^[0-9a-fA-F]{64}\.')
+
+
+def find_system_artifacts(entries, names):
+    '''Return the basenames of the system artifacts named in ``names``.
+
+    A name may be the basename of a system artifact, which is used as
+    it is, or the name of a system artifact, such as
+    ``base-system-x86_64-generic-rootfs``, in which case the most
+    recently used cached artifact of that name is picked. Names that
+    match nothing in the cache are ignored.
+
+    '''
+    basenames = set()
+    for name in names:
+        if cachekey_pattern.match(name):
+            basenames.add(name)
+            continue
+        artifact = 'system.%s' % name
+        candidates = [e for e in entries if artifact in e.artifacts]
+        if candidates:
+            latest = max(candidates, key=lambda e: e.last_used)
+            basenames.add('%s.%s' % (latest.cachekey, artifact))
+        else:
+            logging.debug('No system artifact %s in the cache' % name)
+    return basenames
+
+
+def reachable_cachekeys(lac, system_basenames):
+    '''Return the cache keys of everything that makes up some systems.
+
+    That is the systems themselves, their strata, and the chunks in
+    those strata. Strata and chunks are found from the metadata that
+    is included in every system artifact, and from the chunk lists of
+    the strata, so this only needs the local artifact cache.
+
+    '''
+    keys = set()
+    for basename in system_basenames:
+        keys.add(basename[:64])
+        path = lac.local_path(basename)
+        if path is None:
+            continue
+        for meta in morphlib.bins.read_system_metadata(path).itervalues():
+            cachekey = meta.get('cache-key')
+            if cachekey is None:
+                continue
+            keys.add(cachekey)
+            if meta.get('kind') != 'stratum':
+                continue
+            stratum_path = lac.local_path(
+                '%s.stratum.%s' % (cachekey, meta['artifact-name']))
+            if stratum_path is None:
+                continue
+            with open(stratum_path) as f:
+                keys.update(chunk[:64] for chunk in json.load(f))
+    return keys
+
+
+def system_cachekeys(entries, used_before):
+    '''Return the cache keys of the systems not used since ``used_before``.
+
+    Workers remove system artifacts, since they are not needed once the
+    controller has copied them to the shared artifact cache, but one
+    that has only just been built may not have been copied yet, so it
+    is left alone until it has not been used for a while.
+
+    '''
+    return set(entry.cachekey for entry in entries
+               if entry.last_used < used_before and
+                  any(a.startswith('system.') for a in entry.artifacts))
+
+
+class CacheEvictionPlanner(object):
+
+    '''Decide which sources to remove from the artifact cache.
+
+    Sources used before ``always_delete_before`` are always removed,
+    and sources used after ``keep_after`` never are. Among the rest,
+    sources are removed until enough space is freed, starting with the
+    ones that are cheapest to lose for the space they take.
+
+    The value of keeping a source is the time it would take to build it
+    again, divided by its size, and discounted by how long ago it was
+    last used: something unused for ``recency_scale`` seconds is worth
+    half as much as something used just now. Sources with no recorded
+    build time, for example because they were fetched from an older
+    cache server, are assumed to take as long as the median of the
+    known build times.
+
+    Pinned sources are never removed.
+
+    '''
+
+    def __init__(self, now, always_delete_before, keep_after,
+                 recency_scale=60*60*24):
+        self.now = now
+        self.always_delete_before = always_delete_before
+        self.keep_after = keep_after
+        self.recency_scale = float(recency_scale)
+
+    def _default_build_time(self, entries):
+        times = sorted(e.build_time for e in entries
+                       if e.build_time is not None)
+        if not times:
+            return 0.0
+        return times[len(times) // 2]
+
+    def value(self, entry, default_build_time=0.0):
+        '''Return how much keeping ``entry`` is worth per byte.'''
+        build_time = entry.build_time
+        if build_time is None:
+            build_time = default_build_time
+        age = max(0.0, self.now - entry.last_used)
+        return (build_time / max(entry.size, 1) /
+                (1.0 + age / self.recency_scale))
+
+    def plan(self, entries, pinned, needed, always_remove=()):
+        '''Return the entries to remove to free ``needed`` bytes.
+
+        Entries that must be removed because of their age, or because
+        their cache key is in ``always_remove``, are included even if
+        that frees more than ``needed``, and the result may free less if
+        there is not enough that may be removed.
+
+        '''
+        default_build_time = self._default_build_time(entries)
+        always = []
+        maybe = []
+        for entry in entries:
+            if entry.cachekey in pinned:
+                continue
+            if entry.cachekey in always_remove:
+                always.append(entry)
+            elif entry.last_used >= self.keep_after:
+                continue
+            elif entry.last_used < self.always_delete_before:
+                always.append(entry)
+            else:
+                maybe.append(entry)
+
+        plan = list(always)
+        freed = sum(e.size for e in always)
+        # Of sources worth the same, removing the biggest frees the space
+        # with the fewest rebuilds.
+        maybe.sort(key=lambda e: (self.value(e, default_build_time), -e.size))
+        for entry in maybe:
+            if freed >= needed:
+                break
+            plan.append(entry)
+            freed += entry.size
+        return plan
@@ -0,0 +1,210 @@
+# Copyright (C) 2014  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import json
+import os
+import shutil
+import StringIO
+import tarfile
+import tempfile
+import unittest
+
+import morphlib
+from morphlib.cacheevictionplanner import CacheEntry
+
+
+class FakeLocalArtifactCache(object):
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+
+    def local_path(self, filename):
+        path = os.path.join(self.dirname, filename)
+        if os.path.exists(path):
+            return path
+        return None
+
+    def list_sizes(self):
+        return [('key', set(['chunk.foo']), 10, 20)]
+
+
+class CacheContentsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.lac = FakeLocalArtifactCache(self.tempdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def write(self, filename, data):
+        with open(os.path.join(self.tempdir, filename), 'w') as f:
+            f.write(data)
+
+    def write_system(self, basename, metas):
+        with tarfile.open(os.path.join(self.tempdir, basename), 'w') as tar:
+            for name, meta in metas.iteritems():
+                data = json.dumps(meta)
+                info = tarfile.TarInfo('baserock/%s.meta' % name)
+                info.size = len(data)
+                tar.addfile(info, StringIO.StringIO(data))
+
+    def test_reads_recorded_build_time(self):
+        self.write('key.meta', json.dumps(
+            {'build-times': {'overall-build': {'delta': '12.5000'}}}))
+        self.assertEqual(
+            morphlib.cacheevictionplanner.read_build_time(self.lac, 'key'),
+            12.5)
+
+    def test_build_time_is_none_if_not_recorded(self):
+        self.assertEqual(
+            morphlib.cacheevictionplanner.read_build_time(self.lac, 'key'),
+            None)
+        self.write('key.meta', '{}')
+        self.assertEqual(
+            morphlib.cacheevictionplanner.read_build_time(self.lac, 'key'),
+            None)
+
+    def test_lists_entries_with_build_times(self):
+        self.write('key.meta', json.dumps(
+            {'build-times': {'overall-build': {'delta': '1.0000'}}}))
+        self.assertEqual(
+            morphlib.cacheevictionplanner.cache_entries(self.lac),
+            [CacheEntry('key', set(['chunk.foo']), 10, 20, 1.0)])
+
+    def test_finds_most_recent_system_artifact_by_name(self):
+        old = '0' * 64
+        new = '1' * 64
+        entries = [
+            CacheEntry(old, set(['system.foo-rootfs']), 1, 10, None),
+            CacheEntry(new, set(['system.foo-rootfs']), 1, 20, None),
+        ]
+        self.assertEqual(
+            morphlib.cacheevictionplanner.find_system_artifacts(
+                entries, ['foo-rootfs', 'bar-rootfs',
+                          '%s.system.foo-rootfs' % old]),
+            set(['%s.system.foo-rootfs' % new,
+                 '%s.system.foo-rootfs' % old]))
+
+    def test_finds_strata_and_chunks_of_system(self):
+        system = '0' * 64 + '.system.foo-rootfs'
+        stratum_key = '1' * 64
+        chunk = '2' * 64 + '.chunk.bar'
+        self.write('%s.stratum.baz-runtime' % stratum_key,
+                   json.dumps([chunk]))
+        self.write_system(system, {
+            'baz-runtime': {'kind': 'stratum', 'cache-key': stratum_key,
+                            'artifact-name': 'baz-runtime'},
+            'bar': {'kind': 'chunk', 'cache-key': '3' * 64},
+        })
+        self.assertEqual(
+            morphlib.cacheevictionplanner.reachable_cachekeys(
+                self.lac, [system]),
+            set(['0' * 64, stratum_key, '2' * 64, '3' * 64]))
+
+    def test_pins_what_it_can_find_of_incomplete_systems(self):
+        system = '0' * 64 + '.system.foo-rootfs'
+        missing = '4' * 64 + '.system.foo-rootfs'
+        stratum_key = '1' * 64
+        self.write_system(system, {
+            'baz-runtime': {'kind': 'stratum', 'cache-key': stratum_key,
+                            'artifact-name': 'baz-runtime'},
+            'foo-rootfs': {'kind': 'system'},
+        })
+        self.assertEqual(
+            morphlib.cacheevictionplanner.reachable_cachekeys(
+                self.lac, [system, missing]),
+            set(['0' * 64, '4' * 64, stratum_key]))
+
+
+    def test_finds_systems_not_used_recently(self):
+        entries = [CacheEntry('old', set(['system.foo-rootfs']), 10, 50, 1),
+                   CacheEntry('new', set(['system.foo-rootfs']), 10, 950, 1),
+                   CacheEntry('chunk', set(['chunk.foo']), 10, 50, 1)]
+        self.assertEqual(
+            morphlib.cacheevictionplanner.system_cachekeys(entries, 900),
+            set(['old']))
+
+
+class CacheEvictionPlannerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.planner = morphlib.cacheevictionplanner.CacheEvictionPlanner(
+            now=1000, always_delete_before=100, keep_after=900,
+            recency_scale=100)
+
+    def plan(self, entries, pinned=(), needed=0, always_remove=()):
+        return [entry.cachekey
+                for entry in self.planner.plan(entries, pinned, needed,
+                                               always_remove)]
+
+    def test_always_removes_old_entries(self):
+        entries = [CacheEntry('old', set(), 10, 50, 1000)]
+        self.assertEqual(self.plan(entries), ['old'])
+
+    def test_always_removes_entries_it_is_told_to_unless_pinned(self):
+        entries = [CacheEntry('new', set(), 10, 950, 1),
+                   CacheEntry('pinned', set(), 10, 950, 1)]
+        self.assertEqual(self.plan(entries, pinned=['pinned'],
+                                   always_remove=['new', 'pinned']),
+                         ['new'])
+
+    def test_keeps_just_built_system_when_removing_systems(self):
+        entries = [CacheEntry('old', set(['system.foo-rootfs']), 10, 50, 1),
+                   CacheEntry('new', set(['system.foo-rootfs']), 10, 999, 1)]
+        always_remove = morphlib.cacheevictionplanner.system_cachekeys(
+            entries, 1000 - 60)
+        self.assertEqual(self.plan(entries, needed=100,
+                                   always_remove=always_remove),
+                         ['old'])
+
+    def test_never_removes_recent_entries(self):
+        entries = [CacheEntry('new', set(), 10, 950, 1)]
+        self.assertEqual(self.plan(entries, needed=100), [])
+
+    def test_never_removes_pinned_entries(self):
+        entries = [CacheEntry('old', set(), 10, 50, 1),
+                   CacheEntry('mid', set(), 10, 500, 1)]
+        self.assertEqual(self.plan(entries, pinned=['old', 'mid'],
+                                   needed=100), [])
+
+    def test_removes_only_as_much_as_needed(self):
+        entries = [CacheEntry('a', set(), 10, 500, 1),
+                   CacheEntry('b', set(), 10, 500, 2),
+                   CacheEntry('c', set(), 10, 500, 3)]
+        self.assertEqual(self.plan(entries, needed=15), ['a', 'b'])
+
+    def test_keeps_expensive_entries_over_cheap_big_ones(self):
+        entries = [CacheEntry('gcc', set(), 100, 500, 7200),
+                   CacheEntry('docs', set(), 1000, 500, 5)]
+        self.assertEqual(self.plan(entries, needed=50), ['docs'])
+
+    def test_prefers_removing_less_recently_used_entries(self):
+        entries = [CacheEntry('recent', set(), 10, 800, 10),
+                   CacheEntry('stale', set(), 10, 200, 10)]
+        self.assertEqual(self.plan(entries, needed=10), ['stale'])
+
+    def test_unknown_build_time_is_median_of_known(self):
+        entries = [CacheEntry('a', set(), 10, 500, 1),
+                   CacheEntry('b', set(), 10, 500, 50),
+                   CacheEntry('c', set(), 10, 500, 100),
+                   CacheEntry('unknown', set(), 10, 500, None)]
+        self.assertEqual(self.plan(entries, needed=20), ['a', 'b'])
+
+    def test_removes_largest_first_without_build_times(self):
+        entries = [CacheEntry('small', set(), 10, 500, None),
+                   CacheEntry('big', set(), 100, 500, None)]
+        self.assertEqual(self.plan(entries, needed=50), ['big'])
@@ -0,0 +1,134 @@
+# Copyright (C) 2014  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import logging
+import sys
+import threading
+
+
+class _Failures(object):
+
+    '''The errors from the deployments of a run, in order of failure.'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.exc_infos = []
+
+    def add(self, exc_info):
+        with self.lock:
+            self.exc_infos.append(exc_info)
+
+    def __nonzero__(self):
+        return bool(self.exc_infos)
+
+
+def _deploy_serially(deployment, setup, write):
+    setup(deployment)
+    for child in deployment.children:
+        _deploy_serially(child, setup, write)
+    write(deployment)
+
+
+def _deploy_in_thread(deployment, setup, write, slots, failures):
+    try:
+        if not deployment.children:
+            # Keep the slot until the deployment is written, so that no
+            # more than the limit are set up, using disk, at once.
+            with slots:
+                if failures:
+                    return
+                setup(deployment)
+                write(deployment)
+            return
+
+        # The children need the slots, so a deployment with children
+        # cannot keep one while they are deployed.
+        with slots:
+            if failures:
+                return
+            setup(deployment)
+        threads = _start_threads(deployment.children, setup, write, slots,
+                                 failures)
+        for thread in threads:
+            thread.join()
+        with slots:
+            if failures:
+                return
+            write(deployment)
+    except BaseException:
+        failures.add(sys.exc_info())
+
+
+def _deploy_tree_in_thread(deployment, setup, write, slots, failures,
+                           trees):
+    with trees:
+        _deploy_in_thread(deployment, setup, write, slots, failures)
+
+
+def _start_threads(deployments, setup, write, slots, failures,
+                   trees=None):
+    threads = []
+    for deployment in deployments:
+        if trees is None:
+            target = _deploy_in_thread
+            args = (deployment, setup, write, slots, failures)
+        else:
+            target = _deploy_tree_in_thread
+            args = (deployment, setup, write, slots, failures, trees)
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    return threads
+
+
+def run_deployments(deployments, setup, write, jobs=1):
+    '''Set up and write a tree of deployments, up to ``jobs`` at a time.
+
+    Every deployment has a list of ``children``: the deployments nested
+    in it, which are written into it. ``setup(deployment)`` is called for
+    every deployment before its children, and ``write(deployment)`` after
+    all of its children have been written. Otherwise deployments are
+    independent of each other, and at most ``jobs`` of them are being set
+    up or written at any one time. A deployment without children keeps
+    its place from being set up until it has been written, and at most
+    ``jobs`` of the ``deployments`` given are in progress at once, with
+    their children, so that the disk used for deployments that have been
+    set up does not grow with the number of deployments.
+
+    If a deployment fails, no more deployments are started, and once the
+    ones that are running have finished, the first error is raised again.
+
+    '''
+
+    if jobs <= 1:
+        for deployment in deployments:
+            _deploy_serially(deployment, setup, write)
+        return
+
+    slots = threading.Semaphore(jobs)
+    trees = threading.Semaphore(jobs)
+    failures = _Failures()
+    for thread in _start_threads(deployments, setup, write, slots, failures,
+                                 trees):
+        thread.join()
+
+    if failures:
+        for exc_info in failures.exc_infos[1:]:
+            logging.error('Another deployment also failed',
+                          exc_info=exc_info)
+        exc_type, exc_value, exc_tb = failures.exc_infos[0]
+        raise exc_type, exc_value, exc_tb
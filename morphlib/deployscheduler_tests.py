@@ -0,0 +1,148 @@
+# Copyright (C) 2014  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import threading
+import time
+import unittest
+
+import morphlib
+
+
+class FakeDeployment(object):
+
+    def __init__(self, name, children=()):
+        self.name = name
+        self.children = list(children)
+
+
+class Recorder(object):
+
+    def __init__(self, fail=(), delay=0):
+        self.lock = threading.Lock()
+        self.events = []
+        self.fail = fail
+        self.delay = delay
+        self.running = 0
+        self.max_running = 0
+
+    def _record(self, step, deployment):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(self.delay)
+        with self.lock:
+            self.running -= 1
+            self.events.append((step, deployment.name))
+        if (step, deployment.name) in self.fail:
+            raise Exception('%s of %s failed' % (step, deployment.name))
+
+    def setup(self, deployment):
+        self._record('setup', deployment)
+
+    def write(self, deployment):
+        self._record('write', deployment)
+
+
+class RunDeploymentsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.cluster = [
+            FakeDeployment('a', [FakeDeployment('a1'),
+                                 FakeDeployment('a2')]),
+            FakeDeployment('b'),
+            FakeDeployment('c'),
+        ]
+
+    def run_deployments(self, recorder, jobs):
+        morphlib.deployscheduler.run_deployments(
+            self.cluster, recorder.setup, recorder.write, jobs)
+
+    def test_deploys_serially_in_order_with_one_job(self):
+        recorder = Recorder()
+        self.run_deployments(recorder, 1)
+        self.assertEqual(recorder.events,
+                         [('setup', 'a'),
+                          ('setup', 'a1'), ('write', 'a1'),
+                          ('setup', 'a2'), ('write', 'a2'),
+                          ('write', 'a'),
+                          ('setup', 'b'), ('write', 'b'),
+                          ('setup', 'c'), ('write', 'c')])
+
+    def test_deploys_everything_with_several_jobs(self):
+        recorder = Recorder()
+        self.run_deployments(recorder, 3)
+        self.assertEqual(
+            sorted(recorder.events),
+            sorted((step, name)
+                   for name in ('a', 'a1', 'a2', 'b', 'c')
+                   for step in ('setup', 'write')))
+
+    def test_writes_parent_after_setup_and_children(self):
+        recorder = Recorder(delay=0.01)
+        self.run_deployments(recorder, 3)
+        events = recorder.events
+        for child in ('a1', 'a2'):
+            self.assertTrue(events.index(('setup', 'a')) <
+                            events.index(('setup', child)))
+            self.assertTrue(events.index(('write', child)) <
+                            events.index(('write', 'a')))
+
+    def test_runs_deployments_concurrently_up_to_the_limit(self):
+        recorder = Recorder(delay=0.05)
+        self.run_deployments(recorder, 2)
+        self.assertEqual(recorder.max_running, 2)
+
+    def most_set_up_at_once(self, events, names):
+        set_up = set()
+        most = 0
+        for step, name in events:
+            if name not in names:
+                continue
+            if step == 'setup':
+                set_up.add(name)
+            else:
+                set_up.discard(name)
+            most = max(most, len(set_up))
+        return most
+
+    def test_sets_up_no_more_than_the_limit_before_writing(self):
+        self.cluster = [FakeDeployment(name) for name in 'abcdef']
+        recorder = Recorder(delay=0.01)
+        self.run_deployments(recorder, 2)
+        self.assertEqual(
+            self.most_set_up_at_once(recorder.events, 'abcdef'), 2)
+
+    def test_deploys_no_more_than_the_limit_of_trees_at_once(self):
+        self.cluster = [FakeDeployment(name, [FakeDeployment(name + '1')])
+                        for name in 'abcdef']
+        recorder = Recorder(delay=0.01)
+        self.run_deployments(recorder, 2)
+        self.assertEqual(
+            self.most_set_up_at_once(recorder.events, 'abcdef'), 2)
+
+    def test_raises_first_error(self):
+        recorder = Recorder(fail=[('setup', 'b')])
+        self.assertRaises(Exception, self.run_deployments, recorder, 3)
+
+    def test_does_not_write_parent_if_child_fails(self):
+        recorder = Recorder(fail=[('write', 'a1')])
+        self.assertRaises(Exception, self.run_deployments, recorder, 3)
+        self.assertFalse(('write', 'a') in recorder.events)
+
+    def test_stops_at_first_error_with_one_job(self):
+        recorder = Recorder(fail=[('setup', 'a')])
+        self.assertRaises(Exception, self.run_deployments, recorder, 1)
+        self.assertEqual(recorder.events, [('setup', 'a')])
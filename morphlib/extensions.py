@@ -160,6 +160,27 @@ class get_extension_filename():
             os.remove(self.ext_filename)
 
 
+TAR_STREAM_DECLARATION = '# morph: write-extension-reads-tar-stream'
+
+def reads_tar_stream(filename):
+    '''Say whether the write extension in 'filename' reads a tar stream.
+
+    Write extensions are normally given the unpacked directory tree of
+    the system as their first argument. One with the line
+
+        # morph: write-extension-reads-tar-stream
+
+    is given '-' instead, and a tar archive of the system on its
+    standard input, which Morph may make without unpacking the system
+    at all.
+    '''
+    with open(filename) as f:
+        for line in f:
+            if line.strip() == TAR_STREAM_DECLARATION:
+                return True
+    return False
+
+
 class _EOFWrapper(asyncore.file_wrapper):
     '''File object that reports when it hits EOF
 
@@ -203,7 +224,7 @@ class ExtensionSubprocess(object):
         self._report_stderr = report_stderr
         self._report_logger = report_logger
 
-    def run(self, filename, args, cwd, env):
+    def run(self, filename, args, cwd, env, stdin=None):
         '''Run an extension.
 
         Anything written by the extension to stdout is passed to status(), thus
@@ -211,6 +232,8 @@ class ExtensionSubprocess(object):
         environment variable MORPH_LOG_FD, and anything written here will be
         included as debug messages in Morph's log file.
 
+        The extension reads from 'stdin', a file descriptor, if it is given.
+
         '''
 
         log_read_fd, log_write_fd = os.pipe()
@@ -226,7 +249,7 @@ class ExtensionSubprocess(object):
                 os.close(log_read_fd)
             p = subprocess.Popen(
                 morphlib.util.unshared_cmdline([filename] + list(args)),
-                cwd=cwd, env=new_env,
+                cwd=cwd, env=new_env, stdin=stdin,
                 stdout=subprocess.PIPE, stderr=subprocess.PIPE,
                 preexec_fn=close_read_end)
             os.close(log_write_fd)
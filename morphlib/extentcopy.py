@@ -0,0 +1,132 @@
+# Copyright (C) 2014  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import collections
+import os
+import time
+
+
+BLOCKSIZE = 1024**2
+
+
+class CopyStats(collections.namedtuple(
+        'CopyStats', ('copied', 'skipped', 'seconds'))):
+
+    '''How much was copied, and how quickly.
+
+    ``copied`` is the number of bytes that were written, and
+    ``skipped`` the number of bytes of zeroes that were left as holes.
+
+    '''
+
+    @property
+    def rate(self):
+        '''Bytes of the input processed per second.'''
+        return (self.copied + self.skipped) / max(self.seconds, 1e-6)
+
+    def __str__(self):
+        mebibyte = float(1024**2)
+        return ('%.1f MiB copied, %.1f MiB of holes skipped, %.1f MiB/s' %
+                (self.copied / mebibyte, self.skipped / mebibyte,
+                 self.rate / mebibyte))
+
+
+class _Copier(object):
+
+    def __init__(self, blocksize):
+        self.buf = bytearray(blocksize)
+        self.zeroes = bytearray(blocksize)
+        self.copied = 0
+        self.skipped = 0
+        self.started = time.time()
+
+    def stats(self):
+        return CopyStats(self.copied, self.skipped,
+                         time.time() - self.started)
+
+    def is_zero(self, block, n):
+        '''Is the start of block, n bytes long, all zeroes?
+
+        A whole block is compared with a block of zeroes made once, since
+        that is much faster than counting the zeroes.
+
+        '''
+
+        if n == len(self.zeroes):
+            return block == self.zeroes
+        return block.count(b'\0', 0, n) == n
+
+    def fill(self, inputfp):
+        '''Read a block from inputfp, returning it and its length.
+
+        Short reads are combined in the buffer, so that less than a
+        whole block is only returned at the end of the input.
+
+        '''
+
+        size = len(self.buf)
+        data = inputfp.read(size)
+        if len(data) == size or not data:
+            return data, len(data)
+        n = len(data)
+        self.buf[:n] = data
+        while n < size:
+            data = inputfp.read(size - n)
+            if not data:
+                break
+            self.buf[n:n + len(data)] = data
+            n += len(data)
+        return self.buf, n
+
+    def copy_stream(self, inputfp, outputfp):
+        '''Copy inputfp to outputfp, which must be seekable.
+
+        Blocks of zeroes are skipped over in outputfp, leaving holes.
+
+        '''
+
+        sparse = False
+        while True:
+            block, n = self.fill(inputfp)
+            if n == 0:
+                break
+            if self.is_zero(block, n):
+                outputfp.seek(n, os.SEEK_CUR)
+                self.skipped += n
+                # The size of outputfp is wrong until we write again.
+                sparse = True
+            else:
+                outputfp.write(memoryview(block)[:n])
+                self.copied += n
+                sparse = False
+        if sparse:
+            outputfp.seek(-1, os.SEEK_CUR)
+            outputfp.write(b'\0')
+
+
+def copy_fileobj(inputfp, outputfp, blocksize=BLOCKSIZE):
+    '''Copy inputfp to outputfp, leaving holes where there are zeroes.
+
+    outputfp must be seekable, and have nothing after its current
+    position, since zeroes are skipped over rather than written.
+
+    Return a CopyStats, so callers can report the throughput.
+
+    '''
+
+    copier = _Copier(blocksize)
+    copier.copy_stream(inputfp, outputfp)
+    return copier.stats()
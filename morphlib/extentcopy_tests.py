@@ -0,0 +1,119 @@
+# Copyright (C) 2014  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import gzip
+import os
+import shutil
+import StringIO
+import tempfile
+import unittest
+
+import morphlib
+
+
+BLOCK = 4096
+
+
+class ShortReader(object):
+
+    '''A stream that returns at most a few bytes from each read.'''
+
+    def __init__(self, data):
+        self.f = StringIO.StringIO(data)
+
+    def read(self, n):
+        return self.f.read(min(n, 100))
+
+
+class CopyStatsTests(unittest.TestCase):
+
+    def test_reports_throughput(self):
+        stats = morphlib.extentcopy.CopyStats(1024**2, 3 * 1024**2, 2.0)
+        self.assertEqual(stats.rate, 2 * 1024**2)
+        self.assertEqual(
+            str(stats),
+            '1.0 MiB copied, 3.0 MiB of holes skipped, 2.0 MiB/s')
+
+
+class CopyFileobjTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.source = os.path.join(self.tempdir, 'source')
+        self.target = os.path.join(self.tempdir, 'target')
+        with open(self.source, 'wb') as f:
+            f.write(b'foo')
+            f.seek(BLOCK)
+            f.write(b'foo')
+            f.seek(4 * BLOCK + 3)
+            f.write(b'bar')
+            f.truncate(8 * BLOCK)
+        with open(self.source, 'rb') as f:
+            self.contents = f.read()[BLOCK:]
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def read(self, filename):
+        with open(filename, 'rb') as f:
+            return f.read()
+
+    def copy_from(self, inputfp):
+        with open(self.target, 'wb') as outputfp:
+            return morphlib.extentcopy.copy_fileobj(inputfp, outputfp,
+                                                    blocksize=BLOCK)
+
+    def copy_file(self):
+        with open(self.source, 'rb') as inputfp:
+            inputfp.seek(BLOCK)
+            return self.copy_from(inputfp)
+
+    def test_copies_file_from_current_position(self):
+        self.copy_file()
+        self.assertEqual(self.read(self.target), self.contents)
+
+    def test_skips_holes_in_file(self):
+        stats = self.copy_file()
+        self.assertEqual(stats.copied + stats.skipped, len(self.contents))
+        self.assertTrue(stats.copied <= 2 * BLOCK)
+
+    def test_copies_file_to_current_position(self):
+        with open(self.source, 'rb') as inputfp:
+            with open(self.target, 'wb') as outputfp:
+                outputfp.write(b'header')
+                morphlib.extentcopy.copy_fileobj(inputfp, outputfp)
+                outputfp.write(b'trailer')
+        self.assertEqual(self.read(self.target),
+                         b'header' + self.read(self.source) + b'trailer')
+
+    def test_copies_stream_leaving_holes(self):
+        compressed = os.path.join(self.tempdir, 'source.gz')
+        with gzip.open(compressed, 'wb') as f:
+            f.write(self.contents)
+        with gzip.open(compressed, 'rb') as f:
+            stats = self.copy_from(f)
+        self.assertEqual(self.read(self.target), self.contents)
+        self.assertEqual(stats.copied, 2 * BLOCK)
+        self.assertEqual(stats.skipped, len(self.contents) - 2 * BLOCK)
+
+    def test_combines_short_reads(self):
+        stats = self.copy_from(ShortReader(self.contents))
+        self.assertEqual(self.read(self.target), self.contents)
+        self.assertEqual(stats.copied, 2 * BLOCK)
+
+    def test_writes_size_of_stream_ending_in_zeroes(self):
+        self.copy_from(ShortReader(b'foo' + b'\0' * (2 * BLOCK)))
+        self.assertEqual(self.read(self.target), b'foo' + b'\0' * (2 * BLOCK))
@@ -57,6 +57,13 @@ def mount(runcmd, partition, mount_point, fstype=None): # pragma: no cover
     runcmd(['mount', partition, mount_point] + fstype)
 
 
+def mount_overlay(runcmd, lowerdir, upperdir, workdir,
+                  mount_point): # pragma: no cover
+    runcmd(['mount', '-t', 'overlay', 'overlay', mount_point, '-o',
+            'lowerdir=%s,upperdir=%s,workdir=%s' %
+            (lowerdir, upperdir, workdir)])
+
+
 def unmount(runcmd, mount_point): # pragma: no cover
     runcmd(['umount', mount_point])
 
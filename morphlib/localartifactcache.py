@@ -14,14 +14,27 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 
-import collections
+import errno
 import os
-import time
 
 import morphlib
 
 
-class LocalArtifactCache(object):
+# The files kept next to an artifact, which go wherever it goes.
+_sidecar_filenames = (
+    morphlib.artifactdigest.digest_filename,
+    morphlib.bins.member_index_filename,
+)
+
+
+def open_index(dirname):
+    '''Open the index of the artifact cache directory ``dirname``.'''
+    return morphlib.artifactcacheindex.ArtifactCacheIndex(
+        dirname, sidecar_suffixes=[sidecar('') for sidecar
+                                   in _sidecar_filenames])
+
+
+class LocalArtifactCache(morphlib.artifactstore.ArtifactStore):
     '''Abstraction over the local artifact cache
 
        It provides methods for getting a file handle to cached artifacts
@@ -43,29 +56,66 @@ class LocalArtifactCache(object):
 
        Since the cleanup logic will be complicated for other reasons it makes
        sense to put the complication there.
+
+       The content digest of every artifact is computed while it is being
+       written, and stored next to it, see morphlib.artifactdigest.
+
+       Files can be brought in from another artifact store without copying
+       their data with ``link_from``, if that store keeps them on the same
+       filesystem.
        '''
 
-    def __init__(self, cachefs):
+    def __init__(self, cachefs, index=None):
         self.cachefs = cachefs
+        if index is None:
+            index = open_index(self._join('/'))
+        self.index = index
 
     def put(self, artifact):
         filename = self.artifact_filename(artifact)
-        return morphlib.savefile.SaveFile(filename, mode='w')
+        return IndexedDigestSaveFile(self.index, filename, mode='w')
 
     def put_artifact_metadata(self, artifact, name):
         filename = self._artifact_metadata_filename(artifact, name)
-        return morphlib.savefile.SaveFile(filename, mode='w')
+        return IndexedSaveFile(self.index, filename, mode='w')
 
     def put_source_metadata(self, source, cachekey, name):
         filename = self._source_metadata_filename(source, cachekey, name)
-        return morphlib.savefile.SaveFile(filename, mode='w')
+        return IndexedSaveFile(self.index, filename, mode='w')
+
+    def put_member_index(self, artifact):
+        '''Write the member index of a tarball artifact next to it.
+
+        This lets the files in the artifact be read without unpacking
+        it, see morphlib.bins.TarballMembers.
+
+        '''
+        filename = self.artifact_filename(artifact)
+        morphlib.bins.write_member_index(filename)
+        self.register(morphlib.bins.member_index_filename(filename))
+
+    def register(self, filename):
+        '''Record a file that was put in the cache directory by hand.
+
+        This is for files written to a path returned by, for example,
+        ``get_source_metadata_filename``, rather than through ``put``.
+
+        '''
+        self.index.add([os.path.basename(filename)])
+
+    def _use(self, filename):
+        os.utime(filename, None)
+        self.index.touch([os.path.basename(filename)])
 
     def _has_file(self, filename):
         if os.path.exists(filename):
-            os.utime(filename, None)
+            self._use(filename)
             return True
         return False
 
+    def has_many(self, filenames):
+        return set(f for f in filenames if self._has_file(self._join(f)))
+
     def has(self, artifact):
         filename = self.artifact_filename(artifact)
         return self._has_file(filename)
@@ -78,14 +128,19 @@ class LocalArtifactCache(object):
         filename = self._source_metadata_filename(source, cachekey, name)
         return self._has_file(filename)
 
+    def open(self, filename):
+        filename = self._join(filename)
+        self._use(filename)
+        return open(filename)
+
     def get(self, artifact):
         filename = self.artifact_filename(artifact)
-        os.utime(filename, None)
+        self._use(filename)
         return open(filename)
 
     def get_artifact_metadata(self, artifact, name):
         filename = self._artifact_metadata_filename(artifact, name)
-        os.utime(filename, None)
+        self._use(filename)
         return open(filename)
 
     def get_source_metadata_filename(self, source, cachekey, name):
@@ -93,7 +148,7 @@ class LocalArtifactCache(object):
 
     def get_source_metadata(self, source, cachekey, name):
         filename = self._source_metadata_filename(source, cachekey, name)
-        os.utime(filename, None)
+        self._use(filename)
         return open(filename)
 
     def _join(self, basename):
@@ -104,6 +159,55 @@ class LocalArtifactCache(object):
         '''
         return str(self.cachefs.getsyspath(basename))
 
+    def local_path(self, filename):
+        path = self._join(filename)
+        if os.path.exists(path):
+            return path
+        return None
+
+    def link_from(self, store, filenames):
+        '''Put files from another artifact store in the cache without copying.
+
+        Each file is reflinked, or hard linked if that is not possible,
+        along with its digest if it has one. This only works if ``store``
+        has all of the files on the same filesystem as this cache. If
+        any file can't be linked, the ones already linked are removed
+        again and False is returned, so the caller can copy them instead.
+
+        '''
+        paths = [store.local_path(f) for f in filenames]
+        if None in paths:
+            return False
+        linked = []
+        try:
+            for path, filename in zip(paths, filenames):
+                target = self._join(filename)
+                if not morphlib.util.clone_file(path, target):
+                    break
+                linked.append(target)
+                for sidecar in _sidecar_filenames:
+                    if os.path.exists(sidecar(path)):
+                        morphlib.util.clone_file(sidecar(path),
+                                                 sidecar(target))
+            else:
+                self.index.add(
+                    os.path.basename(p) for target in linked for p in
+                    [target] + [sidecar(target)
+                                for sidecar in _sidecar_filenames])
+                return True
+        except BaseException:
+            self._unlink_all(linked)
+            raise
+        self._unlink_all(linked)
+        return False
+
+    def _unlink_all(self, filenames):
+        for filename in filenames:
+            for path in [filename] + [sidecar(filename)
+                                      for sidecar in _sidecar_filenames]:
+                if os.path.exists(path):
+                    os.remove(path)
+
     def artifact_filename(self, artifact):
         basename = artifact.basename()
         return self._join(basename)
@@ -122,30 +226,77 @@ class LocalArtifactCache(object):
 
          '''
         for filename in self.cachefs.walkfiles():
-            self.cachefs.remove(filename)
+            if not os.path.basename(filename).startswith('.'):
+                self.cachefs.remove(filename)
+        self.index.clear()
+
+    def list(self):
+        return (filename for filename, size, used, last_used
+                in self.index.files())
 
     def list_contents(self):
         '''Return the set of sources cached and related information.
 
            returns a [(cache_key, set(artifacts), last_used)]
 
+           This is answered from the index of the cache, without looking
+           at the files themselves.
+
         '''
-        CacheInfo = collections.namedtuple('CacheInfo', ('artifacts', 'mtime'))
-        contents = collections.defaultdict(lambda: CacheInfo(set(), 0))
-        for filename in self.cachefs.walkfiles():
-            cachekey = filename[:63]
-            artifact = filename[65:]
-            artifacts, max_mtime = contents[cachekey]
-            artifacts.add(artifact)
-            art_info = self.cachefs.getinfo(filename)
-            time_t = art_info['modified_time'].timetuple()
-            contents[cachekey] = CacheInfo(artifacts,
-                                           max(max_mtime, time.mktime(time_t)))
-        return ((cache_key, info.artifacts, info.mtime)
-                for cache_key, info in contents.iteritems())
+        return ((info.cachekey,
+                 set(basename[65:] for basename in info.basenames),
+                 info.last_used)
+                for info in self.index.cachekeys())
+
+    def list_sizes(self):
+        '''Return [(cache_key, set(artifacts), size, last_used)].
+
+           ``size`` is the disk space used by all files of the cache key.
+
+        '''
+        return ((info.cachekey,
+                 set(basename[65:] for basename in info.basenames),
+                 info.size, info.last_used)
+                for info in self.index.cachekeys())
 
     def remove(self, cachekey):
         '''Remove all artifacts associated with the given cachekey.'''
-        for filename in (x for x in self.cachefs.walkfiles()
-                         if x.startswith(cachekey)):
-            self.cachefs.remove(filename)
+        for basename in self.index.remove_cachekey(cachekey):
+            filename = self._join(basename)
+            try:
+                os.remove(filename)
+            except OSError, e:
+                if e.errno != errno.ENOENT:  # pragma: no cover
+                    raise
+
+
+class IndexedSaveFile(morphlib.savefile.SaveFile):
+
+    '''A SaveFile which adds the file to an artifact cache index on close.'''
+
+    def __init__(self, index, filename, *args, **kwargs):
+        morphlib.savefile.SaveFile.__init__(self, filename, *args, **kwargs)
+        self.index = index
+
+    def close(self):
+        ret = morphlib.savefile.SaveFile.close(self)
+        self.index.add([os.path.basename(self.real_filename)])
+        return ret
+
+
+class IndexedDigestSaveFile(morphlib.artifactdigest.DigestSaveFile):
+
+    '''A DigestSaveFile which adds the file and its digest to an index.'''
+
+    def __init__(self, index, filename, *args, **kwargs):
+        morphlib.artifactdigest.DigestSaveFile.__init__(
+            self, filename, *args, **kwargs)
+        self.index = index
+
+    def close(self):
+        ret = morphlib.artifactdigest.DigestSaveFile.close(self)
+        filename = self.real_filename
+        self.index.add(
+            os.path.basename(f) for f in
+            (filename, morphlib.artifactdigest.digest_filename(filename)))
+        return ret
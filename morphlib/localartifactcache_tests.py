@@ -14,6 +14,9 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 
+import hashlib
+import StringIO
+import tarfile
 import unittest
 import os
 
@@ -116,6 +119,41 @@ class LocalArtifactCacheTests(unittest.TestCase):
 
         self.assertEqual(stored_data, 'devel')
 
+    def test_put_artifact_and_get_its_digest(self):
+        cache = morphlib.localartifactcache.LocalArtifactCache(self.tempfs)
+
+        filename = cache.artifact_filename(self.runtime_artifact)
+        self.assertEqual(morphlib.artifactdigest.read_digest(filename), None)
+
+        handle = cache.put(self.runtime_artifact)
+        handle.write('runtime')
+        handle.close()
+
+        self.assertEqual(morphlib.artifactdigest.read_digest(filename),
+                         hashlib.sha256('runtime').hexdigest())
+
+    def test_put_member_index_and_remove_it_with_the_artifact(self):
+        cache = morphlib.localartifactcache.LocalArtifactCache(self.tempfs)
+
+        handle = cache.put(self.runtime_artifact)
+        tar = tarfile.open(fileobj=handle, mode='w:')
+        info = tarfile.TarInfo('usr/bin/foo')
+        info.size = len('foo')
+        tar.addfile(info, StringIO.StringIO('foo'))
+        tar.close()
+        handle.close()
+        cache.put_member_index(self.runtime_artifact)
+
+        filename = cache.artifact_filename(self.runtime_artifact)
+        index = morphlib.bins.member_index_filename(filename)
+        self.assertTrue(os.path.exists(index))
+        self.assertEqual(list(cache.list()), [os.path.basename(filename)])
+        with morphlib.bins.TarballMembers(filename) as members:
+            self.assertEqual(members.read('usr/bin/foo'), 'foo')
+
+        cache.remove(self.source.cache_key)
+        self.assertFalse(os.path.exists(index))
+
     def test_put_check_and_get_artifact_metadata(self):
         cache = morphlib.localartifactcache.LocalArtifactCache(self.tempfs)
 
@@ -190,3 +228,48 @@ class LocalArtifactCacheTests(unittest.TestCase):
         cache.remove(key)
 
         self.assertEqual(len(list(cache.list_contents())), 0)
+
+    def test_lists_sizes_of_cached_sources(self):
+        cache = morphlib.localartifactcache.LocalArtifactCache(self.tempfs)
+
+        handle = cache.put(self.runtime_artifact)
+        handle.write('runtime')
+        handle.close()
+
+        (key, artifacts, size, last_used), = cache.list_sizes()
+        self.assertEqual(key, self.source.cache_key)
+        self.assertEqual(artifacts, set(['chunk.chunk-runtime']))
+        self.assertTrue(size > 0)
+
+    def test_lists_registered_files(self):
+        cache = morphlib.localartifactcache.LocalArtifactCache(self.tempfs)
+
+        filename = cache.get_source_metadata_filename(
+            self.source, self.source.cache_key, 'build-log')
+        with open(filename, 'w') as f:
+            f.write('log')
+        cache.register(filename)
+        self.assertEqual(list(cache.list()), [os.path.basename(filename)])
+
+    def test_lists_files_added_and_removed_by_others(self):
+        cache = morphlib.localartifactcache.LocalArtifactCache(self.tempfs)
+
+        filename = cache.get_source_metadata_filename(
+            self.source, self.source.cache_key, 'build-log')
+        with open(filename, 'w') as f:
+            f.write('log')
+        self.assertEqual(list(cache.list()), [os.path.basename(filename)])
+
+        os.remove(filename)
+        self.assertEqual(list(cache.list()), [])
+
+    def test_removes_files_listed_by_index(self):
+        cache = morphlib.localartifactcache.LocalArtifactCache(self.tempfs)
+
+        handle = cache.put(self.runtime_artifact)
+        handle.write('runtime')
+        handle.close()
+
+        cache.remove(self.source.cache_key)
+        self.assertFalse(cache.has(self.runtime_artifact))
+        self.assertEqual(list(cache.list()), [])
@@ -14,6 +14,7 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 
+import logging
 import os
 
 import morphlib
@@ -50,7 +51,6 @@ class MorphologyFactory(object):
         self.status = status_cb or null_status_function
 
     def get_morphology(self, reponame, sha1, filename):
-        morph_name = os.path.splitext(os.path.basename(filename))[0]
         loader = morphlib.morphloader.MorphologyLoader()
         if self._lrc.has_repo(reponame):
             self.status(msg="Looking for %s in local repo cache" % filename,
@@ -76,14 +76,56 @@ class MorphologyFactory(object):
             raise NotcachedError(reponame)
 
         if morph is None:
-            self.status(msg="File %s doesn't exist: attempting to infer "
-                            "chunk morph from repo's build system"
-                        % filename, chatty=True)
-            bs = morphlib.buildsystem.detect_build_system(file_list)
-            if bs is None:
-                raise MorphologyNotFoundError(filename)
-            morph = bs.get_morphology(morph_name)
-            loader.validate(morph)
-            loader.set_commands(morph)
-            loader.set_defaults(morph)
+            morph = self._infer_morphology(filename, file_list)
+        return morph
+
+    def get_morphologies(self, keys):
+        '''Get many morphologies, given (reponame, sha1, filename) keys.
+
+        Returns a dict mapping each key to its morphology. Morphologies
+        from repos that are not in the local repo cache are fetched from
+        the remote repo cache with a single request.
+
+        '''
+        keys = set(keys)
+        remote = set()
+        if self._rrc is not None:
+            remote = set(key for key in keys
+                         if not self._lrc.has_repo(key[0]))
+        texts = None
+        if remote:
+            self.status(msg="Retrieving %(count)d morphologies from the "
+                            "remote git cache.",
+                        count=len(remote), chatty=True)
+            try:
+                texts = self._rrc.cat_files(remote)
+            except Exception, e:
+                logging.warning('Caught (and ignored) exception: %s' % str(e))
+
+        loader = morphlib.morphloader.MorphologyLoader()
+        morphs = {}
+        for key in keys:
+            if texts is None or key not in remote:
+                morphs[key] = self.get_morphology(*key)
+            elif key in texts:
+                morphs[key] = loader.load_from_string(texts[key])
+            else:
+                reponame, sha1, filename = key
+                morphs[key] = self._infer_morphology(
+                    filename, self._rrc.ls_tree(reponame, sha1))
+        return morphs
+
+    def _infer_morphology(self, filename, file_list):
+        morph_name = os.path.splitext(os.path.basename(filename))[0]
+        loader = morphlib.morphloader.MorphologyLoader()
+        self.status(msg="File %s doesn't exist: attempting to infer "
+                        "chunk morph from repo's build system"
+                    % filename, chatty=True)
+        bs = morphlib.buildsystem.detect_build_system(file_list)
+        if bs is None:
+            raise MorphologyNotFoundError(filename)
+        morph = bs.get_morphology(morph_name)
+        loader.validate(morph)
+        loader.set_commands(morph)
+        loader.set_defaults(morph)
         return morph
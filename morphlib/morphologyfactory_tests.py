@@ -34,6 +34,15 @@ class FakeRemoteRepoCache(object):
              }''' % filename[:-len('.morph')]
         return 'text'
 
+    def cat_files(self, triplets):
+        files = {}
+        for triplet in triplets:
+            try:
+                files[triplet] = self.cat_file(*triplet)
+            except CatFileError:
+                pass
+        return files
+
     def ls_tree(self, reponame, sha1):
         return []
 
@@ -209,6 +218,38 @@ class MorphologyFactoryTests(unittest.TestCase):
                                        'assumed-remote.morph')
         self.assertEqual('assumed-remote', morph['name'])
 
+    def test_gets_many_morphs_from_remote_repo(self):
+        self.lrc.has_repo = self.doesnothaverepo
+        keys = [('reponame', 'sha1', 'remote-chunk.morph'),
+                ('reponame', 'sha1', 'other-chunk.morph')]
+        morphs = self.mf.get_morphologies(keys)
+        self.assertEqual(morphs[keys[0]]['name'], 'remote-chunk')
+        self.assertEqual(morphs[keys[1]]['name'], 'other-chunk')
+
+    def test_gets_many_morphs_from_local_repo(self):
+        keys = [('reponame', 'sha1', 'chunk.morph'),
+                ('reponame', 'sha1', 'chunk-split.morph')]
+        morphs = self.mf.get_morphologies(keys)
+        self.assertEqual(morphs[keys[0]]['name'], 'chunk')
+        self.assertEqual(morphs[keys[1]]['name'], 'chunk-split')
+
+    def test_autodetects_many_remote_morphologies(self):
+        self.lrc.has_repo = self.doesnothaverepo
+        self.rrc.cat_file = self.noremotemorph
+        self.rrc.ls_tree = self.autotoolsbuildsystem
+        key = ('reponame', 'sha1', 'assumed-remote.morph')
+        morphs = self.mf.get_morphologies([key])
+        self.assertEqual(morphs[key]['name'], 'assumed-remote')
+
+    def test_gets_morphs_one_by_one_if_batch_request_fails(self):
+        def fail(triplets):
+            raise IOError('connection refused')
+        self.lrc.has_repo = self.doesnothaverepo
+        self.rrc.cat_files = fail
+        key = ('reponame', 'sha1', 'remote-chunk.morph')
+        morphs = self.mf.get_morphologies([key])
+        self.assertEqual(morphs[key]['name'], 'remote-chunk')
+
     def test_raises_error_when_no_local_morph(self):
         self.lr.cat = self.nolocalfile
         self.assertRaises(MorphologyNotFoundError, self.mf.get_morphology,
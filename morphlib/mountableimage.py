@@ -44,13 +44,15 @@ class MountableImage(object): # pragma: no cover
         try:
             with os.fdopen(tempfd, "wb") as outfh:
                 infh = gzip.open(path, "rb")
-                morphlib.util.copyfileobj(infh, outfh)
+                stats = morphlib.extentcopy.copy_fileobj(infh, outfh)
                 infh.close()
         except BaseException, e:
             logging.error('Caught exception: %s' % str(e))
             logging.info('Removing temporary file %s' % self.temp_path)
             os.unlink(self.temp_path)
             raise
+        self.app.status(msg='  Decompressed: %(stats)s', stats=stats,
+                        chatty=True)
         self.app.status(msg='  Mounting image at %(path)s',
                         path=self.temp_path, chatty=True)
         part = morphlib.fsutils.setup_device_mapping(self.app.runcmd,
@@ -18,10 +18,7 @@ import cliapp
 import glob
 import json
 import os
-import re
-import contextlib
-
-import fs.tempfs
+import tarfile
 
 import morphlib
 
@@ -37,165 +34,43 @@ class NotASystemArtifactError(cliapp.AppException):
                 self, '%s is not a system artifact' % artifact)
 
 
-class ProjectVersionGuesser(object):
-
-    def __init__(self, app, lrc, rrc, interesting_files):
-        self.app = app
-        self.lrc = lrc
-        self.rrc = rrc
-        self.interesting_files = interesting_files
-
-    def file_contents(self, repo, ref, tree):
-        filenames = [x for x in self.interesting_files if x in tree]
-        if filenames:
-            if self.lrc.has_repo(repo):
-                repository = self.lrc.get_repo(repo)
-                for filename in filenames:
-                    yield filename, repository.cat(ref, filename)
-            elif self.rrc:
-                for filename in filenames:
-                    yield filename, self.rrc.cat_file(repo, ref, filename)
-
-
-class AutotoolsVersionGuesser(ProjectVersionGuesser):
-
-    def __init__(self, app, lrc, rrc):
-        ProjectVersionGuesser.__init__(self, app, lrc, rrc, [
-            'configure.ac',
-            'configure.in',
-            'configure.ac.in',
-            'configure.in.in',
-        ])
-
-    def guess_version(self, repo, ref, tree):
-        version = None
-        for filename, data in self.file_contents(repo, ref, tree):
-            # First, try to grep for AC_INIT()
-            version = self._check_ac_init(data)
-            if version:
-                self.app.status(
-                        msg='%(repo)s: Version of %(ref)s detected '
-                            'via %(filename)s:AC_INIT: %(version)s',
-                        repo=repo, ref=ref, filename=filename,
-                        version=version, chatty=True)
-                break
-
-            # Then, try running autoconf against the configure script
-            version = self._check_autoconf_package_version(
-                repo, ref, filename, data)
-            if version:
-                self.app.status(
-                        msg='%(repo)s: Version of %(ref)s detected '
-                            'by processing %(filename)s: %(version)s',
-                        repo=repo, ref=ref, filename=filename,
-                        version=version, chatty=True)
-                break
-        return version
-
-    def _check_ac_init(self, data):
-        data = data.replace('\n', ' ')
-        for macro in ['AC_INIT', 'AM_INIT_AUTOMAKE']:
-            pattern = r'.*%s\((.*?)\).*' % macro
-            if not re.match(pattern, data):
-                continue
-            acinit = re.sub(pattern, r'\1', data)
-            if acinit:
-                version = acinit.split(',')
-                if macro == 'AM_INIT_AUTOMAKE' and len(version) == 1:
-                    continue
-                version = version[0] if len(version) == 1 else version[1]
-                version = re.sub('[\[\]]', '', version).strip()
-                version = version.split()[0]
-                if version:
-                    if version and version[0].isdigit():
-                        return version
-        return None
-
-    def _check_autoconf_package_version(self, repo, ref, filename, data):
-        with contextlib.closing(fs.tempfs.TempFS(
-                temp_dir=self.app.settings['tempdir'])) as tempdir:
-            with open(tempdir.getsyspath(filename), 'w') as f:
-                f.write(data)
-            exit_code, output, errors = self.app.runcmd_unchecked(
-                ['autoconf', filename],
-                ['grep', '^PACKAGE_VERSION='],
-                ['cut', '-d=', '-f2'],
-                ['sed', "s/'//g"],
-                cwd=tempdir.root_path)
-            version = None
-            if output:
-                output = output.strip()
-                if output and output[0].isdigit():
-                    version = output
-            if exit_code != 0:
-                self.app.status(
-                    msg='%(repo)s: Failed to detect version from '
-                    '%(ref)s:%(filename)s',
-                    repo=repo, ref=ref, filename=filename, chatty=True)
-        return version
-
-
-class VersionGuesser(object):
+def read_metadata_dir(artifact, dirname):
+    # Try to find a directory with baserock metadata files.
+    metadirs = [
+        os.path.join(dirname, 'factory', 'baserock'),
+        os.path.join(dirname, 'baserock')
+    ]
+    existing_metadirs = [x for x in metadirs if os.path.isdir(x)]
+    if not existing_metadirs:
+        raise NotASystemArtifactError(artifact)
+    metadir = existing_metadirs[0]
 
-    def __init__(self, app):
-        self.app = app
-        self.lrc, self.rrc = morphlib.util.new_repo_caches(app)
-        self.guessers = [
-            AutotoolsVersionGuesser(app, self.lrc, self.rrc)
-        ]
-
-    def guess_version(self, repo, ref):
-        self.app.status(msg='%(repo)s: Guessing version of %(ref)s',
-                        repo=repo, ref=ref, chatty=True)
-        version = None
-        try:
-            if self.lrc.has_repo(repo):
-                repository = self.lrc.get_repo(repo)
-                if not self.app.settings['no-git-update']:
-                    repository.update()
-                tree = repository.ls_tree(ref)
-            elif self.rrc:
-                repository = None
-                tree = self.rrc.ls_tree(repo, ref)
-            else:
-                return None
-            for guesser in self.guessers:
-                version = guesser.guess_version(repo, ref, tree)
-                if version:
-                    break
-        except cliapp.AppException, err:
-            self.app.status(msg='%(repo)s: Failed to list files in %(ref)s',
-                            repo=repo, ref=ref, chatty=True)
-        return version
+    metadatas = []
+    for metafile in glob.glob(os.path.join(metadir, '*.meta')):
+        with open(metafile) as f:
+            metadatas.append(json.load(f))
+    return metadatas
 
 
 class ManifestGenerator(object):
 
     def __init__(self, app):
         self.app = app
-        self.version_guesser = VersionGuesser(app)
-
-    def generate(self, artifact, dirname):
-        # Try to find a directory with baserock metadata files.
-        metadirs = [
-            os.path.join(dirname, 'factory', 'baserock'),
-            os.path.join(dirname, 'baserock')
-        ]
-        existing_metadirs = [x for x in metadirs if os.path.isdir(x)]
-        if not existing_metadirs:
-            raise NotASystemArtifactError(artifact)
-        metadir = existing_metadirs[0]
-
+        self.version_guesser = morphlib.versionguesser.VersionGuesser(
+            app,
+            memo_filename=os.path.join(
+                morphlib.util.create_cachedir(app.settings),
+                'version-guesses.json'),
+            jobs=app.settings['manifest-jobs'])
+
+    def generate(self, metadatas):
         # Collect all meta information about the system, its strata
         # and its chunks that we are interested in.
         artifacts = []
-        for basename in glob.glob(os.path.join(metadir, '*.meta')):
-            metafile = os.path.join(metadir, basename)
-            metadata = json.load(open(metafile))
-
-            # Try to guess the version of this artifact
-            version = self.version_guesser.guess_version(
-                    metadata['repo'], metadata['sha1'])
+        versions = self.version_guesser.guess_versions(
+            (metadata['repo'], metadata['sha1']) for metadata in metadatas)
+        for metadata in metadatas:
+            version = versions[metadata['repo'], metadata['sha1']]
             if version is None:
                 version = ''
             else:
@@ -219,7 +94,7 @@ class ManifestGenerator(object):
                 'original_ref': original_ref,
                 'sha1': metadata['sha1'][:7]
             })
-        
+
         # Generate a format string for dumping the information.
         fmt = self._generate_output_format(artifacts)
         self.app.output.write(fmt % ('ARTIFACT', 'REPOSITORY',
@@ -260,6 +135,12 @@ class ArtifactInspectionPlugin(cliapp.Plugin):
         self.app.add_subcommand('generate-manifest',
                                 self.generate_manifest,
                                 arg_synopsis='SYSTEM-ARTIFACT')
+        self.app.settings.integer(['manifest-jobs'],
+                                  'read the files of at most N repositories '
+                                  'at the same time when guessing versions '
+                                  'for generate-manifest (default: %default)',
+                                  metavar='N',
+                                  default=4)
 
     def disable(self):
         pass
@@ -288,6 +169,10 @@ class ArtifactInspectionPlugin(cliapp.Plugin):
         * the symbolic reference
         * a 7-char commit id
 
+        Guessed versions are remembered in the cache directory, so each
+        commit is only looked at once. `--manifest-jobs` sets how many
+        repositories are read at the same time.
+
         Example:
 
             morph generate-manifest /src/cache/artifacts/foo-rootfs
@@ -299,9 +184,19 @@ class ArtifactInspectionPlugin(cliapp.Plugin):
                                       'a system image as its input')
 
         artifact = args[0]
+        generator = ManifestGenerator(self.app)
+
+        # The metadata of a tarball can be read without extracting it,
+        # but disk images and older layouts need to be unpacked.
+        try:
+            metadatas = morphlib.bins.read_system_metadata(artifact).values()
+        except tarfile.TarError:
+            metadatas = []
+        if metadatas:
+            generator.generate(metadatas)
+            return
 
         def generate_manifest(dirname):
-            generator = ManifestGenerator(self.app)
-            generator.generate(artifact, dirname)
+            generator.generate(read_metadata_dir(artifact, dirname))
 
         call_in_artifact_directory(self.app, artifact, generate_manifest)
@@ -49,7 +49,9 @@ class BranchAndMergePlugin(cliapp.Plugin):
                                 arg_synopsis='BRANCH')
         group_branch = 'Branching Options'
         self.app.settings.string(['metadata-dir'],
-                                  'Set metadata location for branch-from-image'
+                                  'Set metadata location for '
+                                  'branch-from-image, either a directory '
+                                  'or a system artifact'
                                   ' (default: /baserock)',
                                   metavar='DIR',
                                   default='/baserock',
@@ -567,7 +569,8 @@ class BranchAndMergePlugin(cliapp.Plugin):
         the system was built.
 
         If --metadata-dir is not specified, it defaults to your currently
-        running system.
+        running system. It may also be a system artifact, whose metadata
+        is read without extracting it.
 
         '''
         if len(args) != 1:
@@ -622,8 +625,11 @@ class BranchAndMergePlugin(cliapp.Plugin):
         '''Load all metadata in `path` corresponding to a single System.
         '''
 
-        smd = morphlib.systemmetadatadir.SystemMetadataDir(path)
-        metadata = smd.values()
+        if os.path.isfile(path):
+            metadata = morphlib.bins.read_system_metadata(path).values()
+        else:
+            smd = morphlib.systemmetadatadir.SystemMetadataDir(path)
+            metadata = smd.values()
         systems = [md for md in metadata
                    if 'kind' in md and md['kind'] == 'system']
 
@@ -14,19 +14,39 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 
+import collections
+import fcntl
 import json
 import logging
 import os
 import shutil
+import subprocess
 import sys
-import tarfile
 import tempfile
+import threading
 import uuid
 
 import cliapp
 import morphlib
 
 
+class Deployment(object):
+
+    '''A deployment of a system in a cluster.'''
+
+    def __init__(self, name, status_prefix, artifact, deployment_type,
+                 location, env, parent):
+        self.name = name
+        self.status_prefix = status_prefix
+        self.artifact = artifact
+        self.type = deployment_type
+        self.location = location
+        self.env = env
+        self.parent = parent
+        self.children = []
+        self.system_tree = None
+
+
 class DeployPlugin(cliapp.Plugin):
 
     def enable(self):
@@ -36,6 +56,27 @@ class DeployPlugin(cliapp.Plugin):
                                   'existing cluster. Deprecated: use the '
                                   '`morph upgrade` command instead',
                                   group=group_deploy)
+        self.app.settings.boolean(['deploy-overlay'],
+                                  'unpack each system only once, and let '
+                                  'every deployment of it configure an '
+                                  'overlay of the unpacked system rather '
+                                  'than a copy of its own (needs overlayfs '
+                                  'and root privileges)',
+                                  group=group_deploy)
+        self.app.settings.integer(['deploy-jobs'],
+                                  'set up and write at most N deployments '
+                                  'of a cluster at the same time '
+                                  '(default: %default)',
+                                  metavar='N',
+                                  default=1,
+                                  group=group_deploy)
+        self.app.settings.string(['deploy-log-dir'],
+                                 'write the output of the extensions run '
+                                 'for each deployment to DEPLOYMENT.log in '
+                                 'DIR, as well as to the log of Morph',
+                                 metavar='DIR',
+                                 default='',
+                                 group=group_deploy)
         self.app.add_subcommand(
             'deploy', self.deploy,
             arg_synopsis='CLUSTER [DEPLOYMENT...] [SYSTEM.KEY=VALUE]')
@@ -308,6 +349,31 @@ class DeployPlugin(cliapp.Plugin):
         are set as environment variables when either the configuration or the
         write extension runs (except `type` and `location`).
 
+        Normally the system is unpacked separately for every deployment.
+        With `--deploy-overlay`, each system is unpacked only once, and
+        every deployment of it gets an overlay of the unpacked system in
+        which the configuration extensions make their changes. The write
+        extension reads the configured system through the overlay. This
+        needs a kernel with overlayfs, and root privileges; if the overlay
+        cannot be mounted, Morph unpacks the system as usual.
+
+        A write extension may instead read a tar archive of the system on
+        its standard input, by having the line
+        `# morph: write-extension-reads-tar-stream`; it then gets `-` in
+        place of the unpacked system. If such a deployment has no
+        configuration extensions and no subsystems, the system is not
+        unpacked at all: the archive is streamed straight from the
+        artifact cache, with deployment.meta added to the end, so the
+        only copy of the system made is the one at the target. The
+        built-in `tar` write extension works this way.
+
+        Deployments are set up and written one at a time, unless
+        `--deploy-jobs` allows more. Deployments of subsystems are always
+        written before the deployment they are nested in, but independent
+        deployments are written at the same time, each with its own status
+        prefix. With `--deploy-log-dir`, the output of the extensions run
+        for each deployment is also written to a log file of its own.
+
         Deployment configuration is stored in the deployed system as
         /baserock/deployment.meta. THIS CONTAINS ALL ENVIRONMENT VARIABLES SET
         DURING DEPLOYMENT, so make sure you have no sensitive information in
@@ -382,16 +448,41 @@ class DeployPlugin(cliapp.Plugin):
                 name=name, email=email, build_uuid=build_uuid,
                 status=self.app.status)
         with pbb as (repo, commit, original_ref):
+            # Resolve all the systems together, since they usually have
+            # most of their strata and chunks in common.
+            self.system_artifacts = build_command.resolve_systems(
+                repo, commit, self.system_filenames(
+                    cluster_morphology['systems'], deployments))
+
+            planned = []
+            for system in cluster_morphology['systems']:
+                planned.extend(self.plan_system(build_command, root_repo_dir,
+                                                commit, system, env_vars,
+                                                deployments, parent=None))
+
             # Create a tempdir for this deployment to work in
             deploy_tempdir = tempfile.mkdtemp(
                 dir=os.path.join(self.app.settings['tempdir'], 'deployments'))
+            self.unpacked_systems = {}
+            self.unpack_locks = collections.defaultdict(threading.Lock)
+            self.unpack_locks_lock = threading.Lock()
+            self.overlays = {}
+            self.streamed_systems = {}
             try:
-                for system in cluster_morphology['systems']:
-                    self.deploy_system(build_command, deploy_tempdir,
-                                       root_repo_dir, repo, commit, system,
-                                       env_vars, deployments,
-                                       parent_location='')
+                morphlib.deployscheduler.run_deployments(
+                    planned,
+                    lambda d: self.setup_deployment(build_command,
+                                                    deploy_tempdir,
+                                                    root_repo_dir, commit,
+                                                    d),
+                    lambda d: self.write_deployment(deploy_tempdir,
+                                                    root_repo_dir, commit,
+                                                    d),
+                    self.app.settings['deploy-jobs'])
             finally:
+                self.app.status_prefix = ''
+                for system_tree in self.overlays.keys():
+                    self.release_system_tree(system_tree)
                 shutil.rmtree(deploy_tempdir)
 
         self.app.status(msg='Finished deployment')
@@ -412,22 +503,46 @@ class DeployPlugin(cliapp.Plugin):
                         'Variable referenced a non-existent deployment '
                         'name: %s' % var)
 
-    def deploy_system(self, build_command, deploy_tempdir,
-                      root_repo_dir, build_repo, ref, system, env_vars,
-                      deployment_filter, parent_location):
+    def system_filenames(self, systems, deployment_filter):
+        '''Return the filenames of the systems that will be deployed.'''
+        filenames = []
+        for system in systems:
+            if deployment_filter and not any(
+                    sys_id in deployment_filter
+                    for sys_id in system['deploy']):
+                continue
+            filename = morphlib.util.sanitise_morphology_path(system['morph'])
+            if filename not in filenames:
+                filenames.append(filename)
+            for subsystem in self.system_filenames(
+                    system.get('subsystems', []), []):
+                if subsystem not in filenames:
+                    filenames.append(subsystem)
+        return filenames
+
+    def plan_system(self, build_command, root_repo_dir, ref, system,
+                    env_vars, deployment_filter, parent):
+        '''Return the deployments of a system in a cluster morphology.
+
+        The artifact of the system, which must have been resolved
+        already, is fetched if it is not in the local cache, and the
+        configuration of every deployment is worked out and checked, so
+        that problems are found before any deployment is written. The
+        deployments of subsystems are returned as the children of the
+        deployment they are nested in.
+
+        '''
         sys_ids = set(system['deploy'].iterkeys())
         if deployment_filter and not \
                 any(sys_id in deployment_filter for sys_id in sys_ids):
-            return
+            return []
         old_status_prefix = self.app.status_prefix
         system_status_prefix = '%s[%s]' % (old_status_prefix, system['morph'])
         self.app.status_prefix = system_status_prefix
+        planned = []
         try:
-            # Find the artifact to build
             morph = morphlib.util.sanitise_morphology_path(system['morph'])
-            srcpool = build_command.create_source_pool(build_repo, ref, morph)
-
-            artifact = build_command.resolve_artifacts(srcpool)
+            artifact = self.system_artifacts[morph]
 
             deploy_defaults = system.get('deploy-defaults', {})
             for system_id, deploy_params in system['deploy'].iteritems():
@@ -464,30 +579,69 @@ class DeployPlugin(cliapp.Plugin):
                     morphlib.util.sanitize_environment(final_env)
                     self.check_deploy(root_repo_dir, ref, deployment_type,
                                       location, final_env)
-                    system_tree = self.setup_deploy(build_command,
-                                                    deploy_tempdir,
-                                                    root_repo_dir,
-                                                    ref, artifact,
-                                                    deployment_type,
-                                                    location, final_env)
+                    self.cache_system_locally(build_command, artifact)
+                    deployment = Deployment(
+                        system_id, deployment_status_prefix, artifact,
+                        deployment_type, location, final_env, parent)
                     for subsystem in system.get('subsystems', []):
-                        self.deploy_system(build_command, deploy_tempdir,
-                                           root_repo_dir, build_repo,
-                                           ref, subsystem, env_vars, [],
-                                           parent_location=system_tree)
-                    if parent_location:
-                        deploy_location = os.path.join(parent_location,
-                                                       location.lstrip('/'))
-                    else:
-                        deploy_location = location
-                    self.run_deploy_commands(deploy_tempdir, final_env,
-                                             artifact, root_repo_dir,
-                                             ref, deployment_type,
-                                             system_tree, deploy_location)
+                        deployment.children.extend(self.plan_system(
+                            build_command, root_repo_dir, ref, subsystem,
+                            env_vars, [], parent=deployment))
+                    planned.append(deployment)
                 finally:
                     self.app.status_prefix = system_status_prefix
         finally:
             self.app.status_prefix = old_status_prefix
+        return planned
+
+    def setup_deployment(self, build_command, deploy_tempdir, root_repo_dir,
+                         ref, deployment):
+        self.app.status_prefix = deployment.status_prefix
+        # The system must be unpacked if anything is to be done to its
+        # files before it is written, or if subsystems are deployed into
+        # it, unless the write extension can take it as a tar stream.
+        configuration_extensions = \
+            deployment.artifact.source.morphology['configuration-extensions']
+        unpack = (configuration_extensions or deployment.children or
+                  not self.write_reads_tar_stream(deployment.type))
+        deployment.system_tree = self.setup_deploy(
+            build_command, deploy_tempdir, root_repo_dir, ref,
+            deployment.artifact, deployment.type, deployment.location,
+            deployment.env, unpack=unpack)
+
+    def write_deployment(self, deploy_tempdir, root_repo_dir, ref,
+                         deployment):
+        self.app.status_prefix = deployment.status_prefix
+        if deployment.parent is not None:
+            deploy_location = os.path.join(deployment.parent.system_tree,
+                                           deployment.location.lstrip('/'))
+        else:
+            deploy_location = deployment.location
+        log = self.open_deployment_log(deployment)
+        try:
+            self.run_deploy_commands(deploy_tempdir, deployment.env,
+                                     deployment.artifact, root_repo_dir,
+                                     ref, deployment.type,
+                                     deployment.system_tree,
+                                     deploy_location, log)
+        finally:
+            self.release_system_tree(deployment.system_tree)
+            if log is not None:
+                log.close()
+
+    def open_deployment_log(self, deployment):
+        '''Open the log file of a deployment, if they are wanted.'''
+        log_dir = self.app.settings['deploy-log-dir']
+        if not log_dir:
+            return None
+        if not os.path.isdir(log_dir):
+            try:
+                os.makedirs(log_dir)
+            except OSError:  # pragma: no cover
+                # Another deployment created it at the same time.
+                if not os.path.isdir(log_dir):
+                    raise
+        return open(os.path.join(log_dir, '%s.log' % deployment.name), 'w')
 
     def upgrade(self, args):
         '''Upgrade an existing set of instances using built images.
@@ -519,33 +673,41 @@ class DeployPlugin(cliapp.Plugin):
         except morphlib.extensions.ExtensionNotFoundError:
             pass
 
+    def write_reads_tar_stream(self, deployment_type):
+        try:
+            with morphlib.extensions.get_extension_filename(
+                    deployment_type, '.write') as fn:
+                return morphlib.extensions.reads_tar_stream(fn)
+        except morphlib.extensions.ExtensionError:
+            # It is reported when the extension is run.
+            return False
+
     def setup_deploy(self, build_command, deploy_tempdir, root_repo_dir, ref,
-                     artifact, deployment_type, location, env):
+                     artifact, deployment_type, location, env, unpack=True):
         # deployment_type, location and env are only used for saving metadata
 
         # Create a tempdir to extract the rootfs in
         system_tree = tempfile.mkdtemp(dir=deploy_tempdir)
 
         try:
-            # Unpack the artifact (tarball) to a temporary directory.
-            self.app.status(msg='Unpacking system for configuration')
-
-            if build_command.lac.has(artifact):
-                f = build_command.lac.get(artifact)
-            elif build_command.rac.has(artifact):
-                build_command.cache_artifacts_locally([artifact])
-                f = build_command.lac.get(artifact)
-            else:
-                raise cliapp.AppException('Deployment failed as system is'
-                                          ' not yet built.\nPlease ensure'
-                                          ' the system is built before'
-                                          ' deployment.')
-            tf = tarfile.open(fileobj=f)
-            tf.extractall(path=system_tree)
-
-            self.app.status(
-                msg='System unpacked at %(system_tree)s',
-                system_tree=system_tree)
+            if not unpack:
+                # Only deployment.meta is kept in system_tree, and it is
+                # added to the archive of the system as it is streamed to
+                # the write extension.
+                os.mkdir(os.path.join(system_tree, 'baserock'))
+                self.streamed_systems[system_tree] = \
+                    build_command.lac.artifact_filename(artifact)
+                self.app.status(msg='Streaming system without unpacking it')
+            elif not (self.app.settings['deploy-overlay'] and
+                    self.overlay_system(build_command, deploy_tempdir,
+                                        artifact, system_tree)):
+                # Unpack the artifact (tarball) to a temporary directory.
+                self.app.status(msg='Unpacking system for configuration')
+                self.unpack_system(build_command, artifact, system_tree)
+
+                self.app.status(
+                    msg='System unpacked at %(system_tree)s',
+                    system_tree=system_tree)
 
             self.app.status(
                 msg='Writing deployment metadata file')
@@ -558,11 +720,90 @@ class DeployPlugin(cliapp.Plugin):
                           sort_keys=True, encoding='unicode-escape')
             return system_tree
         except Exception:
+            self.release_system_tree(system_tree)
             shutil.rmtree(system_tree)
             raise
 
+    def cache_system_locally(self, build_command, artifact):
+        if build_command.lac.has(artifact):
+            return
+        elif build_command.rac.has(artifact):
+            build_command.cache_artifacts_locally([artifact])
+        else:
+            raise cliapp.AppException('Deployment failed as system is'
+                                      ' not yet built.\nPlease ensure'
+                                      ' the system is built before'
+                                      ' deployment.')
+
+    def unpack_system(self, build_command, artifact, dirname):
+        '''Unpack a system artifact from the local cache into a directory.
+
+        GNU tar reads the artifact and writes the files as it goes, which
+        is a lot quicker than extracting it with Python's tarfile module.
+
+        '''
+        self.app.runcmd(['tar', '-C', dirname, '-xf',
+                         build_command.lac.artifact_filename(artifact)])
+
+    def overlay_system(self, build_command, deploy_tempdir, artifact,
+                       system_tree):
+        '''Mount an overlay of the unpacked system artifact on system_tree.
+
+        The system is unpacked the first time one of its deployments is
+        set up, and every deployment of it then gets an overlay of its
+        own, in which its configuration is kept. This means the root
+        filesystem is only written out once more, when the write extension
+        copies it to the target.
+
+        Returns False if the overlay could not be mounted, for example
+        because the kernel does not support overlayfs.
+
+        '''
+        basename = artifact.basename()
+        # Deployments of the same system may be set up at the same time,
+        # but only one of them must unpack it.
+        with self.unpack_locks_lock:
+            unpack_lock = self.unpack_locks[basename]
+        with unpack_lock:
+            if basename not in self.unpacked_systems:
+                lowerdir = tempfile.mkdtemp(dir=deploy_tempdir)
+                self.app.status(msg='Unpacking system %(name)s',
+                                name=artifact.name)
+                self.unpack_system(build_command, artifact, lowerdir)
+                self.unpacked_systems[basename] = lowerdir
+        lowerdir = self.unpacked_systems[basename]
+
+        layerdir = tempfile.mkdtemp(dir=deploy_tempdir)
+        upperdir = os.path.join(layerdir, 'upper')
+        workdir = os.path.join(layerdir, 'work')
+        os.mkdir(upperdir)
+        os.mkdir(workdir)
+        try:
+            morphlib.fsutils.mount_overlay(self.app.runcmd, lowerdir,
+                                           upperdir, workdir, system_tree)
+        except cliapp.AppException, e:
+            logging.warning('Cannot mount overlay, unpacking the system '
+                            'for each deployment instead: %s' % e)
+            self.app.status(msg='Cannot mount overlay of the system, '
+                                'unpacking it instead')
+            shutil.rmtree(layerdir)
+            return False
+        self.overlays[system_tree] = layerdir
+        self.app.status(msg='System overlay mounted at %(system_tree)s',
+                        system_tree=system_tree)
+        return True
+
+    def release_system_tree(self, system_tree):
+        '''Unmount the overlay on system_tree, if there is one.'''
+        self.streamed_systems.pop(system_tree, None)
+        layerdir = self.overlays.pop(system_tree, None)
+        if layerdir is not None:
+            morphlib.fsutils.unmount(self.app.runcmd, system_tree)
+            shutil.rmtree(layerdir)
+
     def run_deploy_commands(self, deploy_tempdir, env, artifact, root_repo_dir,
-                            ref, deployment_type, system_tree, location):
+                            ref, deployment_type, system_tree, location,
+                            log=None):
         # Extensions get a private tempdir so we can more easily clean
         # up any files an extension left behind
         deploy_private_tempdir = tempfile.mkdtemp(dir=deploy_tempdir)
@@ -578,7 +819,7 @@ class DeployPlugin(cliapp.Plugin):
                     name,
                     '.configure',
                     [system_tree],
-                    env)
+                    env, log)
 
             # Run write extension.
             self.app.status(msg='Writing to device')
@@ -587,23 +828,33 @@ class DeployPlugin(cliapp.Plugin):
                 deployment_type,
                 '.write',
                 [system_tree, location],
-                env)
+                env, log)
 
         finally:
             # Cleanup.
             self.app.status(msg='Cleaning up')
             shutil.rmtree(deploy_private_tempdir)
 
-    def _report_extension_stdout(self, line):
-        self.app.status(msg=line.replace('%s', '%%'))
-    def _report_extension_stderr(self, error_list):
+    def _report_extension_stdout(self, log):
         def cb(line):
+            if log is not None:
+                log.write('%s\n' % line)
+            self.app.status(msg=line.replace('%s', '%%'))
+        return cb
+    def _report_extension_stderr(self, error_list, log):
+        def cb(line):
+            if log is not None:
+                log.write('%s\n' % line)
             error_list.append(line)
             sys.stderr.write('%s\n' % line)
         return cb
-    def _report_extension_logger(self, name, kind):
-        return lambda line: logging.debug('%s%s: %s', name, kind, line)
-    def _run_extension(self, gd, name, kind, args, env):
+    def _report_extension_logger(self, name, kind, log):
+        def cb(line):
+            if log is not None:
+                log.write('%s%s: %s\n' % (name, kind, line))
+            logging.debug('%s%s: %s', name, kind, line)
+        return cb
+    def _run_extension(self, gd, name, kind, args, env, log=None):
         '''Run an extension.
 
         The ``kind`` should be either ``.configure`` or ``.write``,
@@ -612,15 +863,22 @@ class DeployPlugin(cliapp.Plugin):
         The extension is found either in the git repository of the
         system morphology (repo, ref), or with the Morph code.
 
+        If ``log`` is an open file, everything the extension outputs is
+        written to it as well.
+
         '''
         error_list = []
         with morphlib.extensions.get_extension_filename(name, kind) as fn:
             ext = morphlib.extensions.ExtensionSubprocess(
-                report_stdout=self._report_extension_stdout,
-                report_stderr=self._report_extension_stderr(error_list),
-                report_logger=self._report_extension_logger(name, kind),
+                report_stdout=self._report_extension_stdout(log),
+                report_stderr=self._report_extension_stderr(error_list, log),
+                report_logger=self._report_extension_logger(name, kind, log),
             )
-            returncode = ext.run(fn, args, env=env, cwd=gd.dirname)
+            if kind == '.write' and morphlib.extensions.reads_tar_stream(fn):
+                returncode = self._run_extension_with_tar_stream(
+                    ext, fn, args, env, gd)
+            else:
+                returncode = ext.run(fn, args, env=env, cwd=gd.dirname)
         if returncode == 0:
             logging.info('%s%s succeeded', name, kind)
         else:
@@ -628,6 +886,53 @@ class DeployPlugin(cliapp.Plugin):
                 name, kind, returncode, '\n'.join(error_list))
             raise cliapp.AppException(message)
 
+    def _run_extension_with_tar_stream(self, ext, filename, args, env, gd):
+        '''Run a write extension with the system as a tar stream.
+
+        The archive is written to the standard input of the extension by
+        another thread, while this one relays what the extension outputs.
+
+        '''
+        system_tree = args[0]
+        read_fd, write_fd = os.pipe()
+        for fd in (read_fd, write_fd):
+            # Other processes must not keep the pipe open.
+            fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        errors = []
+
+        def write_stream():
+            try:
+                with os.fdopen(write_fd, 'wb') as f:
+                    self.write_tar_stream(system_tree, f)
+            except Exception, e:
+                errors.append(e)
+
+        writer = threading.Thread(target=write_stream)
+        writer.start()
+        try:
+            returncode = ext.run(filename, ['-'] + list(args[1:]),
+                                 env=env, cwd=gd.dirname, stdin=read_fd)
+        finally:
+            # If the extension did not read all of it, this stops the
+            # writer too.
+            os.close(read_fd)
+            writer.join()
+        if returncode == 0 and errors:
+            raise cliapp.AppException(
+                'Could not stream system to write extension: %s' % errors[0])
+        return returncode
+
+    def write_tar_stream(self, system_tree, f):
+        '''Write a tar archive of a system being deployed to f.'''
+        artifact_filename = self.streamed_systems.get(system_tree)
+        if artifact_filename is None:
+            subprocess.check_call(['tar', '-C', system_tree, '-cf', '-', '.'],
+                                  stdout=f)
+        else:
+            morphlib.tarstream.write_with_files(
+                artifact_filename, system_tree,
+                ['baserock/deployment.meta'], f)
+
     def create_metadata(self, system_artifact, root_repo_dir, deployment_type,
                         location, env):
         '''Deployment-specific metadata.
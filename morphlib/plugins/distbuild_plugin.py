@@ -18,7 +18,8 @@
 
 import cliapp
 import logging
-import re
+import os
+import socket
 import sys
 
 import morphlib
@@ -81,6 +82,9 @@ class WorkerBuild(cliapp.Plugin):
     def enable(self):
         self.app.add_subcommand(
             'worker-build', self.worker_build, arg_synopsis='')
+        self.app.add_subcommand(
+            'worker-build-server', self.worker_build_server,
+            arg_synopsis='')
 
     def disable(self):
         pass
@@ -94,29 +98,73 @@ class WorkerBuild(cliapp.Plugin):
         '''
         
         distbuild.add_crash_conditions(self.app.settings['crash-condition'])
+        self._build(morphlib.buildcommand.BuildCommand(self.app))
 
-        serialized = sys.stdin.readline()
-        artifact = distbuild.deserialise_artifact(serialized)
-        
-        bc = morphlib.buildcommand.BuildCommand(self.app)
+    def worker_build_server(self, args):
+        '''Internal use only: Run worker-builds in forked processes.
+
+        This is started once by distbuild-helper, which then sends the
+        standard input, output and error of each worker-build over the
+        Unix domain socket given as our standard input. Morph and its
+        caches are set up once here, rather than for every build, and
+        each build runs in a process forked from this one.
+
+        '''
+
+        distbuild.add_crash_conditions(self.app.settings['crash-condition'])
+
+        sock = socket.fromfd(0, socket.AF_UNIX, socket.SOCK_STREAM)
+        null = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(null, 0)
+        os.close(null)
 
-        # Now, before we start the build, we garbage collect the caches
-        # to ensure we have room.  First we remove all system artifacts
-        # since we never need to recover those from workers post-hoc
-        for cachekey, artifacts, last_used in bc.lac.list_contents():
-            if any(self.is_system_artifact(f) for f in artifacts):
-                logging.debug("Removing all artifacts for system %s" %
-                        cachekey)
-                bc.lac.remove(cachekey)
+        bc = morphlib.buildcommand.BuildCommand(self.app)
 
-        self.app.subcommands['gc']([])
+        def run_job():
+            try:
+                self._build(bc)
+            except cliapp.AppException, e:
+                logging.error(str(e))
+                sys.stderr.write('ERROR: %s\n' % e)
+                return 1
+            finally:
+                # The forked process exits without running atexit hooks.
+                morphlib.artifactcacheindex.flush_all()
+            return 0
+
+        distbuild.ForkServer(sock, run_job).serve()
+
+    def _build(self, bc):
+        # Controllers send just what is needed to build the artifact, as
+        # made by serialise_job, but older ones send the whole build graph.
+        serialized = sys.stdin.readline()
+        if serialized.startswith('{'):
+            artifact = distbuild.deserialise_job(serialized)
+        else:
+            artifact = distbuild.deserialise_artifact(serialized)
+
+        # Old artifacts are removed in the background by the worker
+        # daemon, so the build can normally start straight away. Only if
+        # that has not kept up do we have to make space first.
+        tempdir = self.app.settings['tempdir']
+        tempdir_min_space = self.app.settings['tempdir-min-space']
+        cachedir = self.app.settings['cachedir']
+        cachedir_min_space = self.app.settings['cachedir-min-space']
+        try:
+            morphlib.util.check_disk_available(
+                tempdir, tempdir_min_space, cachedir, cachedir_min_space)
+        except morphlib.Error:
+            logging.warning('Not enough space to build, collecting garbage')
+            # Other builds may be running on this worker, using staging
+            # areas and unpacked chunks in the temporary directory.
+            self.app.settings['gc-only-cachedir'] = True
+            self.app.subcommands['gc']([])
+            morphlib.util.check_disk_available(
+                tempdir, tempdir_min_space, cachedir, cachedir_min_space)
 
         arch = artifact.arch
         bc.build_source(artifact.source, bc.new_build_env(arch))
 
-    def is_system_artifact(self, filename):
-        return re.match(r'^[0-9a-fA-F]{64}\.system\.', filename)
-
 class WorkerDaemon(cliapp.Plugin):
 
     def enable(self):
@@ -135,6 +183,50 @@ class WorkerDaemon(cliapp.Plugin):
             'write port used by worker-daemon to FILE',
             default='',
             group=group_distbuild)
+        self.app.settings.integer(
+            ['worker-slots'],
+            'run at most N builds at the same time; distbuild-helper '
+                'must be allowed at least as many requests '
+                '(default: %default)',
+            metavar='N',
+            default=1,
+            group=group_distbuild)
+        self.app.settings.integer(
+            ['worker-cores'],
+            'tell the controller builds can share N CPU cores '
+                '(default: the number of CPU cores of this machine)',
+            metavar='N',
+            default=0,
+            group=group_distbuild)
+        self.app.settings.bytesize(
+            ['worker-memory'],
+            'tell the controller builds can share SIZE bytes of memory '
+                '(default: the memory of this machine)',
+            metavar='SIZE',
+            default='0',
+            group=group_distbuild)
+        self.app.settings.bytesize(
+            ['worker-cache-low-water'],
+            'start removing old artifacts in the background when there '
+                'are less than SIZE bytes free in the cache directory '
+                '(default: %default)',
+            metavar='SIZE',
+            default='12G',
+            group=group_distbuild)
+        self.app.settings.bytesize(
+            ['worker-cache-high-water'],
+            'when removing old artifacts in the background, make SIZE '
+                'bytes free (default: %default)',
+            metavar='SIZE',
+            default='20G',
+            group=group_distbuild)
+        self.app.settings.integer(
+            ['worker-cache-check-interval'],
+            'check the free space in the cache directory every SECONDS '
+                '(default: %default)',
+            metavar='SECONDS',
+            default=60,
+            group=group_distbuild)
         self.app.add_subcommand(
             'worker-daemon',
             self.worker_daemon,
@@ -151,10 +243,37 @@ class WorkerDaemon(cliapp.Plugin):
         address = self.app.settings['worker-daemon-address']
         port = self.app.settings['worker-daemon-port']
         port_file = self.app.settings['worker-daemon-port-file']
+        capacity = {
+            'slots': self.app.settings['worker-slots'],
+            'cores': (self.app.settings['worker-cores'] or
+                      morphlib.util.cpu_count()),
+            'memory': (self.app.settings['worker-memory'] or
+                       os.sysconf('SC_PHYS_PAGES') *
+                       os.sysconf('SC_PAGE_SIZE')),
+        }
         router = distbuild.ListenServer(address, port, distbuild.JsonRouter,
+                                        extra_args=[capacity],
                                         port_file=port_file)
         loop = distbuild.MainLoop()
         loop.add_state_machine(router)
+
+        # System artifacts are never needed on a worker once they have
+        # been uploaded, so they are the first to go.
+        gc_argv = [
+            self.app.settings['morph-instance'], 'gc',
+            '--cachedir=%s' % self.app.settings['cachedir'],
+            '--tempdir=%s' % self.app.settings['tempdir'],
+            '--gc-only-cachedir',
+            '--cachedir-delete-systems',
+        ]
+        maintainer = distbuild.CacheMaintainer(
+            self.app.settings['cachedir'],
+            self.app.settings['worker-cache-low-water'],
+            self.app.settings['worker-cache-high-water'],
+            self.app.settings['worker-cache-check-interval'],
+            gc_argv)
+        loop.add_state_machine(maintainer)
+
         loop.run()
 
 
@@ -227,6 +346,105 @@ class ControllerDaemon(cliapp.Plugin):
             default='morph',
             group=group_distbuild)
 
+        self.app.settings.string(
+            ['controller-graph-cache-dir'],
+            'remember the build graphs of systems in DIR, so they are not '
+                'computed again for the same definitions commit (default: '
+                'graphs in the cache directory)',
+            metavar='DIR',
+            default='',
+            group=group_distbuild)
+        self.app.settings.integer(
+            ['controller-graph-cache-memory'],
+            'keep at most N build graphs in memory (default: %default)',
+            metavar='N',
+            default=32,
+            group=group_distbuild)
+        self.app.settings.integer(
+            ['controller-graph-cache-files'],
+            'keep at most N build graphs on disk (default: %default)',
+            metavar='N',
+            default=1000,
+            group=group_distbuild)
+
+        self.app.settings.string(
+            ['controller-step-log-dir'],
+            'keep the output of build steps in DIR, for initiators to '
+                'be sent it as they can take it (default: step-logs in '
+                'the cache directory)',
+            metavar='DIR',
+            default='',
+            group=group_distbuild)
+        self.app.settings.integer(
+            ['controller-step-log-files'],
+            'keep the output of at most N finished build steps '
+                '(default: %default)',
+            metavar='N',
+            default=1000,
+            group=group_distbuild)
+
+        self.app.settings.string(
+            ['controller-metrics-address'],
+            'listen for requests for metrics and build traces on ADDRESS '
+                '(domain / IP address)',
+            default='',
+            group=group_distbuild)
+        self.app.settings.integer(
+            ['controller-metrics-port'],
+            'serve metrics at /metrics and build traces at /traces/ over '
+                'HTTP on PORT (default: do not serve them)',
+            default=-1,
+            group=group_distbuild)
+        self.app.settings.string(
+            ['controller-metrics-port-file'],
+            'write the port to listen for requests for metrics to FILE',
+            default='',
+            group=group_distbuild)
+        self.app.settings.string(
+            ['controller-trace-dir'],
+            'write a trace of when each step of each build ran to DIR '
+                '(default: do not write traces)',
+            metavar='DIR',
+            default='',
+            group=group_distbuild)
+
+        self.app.settings.string(
+            ['controller-journal-dir'],
+            'record the builds that are running in DIR, so that they '
+                'can carry on if the controller restarts (default: '
+                'journal in the cache directory)',
+            metavar='DIR',
+            default='',
+            group=group_distbuild)
+
+        self.app.settings.string(
+            ['controller-job-table-dir'],
+            'share the jobs of this controller with the other controllers '
+                'on this host that use DIR too, so that they can share '
+                'workers without building anything twice (default: do '
+                'not share jobs)',
+            metavar='DIR',
+            default='',
+            group=group_distbuild)
+        self.app.settings.string(
+            ['controller-name'],
+            'call this controller NAME in the job table, which must be '
+                'different for each controller sharing it (default: the '
+                'host name and initiator port)',
+            metavar='NAME',
+            default='',
+            group=group_distbuild)
+
+        self.app.settings.string(
+            ['controller-resource-history'],
+            'remember how much memory each build needed in FILE, to '
+                'avoid running builds together on a worker that does '
+                'not have the memory for them (default: '
+                'resource-history.json in the cache directory)',
+            metavar='FILE',
+            default='',
+            group=group_distbuild)
+
         self.app.add_subcommand(
             'controller-daemon', self.controller_daemon, arg_synopsis='')
 
@@ -245,6 +463,35 @@ class ControllerDaemon(cliapp.Plugin):
         worker_cache_server_port = \
             self.app.settings['worker-cache-server-port']
         morph_instance = self.app.settings['morph-instance']
+        graph_cache = distbuild.GraphCache(
+            dirname=(self.app.settings['controller-graph-cache-dir'] or
+                     os.path.join(self.app.settings['cachedir'], 'graphs')),
+            memory_entries=self.app.settings['controller-graph-cache-memory'],
+            disk_entries=self.app.settings['controller-graph-cache-files'],
+            version=morphlib.__version__)
+        trace_dir = self.app.settings['controller-trace-dir'] or None
+        if trace_dir and not os.path.exists(trace_dir):
+            os.makedirs(trace_dir)
+
+        job_table = None
+        own_cachedir = self.app.settings['cachedir']
+        if self.app.settings['controller-job-table-dir']:
+            controller_name = (
+                self.app.settings['controller-name'] or
+                '%s:%d' % (socket.getfqdn(),
+                           self.app.settings['controller-initiator-port']))
+            job_table = distbuild.JobTable(
+                self.app.settings['controller-job-table-dir'],
+                controller_name)
+            # Controllers sharing jobs may share a cache directory too,
+            # but each needs its own journal and step logs.
+            own_cachedir = os.path.join(
+                own_cachedir, 'controllers', controller_name)
+
+        journal = distbuild.Journal(
+            self.app.settings['controller-journal-dir'] or
+            os.path.join(own_cachedir, 'journal'))
+        journal.recover()
 
         listener_specs = [
             # address, port, class to initiate on connection, class init args
@@ -254,14 +501,30 @@ class ControllerDaemon(cliapp.Plugin):
             ('controller-initiator-address', 'controller-initiator-port',
              'controller-initiator-port-file',
              distbuild.InitiatorConnection, 
-             [artifact_cache_server, morph_instance]),
+             [artifact_cache_server, morph_instance, graph_cache,
+              trace_dir, journal]),
         ]
+        if self.app.settings['controller-metrics-port'] >= 0:
+            listener_specs.append(
+                ('controller-metrics-address', 'controller-metrics-port',
+                 'controller-metrics-port-file',
+                 distbuild.MetricsConnection, [None, trace_dir]))
 
         loop = distbuild.MainLoop()
         
-        queuer = distbuild.WorkerBuildQueuer()
+        resource_history = distbuild.ResourceHistory(
+            self.app.settings['controller-resource-history'] or
+            os.path.join(self.app.settings['cachedir'],
+                         'resource-history.json'))
+        queuer = distbuild.WorkerBuildQueuer(
+            resource_history, journal, job_table)
         loop.add_state_machine(queuer)
 
+        step_logs = distbuild.StepLogs(
+            dirname=(self.app.settings['controller-step-log-dir'] or
+                     os.path.join(own_cachedir, 'step-logs')),
+            max_files=self.app.settings['controller-step-log-files'])
+
         for addr, port, port_file, sm, extra_args in listener_specs:
             addr = self.app.settings[addr]
             port = self.app.settings[port]
@@ -280,7 +543,7 @@ class ControllerDaemon(cliapp.Plugin):
             cm = distbuild.ConnectionMachine(
                 addr, port, distbuild.WorkerConnection, 
                 [writeable_cache_server, worker_cache_server_port,
-                 morph_instance])
+                 morph_instance, step_logs, journal])
             loop.add_state_machine(cm)
 
         loop.run()
@@ -302,6 +565,7 @@ class GraphStateMachines(cliapp.Plugin):
         self.graph_one(cm)
 
         self.graph_one(distbuild.BuildController(None, None, None))
+        self.graph_one(distbuild.CacheMaintainer(None, 0, 0, 1, []))
         self.graph_one(distbuild.HelperRouter(None))
         self.graph_one(distbuild.InitiatorConnection(None, None, None))
         self.graph_one(distbuild.JsonMachine(None))
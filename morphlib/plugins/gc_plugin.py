@@ -29,7 +29,7 @@ class GCPlugin(cliapp.Plugin):
 
     def enable(self):
         self.app.add_subcommand('gc', self.gc,
-                                arg_synopsis='')
+                                arg_synopsis='[SYSTEM]...')
         self.app.settings.integer(['cachedir-artifact-delete-older-than'],
                                   'always delete artifacts older than this '
                                   'period in seconds, (default: 1 week)',
@@ -42,6 +42,31 @@ class GCPlugin(cliapp.Plugin):
                                   metavar='PERIOD',
                                   group="Storage Options",
                                   default=(60*60*24))
+        self.app.settings.string_list(['cachedir-pin-system'],
+                                      'never delete the artifacts that '
+                                      'make up the most recently used '
+                                      'cached system artifact called NAME '
+                                      '(may be given many times)',
+                                      metavar='NAME',
+                                      group="Storage Options")
+        self.app.settings.boolean(['cachedir-delete-systems'],
+                                  'always delete system artifacts when '
+                                  'cleaning up the cache directory',
+                                  group="Storage Options")
+        self.app.settings.integer(['cachedir-delete-systems-after'],
+                                  'with --cachedir-delete-systems, only '
+                                  'delete system artifacts not used for '
+                                  'this period in seconds, so that ones '
+                                  'just built can be uploaded first '
+                                  '(default: 1 hour)',
+                                  metavar='PERIOD',
+                                  group="Storage Options",
+                                  default=(60*60))
+        self.app.settings.boolean(['gc-only-cachedir'],
+                                  'only clean up the cache directory, not '
+                                  'the temporary directory, which running '
+                                  'builds may be using',
+                                  group="Storage Options")
 
     def disable(self):
         pass
@@ -49,17 +74,35 @@ class GCPlugin(cliapp.Plugin):
     def gc(self, args):
         '''Make space by removing unused files.
 
-           This command removes all artifacts older than
-           --cachedir-artifact-delete-older-than if the file system
-           that holds the cache directory has less than --cachedir-min-space
-           bytes free.
+           Command line arguments:
+
+           * `SYSTEM` is the name of a system artifact, such as
+             `base-system-x86_64-generic-rootfs`, or the full file name of
+             one in the artifact cache. The artifacts that make up the
+             most recently used cached system of that name are never
+             removed, in addition to those of --cachedir-pin-system.
+
+           If the file system that holds the cache directory has less than
+           --cachedir-min-space bytes free, this command removes all
+           artifacts older than --cachedir-artifact-delete-older-than.
 
            It may delete artifacts older than
            --cachedir-artifact-keep-younger-than if it still needs to make
-           space.
-
-           It also removes any left over temporary chunks and staging areas
-           from failed builds.
+           space. Those are picked by comparing how long they took to
+           build, how much space they use and when they were last used,
+           so that artifacts which are slow to rebuild are kept in
+           preference to big ones that are quick to rebuild.
+
+           With --cachedir-delete-systems, all system artifacts that are
+           not pinned and have not been used for
+           --cachedir-delete-systems-after are removed too.
+
+           Unless --gc-only-cachedir is given, it also removes any left
+           over temporary chunks and staging areas from failed builds.
+           Otherwise, if the temporary directory is short of space, only
+           the unpacked chunks that have not been used for a while are
+           removed from it, least recently used first, since running
+           builds may be using the rest.
 
            In addition we remove failed deployments, generally these are
            cleared up by morph during deployment but in some cases they
@@ -75,8 +118,13 @@ class GCPlugin(cliapp.Plugin):
                 tempdir, self.app.settings['tempdir-min-space'],
                 cachedir, self.app.settings['cachedir-min-space'])
 
-        self.cleanup_tempdir(tempdir, tempdir_min_space)
-        self.cleanup_cachedir(cachedir, cachedir_min_space)
+        if not self.app.settings['gc-only-cachedir']:
+            self.cleanup_tempdir(tempdir, tempdir_min_space)
+        else:
+            self.cleanup_chunk_store(tempdir, tempdir_min_space)
+        self.cleanup_cachedir(cachedir, cachedir_min_space,
+                              self.app.settings['cachedir-pin-system'] +
+                              args)
         
     def cleanup_tempdir(self, temp_path, min_space):
         # The subdirectories in tempdir are created at Morph startup time. Code
@@ -97,6 +145,17 @@ class GCPlugin(cliapp.Plugin):
                 shutil.rmtree(path)
             os.mkdir(path)
 
+    def cleanup_chunk_store(self, temp_path, min_space):
+        needed = min_space - morphlib.util.get_bytes_free_in_path(temp_path)
+        chunks_path = os.path.join(temp_path, 'chunks')
+        if needed <= 0 or not os.path.isdir(chunks_path):
+            return
+        store = morphlib.unpackedchunkstore.UnpackedChunkStore(chunks_path)
+        freed = store.remove_unused(needed, time.time())
+        self.app.status(msg='Removed %(freed)d bytes of unpacked chunks '
+                            'from %(chunks_path)s',
+                        freed=freed, chunks_path=chunks_path, chatty=True)
+
     def calculate_delete_range(self):
         now = time.time()
         always_delete_age =  \
@@ -105,23 +164,9 @@ class GCPlugin(cliapp.Plugin):
             now - self.app.settings['cachedir-artifact-keep-younger-than']
         return always_delete_age, may_delete_age
 
-    def find_deletable_artifacts(self, lac, max_age, min_age):
-        '''Get a list of cache keys in order of how old they are.'''
-        contents = list(lac.list_contents())
-        always = set(cachekey
-                     for cachekey, artifacts, mtime in contents
-                     if mtime < max_age)
-        maybe = ((cachekey, mtime)
-                 for cachekey, artifacts, mtime in contents
-                 if max_age <= mtime < min_age)
-        return always, [cachekey for cachekey, mtime
-                        in sorted(maybe, key=lambda x: x[1])]
-
-    def cleanup_cachedir(self, cache_path, min_space):
-        def sufficient_free():
-            free = morphlib.util.get_bytes_free_in_path(cache_path)
-            return (free >= min_space)
-        if sufficient_free():
+    def cleanup_cachedir(self, cache_path, min_space, pinned_systems=()):
+        free = morphlib.util.get_bytes_free_in_path(cache_path)
+        if free >= min_space:
             self.app.status(msg='Not cleaning up cachedir, '
                                 'sufficient space already cleared',
                             chatty=True)
@@ -131,37 +176,38 @@ class GCPlugin(cliapp.Plugin):
         max_age, min_age = self.calculate_delete_range()
         logging.debug('Must remove artifacts older than timestamp %d'
                       % max_age)
-        always_delete, may_delete = \
-            self.find_deletable_artifacts(lac, max_age, min_age)
-        removed = 0
-        source_count = len(always_delete) + len(may_delete)
-        logging.debug('Must remove artifacts %s' % repr(always_delete))
-        logging.debug('Can remove artifacts %s' % repr(may_delete))
-
-        # Remove all old artifacts
-        for cachekey in always_delete:
-            self.app.status(msg='Removing source %(cachekey)s',
-                            cachekey=cachekey, chatty=True)
-            lac.remove(cachekey)
-            removed += 1
-
-        # Maybe remove remaining middle-aged artifacts
-        for cachekey in may_delete:
-            if sufficient_free():
-                self.app.status(msg='Finished cleaning up cachedir with '
-                                    '%(remaining)d old sources remaining',
-                                remaining=(source_count - removed),
-                                chatty=True)
-                break
+
+        entries = morphlib.cacheevictionplanner.cache_entries(lac)
+        roots = morphlib.cacheevictionplanner.find_system_artifacts(
+            entries, pinned_systems)
+        pinned = morphlib.cacheevictionplanner.reachable_cachekeys(
+            lac, roots)
+        logging.debug('Pinned sources %s' % repr(pinned))
+
+        planner = morphlib.cacheevictionplanner.CacheEvictionPlanner(
+            time.time(), max_age, min_age)
+        always_remove = set()
+        if self.app.settings['cachedir-delete-systems']:
+            always_remove.update(
+                morphlib.cacheevictionplanner.system_cachekeys(
+                    entries, time.time() -
+                    self.app.settings['cachedir-delete-systems-after']))
+        plan = planner.plan(entries, pinned, min_space - free, always_remove)
+        logging.debug('Removing sources %s' %
+                      repr([entry.cachekey for entry in plan]))
+
+        for entry in plan:
             self.app.status(msg='Removing source %(cachekey)s',
-                            cachekey=cachekey, chatty=True)
-            lac.remove(cachekey)
-            removed += 1
+                            cachekey=entry.cachekey, chatty=True)
+            lac.remove(entry.cachekey)
+        removed = len(plan)
 
-        if sufficient_free():
+        if morphlib.util.get_bytes_free_in_path(cache_path) >= min_space:
             self.app.status(msg='Made sufficient space in %(cache_path)s '
-                                'after removing %(removed)d sources',
-                            removed=removed, cache_path=cache_path)
+                                'after removing %(removed)d sources, '
+                                '%(remaining)d sources remaining',
+                            removed=removed, cache_path=cache_path,
+                            remaining=(len(entries) - removed))
             return
         self.app.status(msg='Unable to clear enough space in %(cache_path)s '
                             'after removing %(removed)d sources. Please '
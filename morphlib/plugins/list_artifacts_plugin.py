@@ -58,59 +58,40 @@ class ListArtifactsPlugin(cliapp.Plugin):
         system_filenames = map(morphlib.util.sanitise_morphology_path,
                                args[2:])
 
-        self.lrc, self.rrc = morphlib.util.new_repo_caches(self.app)
-        self.resolver = morphlib.artifactresolver.ArtifactResolver()
-
-        artifact_files = set()
-        for system_filename in system_filenames:
-            system_artifact_files = self.list_artifacts_for_system(
-                repo, ref, system_filename)
-            artifact_files.update(system_artifact_files)
-
-        for artifact_file in sorted(artifact_files):
-            print artifact_file
-
-    def list_artifacts_for_system(self, repo, ref, system_filename):
-        '''List all artifact files in the build graph of a single system.'''
-
-        # Sadly, we must use a fresh source pool and a fresh list of artifacts
-        # for each system. Creating a source pool is slow (queries every Git
-        # repo involved in the build) and resolving artifacts isn't so quick
-        # either. Unfortunately, each Source object can only have one set of
-        # Artifact objects associated, which means the source pool cannot mix
-        # sources that are being built for multiple architectures: the build
-        # graph representation does not distinguish chunks or strata of
-        # different architectures right now.
+        build_command = morphlib.buildcommand.BuildCommand(self.app)
 
+        # The build graphs of all the systems are created together, so
+        # the strata and chunks they share are only resolved once. They
+        # are not resolved by build_command, which would insist that
+        # they can be built on this machine.
         self.app.status(
-            msg='Creating source pool for %s' % system_filename, chatty=True)
-        source_pool = morphlib.sourceresolver.create_source_pool(
-            self.lrc, self.rrc, repo, ref, system_filename,
+            msg='Creating source pool for %(count)d systems',
+            count=len(system_filenames), chatty=True)
+        roots = morphlib.sourceresolver.resolve_systems(
+            build_command.lrc, build_command.rrc, repo, ref,
+            system_filenames,
             update_repos = not self.app.settings['no-git-update'],
             status_cb=self.app.status)
 
-        self.app.status(
-            msg='Resolving artifacts for %s' % system_filename, chatty=True)
-        root_artifacts = self.resolver.resolve_root_artifacts(source_pool)
+        system_artifacts = []
+        for system_filename in system_filenames:
+            if not roots[system_filename]:
+                raise cliapp.AppException(
+                    'No artifacts found for %s' % system_filename)
+            system_artifacts.extend(roots[system_filename])
 
-        def find_artifact_by_name(artifacts_list, filename):
-            for a in artifacts_list:
-                if a.source.filename == filename:
-                    return a
-            raise ValueError
+        build_command.compute_cache_keys_for_systems(system_artifacts)
 
-        system_artifact = find_artifact_by_name(root_artifacts,
-                                                system_filename)
+        artifact_files = set()
+        for system_artifact in system_artifacts:
+            artifact_files.update(
+                self.list_artifacts_for_system(system_artifact))
 
-        self.app.status(
-            msg='Computing cache keys for %s' % system_filename, chatty=True)
-        build_env = morphlib.buildenvironment.BuildEnvironment(
-            self.app.settings, system_artifact.source.morphology['arch'])
-        ckc = morphlib.cachekeycomputer.CacheKeyComputer(build_env)
-
-        for source in set(a.source for a in system_artifact.walk()):
-            source.cache_key = ckc.compute_key(source)
-            source.cache_id = ckc.get_cache_id(source)
+        for artifact_file in sorted(artifact_files):
+            print artifact_file
+
+    def list_artifacts_for_system(self, system_artifact):
+        '''List all artifact files in the build graph of a single system.'''
 
         artifact_files = set()
         for artifact in system_artifact.walk():
@@ -15,11 +15,14 @@
 
 
 import cliapp
+import json
 import logging
 import urllib
 import urllib2
 import urlparse
 
+import morphlib
+
 
 class HeadRequest(urllib2.Request):  # pragma: no cover
 
@@ -54,7 +57,7 @@ class GetSourceMetadataError(GetError):
                   (name, source, cache_key, cache))
 
 
-class RemoteArtifactCache(object):
+class RemoteArtifactCache(morphlib.artifactstore.ArtifactStore):
 
     def __init__(self, server_url):
         self.server_url = server_url
@@ -69,9 +72,39 @@ class RemoteArtifactCache(object):
         filename = '%s.%s' % (cachekey, name)
         return self._has_file(filename)
 
+    def has_many(self, filenames):  # pragma: no cover
+        url = urlparse.urljoin(self._server_url(), '/1.0/artifacts')
+        request = urllib2.Request(url, json.dumps(list(filenames)),
+                                  {'Content-Type': 'application/json'})
+        logging.debug('RemoteArtifactCache.has_many: url=%s' % url)
+        response = json.load(urllib2.urlopen(request))
+        return set(f for f, present in response.iteritems() if present)
+
+    def open(self, filename):
+        '''Return a file object for reading a file from the server.
+
+        If the server sent the file's digest, the content is verified
+        while it is read, and the read reaching the end of a corrupt
+        file raises morphlib.artifactdigest.DigestMismatchError.
+
+        '''
+        f = self._get_file(filename)
+        digest = morphlib.artifactdigest.digest_from_headers(f)
+        if digest is None:
+            return f
+        return morphlib.artifactdigest.VerifyingReader(
+            f, digest, '%s from %s' % (filename, self))
+
+    def list(self):  # pragma: no cover
+        # This needs the server to have --enable-writes set.
+        url = urlparse.urljoin(self._server_url(), '/1.0/list')
+        logging.debug('RemoteArtifactCache.list: url=%s' % url)
+        response = json.load(urllib2.urlopen(url))
+        return response['files'].iterkeys()
+
     def get(self, artifact, log=logging.error):
         try:
-            return self._get_file(artifact.basename())
+            return self.open(artifact.basename())
         except urllib2.URLError, e:
             log(str(e))
             raise GetError(self, artifact)
@@ -105,12 +138,15 @@ class RemoteArtifactCache(object):
         logging.debug('RemoteArtifactCache._get_file: url=%s' % url)
         return urllib2.urlopen(url)
 
-    def _request_url(self, filename):  # pragma: no cover
+    def _server_url(self):  # pragma: no cover
         server_url = self.server_url
         if not server_url.endswith('/'):
             server_url += '/'
+        return server_url
+
+    def _request_url(self, filename):  # pragma: no cover
         return urlparse.urljoin(
-            server_url, '/1.0/artifacts?filename=%s' % 
+            self._server_url(), '/1.0/artifacts?filename=%s' % 
             urllib.quote(filename))
 
     def __str__(self):  # pragma: no cover
@@ -14,6 +14,8 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 
+import hashlib
+import mimetools
 import StringIO
 import unittest
 import urllib2
@@ -121,6 +123,27 @@ class RemoteArtifactCacheTests(unittest.TestCase):
         data = handle.read()
         self.assertEqual(data, self.devel_artifact.basename())
 
+    def _get_file_with_digest(self, filename, data):
+        digest = hashlib.sha256(filename).hexdigest()
+        response = StringIO.StringIO(data)
+        response.info = lambda: mimetools.Message(StringIO.StringIO(
+            'X-Artifact-SHA256: %s\n\n' % digest))
+        return response
+
+    def test_get_verifies_artifact_with_digest(self):
+        self.cache._get_file = lambda filename: \
+            self._get_file_with_digest(filename, filename)
+        handle = self.cache.get(self.runtime_artifact)
+        data = handle.read()
+        self.assertEqual(data, self.runtime_artifact.basename())
+
+    def test_get_fails_to_verify_corrupt_artifact(self):
+        self.cache._get_file = lambda filename: \
+            self._get_file_with_digest(filename, 'corrupt')
+        handle = self.cache.get(self.runtime_artifact)
+        self.assertRaises(morphlib.artifactdigest.DigestMismatchError,
+                          handle.read)
+
     def test_fails_to_get_a_non_existent_artifact(self):
         self.assertRaises(morphlib.remoteartifactcache.GetError,
                           self.cache.get, self.doc_artifact,
@@ -14,9 +14,12 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 
+import base64
 import cliapp
+import httplib
 import json
 import logging
+import socket
 import urllib2
 import urlparse
 import urllib
@@ -47,9 +50,18 @@ class LsTreeError(cliapp.AppException):
 
 class RemoteRepoCache(object):
 
+    '''Ask a morph-cache-server about the git repositories it holds.
+
+    One HTTP connection to the server is kept open and reused for all
+    requests. ``resolve_refs`` and ``cat_files`` answer many questions
+    with a single request each.
+
+    '''
+
     def __init__(self, server_url, resolver):
         self.server_url = server_url
         self._resolver = resolver
+        self._connection = None
 
     def resolve_ref(self, repo_name, ref):
         repo_url = self._resolver.pull_url(repo_name)
@@ -69,6 +81,53 @@ class RemoteRepoCache(object):
                 raise CatFileError(repo_name, ref, filename)
             raise # pragma: no cover
 
+    def resolve_refs(self, pairs):
+        '''Resolve many (repo_name, ref) pairs with one request.
+
+        Returns a dict mapping each pair that could be resolved to
+        a (sha1, tree) tuple. Pairs the server could not resolve are
+        left out.
+
+        '''
+        pairs = list(pairs)
+        if not pairs:
+            return {}
+        results = self._resolve_refs_for_repo_urls(
+            [(self._resolver.pull_url(repo_name), ref)
+             for repo_name, ref in pairs])
+        resolved = {}
+        for pair, info in zip(pairs, results):
+            if 'error' in info:
+                logging.debug('Failed to resolve %s %s: %s' %
+                              (pair[0], pair[1], info['error']))
+            else:
+                resolved[pair] = info['sha1'], info['tree']
+        return resolved
+
+    def cat_files(self, triplets):
+        '''Get many (repo_name, ref, filename) files with one request.
+
+        Returns a dict mapping each triplet whose file exists to the
+        contents of the file. Files the server could not find are left
+        out.
+
+        '''
+        triplets = list(triplets)
+        if not triplets:
+            return {}
+        results = self._cat_files_for_repo_urls(
+            [(self._resolver.pull_url(repo_name), ref, filename)
+             for repo_name, ref, filename in triplets])
+        files = {}
+        for triplet, info in zip(triplets, results):
+            if 'error' in info:
+                logging.debug('Failed to cat file %s in %s %s: %s' %
+                              (triplet[2], triplet[0], triplet[1],
+                               info['error']))
+            else:
+                files[triplet] = base64.b64decode(info['data'])
+        return files
+
     def ls_tree(self, repo_name, ref):
         repo_url = self._resolver.pull_url(repo_name)
         try:
@@ -90,6 +149,18 @@ class RemoteRepoCache(object):
             'files?repo=%s&ref=%s&filename=%s'
             % self._quote_strings(repo_url, ref, filename))
 
+    def _resolve_refs_for_repo_urls(self, pairs):  # pragma: no cover
+        data = self._make_request(
+            'sha1s', [{'repo': repo_url, 'ref': ref}
+                      for repo_url, ref in pairs])
+        return json.loads(data)
+
+    def _cat_files_for_repo_urls(self, triplets):  # pragma: no cover
+        data = self._make_request(
+            'files', [{'repo': repo_url, 'ref': ref, 'filename': filename}
+                      for repo_url, ref, filename in triplets])
+        return json.loads(data)
+
     def _ls_tree_for_repo_url(self, repo_url, ref):  # pragma: no cover
         return self._make_request(
             'trees?repo=%s&ref=%s' % self._quote_strings(repo_url, ref))
@@ -97,10 +168,47 @@ class RemoteRepoCache(object):
     def _quote_strings(self, *args):  # pragma: no cover
         return tuple(urllib.quote(string) for string in args)
 
-    def _make_request(self, path):  # pragma: no cover
-        server_url = self.server_url
-        if not server_url.endswith('/'):
-            server_url += '/'
-        url = urlparse.urljoin(server_url, '/1.0/%s' % path)
-        handle = urllib2.urlopen(url)
-        return handle.read()
+    def _connect(self):  # pragma: no cover
+        if self._connection is None:
+            scheme, netloc = urlparse.urlsplit(self.server_url)[:2]
+            if scheme == 'https':
+                self._connection = httplib.HTTPSConnection(netloc)
+            else:
+                self._connection = httplib.HTTPConnection(netloc)
+        return self._connection
+
+    def _make_request(self, path, body=None):  # pragma: no cover
+        '''Request /1.0/PATH from the server and return the response body.
+
+        If ``body`` is given it is sent as JSON in a POST request. Errors
+        from the server are raised as urllib2.HTTPError.
+
+        '''
+        url = '/1.0/%s' % path
+        if body is None:
+            method, headers = 'GET', {}
+        else:
+            method = 'POST'
+            headers = {'Content-Type': 'application/json'}
+            body = json.dumps(body)
+        # The server may have closed the connection since the last
+        # request, in which case it is opened again and the request
+        # retried once.
+        for retry in (True, False):
+            connection = self._connect()
+            try:
+                connection.request(method, url, body, headers)
+                response = connection.getresponse()
+                data = response.read()
+                break
+            except (httplib.HTTPException, socket.error), e:
+                connection.close()
+                self._connection = None
+                if not retry:
+                    raise
+                logging.debug('Retrying %s %s: %s' % (method, url, e))
+        if response.status != httplib.OK:
+            raise urllib2.HTTPError(urlparse.urljoin(self.server_url, url),
+                                    response.status, response.reason,
+                                    response.msg, None)
+        return data
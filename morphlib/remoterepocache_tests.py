@@ -14,6 +14,7 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 
+import base64
 import json
 import unittest
 import urllib2
@@ -40,7 +41,35 @@ class RemoteRepoCacheTests(unittest.TestCase):
             'tree': self.files[repo_url][sha1]
         })
 
+    def _resolve_refs_for_repo_urls(self, pairs):
+        self.requests += 1
+        results = []
+        for repo_url, ref in pairs:
+            try:
+                results.append({'repo': repo_url, 'ref': ref,
+                                'sha1': self.sha1s[repo_url][ref],
+                                'tree': 'tree'})
+            except KeyError:
+                results.append({'repo': repo_url, 'ref': ref,
+                                'error': 'not found'})
+        return results
+
+    def _cat_files_for_repo_urls(self, triplets):
+        self.requests += 1
+        results = []
+        for repo_url, sha1, filename in triplets:
+            try:
+                data = self.files[repo_url][sha1][filename]
+                results.append({'repo': repo_url, 'ref': sha1,
+                                'filename': filename,
+                                'data': base64.b64encode(data)})
+            except KeyError:
+                results.append({'repo': repo_url, 'ref': sha1,
+                                'filename': filename, 'error': 'not found'})
+        return results
+
     def setUp(self):
+        self.requests = 0
         self.sha1s = {
             'git://gitorious.org/baserock/morph': {
                 'master': 'e28a23812eadf2fce6583b8819b9c5dbd36b9fb9'
@@ -64,6 +93,9 @@ class RemoteRepoCacheTests(unittest.TestCase):
         self.cache._resolve_ref_for_repo_url = self._resolve_ref_for_repo_url
         self.cache._cat_file_for_repo_url = self._cat_file_for_repo_url
         self.cache._ls_tree_for_repo_url = self._ls_tree_for_repo_url
+        self.cache._resolve_refs_for_repo_urls = \
+            self._resolve_refs_for_repo_urls
+        self.cache._cat_files_for_repo_urls = self._cat_files_for_repo_urls
 
     def test_sets_server_url(self):
         self.assertEqual(self.cache.server_url, self.server_url)
@@ -136,3 +168,33 @@ class RemoteRepoCacheTests(unittest.TestCase):
         self.assertRaises(morphlib.remoterepocache.LsTreeError,
                           self.cache.ls_tree, 'non-existent-repo',
                           'e28a23812eadf2fce6583b8819b9c5dbd36b9fb9')
+
+    def test_resolves_many_refs_with_one_request(self):
+        resolved = self.cache.resolve_refs(
+            [('baserock:morph', 'master'), ('baserock:morph', 'missing'),
+             ('non-existent-repo', 'master')])
+        self.assertEqual(
+            resolved,
+            {('baserock:morph', 'master'):
+                (self.sha1s['git://gitorious.org/baserock/morph']['master'],
+                 'tree')})
+        self.assertEqual(self.requests, 1)
+
+    def test_resolving_no_refs_makes_no_request(self):
+        self.assertEqual(self.cache.resolve_refs([]), {})
+        self.assertEqual(self.requests, 0)
+
+    def test_cats_many_files_with_one_request(self):
+        sha1 = 'e28a23812eadf2fce6583b8819b9c5dbd36b9fb9'
+        files = self.cache.cat_files(
+            [('upstream:linux', sha1, 'linux.morph'),
+             ('upstream:linux', sha1, 'non-existent-file'),
+             ('non-existent-repo', sha1, 'linux.morph')])
+        self.assertEqual(
+            files, {('upstream:linux', sha1, 'linux.morph'):
+                        'linux morphology'})
+        self.assertEqual(self.requests, 1)
+
+    def test_catting_no_files_makes_no_request(self):
+        self.assertEqual(self.cache.cat_files([]), {})
+        self.assertEqual(self.requests, 0)
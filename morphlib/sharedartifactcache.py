@@ -0,0 +1,74 @@
+# Copyright (C) 2014  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import os
+
+import morphlib
+
+
+class SharedArtifactCache(morphlib.artifactstore.ArtifactStore):
+
+    '''An artifact store in a directory shared between hosts.
+
+    The directory is typically on NFS or a cluster filesystem, mounted
+    on several workers, or the artifact directory of a morph-cache-server
+    that is also mounted on the workers. Artifacts are read directly
+    rather than through HTTP, and can be linked into a local artifact
+    cache on the same filesystem without copying them.
+
+    Only plain POSIX file operations are used, and files are written
+    under a temporary name and renamed, which is safe on NFS.
+
+    '''
+
+    def __init__(self, path):
+        self.path = path
+
+    def _path(self, filename):
+        return os.path.join(self.path, filename)
+
+    def has_many(self, filenames):
+        return set(f for f in filenames if os.path.exists(self._path(f)))
+
+    def open(self, filename):
+        path = self._path(filename)
+        f = open(path)
+        digest = morphlib.artifactdigest.read_digest(path)
+        if digest is None:
+            return f
+        return morphlib.artifactdigest.VerifyingReader(
+            f, digest, '%s from %s' % (filename, self))
+
+    def put(self, artifact):
+        return morphlib.artifactdigest.DigestSaveFile(
+            self._path(artifact.basename()), mode='w')
+
+    def list(self):
+        for filename in os.listdir(self.path):
+            # Files being written by SaveFile, files being fetched by
+            # morph-cache-server, and its index
+            if filename.startswith('tmp') or filename.startswith('.'):
+                continue
+            yield filename
+
+    def local_path(self, filename):
+        path = self._path(filename)
+        if os.path.exists(path):
+            return path
+        return None
+
+    def __str__(self):  # pragma: no cover
+        return self.path
@@ -0,0 +1,102 @@
+# Copyright (C) 2014  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import fs.tempfs
+
+import morphlib
+
+
+class FakeArtifact(object):
+
+    def __init__(self, basename):
+        self._basename = basename
+
+    def basename(self):
+        return self._basename
+
+
+class SharedArtifactCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.cache = morphlib.sharedartifactcache.SharedArtifactCache(
+            self.tempdir)
+        self.artifact = FakeArtifact('0' * 64 + '.chunk.foo')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def put(self, data):
+        with self.cache.put(self.artifact) as f:
+            f.write(data)
+
+    def test_is_empty_initially(self):
+        self.assertEqual(list(self.cache.list()), [])
+        self.assertFalse(self.cache.has(self.artifact))
+
+    def test_put_artifact_and_get_it_afterwards(self):
+        self.put('foo')
+        self.assertTrue(self.cache.has(self.artifact))
+        self.assertEqual(self.cache.get(self.artifact).read(), 'foo')
+
+    def test_lists_artifact_and_digest_but_not_temporary_files(self):
+        handle = self.cache.put(self.artifact)
+        self.put('foo')
+        filename = self.artifact.basename()
+        self.assertEqual(sorted(self.cache.list()),
+                         [filename, '%s.sha256' % filename])
+        handle.abort()
+
+    def test_open_verifies_digest(self):
+        self.put('foo')
+        with open(os.path.join(self.tempdir, self.artifact.basename()),
+                  'w') as f:
+            f.write('bar')
+        handle = self.cache.get(self.artifact)
+        self.assertRaises(morphlib.artifactdigest.DigestMismatchError,
+                          handle.read)
+
+    def test_has_local_path_only_for_existing_files(self):
+        filename = self.artifact.basename()
+        self.assertEqual(self.cache.local_path(filename), None)
+        self.put('foo')
+        self.assertEqual(self.cache.local_path(filename),
+                         os.path.join(self.tempdir, filename))
+
+    def test_artifacts_are_linked_into_local_artifact_cache(self):
+        self.put('foo')
+        tempfs = fs.tempfs.TempFS(temp_dir=self.tempdir)
+        lac = morphlib.localartifactcache.LocalArtifactCache(tempfs)
+        self.assertTrue(lac.link_from(self.cache,
+                                      [self.artifact.basename()]))
+        self.assertTrue(lac.has(self.artifact))
+        self.assertEqual(lac.get(self.artifact).read(), 'foo')
+        self.assertEqual(morphlib.artifactdigest.read_digest(
+                             lac.artifact_filename(self.artifact)),
+                         self.cache.open(self.artifact.basename() +
+                                         '.sha256').read().strip())
+
+    def test_link_fails_for_missing_artifacts(self):
+        tempfs = fs.tempfs.TempFS(temp_dir=self.tempdir)
+        lac = morphlib.localartifactcache.LocalArtifactCache(tempfs)
+        self.assertFalse(lac.link_from(self.cache,
+                                       [self.artifact.basename()]))
+        self.assertFalse(lac.has(self.artifact))
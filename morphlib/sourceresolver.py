@@ -94,6 +94,34 @@ class SourceResolver(object):
             absref, tree = repo.resolve_ref(ref)
         return absref, tree
 
+    def resolve_refs(self, pairs):
+        '''Resolve many (reponame, ref) pairs and return a dict of results.
+
+        Refs in repos that are not in the local repo cache are resolved
+        with a single request to the remote repo cache. Any that can't
+        be resolved that way are resolved one at a time by
+        ``resolve_ref``.
+
+        '''
+        resolved = {}
+        remote = []
+        for reponame, ref in set(pairs):
+            if self.rrc is None or self.lrc.has_repo(reponame):
+                resolved[reponame, ref] = self.resolve_ref(reponame, ref)
+            else:
+                remote.append((reponame, ref))
+        if remote:
+            try:
+                resolved.update(self.rrc.resolve_refs(remote))
+                self.status(msg='Resolved %(count)d refs via remote repo '
+                            'cache', count=len(remote), chatty=True)
+            except BaseException, e:
+                logging.warning('Caught (and ignored) exception: %s' % str(e))
+        for reponame, ref in remote:
+            if (reponame, ref) not in resolved:
+                resolved[reponame, ref] = self.resolve_ref(reponame, ref)
+        return resolved
+
     def traverse_morphs(self, definitions_repo, definitions_ref,
                         system_filenames,
                         visit=lambda rn, rf, fn, arf, m: None,
@@ -103,7 +131,6 @@ class SourceResolver(object):
         definitions_queue = collections.deque(system_filenames)
         chunk_in_definitions_repo_queue = []
         chunk_in_source_repo_queue = []
-        resolved_refs = {}
         resolved_morphologies = {}
 
         # Resolve the (repo, ref) pair for the definitions repo, cache result.
@@ -113,12 +140,25 @@ class SourceResolver(object):
         if definitions_original_ref:
             definitions_ref = definitions_original_ref
 
+        def get_morphologies(keys):
+            # Fetch all the morphologies that are needed next together,
+            # rather than one at a time.
+            resolved_morphologies.update(morph_factory.get_morphologies(
+                key for key in keys if key not in resolved_morphologies))
+
+        # Strata and chunks that several systems or strata have in common
+        # only need visiting once.
+        visited = set()
+
         while definitions_queue:
+            get_morphologies((definitions_repo, definitions_absref, filename)
+                             for filename in definitions_queue)
             filename = definitions_queue.popleft()
+            if filename in visited:
+                continue
+            visited.add(filename)
 
             key = (definitions_repo, definitions_absref, filename)
-            if not key in resolved_morphologies:
-                resolved_morphologies[key] = morph_factory.get_morphology(*key)
             morphology = resolved_morphologies[key]
 
             visit(definitions_repo, definitions_ref, filename,
@@ -139,29 +179,34 @@ class SourceResolver(object):
                     if 'morph' not in c:
                         path = morphlib.util.sanitise_morphology_path(
                             c.get('morph', c['name']))
-                        chunk_in_source_repo_queue.append(
-                            (c['repo'], c['ref'], path))
-                        continue
-                    chunk_in_definitions_repo_queue.append(
-                        (c['repo'], c['ref'], c['morph']))
+                        chunk = (c['repo'], c['ref'], path)
+                        queue = chunk_in_source_repo_queue
+                    else:
+                        chunk = (c['repo'], c['ref'], c['morph'])
+                        queue = chunk_in_definitions_repo_queue
+                    if chunk not in visited:
+                        visited.add(chunk)
+                        queue.append(chunk)
+
+        resolved_refs = self.resolve_refs(
+            (repo, ref) for repo, ref, filename in
+            chunk_in_definitions_repo_queue + chunk_in_source_repo_queue)
+
+        get_morphologies(
+            [(definitions_repo, definitions_absref, filename)
+             for repo, ref, filename in chunk_in_definitions_repo_queue] +
+            [(repo, resolved_refs[repo, ref][0], filename)
+             for repo, ref, filename in chunk_in_source_repo_queue])
 
         for repo, ref, filename in chunk_in_definitions_repo_queue:
-            if (repo, ref) not in resolved_refs:
-                resolved_refs[repo, ref] = self.resolve_ref(repo, ref)
             absref, tree = resolved_refs[repo, ref]
             key = (definitions_repo, definitions_absref, filename)
-            if not key in resolved_morphologies:
-                resolved_morphologies[key] = morph_factory.get_morphology(*key)
             morphology = resolved_morphologies[key]
             visit(repo, ref, filename, absref, tree, morphology)
 
         for repo, ref, filename in chunk_in_source_repo_queue:
-            if (repo, ref) not in resolved_refs:
-                resolved_refs[repo, ref] = self.resolve_ref(repo, ref)
             absref, tree = resolved_refs[repo, ref]
             key = (repo, absref, filename)
-            if key not in resolved_morphologies:
-                resolved_morphologies[key] = morph_factory.get_morphology(*key)
             morphology = resolved_morphologies[key]
             visit(repo, ref, filename, absref, tree, morphology)
 
@@ -182,6 +227,22 @@ def create_source_pool(lrc, rrc, repo, ref, filename,
     The 'lrc' and 'rrc' parameters specify the local and remote Git repository
     caches used for resolving the sources.
 
+    '''
+    return create_source_pool_for_systems(
+        lrc, rrc, repo, ref, [filename], original_ref=original_ref,
+        update_repos=update_repos, status_cb=status_cb)
+
+
+def create_source_pool_for_systems(lrc, rrc, repo, ref, filenames,
+                                   original_ref=None, update_repos=True,
+                                   status_cb=None):
+    '''Find all the sources involved in building several systems.
+
+    This is like create_source_pool, but the pool holds the sources of
+    every system in ``filenames``. Strata and chunks that the systems
+    have in common are only looked up once, and each of them has a
+    single Source object in the pool.
+
     '''
     pool = morphlib.sourcepool.SourcePool()
 
@@ -193,7 +254,45 @@ def create_source_pool(lrc, rrc, repo, ref, filename,
             pool.add(source)
 
     resolver = SourceResolver(lrc, rrc, update_repos, status_cb)
-    resolver.traverse_morphs(repo, ref, [filename],
+    resolver.traverse_morphs(repo, ref, filenames,
                              visit=add_to_pool,
                              definitions_original_ref=original_ref)
     return pool
+
+
+def resolve_systems(lrc, rrc, repo, ref, filenames, original_ref=None,
+                    update_repos=True, status_cb=None):
+    '''Resolve the artifacts of several systems in one build graph.
+
+    Returns a dict that maps each of ``filenames`` to the list of the
+    root artifacts of that system. The graph is built once for all of
+    the systems, so Source objects, and the cache keys later computed
+    for them, are shared between the systems.
+
+    A Source can only be built for one architecture, so when the
+    systems are for different architectures, a graph is built for each
+    architecture instead.
+
+    '''
+    pool = create_source_pool_for_systems(
+        lrc, rrc, repo, ref, filenames, original_ref=original_ref,
+        update_repos=update_repos, status_cb=status_cb)
+    resolver = morphlib.artifactresolver.ArtifactResolver()
+    roots = collections.defaultdict(list)
+    for artifact in resolver.resolve_root_artifacts(pool):
+        roots[artifact.source.filename].append(artifact)
+
+    by_arch = collections.defaultdict(list)
+    for filename in filenames:
+        arches = set(a.source.morphology.get('arch')
+                     for a in roots[filename])
+        by_arch[tuple(sorted(arches))].append(filename)
+    if len(by_arch) <= 1:
+        return dict((filename, roots[filename]) for filename in filenames)
+
+    result = {}
+    for group in by_arch.itervalues():
+        result.update(resolve_systems(
+            lrc, rrc, repo, ref, group, original_ref=original_ref,
+            update_repos=update_repos, status_cb=status_cb))
+    return result
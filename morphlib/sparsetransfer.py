@@ -0,0 +1,382 @@
+# Copyright (C) 2014  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+'''Transfer a sparse file, such as a disk image, as a stream.
+
+The stream starts with a header giving the size of the file and the
+size of the extents it is divided into. Every extent starts at a
+multiple of the extent size. Each extent that holds anything other
+than zeroes is sent as a record, in order of offset, and everything
+not covered by a record is a hole. The stream ends with an end record.
+
+Each record carries the checksum of the extent's contents, which the
+receiver checks. An extent can be sent as it is, or compressed with
+zlib when that makes it smaller.
+
+When receiving into a file, the receiver keeps a journal of the
+extents it has written next to the file. If the transfer is
+interrupted, the sender can be given that journal to resume the
+transfer: it then sends only a keep record for each extent whose
+contents the receiver already has.
+
+This file is also run on its own, on hosts that do not have morphlib
+installed, so it must not import anything other than the standard
+library. Run it as one of
+
+    sparsetransfer.py send [--compress] [--resume JOURNAL] FILENAME
+    sparsetransfer.py receive-file FILENAME
+    sparsetransfer.py receive-vbox FILENAME DISKSIZE
+    sparsetransfer.py journal FILENAME
+
+``send`` writes the stream for a file to stdout, and the ``receive``
+commands read it from stdin. ``receive-vbox`` pipes the file into
+VirtualBox to be converted into a VDI image without writing it out
+first. ``journal`` writes the journal of an interrupted transfer into
+a file to stdout, or nothing if there is none.
+
+'''
+
+
+import errno
+import io
+import os
+import struct
+import subprocess
+import sys
+import zlib
+
+
+MAGIC = b'MSPARSE1'
+EXTENT_SIZE = 4 * 1024**2
+JOURNAL_SUFFIX = '.sparse-journal'
+
+FLAG_RESUME = 1
+
+DATA = b'D'
+ZLIB = b'Z'
+KEEP = b'K'
+END = b'E'
+
+_header = struct.Struct('!8sBQI')
+_record = struct.Struct('!cQIII')
+
+SEEK_DATA = getattr(os, 'SEEK_DATA', 3)
+SEEK_HOLE = getattr(os, 'SEEK_HOLE', 4)
+
+
+class TransferError(Exception):
+
+    pass
+
+
+def _read_exactly(f, n):
+    data = f.read(n)
+    if len(data) != n:
+        raise TransferError('Stream ended unexpectedly')
+    return data
+
+
+def _checksum(data):
+    return zlib.crc32(data) & 0xffffffff
+
+
+_zeroes = {}
+
+
+def _zeroes_of(n):
+    if n not in _zeroes:
+        _zeroes[n] = b'\0' * n
+    return _zeroes[n]
+
+
+def _write_zeroes(out, n):
+    while n > 0:
+        chunk = min(n, EXTENT_SIZE)
+        out.write(_zeroes_of(chunk))
+        n -= chunk
+
+
+def data_extents(fd, size, extent_size):
+    '''Yield the offsets of the extents of a file that may hold data.
+
+    The extents that are entirely holes are found with SEEK_DATA and
+    SEEK_HOLE, so that only two seeks are needed for each run of data
+    rather than for each extent. If the file system cannot find holes,
+    every extent is yielded.
+
+    '''
+
+    pos = 0
+    while pos < size:
+        try:
+            start = os.lseek(fd, pos, SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                return
+            if e.errno != errno.EINVAL:
+                raise
+            start, end = pos, size
+        else:
+            end = os.lseek(fd, start, SEEK_HOLE)
+        offset = start - start % extent_size
+        while offset < end:
+            yield offset
+            offset += extent_size
+        pos = offset
+
+
+def read_journal(f):
+    '''Read a journal, as written by receive_file.
+
+    Return the file size and extent size from its header, and a dict
+    mapping the offset of each extent it records to a tuple of the
+    extent's length and checksum. The checksum is None for an extent
+    whose write may not have finished.
+
+    '''
+
+    fields = f.readline().split()
+    if len(fields) != 3 or fields[0] != 'morph-sparse-journal':
+        raise TransferError('Not a sparse transfer journal')
+    size, extent_size = int(fields[1]), int(fields[2])
+    extents = {}
+    for line in f:
+        fields = line.split()
+        if len(fields) != 3:
+            # The last line may be incomplete if the receiver died.
+            continue
+        offset, length, checksum = fields
+        extents[int(offset)] = (
+            int(length), None if checksum == '-' else int(checksum))
+    return size, extent_size, extents
+
+
+def send(fd, out, compress=False, journal=None, extent_size=EXTENT_SIZE):
+    '''Write the stream for the file open as fd to out.
+
+    ``journal`` is the result of read_journal, for resuming a transfer
+    that was interrupted, or None to start afresh.
+
+    '''
+
+    size = os.fstat(fd).st_size
+    kept = {}
+    flags = 0
+    if journal is not None and journal[:2] == (size, extent_size):
+        kept = journal[2]
+        flags |= FLAG_RESUME
+    out.write(_header.pack(MAGIC, flags, size, extent_size))
+
+    f = io.FileIO(fd, closefd=False)
+    for offset in data_extents(fd, size, extent_size):
+        os.lseek(fd, offset, os.SEEK_SET)
+        length = min(extent_size, size - offset)
+        data = _read_exactly(f, length)
+        if data == _zeroes_of(length):
+            continue
+        checksum = _checksum(data)
+        if kept.get(offset) == (length, checksum):
+            out.write(_record.pack(KEEP, offset, length, 0, checksum))
+            continue
+        kind = DATA
+        if compress:
+            packed = zlib.compress(data, 1)
+            if len(packed) < length:
+                kind, data = ZLIB, packed
+        out.write(_record.pack(kind, offset, length, len(data), checksum))
+        out.write(data)
+
+    out.write(_record.pack(END, size, 0, 0, 0))
+
+
+def _read_header(f):
+    magic, flags, size, extent_size = _header.unpack(
+        _read_exactly(f, _header.size))
+    if magic != MAGIC:
+        raise TransferError('Not a sparse transfer stream')
+    return flags, size, extent_size
+
+
+def _read_records(f):
+    '''Yield (kind, offset, length, checksum, data) for each record.
+
+    The data is None for keep records, and has been decompressed and
+    checked against the checksum otherwise. The end record is not
+    yielded.
+
+    '''
+
+    while True:
+        kind, offset, length, payload, checksum = _record.unpack(
+            _read_exactly(f, _record.size))
+        if kind == END:
+            return
+        elif kind == KEEP:
+            yield kind, offset, length, checksum, None
+            continue
+        elif kind not in (DATA, ZLIB):
+            raise TransferError('Unknown record %r' % kind)
+        data = _read_exactly(f, payload)
+        if kind == ZLIB:
+            data = zlib.decompress(data)
+        if len(data) != length or _checksum(data) != checksum:
+            raise TransferError(
+                'Extent at offset %d is corrupt' % offset)
+        yield kind, offset, length, checksum, data
+
+
+def receive_file(f, filename):
+    '''Reproduce the file sent in the stream f as filename.
+
+    Holes are left as holes. The journal is removed once the whole
+    file has been received.
+
+    '''
+
+    flags, size, extent_size = _read_header(f)
+    journal_filename = filename + JOURNAL_SUFFIX
+    if flags & FLAG_RESUME:
+        with open(journal_filename) as journal:
+            old = read_journal(journal)
+        if old[:2] != (size, extent_size):
+            raise TransferError(
+                'Cannot resume transfer: %s does not match' %
+                journal_filename)
+        old = old[2]
+        fd = os.open(filename, os.O_WRONLY)
+        journal = open(journal_filename, 'a')
+    else:
+        old = {}
+        fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        journal = open(journal_filename, 'w')
+        journal.write('morph-sparse-journal %d %d\n' % (size, extent_size))
+        journal.flush()
+
+    try:
+        out = io.FileIO(fd, 'w', closefd=False)
+        written = set()
+        for kind, offset, length, checksum, data in _read_records(f):
+            written.add(offset)
+            if kind == KEEP:
+                if old.get(offset) != (length, checksum):
+                    raise TransferError(
+                        'Cannot resume transfer: extent at offset %d '
+                        'has not been received' % offset)
+                continue
+            journal.write('%d %d -\n' % (offset, length))
+            journal.flush()
+            os.lseek(fd, offset, os.SEEK_SET)
+            out.write(data)
+            journal.write('%d %d %d\n' % (offset, length, checksum))
+            journal.flush()
+
+        # Anything written by the interrupted transfer that is not in
+        # the file being sent now must be a hole, so it reads as zeroes.
+        for offset, (length, checksum) in sorted(old.items()):
+            if offset not in written:
+                os.lseek(fd, offset, os.SEEK_SET)
+                _write_zeroes(out, length)
+
+        os.ftruncate(fd, size)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+        journal.close()
+    os.remove(journal_filename)
+
+
+def receive_stream(f, out):
+    '''Write the file sent in the stream f to out, a pipe.
+
+    It is not possible to seek in a pipe, so holes are written out as
+    zeroes.
+
+    '''
+
+    flags, size, extent_size = _read_header(f)
+    if flags & FLAG_RESUME:
+        raise TransferError('Cannot resume a transfer into a pipe')
+    pos = 0
+    for kind, offset, length, checksum, data in _read_records(f):
+        if kind == KEEP:
+            raise TransferError('Cannot resume a transfer into a pipe')
+        _write_zeroes(out, offset - pos)
+        out.write(data)
+        pos = offset + length
+    _write_zeroes(out, size - pos)
+
+
+def receive_vbox(f, filename, disk_size): # pragma: no cover
+    '''Convert the file sent in the stream f to a VirtualBox disk image.'''
+
+    p = subprocess.Popen(
+        ['VBoxManage', 'convertfromraw', 'stdin', filename, str(disk_size)],
+        stdin=subprocess.PIPE)
+    try:
+        receive_stream(f, p.stdin)
+    finally:
+        p.stdin.close()
+        returncode = p.wait()
+    if returncode != 0:
+        raise TransferError('VBoxManage failed with code %d' % returncode)
+
+
+def write_journal(filename, out):
+    journal_filename = filename + JOURNAL_SUFFIX
+    if os.path.exists(filename) and os.path.exists(journal_filename):
+        with open(journal_filename, 'rb') as journal:
+            out.write(journal.read())
+
+
+def main(args): # pragma: no cover
+    stdin = io.open(sys.stdin.fileno(), 'rb', closefd=False)
+    stdout = io.open(sys.stdout.fileno(), 'wb', closefd=False)
+    command = args.pop(0) if args else None
+
+    if command == 'send':
+        compress = False
+        journal = None
+        while len(args) > 1:
+            option = args.pop(0)
+            if option == '--compress':
+                compress = True
+            elif option == '--resume':
+                with open(args.pop(0)) as f:
+                    journal = read_journal(f)
+            else:
+                raise TransferError('Unknown option %s' % option)
+        fd = os.open(args[0], os.O_RDONLY)
+        try:
+            send(fd, stdout, compress=compress, journal=journal)
+        finally:
+            os.close(fd)
+    elif command == 'receive-file' and len(args) == 1:
+        receive_file(stdin, args[0])
+    elif command == 'receive-vbox' and len(args) == 2:
+        receive_vbox(stdin, args[0], int(args[1]))
+    elif command == 'journal' and len(args) == 1:
+        write_journal(args[0], stdout)
+    else:
+        raise TransferError('Unknown command or wrong number of arguments')
+    stdout.flush()
+
+
+if __name__ == '__main__': # pragma: no cover
+    try:
+        main(sys.argv[1:])
+    except TransferError as e:
+        sys.stderr.write('ERROR: %s\n' % e)
+        sys.exit(1)
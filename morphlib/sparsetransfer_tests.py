@@ -0,0 +1,243 @@
+# Copyright (C) 2014  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import errno
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+import morphlib
+
+
+EXTENT = 4096
+
+
+class SparseTransferTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.source = os.path.join(self.tempdir, 'source')
+        self.target = os.path.join(self.tempdir, 'target')
+        self.journal = self.target + morphlib.sparsetransfer.JOURNAL_SUFFIX
+        self.write_source([(EXTENT, b'foo'), (3 * EXTENT + 10, b'bar')],
+                          10 * EXTENT)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def write_source(self, pieces, size):
+        with open(self.source, 'wb') as f:
+            for offset, data in pieces:
+                f.seek(offset)
+                f.write(data)
+            f.truncate(size)
+
+    def read(self, filename):
+        with open(filename, 'rb') as f:
+            return f.read()
+
+    def send(self, **kwargs):
+        out = io.BytesIO()
+        fd = os.open(self.source, os.O_RDONLY)
+        try:
+            morphlib.sparsetransfer.send(fd, out, extent_size=EXTENT,
+                                         **kwargs)
+        finally:
+            os.close(fd)
+        return out.getvalue()
+
+    def receive_file(self, stream):
+        morphlib.sparsetransfer.receive_file(io.BytesIO(stream), self.target)
+
+    def read_journal(self):
+        with open(self.journal) as f:
+            return morphlib.sparsetransfer.read_journal(f)
+
+    def interrupted_transfer(self, **kwargs):
+        stream = self.send(**kwargs)
+        self.assertRaises(morphlib.sparsetransfer.TransferError,
+                          self.receive_file, stream[:-30])
+        return self.read_journal()
+
+    def test_finds_extents_that_may_hold_data(self):
+        fd = os.open(self.source, os.O_RDONLY)
+        try:
+            offsets = list(morphlib.sparsetransfer.data_extents(
+                fd, 10 * EXTENT, EXTENT))
+        finally:
+            os.close(fd)
+        self.assertTrue(EXTENT in offsets)
+        self.assertTrue(3 * EXTENT in offsets)
+
+    def test_finds_every_extent_without_hole_support(self):
+        def lseek(fd, pos, whence):
+            raise OSError(errno.EINVAL, 'Invalid argument')
+        real_lseek = morphlib.sparsetransfer.os.lseek
+        morphlib.sparsetransfer.os.lseek = lseek
+        try:
+            offsets = list(morphlib.sparsetransfer.data_extents(
+                0, 3 * EXTENT + 1, EXTENT))
+        finally:
+            morphlib.sparsetransfer.os.lseek = real_lseek
+        self.assertEqual(offsets, [0, EXTENT, 2 * EXTENT, 3 * EXTENT])
+
+    def test_raises_unexpected_seek_errors(self):
+        fd = os.open(self.source, os.O_RDONLY)
+        os.close(fd)
+        self.assertRaises(
+            OSError, list,
+            morphlib.sparsetransfer.data_extents(fd, EXTENT, EXTENT))
+
+    def test_sends_only_extents_with_data(self):
+        stream = self.send()
+        self.assertEqual(stream.count(b'foo'), 1)
+        self.assertEqual(stream.count(b'bar'), 1)
+        self.assertTrue(len(stream) < 3 * EXTENT)
+
+    def test_reproduces_file(self):
+        self.receive_file(self.send())
+        self.assertEqual(self.read(self.target), self.read(self.source))
+        self.assertFalse(os.path.exists(self.journal))
+
+    def test_reproduces_file_with_compression(self):
+        stream = self.send(compress=True)
+        self.assertTrue(len(stream) < 2 * EXTENT)
+        self.receive_file(stream)
+        self.assertEqual(self.read(self.target), self.read(self.source))
+
+    def test_sends_incompressible_extents_as_they_are(self):
+        data = os.urandom(EXTENT)
+        self.write_source([(0, data)], EXTENT)
+        stream = self.send(compress=True)
+        self.assertTrue(data in stream)
+        self.receive_file(stream)
+        self.assertEqual(self.read(self.target), data)
+
+    def test_writes_stream_with_holes_as_zeroes(self):
+        out = io.BytesIO()
+        morphlib.sparsetransfer.receive_stream(io.BytesIO(self.send()), out)
+        self.assertEqual(out.getvalue(), self.read(self.source))
+
+    def test_rejects_other_streams(self):
+        self.assertRaises(morphlib.sparsetransfer.TransferError,
+                          self.receive_file, b'x' * 100)
+
+    def test_rejects_unknown_records(self):
+        stream = self.send()
+        header = morphlib.sparsetransfer._header.size
+        stream = stream[:header] + b'X' + stream[header + 1:]
+        self.assertRaises(morphlib.sparsetransfer.TransferError,
+                          self.receive_file, stream)
+
+    def test_rejects_corrupt_extents(self):
+        stream = self.send().replace(b'foo', b'baz')
+        self.assertRaises(morphlib.sparsetransfer.TransferError,
+                          self.receive_file, stream)
+
+    def test_journals_extents_received_before_interruption(self):
+        size, extent_size, extents = self.interrupted_transfer()
+        self.assertEqual((size, extent_size), (10 * EXTENT, EXTENT))
+        self.assertEqual(extents[EXTENT][0], EXTENT)
+        self.assertTrue(extents[EXTENT][1] is not None)
+
+    def test_ignores_incomplete_journal_lines(self):
+        self.interrupted_transfer()
+        with open(self.journal, 'a') as f:
+            f.write('%d %d -\n%d' % (3 * EXTENT, EXTENT, 5 * EXTENT))
+        size, extent_size, extents = self.read_journal()
+        self.assertEqual(extents[3 * EXTENT], (EXTENT, None))
+        self.assertFalse(5 * EXTENT in extents)
+
+    def test_rejects_other_journals(self):
+        with open(self.journal, 'w') as f:
+            f.write('rubbish\n')
+        self.assertRaises(morphlib.sparsetransfer.TransferError,
+                          self.read_journal)
+
+    def test_resumes_interrupted_transfer(self):
+        journal = self.interrupted_transfer()
+        stream = self.send(journal=journal)
+        self.assertFalse(b'foo' in stream)
+        self.assertTrue(b'bar' in stream)
+        self.receive_file(stream)
+        self.assertEqual(self.read(self.target), self.read(self.source))
+
+    def test_resends_extents_that_have_changed_since_interruption(self):
+        journal = self.interrupted_transfer()
+        self.write_source([(EXTENT, b'FOO'), (3 * EXTENT + 10, b'bar')],
+                          10 * EXTENT)
+        stream = self.send(journal=journal)
+        self.assertTrue(b'FOO' in stream)
+        self.receive_file(stream)
+        self.assertEqual(self.read(self.target), self.read(self.source))
+
+    def test_clears_extents_that_have_become_holes(self):
+        journal = self.interrupted_transfer()
+        self.write_source([(3 * EXTENT + 10, b'bar')], 10 * EXTENT)
+        self.receive_file(self.send(journal=journal))
+        self.assertEqual(self.read(self.target), self.read(self.source))
+
+    def test_starts_afresh_if_journal_is_for_another_file(self):
+        journal = self.interrupted_transfer()
+        self.write_source([(EXTENT, b'foo')], 20 * EXTENT)
+        stream = self.send(journal=journal)
+        self.assertTrue(b'foo' in stream)
+        self.receive_file(stream)
+        self.assertEqual(self.read(self.target), self.read(self.source))
+
+    def test_refuses_to_resume_if_receiver_journal_differs(self):
+        journal = self.interrupted_transfer()
+        with open(self.journal, 'w') as f:
+            f.write('morph-sparse-journal 1 1\n')
+        self.assertRaises(morphlib.sparsetransfer.TransferError,
+                          self.receive_file, self.send(journal=journal))
+
+    def test_refuses_to_keep_extents_that_were_not_received(self):
+        journal = self.interrupted_transfer()
+        with open(self.journal, 'w') as f:
+            f.write('morph-sparse-journal %d %d\n' % (10 * EXTENT, EXTENT))
+        self.assertRaises(morphlib.sparsetransfer.TransferError,
+                          self.receive_file, self.send(journal=journal))
+
+    def test_refuses_to_resume_into_a_pipe(self):
+        journal = self.interrupted_transfer()
+        self.assertRaises(morphlib.sparsetransfer.TransferError,
+                          morphlib.sparsetransfer.receive_stream,
+                          io.BytesIO(self.send(journal=journal)),
+                          io.BytesIO())
+
+    def test_refuses_keep_records_in_a_pipe(self):
+        journal = self.interrupted_transfer()
+        stream = self.send(journal=journal)
+        header = morphlib.sparsetransfer._header.size
+        flags = header - 13
+        stream = stream[:flags] + b'\0' + stream[flags + 1:]
+        self.assertRaises(morphlib.sparsetransfer.TransferError,
+                          morphlib.sparsetransfer.receive_stream,
+                          io.BytesIO(stream), io.BytesIO())
+
+    def test_writes_journal_of_interrupted_transfer(self):
+        self.interrupted_transfer()
+        out = io.BytesIO()
+        morphlib.sparsetransfer.write_journal(self.target, out)
+        self.assertEqual(out.getvalue(), self.read(self.journal))
+
+    def test_writes_no_journal_without_interrupted_transfer(self):
+        out = io.BytesIO()
+        morphlib.sparsetransfer.write_journal(self.target, out)
+        self.assertEqual(out.getvalue(), b'')
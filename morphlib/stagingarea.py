@@ -20,7 +20,6 @@ import shutil
 import stat
 import cliapp
 from urlparse import urlparse
-import tempfile
 
 import morphlib
 
@@ -156,23 +155,13 @@ class StagingArea(object):
         '''
 
         chunk_cache_dir = os.path.join(self._app.settings['tempdir'], 'chunks')
-        unpacked_artifact = os.path.join(
-            chunk_cache_dir, os.path.basename(handle.name) + '.d')
-        if not os.path.exists(unpacked_artifact):
+        store = morphlib.unpackedchunkstore.UnpackedChunkStore(chunk_cache_dir)
+        basename = os.path.basename(handle.name)
+        if not store.has(basename):
             self._app.status(
                 msg='Unpacking chunk from cache %(filename)s',
-                filename=os.path.basename(handle.name))
-            savedir = tempfile.mkdtemp(dir=chunk_cache_dir)
-            try:
-                morphlib.bins.unpack_binary_from_file(
-                    handle, savedir + '/')
-            except BaseException, e: # pragma: no cover
-                shutil.rmtree(savedir)
-                raise
-            # TODO: This rename is not concurrency safe if two builds are
-            #       extracting the same chunk, one build will fail because
-            #       the other renamed its tempdir here first.
-            os.rename(savedir, unpacked_artifact)
+                filename=basename)
+        unpacked_artifact = store.unpack(basename, handle)
 
         if not os.path.exists(self.dirname):
             self._mkdir(self.dirname)
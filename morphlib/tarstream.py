@@ -0,0 +1,68 @@
+# Copyright (C) 2014  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import os
+import tarfile
+
+
+def members_end(filename):
+    '''Return the offset at which the members of a tar archive end.
+
+    This is where the blocks of zeros marking the end of the archive
+    start. Only the headers of the members are read.
+
+    '''
+
+    tar = tarfile.open(filename)
+    try:
+        for member in tar:
+            pass
+        # Once all the members have been read, tarfile's offset is where
+        # it looked for the next header. The sizes of the members can't
+        # be used to find it, since a sparse member's size is that of
+        # the whole file rather than of the data stored in the archive.
+        return tar.offset
+    finally:
+        tar.close()
+
+
+def write_with_files(filename, dirname, names, f, bufsize=1024**2):
+    '''Write a tar archive with some more files to a stream.
+
+    The members of the uncompressed tar archive ``filename`` are copied
+    to the file object ``f`` as they are, followed by the files ``names``
+    from the directory ``dirname``, so that they are unpacked on top of
+    the others. Only the files themselves are added, not the directories
+    they are in, so the archive must have those already.
+
+    '''
+
+    remaining = members_end(filename)
+    with open(filename, 'rb') as archive:
+        while remaining > 0:
+            data = archive.read(min(bufsize, remaining))
+            if not data:
+                raise tarfile.ReadError('%s ended early' % filename)
+            f.write(data)
+            remaining -= len(data)
+
+    tar = tarfile.open(fileobj=f, mode='w|', format=tarfile.GNU_FORMAT)
+    try:
+        for name in names:
+            tar.add(os.path.join(dirname, name), arcname=name,
+                    recursive=False)
+    finally:
+        tar.close()
@@ -0,0 +1,96 @@
+# Copyright (C) 2014  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import os
+import shutil
+import StringIO
+import subprocess
+import tarfile
+import tempfile
+import unittest
+
+import morphlib
+
+
+class TarStreamTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.system = os.path.join(self.tempdir, 'system')
+        os.makedirs(os.path.join(self.system, 'baserock'))
+        os.makedirs(os.path.join(self.system, 'bin'))
+        with open(os.path.join(self.system, 'bin', 'sh'), 'w') as f:
+            f.write('x' * 1000)
+        os.link(os.path.join(self.system, 'bin', 'sh'),
+                os.path.join(self.system, 'bin', 'bash'))
+        os.symlink('sh', os.path.join(self.system, 'bin', 'dash'))
+        self.archive = os.path.join(self.tempdir, 'system.tar')
+        tar = tarfile.open(self.archive, 'w', format=tarfile.GNU_FORMAT)
+        tar.add(self.system, arcname='.')
+        tar.close()
+
+        self.extra = os.path.join(self.tempdir, 'extra')
+        os.makedirs(os.path.join(self.extra, 'baserock'))
+        with open(os.path.join(self.extra, 'baserock', 'meta'), 'w') as f:
+            f.write('meta')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_finds_end_of_members(self):
+        end = morphlib.tarstream.members_end(self.archive)
+        with open(self.archive, 'rb') as f:
+            members = f.read(end)
+            self.assertEqual(f.read(1024), '\0' * 1024)
+        tar = tarfile.open(fileobj=StringIO.StringIO(members))
+        self.assertEqual(len(tar.getnames()), 6)
+
+    def test_finds_end_of_sparse_members(self):
+        with open(os.path.join(self.system, 'disk.img'), 'wb') as f:
+            f.write('start')
+            f.seek(1024**2)
+            f.write('end')
+        subprocess.check_call(['tar', '--format=gnu', '--sparse', '-cf',
+                               self.archive, '-C', self.system, '.'])
+        end = morphlib.tarstream.members_end(self.archive)
+        self.assertTrue(end < 1024**2)
+        with open(self.archive, 'rb') as f:
+            f.seek(end)
+            self.assertEqual(f.read(1024), '\0' * 1024)
+
+        f = StringIO.StringIO()
+        morphlib.tarstream.write_with_files(
+            self.archive, self.extra, ['baserock/meta'], f)
+        f.seek(0)
+        tar = tarfile.open(fileobj=f)
+        self.assertEqual(tar.extractfile('baserock/meta').read(), 'meta')
+        self.assertEqual(tar.extractfile('./disk.img').read(),
+                         'start' + '\0' * (1024**2 - 5) + 'end')
+
+    def test_adds_files_to_archive(self):
+        f = StringIO.StringIO()
+        morphlib.tarstream.write_with_files(
+            self.archive, self.extra, ['baserock/meta'], f, bufsize=100)
+        f.seek(0)
+        tar = tarfile.open(fileobj=f)
+        names = tar.getnames()
+        self.assertEqual(
+            sorted(names),
+            ['.', './baserock', './bin', './bin/bash', './bin/dash',
+             './bin/sh', 'baserock/meta'])
+        self.assertEqual(names[-1], 'baserock/meta')
+        self.assertEqual(tar.extractfile('baserock/meta').read(), 'meta')
+        self.assertEqual(tar.extractfile('./bin/sh').read(), 'x' * 1000)
@@ -0,0 +1,287 @@
+# Copyright (C) 2014  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import errno
+import fcntl
+import logging
+import multiprocessing
+import os
+import shutil
+import stat
+import tempfile
+
+import morphlib
+
+
+def _unpack_chunk(args):
+    dirname, basename, filename = args
+    store = UnpackedChunkStore(dirname)
+    with open(filename, 'rb') as f:
+        store.unpack(basename, f)
+
+
+class UnpackedChunkStore(object):
+
+    '''Chunk artifacts unpacked into directories of their own.
+
+    Unpacking a chunk with Python's tarfile module is slow, so each
+    chunk is unpacked only once, into ``DIRNAME/BASENAME.d``, and its
+    files are linked from there into every staging area or system root
+    filesystem that needs them.
+
+    The modification time of the directory of a chunk is when it was
+    last used, so that the least recently used chunks can be removed
+    to make space.
+
+    '''
+
+    # Chunks used this recently are never removed, since a build may be
+    # linking them into its staging area.
+    in_use_for = 60 * 60
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+        self._reflink = True
+
+    def path(self, basename):
+        '''Return the directory a chunk is, or will be, unpacked in.'''
+        return os.path.join(self.dirname, basename + '.d')
+
+    def has(self, basename):
+        return os.path.exists(self.path(basename))
+
+    def _touch(self, path):
+        try:
+            os.utime(path, None)
+        except OSError, e:  # pragma: no cover
+            logging.debug('Could not record use of %s: %s' % (path, e))
+
+    def unpack(self, basename, f):
+        '''Unpack a chunk from the open file ``f``, unless already done.
+
+        Returns the directory the chunk is unpacked in. It is safe for
+        several processes to unpack the same chunk at the same time.
+
+        '''
+        path = self.path(basename)
+        if os.path.exists(path):
+            self._touch(path)
+            return path
+        savedir = tempfile.mkdtemp(dir=self.dirname)
+        try:
+            morphlib.bins.unpack_binary_from_file(f, savedir + '/')
+        except BaseException:  # pragma: no cover
+            shutil.rmtree(savedir)
+            raise
+        try:
+            os.rename(savedir, path)
+        except OSError, e:  # pragma: no cover
+            # Someone else finished unpacking the same chunk first.
+            shutil.rmtree(savedir)
+            if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                raise
+        return path
+
+    def unpack_many(self, chunks, jobs=1):
+        '''Unpack many chunks, given as (basename, filename) pairs.
+
+        Chunks that are not unpacked yet are unpacked by up to ``jobs``
+        processes at once.
+
+        '''
+        todo = []
+        seen = set()
+        for basename, filename in chunks:
+            if basename not in seen and not self.has(basename):
+                seen.add(basename)
+                todo.append((self.dirname, basename, filename))
+        if jobs <= 1 or len(todo) <= 1:
+            for args in todo:
+                _unpack_chunk(args)
+            return
+        pool = multiprocessing.Pool(min(jobs, len(todo)))
+        try:
+            pool.map(_unpack_chunk, todo)
+        finally:
+            pool.close()
+            pool.join()
+
+    def link_into(self, basename, destdir, hard_link=True):
+        '''Link the files of an unpacked chunk into ``destdir``.
+
+        The result is the same as unpacking the chunk into ``destdir``:
+        existing files are replaced, and directories are created with
+        the permissions they have in the chunk. Directories that already
+        exist, or are symlinks to directories, are kept.
+
+        Files are reflinked if the filesystem supports it, so that they
+        can be changed in ``destdir`` without changing the store.
+        Otherwise they are hard linked, which is just as fast, but means
+        that files must be replaced rather than changed in place, or,
+        if ``hard_link`` is False, copied. That is slower, but is needed
+        for a system root filesystem, since its files are changed in
+        place by the system integration commands.
+
+        '''
+        srcroot = self.path(basename)
+        self._touch(srcroot)
+        chown = os.geteuid() == 0
+        for dirpath, dirnames, filenames in os.walk(srcroot):
+            relpath = os.path.relpath(dirpath, srcroot)
+            targetdir = os.path.normpath(os.path.join(destdir, relpath))
+            # The top directory was made by mkdtemp, not by the chunk.
+            if relpath != '.':
+                self._make_dir(dirpath, targetdir, chown)
+            # Symlinks to directories are not walked into, but they are
+            # listed in dirnames.
+            for name in dirnames + filenames:
+                src = os.path.join(dirpath, name)
+                st = os.lstat(src)
+                if not stat.S_ISDIR(st.st_mode):
+                    self._link_file(src, os.path.join(targetdir, name), st,
+                                    chown, hard_link)
+
+    def _make_dir(self, src, dst, chown):
+        st = os.lstat(src)
+        try:
+            existing = os.stat(dst)
+        except OSError, e:
+            if e.errno != errno.ENOENT:  # pragma: no cover
+                raise
+            if os.path.islink(dst):  # pragma: no cover
+                os.remove(dst)
+            os.mkdir(dst)
+        else:
+            if not stat.S_ISDIR(existing.st_mode):
+                raise IOError(errno.ENOTDIR,
+                              'Cannot replace non-directory with directory',
+                              dst)
+            if os.path.islink(dst):
+                return
+        if chown:  # pragma: no cover
+            os.lchown(dst, st.st_uid, st.st_gid)
+        os.chmod(dst, stat.S_IMODE(st.st_mode))
+
+    def _link_file(self, src, dst, st, chown, hard_link):
+        if os.path.lexists(dst):
+            if os.path.isdir(dst) and not os.path.islink(dst):
+                raise IOError(errno.EISDIR,
+                              'Cannot replace directory with non-directory',
+                              dst)
+            os.remove(dst)
+        mode = st.st_mode
+        if stat.S_ISREG(mode):
+            if self._reflink and self._clone(src, dst, st, chown):
+                pass
+            elif hard_link:
+                os.link(src, dst)
+            else:
+                self._make_file(src, dst, st, chown, _copy_data)
+        elif stat.S_ISLNK(mode):
+            os.symlink(os.readlink(src), dst)
+            if chown:  # pragma: no cover
+                os.lchown(dst, st.st_uid, st.st_gid)
+        else:  # pragma: no cover
+            # Device nodes, fifos and sockets
+            os.mknod(dst, mode, st.st_rdev)
+            if chown:
+                os.lchown(dst, st.st_uid, st.st_gid)
+            os.chmod(dst, stat.S_IMODE(mode))
+
+    def _clone(self, src, dst, st, chown):
+        '''Reflink src to dst, returning False if that is not supported.'''
+        try:
+            self._make_file(src, dst, st, chown, _reflink_data)
+        except IOError, e:
+            logging.debug('Not reflinking from %s: %s' % (self.dirname, e))
+            self._reflink = False
+            return False
+        return True
+
+    def _make_file(self, src, dst, st, chown, copy_data):
+        '''Make dst with the data of src, as copied by copy_data.'''
+        fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+        try:
+            with open(src, 'rb') as f:
+                copy_data(f.fileno(), fd)
+            # Changing the owner clears the setuid and setgid bits, so
+            # the mode is set afterwards.
+            if chown:  # pragma: no cover
+                os.fchown(fd, st.st_uid, st.st_gid)
+            os.fchmod(fd, stat.S_IMODE(st.st_mode))
+        except BaseException:
+            os.close(fd)
+            os.remove(dst)
+            raise
+        os.close(fd)
+        os.utime(dst, (st.st_atime, st.st_mtime))
+
+    def remove_unused(self, needed, now):
+        '''Remove chunks not used recently to free ``needed`` bytes.
+
+        The least recently used chunks are removed first, and chunks
+        used in the last ``in_use_for`` seconds before ``now`` are
+        kept. Returns the disk space used by the removed chunks, which
+        is not all freed if their files are linked elsewhere too.
+
+        '''
+        chunks = []
+        for name in os.listdir(self.dirname):
+            if not name.endswith('.d'):
+                continue
+            try:
+                last_used = os.stat(os.path.join(self.dirname, name)).st_mtime
+            except OSError:  # pragma: no cover
+                continue  # someone else removed it
+            if last_used < now - self.in_use_for:
+                chunks.append((last_used, name[:-len('.d')]))
+        chunks.sort()
+
+        freed = 0
+        for last_used, basename in chunks:
+            if freed >= needed:
+                break
+            freed += self._remove(basename)
+        return freed
+
+    def _remove(self, basename):
+        # The chunk is moved out of the way first, so that it is either
+        # all there or not there at all for other processes.
+        doomed = tempfile.mkdtemp(dir=self.dirname)
+        try:
+            os.rename(self.path(basename), os.path.join(doomed, 'chunk'))
+        except OSError:  # pragma: no cover
+            shutil.rmtree(doomed)
+            return 0  # someone else removed it
+        size = 0
+        for dirpath, dirnames, filenames in os.walk(doomed):
+            for name in dirnames + filenames:
+                size += os.lstat(os.path.join(dirpath, name)).st_blocks * 512
+        shutil.rmtree(doomed)
+        return size
+
+
+def _reflink_data(src_fd, dst_fd):
+    fcntl.ioctl(dst_fd, morphlib.util.FICLONE, src_fd)
+
+
+def _copy_data(src_fd, dst_fd):
+    while True:
+        data = os.read(src_fd, 1024 * 1024)
+        if not data:
+            break
+        while data:
+            data = data[os.write(dst_fd, data):]
@@ -0,0 +1,192 @@
+# Copyright (C) 2014  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import os
+import shutil
+import stat
+import tarfile
+import tempfile
+import time
+import unittest
+
+import morphlib
+
+
+class UnpackedChunkStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.storedir = os.path.join(self.tempdir, 'chunks')
+        os.mkdir(self.storedir)
+        self.store = morphlib.unpackedchunkstore.UnpackedChunkStore(
+            self.storedir)
+        self.destdir = os.path.join(self.tempdir, 'dest')
+        os.mkdir(self.destdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def make_chunk(self, name, files, dirs=(), symlinks={}):
+        rootdir = os.path.join(self.tempdir, name + '-root')
+        os.mkdir(rootdir)
+        for dirname in dirs:
+            os.makedirs(os.path.join(rootdir, dirname))
+            os.chmod(os.path.join(rootdir, dirname), 0750)
+        for filename, contents in files.iteritems():
+            path = os.path.join(rootdir, filename)
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(contents)
+            os.chmod(path, 0755)
+        for linkname, target in symlinks.iteritems():
+            os.symlink(target, os.path.join(rootdir, linkname))
+        filename = os.path.join(self.tempdir, name)
+        with tarfile.open(filename, 'w') as tar:
+            for entry in sorted(os.listdir(rootdir)):
+                tar.add(os.path.join(rootdir, entry), arcname=entry)
+        return filename
+
+    def read(self, *parts):
+        with open(os.path.join(self.destdir, *parts)) as f:
+            return f.read()
+
+    def test_does_not_have_chunk_before_unpacking(self):
+        self.assertFalse(self.store.has('foo.chunk.bar'))
+
+    def test_unpacks_chunk(self):
+        filename = self.make_chunk('foo.chunk.bar', {'bin/foo': 'foo'})
+        with open(filename) as f:
+            path = self.store.unpack('foo.chunk.bar', f)
+        self.assertTrue(self.store.has('foo.chunk.bar'))
+        self.assertEqual(path, self.store.path('foo.chunk.bar'))
+        self.assertEqual(open(os.path.join(path, 'bin', 'foo')).read(),
+                         'foo')
+
+    def test_unpacks_chunk_only_once(self):
+        filename = self.make_chunk('foo.chunk.bar', {'foo': 'foo'})
+        with open(filename) as f:
+            path = self.store.unpack('foo.chunk.bar', f)
+        with open(os.path.join(path, 'foo'), 'w') as f:
+            f.write('changed')
+        with open(filename) as f:
+            self.store.unpack('foo.chunk.bar', f)
+        self.assertEqual(open(os.path.join(path, 'foo')).read(), 'changed')
+
+    def test_unpacks_many_chunks_in_parallel(self):
+        chunks = [(name, self.make_chunk(name, {name: name}))
+                  for name in ('a.chunk.a', 'b.chunk.b', 'c.chunk.c')]
+        self.store.unpack_many(chunks + chunks[:1], jobs=2)
+        for name, filename in chunks:
+            self.assertTrue(self.store.has(name))
+
+    def test_unpacks_many_chunks_serially(self):
+        chunks = [(name, self.make_chunk(name, {name: name}))
+                  for name in ('a.chunk.a', 'b.chunk.b')]
+        self.store.unpack_many(chunks, jobs=1)
+        for name, filename in chunks:
+            self.assertTrue(self.store.has(name))
+
+    def test_links_chunk_into_directory(self):
+        filename = self.make_chunk('foo.chunk.bar', {'usr/bin/foo': 'foo'},
+                                   dirs=['etc'], symlinks={'bin': 'usr/bin'})
+        self.store.unpack_many([('foo.chunk.bar', filename)])
+        self.store.link_into('foo.chunk.bar', self.destdir)
+        self.assertEqual(self.read('usr', 'bin', 'foo'), 'foo')
+        self.assertEqual(os.readlink(os.path.join(self.destdir, 'bin')),
+                         'usr/bin')
+        mode = os.stat(os.path.join(self.destdir, 'etc')).st_mode
+        self.assertEqual(stat.S_IMODE(mode), 0750)
+        mode = os.stat(os.path.join(self.destdir, 'usr', 'bin', 'foo')).st_mode
+        self.assertEqual(stat.S_IMODE(mode), 0755)
+
+    def test_later_chunks_replace_files_of_earlier_ones(self):
+        first = self.make_chunk('a.chunk.a', {'etc/foo': 'first'})
+        second = self.make_chunk('b.chunk.b', {'etc/foo': 'second',
+                                               'etc/bar': 'bar'})
+        self.store.unpack_many([('a.chunk.a', first),
+                                ('b.chunk.b', second)])
+        self.store.link_into('a.chunk.a', self.destdir)
+        self.store.link_into('b.chunk.b', self.destdir)
+        self.assertEqual(self.read('etc', 'foo'), 'second')
+        self.assertEqual(self.read('etc', 'bar'), 'bar')
+        with open(os.path.join(self.store.path('a.chunk.a'), 'etc',
+                               'foo')) as f:
+            self.assertEqual(f.read(), 'first')
+
+    def test_keeps_symlinks_to_directories(self):
+        first = self.make_chunk('a.chunk.a', {'usr/lib/a': 'a'},
+                                symlinks={'lib': 'usr/lib'})
+        second = self.make_chunk('b.chunk.b', {'lib/b': 'b'})
+        self.store.unpack_many([('a.chunk.a', first),
+                                ('b.chunk.b', second)])
+        self.store.link_into('a.chunk.a', self.destdir)
+        self.store.link_into('b.chunk.b', self.destdir)
+        self.assertTrue(os.path.islink(os.path.join(self.destdir, 'lib')))
+        self.assertEqual(self.read('usr', 'lib', 'b'), 'b')
+
+    def test_refuses_to_replace_directory_with_file(self):
+        first = self.make_chunk('a.chunk.a', {'foo/bar': 'bar'})
+        second = self.make_chunk('b.chunk.b', {'foo': 'foo'})
+        self.store.unpack_many([('a.chunk.a', first),
+                                ('b.chunk.b', second)])
+        self.store.link_into('a.chunk.a', self.destdir)
+        self.assertRaises(IOError, self.store.link_into, 'b.chunk.b',
+                          self.destdir)
+
+    def test_hard_links_if_reflinks_are_not_supported(self):
+        filename = self.make_chunk('foo.chunk.bar', {'foo': 'foo'})
+        self.store.unpack_many([('foo.chunk.bar', filename)])
+        self.store._reflink = False
+        self.store.link_into('foo.chunk.bar', self.destdir)
+        src = os.stat(os.path.join(self.store.path('foo.chunk.bar'), 'foo'))
+        dst = os.stat(os.path.join(self.destdir, 'foo'))
+        self.assertEqual(src.st_ino, dst.st_ino)
+
+    def test_copies_if_reflinks_are_not_supported_and_not_hard_linking(self):
+        filename = self.make_chunk('foo.chunk.bar', {'foo': 'foo'})
+        self.store.unpack_many([('foo.chunk.bar', filename)])
+        self.store._reflink = False
+        self.store.link_into('foo.chunk.bar', self.destdir, hard_link=False)
+        src = os.path.join(self.store.path('foo.chunk.bar'), 'foo')
+        dst = os.path.join(self.destdir, 'foo')
+        self.assertNotEqual(os.stat(src).st_ino, os.stat(dst).st_ino)
+        self.assertEqual(stat.S_IMODE(os.stat(dst).st_mode), 0755)
+        with open(dst, 'w') as f:
+            f.write('changed')
+        with open(src) as f:
+            self.assertEqual(f.read(), 'foo')
+
+    def test_removes_least_recently_used_chunks_first(self):
+        for name, last_used in [('a.chunk.a', 100), ('b.chunk.b', 200),
+                                ('c.chunk.c', 300)]:
+            filename = self.make_chunk(name, {'foo': 'x' * 10000})
+            self.store.unpack_many([(name, filename)])
+            os.utime(self.store.path(name), (last_used, last_used))
+        self.store.in_use_for = 1000
+        freed = self.store.remove_unused(1, now=1250)
+        self.assertTrue(freed > 0)
+        self.assertFalse(self.store.has('a.chunk.a'))
+        self.assertTrue(self.store.has('b.chunk.b'))
+        self.assertTrue(self.store.has('c.chunk.c'))
+
+    def test_keeps_chunks_used_recently(self):
+        filename = self.make_chunk('foo.chunk.bar', {'foo': 'foo'})
+        self.store.unpack_many([('foo.chunk.bar', filename)])
+        self.store.link_into('foo.chunk.bar', self.destdir)
+        self.assertEqual(self.store.remove_unused(1000, time.time()), 0)
+        self.assertTrue(self.store.has('foo.chunk.bar'))
+        self.assertEqual(os.listdir(self.storedir), ['foo.chunk.bar.d'])
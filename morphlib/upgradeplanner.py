@@ -0,0 +1,141 @@
+# Copyright (C) 2014  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import collections
+import json
+import logging
+import os
+import stat
+import tarfile
+
+
+UpgradePlan = collections.namedtuple(
+    'UpgradePlan', ('changed', 'removed', 'unchanged', 'files'))
+
+
+def _chunk_metadata(name, f):
+    try:
+        meta = json.load(f)
+    except ValueError:
+        logging.warning('Ignoring corrupt metadata %s' % name)
+        return None
+    if meta.get('kind') != 'chunk':
+        return None
+    return meta
+
+
+def read_chunk_metadata(root):
+    '''Return the metadata of the chunk artifacts in a system tree.
+
+    The result maps the artifact name of every chunk artifact in the
+    system to its metadata, as read from ``baserock/NAME.meta``.
+
+    '''
+    metadata = {}
+    baserock = os.path.join(root, 'baserock')
+    if not os.path.isdir(baserock):
+        return metadata
+    for basename in os.listdir(baserock):
+        if not basename.endswith('.meta'):
+            continue
+        with open(os.path.join(baserock, basename)) as f:
+            meta = _chunk_metadata(basename, f)
+        if meta is not None:
+            metadata[meta['artifact-name']] = meta
+    return metadata
+
+
+def read_chunk_metadata_from_tar(f):
+    '''Like read_chunk_metadata, but from a tarball of a baserock directory.
+
+    This is for reading the metadata of a system on another machine,
+    where it can be streamed with ``tar -C ROOT -cf - baserock``.
+
+    '''
+    metadata = {}
+    with tarfile.open(fileobj=f, mode='r|') as tar:
+        for member in tar:
+            if not (member.isfile() and member.name.endswith('.meta')):
+                continue
+            meta = _chunk_metadata(member.name, tar.extractfile(member))
+            if meta is not None:
+                metadata[meta['artifact-name']] = meta
+    return metadata
+
+
+def _normalise(path):
+    return os.path.normpath(path).lstrip('/')
+
+
+def _is_file(root, path):
+    '''Is there something other than a directory at path in root?'''
+    try:
+        st = os.lstat(os.path.join(root, path))
+    except OSError:
+        return False
+    return not stat.S_ISDIR(st.st_mode)
+
+
+def plan_upgrade(old_metadata, new_metadata, new_root):
+    '''Work out which files need copying to upgrade a system.
+
+    ``old_metadata`` and ``new_metadata`` are the chunk metadata of the
+    system being upgraded and of the new system, as returned by
+    read_chunk_metadata, and ``new_root`` is the configured tree of the
+    new system.
+
+    A chunk artifact whose cache key has not changed has exactly the
+    same files as before, so only the files of chunk artifacts that are
+    new or have changed need their contents comparing. So do the files
+    that do not belong to any chunk, which are made when the system is
+    built or configured.
+
+    The ``files`` of the plan are those files, as paths relative to the
+    root, without any directories. The other fields list the names of
+    the chunk artifacts that have changed, have been removed, or have
+    stayed the same.
+
+    '''
+    changed = []
+    unchanged = []
+    for name, meta in sorted(new_metadata.iteritems()):
+        old = old_metadata.get(name)
+        if old is not None and old.get('cache-key') == meta['cache-key']:
+            unchanged.append(name)
+        else:
+            changed.append(name)
+    removed = sorted(set(old_metadata) - set(new_metadata))
+
+    owned = set()
+    for meta in new_metadata.itervalues():
+        owned.update(_normalise(p) for p in meta.get('contents', []))
+
+    files = set()
+    for name in changed:
+        files.update(
+            p for p in (_normalise(p)
+                        for p in new_metadata[name].get('contents', []))
+            if _is_file(new_root, p))
+
+    for dirname, subdirs, basenames in os.walk(new_root):
+        reldir = os.path.relpath(dirname, new_root)
+        for name in basenames + [d for d in subdirs
+                                 if os.path.islink(os.path.join(dirname, d))]:
+            path = _normalise(os.path.join(reldir, name))
+            if path not in owned:
+                files.add(path)
+
+    return UpgradePlan(changed, removed, unchanged, sorted(files))
@@ -0,0 +1,138 @@
+# Copyright (C) 2014  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import json
+import os
+import shutil
+import StringIO
+import tarfile
+import tempfile
+import unittest
+
+import morphlib
+
+
+class UpgradePlannerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.root = os.path.join(self.tempdir, 'root')
+        os.makedirs(os.path.join(self.root, 'baserock'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def add_file(self, path, contents=''):
+        path = os.path.join(self.root, path)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(contents)
+
+    def chunk_meta(self, name, cachekey, contents):
+        return {
+            'artifact-name': name,
+            'kind': 'chunk',
+            'cache-key': cachekey,
+            'contents': contents,
+        }
+
+    def add_chunk(self, name, cachekey, files):
+        meta_path = 'baserock/%s.meta' % name
+        for path in files:
+            self.add_file(path, name)
+        contents = set()
+        for path in files + [meta_path]:
+            while path:
+                contents.add(path)
+                path = os.path.dirname(path)
+        meta = self.chunk_meta(name, cachekey, sorted(contents))
+        self.add_file(meta_path, json.dumps(meta))
+        return meta
+
+    def test_reads_chunk_metadata_from_tree(self):
+        meta = self.add_chunk('foo-bins', 'abc', ['usr/bin/foo'])
+        self.add_file('baserock/stratum.meta',
+                      json.dumps({'artifact-name': 'stratum',
+                                  'kind': 'stratum'}))
+        self.add_file('baserock/broken.meta', '{')
+        self.assertEqual(morphlib.upgradeplanner.read_chunk_metadata(
+                             self.root),
+                         {'foo-bins': meta})
+
+    def test_reads_no_chunk_metadata_without_baserock_directory(self):
+        shutil.rmtree(os.path.join(self.root, 'baserock'))
+        self.assertEqual(
+            morphlib.upgradeplanner.read_chunk_metadata(self.root), {})
+
+    def test_reads_chunk_metadata_from_tar(self):
+        meta = self.add_chunk('foo-bins', 'abc', ['usr/bin/foo'])
+        f = StringIO.StringIO()
+        with tarfile.open(fileobj=f, mode='w') as tar:
+            tar.add(os.path.join(self.root, 'baserock'), arcname='baserock')
+        f.seek(0)
+        self.assertEqual(
+            morphlib.upgradeplanner.read_chunk_metadata_from_tar(f),
+            {'foo-bins': meta})
+
+    def test_compares_only_files_of_changed_chunks(self):
+        old_foo = self.chunk_meta('foo-bins', 'abc', ['usr/bin/foo'])
+        old_bar = self.chunk_meta('bar-bins', 'def', ['usr/bin/bar'])
+        new_foo = self.add_chunk('foo-bins', 'abc', ['usr/bin/foo'])
+        new_bar = self.add_chunk('bar-bins', 'xyz', ['usr/bin/bar'])
+        plan = morphlib.upgradeplanner.plan_upgrade(
+            {'foo-bins': old_foo, 'bar-bins': old_bar},
+            {'foo-bins': new_foo, 'bar-bins': new_bar},
+            self.root)
+        self.assertEqual(plan.changed, ['bar-bins'])
+        self.assertEqual(plan.unchanged, ['foo-bins'])
+        self.assertEqual(plan.removed, [])
+        self.assertEqual(plan.files,
+                         ['baserock/bar-bins.meta', 'usr/bin/bar'])
+
+    def test_compares_new_chunks_and_lists_removed_ones(self):
+        old_bar = self.chunk_meta('bar-bins', 'def', ['usr/bin/bar'])
+        new_foo = self.add_chunk('foo-bins', 'abc', ['usr/bin/foo'])
+        plan = morphlib.upgradeplanner.plan_upgrade(
+            {'bar-bins': old_bar}, {'foo-bins': new_foo}, self.root)
+        self.assertEqual(plan.changed, ['foo-bins'])
+        self.assertEqual(plan.removed, ['bar-bins'])
+        self.assertEqual(plan.files,
+                         ['baserock/foo-bins.meta', 'usr/bin/foo'])
+
+    def test_compares_files_that_belong_to_no_chunk(self):
+        meta = self.add_chunk('foo-bins', 'abc', ['usr/bin/foo'])
+        self.add_file('etc/fstab', 'configured')
+        self.add_file('baserock/deployment.meta', '{}')
+        os.symlink('usr/bin', os.path.join(self.root, 'bin'))
+        plan = morphlib.upgradeplanner.plan_upgrade(
+            {'foo-bins': meta}, {'foo-bins': meta}, self.root)
+        self.assertEqual(plan.files,
+                         ['baserock/deployment.meta', 'bin', 'etc/fstab'])
+
+    def test_compares_everything_without_old_metadata(self):
+        meta = self.add_chunk('foo-bins', 'abc', ['usr/bin/foo'])
+        plan = morphlib.upgradeplanner.plan_upgrade(
+            {}, {'foo-bins': meta}, self.root)
+        self.assertEqual(plan.files,
+                         ['baserock/foo-bins.meta', 'usr/bin/foo'])
+
+    def test_ignores_listed_files_that_are_missing(self):
+        meta = self.add_chunk('foo-bins', 'abc', ['usr/bin/foo'])
+        os.remove(os.path.join(self.root, 'usr', 'bin', 'foo'))
+        plan = morphlib.upgradeplanner.plan_upgrade(
+            {}, {'foo-bins': meta}, self.root)
+        self.assertEqual(plan.files, ['baserock/foo-bins.meta'])
@@ -14,10 +14,13 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 import contextlib
+import fcntl
 import itertools
 import os
 import re
+import shutil
 import subprocess
+import tempfile
 import textwrap
 
 import fs.osfs
@@ -135,10 +138,22 @@ def new_artifact_caches(settings):  # pragma: no cover
     lac = morphlib.localartifactcache.LocalArtifactCache(
             fs.osfs.OSFS(artifact_cachedir))
 
+    # Artifacts missing from the local cache are looked for in the
+    # shared artifact directory first, then on the artifact cache server.
+    stores = []
+    if settings['shared-artifact-cache']:
+        stores.append(morphlib.sharedartifactcache.SharedArtifactCache(
+            settings['shared-artifact-cache']))
     rac_url = get_artifact_cache_server(settings)
-    rac = None
     if rac_url:
-        rac = morphlib.remoteartifactcache.RemoteArtifactCache(rac_url)
+        stores.append(morphlib.remoteartifactcache.RemoteArtifactCache(
+            rac_url))
+
+    rac = None
+    if len(stores) == 1:
+        rac = stores[0]
+    elif stores:
+        rac = morphlib.artifactstore.LayeredArtifactStore(stores)
     return lac, rac
 
 
@@ -252,43 +267,36 @@ def log_environment_changes(app, current_env, previous_env): # pragma: no cover
         if key not in current_env:
             log_event(key, previous_env[key], 'unset')
 
-# This acquired from rdiff-backup which is GPLv2+ and a patch from 2011
-# which has not yet been merged, combined with a tad of tidying from us.
-def copyfileobj(inputfp, outputfp, blocksize=1024*1024):  # pragma: no cover
-    """Copies file inputfp to outputfp in blocksize intervals"""
-
-    sparse = False
-    buf = None
-    while 1:
-        inbuf = inputfp.read(blocksize)
-        if not inbuf: break
-        if not buf:
-            buf = inbuf
-        else:
-            buf += inbuf
-
-        # Combine "short" reads
-        if (len(buf) < blocksize):
-            continue
-
-        buflen = len(buf)
-        if buf == "\x00" * buflen:
-            outputfp.seek(buflen, os.SEEK_CUR)
-            buf = None
-            # flag sparse=True, that we seek()ed, but have not written yet
-            # The filesize is wrong until we write
-            sparse = True
-        else:
-            outputfp.write(buf)
-            buf = None
-            # We wrote, so clear sparse.
-            sparse = False
-
-    if buf:
-        outputfp.write(buf)
-    elif sparse:
-        outputfp.seek(-1, os.SEEK_CUR)
-        outputfp.write("\x00")
+# The FICLONE ioctl, known as BTRFS_IOC_CLONE before other filesystems
+# supported reflinks.
+FICLONE = 0x40049409
+
+def clone_file(src, dst):  # pragma: no cover
+    """Make dst a copy of src without copying the data, if possible.
+
+       The file is reflinked if the filesystem supports it, so the two
+       files share data but are otherwise independent. Otherwise it is
+       hard linked. dst appears atomically. False is returned if neither
+       is possible, for example because the files are on different
+       filesystems.
+
+    """
+    fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(dst))
+    try:
+        try:
+            with open(src, 'rb') as f:
+                fcntl.ioctl(fd, FICLONE, f.fileno())
+            shutil.copymode(src, tmpname)
+        except (IOError, OSError):
+            os.remove(tmpname)
+            try:
+                os.link(src, tmpname)
+            except OSError:
+                return False
+        os.rename(tmpname, dst)
+        return True
+    finally:
+        os.close(fd)
 
 def get_bytes_free_in_path(path): # pragma: no cover
     """Returns the bytes free in the filesystem that path is part of"""
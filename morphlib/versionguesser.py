@@ -0,0 +1,325 @@
+# Copyright (C) 2012-2014 Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import cliapp
+import collections
+import contextlib
+import httplib
+import json
+import logging
+import multiprocessing.pool
+import os
+import re
+
+import fs.tempfs
+
+import morphlib
+
+
+class ProjectVersionGuesser(object):
+
+    def __init__(self, app, interesting_files):
+        self.app = app
+        self.interesting_files = interesting_files
+
+    def file_contents(self, files):
+        for filename in self.interesting_files:
+            if filename in files:
+                yield filename, files[filename]
+
+
+class AutotoolsVersionGuesser(ProjectVersionGuesser):
+
+    def __init__(self, app):
+        ProjectVersionGuesser.__init__(self, app, [
+            'configure.ac',
+            'configure.in',
+            'configure.ac.in',
+            'configure.in.in',
+        ])
+
+    def guess_version(self, repo, ref, files, status):
+        version = None
+        for filename, data in self.file_contents(files):
+            # First, try to grep for AC_INIT()
+            version = self._check_ac_init(data)
+            if version:
+                status(msg='%(repo)s: Version of %(ref)s detected '
+                           'via %(filename)s:AC_INIT: %(version)s',
+                       repo=repo, ref=ref, filename=filename,
+                       version=version, chatty=True)
+                break
+
+            # Then, try running autoconf against the configure script
+            version = self._check_autoconf_package_version(
+                repo, ref, filename, data, status)
+            if version:
+                status(msg='%(repo)s: Version of %(ref)s detected '
+                           'by processing %(filename)s: %(version)s',
+                       repo=repo, ref=ref, filename=filename,
+                       version=version, chatty=True)
+                break
+        return version
+
+    def _check_ac_init(self, data):
+        data = data.replace('\n', ' ')
+        for macro in ['AC_INIT', 'AM_INIT_AUTOMAKE']:
+            pattern = r'.*%s\((.*?)\).*' % macro
+            if not re.match(pattern, data):
+                continue
+            acinit = re.sub(pattern, r'\1', data)
+            if acinit:
+                version = acinit.split(',')
+                if macro == 'AM_INIT_AUTOMAKE' and len(version) == 1:
+                    continue
+                version = version[0] if len(version) == 1 else version[1]
+                version = re.sub('[\[\]]', '', version).strip()
+                version = version.split()[0]
+                if version:
+                    if version and version[0].isdigit():
+                        return version
+        return None
+
+    def _check_autoconf_package_version(self, repo, ref, filename, data,
+                                        status):
+        with contextlib.closing(fs.tempfs.TempFS(
+                temp_dir=self.app.settings['tempdir'])) as tempdir:
+            with open(tempdir.getsyspath(filename), 'w') as f:
+                f.write(data)
+            exit_code, output, errors = self.app.runcmd_unchecked(
+                ['autoconf', filename],
+                ['grep', '^PACKAGE_VERSION='],
+                ['cut', '-d=', '-f2'],
+                ['sed', "s/'//g"],
+                cwd=tempdir.root_path)
+            version = None
+            if output:
+                output = output.strip()
+                if output and output[0].isdigit():
+                    version = output
+            if exit_code != 0:
+                status(msg='%(repo)s: Failed to detect version from '
+                           '%(ref)s:%(filename)s',
+                       repo=repo, ref=ref, filename=filename, chatty=True)
+        return version
+
+
+class VersionGuesser(object):
+
+    '''Guess the versions of many commits at once.
+
+    The files the guessers look at are read from the local repository
+    cache where possible, from up to ``jobs`` repositories at the same
+    time. The files of repositories that are not cached locally are all
+    fetched from the remote repository cache in one request.
+
+    The version of a commit never changes, so each guess is remembered
+    in ``memo_filename``, if one is given, and not made again.
+
+    ``repo_caches`` is the local and remote repository caches to use,
+    which are made from the settings of ``app`` if it is not given.
+
+    '''
+
+    # Change this when the guessers change, to forget the old guesses.
+    memo_format = 1
+
+    def __init__(self, app, memo_filename=None, jobs=1, repo_caches=None):
+        self.app = app
+        if repo_caches is None:  # pragma: no cover
+            repo_caches = morphlib.util.new_repo_caches(app)
+        self.lrc, self.rrc = repo_caches
+        self.guessers = [
+            AutotoolsVersionGuesser(app)
+        ]
+        self.memo_filename = memo_filename
+        self.jobs = jobs
+        self.memo = self._load_memo()
+
+    def _load_memo(self):
+        if self.memo_filename is None or \
+                not os.path.exists(self.memo_filename):
+            return {}
+        try:
+            with open(self.memo_filename) as f:
+                data = json.load(f)
+        except ValueError:
+            data = None
+        if not isinstance(data, dict) or \
+                data.get('format') != self.memo_format:
+            logging.warning('Ignoring old or corrupt %s' % self.memo_filename)
+            return {}
+        return data['guesses']
+
+    def _save_memo(self):
+        if self.memo_filename is None:
+            return
+        with morphlib.savefile.SaveFile(self.memo_filename, 'w') as f:
+            json.dump({'format': self.memo_format, 'guesses': self.memo}, f,
+                      indent=4, sort_keys=True)
+            f.write('\n')
+
+    def interesting_files(self):
+        return [filename for guesser in self.guessers
+                for filename in guesser.interesting_files]
+
+    def guess_version(self, repo, ref):
+        return self.guess_versions([(repo, ref)]).get((repo, ref))
+
+    def guess_versions(self, pairs):
+        '''Guess the version of each (repo, ref) pair.
+
+        Return a dict mapping each pair to its version, or None if it
+        could not be guessed.
+
+        '''
+
+        versions = {}
+        todo = collections.defaultdict(set)
+        for repo, ref in pairs:
+            if ref in self.memo.get(repo, {}):
+                versions[repo, ref] = self.memo[repo][ref]
+            else:
+                versions[repo, ref] = None
+                todo[repo].add(ref)
+
+        jobs = []
+        remote = []
+        for repo, refs in sorted(todo.iteritems()):
+            if self.lrc.has_repo(repo):
+                jobs.append((repo, sorted(refs), self.lrc.get_repo(repo)))
+            elif self.rrc:
+                remote.append((repo, sorted(refs)))
+        if remote:
+            files = self._fetch_remote_files(remote)
+            jobs.extend((repo, refs, files) for repo, refs in remote)
+
+        changed = False
+        for repo, guesses, messages in self._map(self._guess_repo, jobs):
+            # Report each repo's messages together, not interleaved.
+            for kwargs in messages:
+                self.app.status(**kwargs)
+            for ref, version, remember in guesses:
+                versions[repo, ref] = version
+                if remember:
+                    self.memo.setdefault(repo, {})[ref] = version
+                    changed = True
+        if changed:
+            self._save_memo()
+        return versions
+
+    def _fetch_remote_files(self, remote):
+        '''Return {(repo, ref): {filename: data}} for remote repos.
+
+        Refs which the remote repository cache knows, but which have
+        none of the interesting files, are given an empty dict. Refs it
+        could not be asked about are left out.
+
+        '''
+
+        triplets = [(repo, ref, filename)
+                    for repo, refs in remote for ref in refs
+                    for filename in self.interesting_files()]
+        files = {}
+        try:
+            found = self.rrc.cat_files(triplets)
+            for (repo, ref, filename), data in found.iteritems():
+                files.setdefault((repo, ref), {})[filename] = data
+            # The remote cache does not say whether a file is missing
+            # because the ref has no such file, or because it does not
+            # know the ref, so the refs without files are looked up.
+            empty = [(repo, ref) for repo, refs in remote for ref in refs
+                     if (repo, ref) not in files]
+            if empty:
+                for pair in self.rrc.resolve_refs(empty):
+                    files[pair] = {}
+        except (httplib.HTTPException, IOError), e:
+            self.app.status(msg='Failed to read files from the remote '
+                                'repository cache: %(error)s',
+                            error=str(e), chatty=True)
+        return files
+
+    def _map(self, func, jobs):
+        if self.jobs <= 1 or len(jobs) <= 1:
+            return map(func, jobs)
+        pool = multiprocessing.pool.ThreadPool(min(self.jobs, len(jobs)))
+        try:
+            return pool.map(func, jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _read_local_files(self, repository, ref):
+        tree = repository.ls_tree(ref)
+        return dict((filename, repository.cat(ref, filename))
+                    for filename in self.interesting_files()
+                    if filename in tree)
+
+    def _guess_repo(self, job):
+        '''Guess the versions of some refs of one repo.
+
+        ``job`` is a tuple of the repo, its refs, and either the cached
+        repository to read files from or the files already fetched from
+        the remote repository cache. Return the repo, a list of
+        (ref, version, remember) tuples, where ``remember`` is False if
+        the guess should be made again next time because the files
+        could not be read, and a list of the keyword arguments of the
+        status messages to report.
+
+        This may be run in a thread other than the main one, so its own
+        messages are returned to be reported together by the main
+        thread. The git and autoconf commands it runs are still logged
+        by app.runcmd, which may be called from any thread.
+
+        '''
+
+        repo, refs, source = job
+        local = not isinstance(source, dict)
+        guesses = []
+        messages = []
+
+        def status(**kwargs):
+            messages.append(kwargs)
+
+        if local and not self.app.settings['no-git-update']:
+            try:
+                source.update()
+            except cliapp.AppException:
+                status(msg='%(repo)s: Failed to update',
+                       repo=repo, chatty=True)
+                return repo, guesses, messages
+
+        for ref in refs:
+            status(msg='%(repo)s: Guessing version of %(ref)s',
+                   repo=repo, ref=ref, chatty=True)
+            if local:
+                try:
+                    files = self._read_local_files(source, ref)
+                except cliapp.AppException:
+                    status(msg='%(repo)s: Failed to list files in %(ref)s',
+                           repo=repo, ref=ref, chatty=True)
+                    continue
+                remember = True
+            else:
+                remember = (repo, ref) in source
+                files = source.get((repo, ref), {})
+            version = None
+            for guesser in self.guessers:
+                version = guesser.guess_version(repo, ref, files, status)
+                if version:
+                    break
+            guesses.append((ref, version, remember))
+        return repo, guesses, messages
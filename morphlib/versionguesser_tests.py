@@ -0,0 +1,251 @@
+# Copyright (C) 2014  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import cliapp
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import morphlib
+
+
+class FakeApplication(object):
+
+    def __init__(self, tempdir):
+        self.settings = {
+            'tempdir': tempdir,
+            'no-git-update': False,
+        }
+        self.messages = []
+        self.commands = []
+        self.autoconf_output = ''
+
+    def status(self, **kwargs):
+        self.messages.append((threading.current_thread(), kwargs))
+
+    def runcmd_unchecked(self, *argvs, **kwargs):
+        self.commands.append(argvs)
+        with open(os.path.join(kwargs['cwd'], argvs[0][1])) as f:
+            f.read()
+        if self.autoconf_output:
+            return 0, self.autoconf_output, ''
+        return 1, '', 'autoconf: error'
+
+
+class FakeCachedRepo(object):
+
+    def __init__(self, files, fail_update=False):
+        self.files = files
+        self.fail_update = fail_update
+        self.updates = 0
+
+    def update(self):
+        self.updates += 1
+        if self.fail_update:
+            raise cliapp.AppException('update failed')
+
+    def ls_tree(self, ref):
+        if ref not in self.files:
+            raise cliapp.AppException('no such ref %s' % ref)
+        return self.files[ref].keys()
+
+    def cat(self, ref, filename):
+        return self.files[ref][filename]
+
+
+class FakeLocalRepoCache(object):
+
+    def __init__(self, repos):
+        self.repos = repos
+
+    def has_repo(self, repo):
+        return repo in self.repos
+
+    def get_repo(self, repo):
+        return self.repos[repo]
+
+
+class FakeRemoteRepoCache(object):
+
+    def __init__(self, files, refs):
+        self.files = files
+        self.refs = refs
+        self.requests = []
+        self.error = None
+
+    def cat_files(self, triplets):
+        self.requests.append(('files', triplets))
+        if self.error:
+            raise self.error
+        return dict((triplet, self.files[triplet]) for triplet in triplets
+                    if triplet in self.files)
+
+    def resolve_refs(self, pairs):
+        self.requests.append(('refs', pairs))
+        return [pair for pair in pairs if pair in self.refs]
+
+
+class VersionGuesserTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.memo_filename = os.path.join(self.tempdir, 'guesses.json')
+        self.app = FakeApplication(self.tempdir)
+        self.local = FakeCachedRepo({
+            'a' * 40: {'configure.ac': 'AC_INIT([foo], [1.2.3])'},
+            'b' * 40: {'README': 'nothing to see'},
+        })
+        self.lrc = FakeLocalRepoCache({'baserock:local': self.local})
+        self.rrc = FakeRemoteRepoCache(
+            {('baserock:remote', 'c' * 40, 'configure.in'):
+             'AC_INIT(bar, 4.5)'},
+            [('baserock:remote', 'c' * 40), ('baserock:remote', 'd' * 40)])
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def new_guesser(self, jobs=1):
+        return morphlib.versionguesser.VersionGuesser(
+            self.app, memo_filename=self.memo_filename, jobs=jobs,
+            repo_caches=(self.lrc, self.rrc))
+
+    def test_guesses_version_from_local_repo(self):
+        guesser = self.new_guesser()
+        self.assertEqual(guesser.guess_version('baserock:local', 'a' * 40),
+                         '1.2.3')
+        self.assertEqual(guesser.guess_version('baserock:local', 'b' * 40),
+                         None)
+
+    def test_remembers_guesses_between_runs(self):
+        self.new_guesser().guess_versions([('baserock:local', 'a' * 40),
+                                           ('baserock:local', 'b' * 40)])
+        self.local.files = {}
+        versions = self.new_guesser().guess_versions(
+            [('baserock:local', 'a' * 40), ('baserock:local', 'b' * 40)])
+        self.assertEqual(versions, {('baserock:local', 'a' * 40): '1.2.3',
+                                    ('baserock:local', 'b' * 40): None})
+        self.assertEqual(self.local.updates, 1)
+
+    def test_does_not_update_when_told_not_to(self):
+        self.app.settings['no-git-update'] = True
+        self.new_guesser().guess_version('baserock:local', 'a' * 40)
+        self.assertEqual(self.local.updates, 0)
+
+    def test_fetches_remote_files_in_one_request(self):
+        guesser = self.new_guesser()
+        versions = guesser.guess_versions([('baserock:remote', 'c' * 40),
+                                           ('baserock:remote', 'd' * 40)])
+        self.assertEqual(versions, {('baserock:remote', 'c' * 40): '4.5',
+                                    ('baserock:remote', 'd' * 40): None})
+        kinds = [kind for kind, args in self.rrc.requests]
+        self.assertEqual(kinds, ['files', 'refs'])
+        self.assertEqual(self.rrc.requests[1][1],
+                         [('baserock:remote', 'd' * 40)])
+
+    def test_remembers_remote_refs_without_interesting_files(self):
+        pairs = [('baserock:remote', 'c' * 40), ('baserock:remote', 'd' * 40)]
+        self.new_guesser().guess_versions(pairs)
+        self.rrc.requests = []
+        versions = self.new_guesser().guess_versions(pairs)
+        self.assertEqual(versions[('baserock:remote', 'd' * 40)], None)
+        self.assertEqual(self.rrc.requests, [])
+
+    def test_asks_again_about_unknown_remote_refs(self):
+        pair = ('baserock:remote', 'e' * 40)
+        self.assertEqual(self.new_guesser().guess_version(*pair), None)
+        self.rrc.requests = []
+        self.rrc.refs.append(pair)
+        self.rrc.files[pair + ('configure.ac',)] = 'AC_INIT(baz, 6)'
+        self.assertEqual(self.new_guesser().guess_version(*pair), '6')
+        self.assertEqual(len(self.rrc.requests), 1)
+
+    def test_asks_again_after_remote_cache_fails(self):
+        pair = ('baserock:remote', 'c' * 40)
+        self.rrc.error = IOError('connection refused')
+        self.assertEqual(self.new_guesser().guess_version(*pair), None)
+        self.rrc.error = None
+        self.assertEqual(self.new_guesser().guess_version(*pair), '4.5')
+
+    def test_ignores_repos_it_cannot_find(self):
+        self.rrc = None
+        guesser = self.new_guesser()
+        self.assertEqual(guesser.guess_version('baserock:remote', 'c' * 40),
+                         None)
+        self.assertFalse(os.path.exists(self.memo_filename))
+
+    def test_reports_status_from_main_thread(self):
+        guesser = self.new_guesser(jobs=2)
+        versions = guesser.guess_versions([('baserock:local', 'a' * 40),
+                                           ('baserock:remote', 'c' * 40)])
+        self.assertEqual(versions, {('baserock:local', 'a' * 40): '1.2.3',
+                                    ('baserock:remote', 'c' * 40): '4.5'})
+        self.assertTrue(self.app.messages)
+        for thread, kwargs in self.app.messages:
+            self.assertEqual(thread, threading.current_thread())
+
+    def test_asks_again_after_update_fails(self):
+        self.local.fail_update = True
+        self.assertEqual(
+            self.new_guesser().guess_version('baserock:local', 'a' * 40),
+            None)
+        self.local.fail_update = False
+        self.assertEqual(
+            self.new_guesser().guess_version('baserock:local', 'a' * 40),
+            '1.2.3')
+
+    def test_asks_again_after_listing_files_fails(self):
+        pair = ('baserock:local', 'f' * 40)
+        self.assertEqual(self.new_guesser().guess_version(*pair), None)
+        self.local.files['f' * 40] = {'configure.ac': 'AC_INIT(qux, 7)'}
+        self.assertEqual(self.new_guesser().guess_version(*pair), '7')
+
+    def test_ignores_corrupt_memo(self):
+        with open(self.memo_filename, 'w') as f:
+            f.write('{')
+        guesser = self.new_guesser()
+        self.assertEqual(guesser.memo, {})
+        self.assertEqual(guesser.guess_version('baserock:local', 'a' * 40),
+                         '1.2.3')
+
+    def test_ignores_memo_of_other_format(self):
+        with open(self.memo_filename, 'w') as f:
+            f.write('{"format": 0, "guesses": {}}')
+        self.assertEqual(self.new_guesser().memo, {})
+
+    def test_works_without_memo_file(self):
+        guesser = morphlib.versionguesser.VersionGuesser(
+            self.app, repo_caches=(self.lrc, self.rrc))
+        self.assertEqual(guesser.guess_version('baserock:local', 'a' * 40),
+                         '1.2.3')
+        self.assertFalse(os.path.exists(self.memo_filename))
+
+    def test_runs_autoconf_when_ac_init_has_no_version(self):
+        self.local.files['f' * 40] = {'configure.ac': 'AC_INIT(qux)'}
+        self.app.autoconf_output = '8.9\n'
+        self.assertEqual(
+            self.new_guesser().guess_version('baserock:local', 'f' * 40),
+            '8.9')
+        self.assertEqual(len(self.app.commands), 1)
+
+    def test_reports_autoconf_failure(self):
+        self.local.files['f' * 40] = {'configure.ac': 'AC_INIT(qux)'}
+        self.assertEqual(
+            self.new_guesser().guess_version('baserock:local', 'f' * 40),
+            None)
+        msgs = [kwargs['msg'] for thread, kwargs in self.app.messages]
+        self.assertTrue(any('Failed to detect' in msg for msg in msgs))
@@ -315,6 +315,57 @@ class WriteExtension(cliapp.Application):
         self.status(msg='Copying files to orig subvolume')
         cliapp.runcmd(['cp', '-a', temp_root + '/.', orig + '/.'])
 
+    def upgrade_orig(self, temp_root, old_metadata, new_orig):
+        '''Turn a snapshot of the old system into the new system.
+
+        ``new_orig`` starts out as a copy of the system being upgraded,
+        whose chunk metadata is ``old_metadata``. It may be a local path
+        or an rsync destination on another host.
+
+        Only the files of chunks that have changed, and the files that
+        do not belong to any chunk, have their contents compared. All the
+        other files belong to chunks that are the same in both systems,
+        so rsync's check of their size and modification time is enough,
+        and nothing is read to checksum them.
+
+        If UPGRADE_VERIFY is set, the whole tree is compared by checksum
+        afterwards, and the upgrade fails if anything differs.
+
+        '''
+        new_metadata = morphlib.upgradeplanner.read_chunk_metadata(temp_root)
+        plan = morphlib.upgradeplanner.plan_upgrade(
+            old_metadata, new_metadata, temp_root)
+        self.status(msg='%(changed)d chunk artifacts changed, %(removed)d '
+                        'removed and %(unchanged)d unchanged',
+                    changed=len(plan.changed), removed=len(plan.removed),
+                    unchanged=len(plan.unchanged))
+
+        rsync = ['rsync', '-as', '--numeric-ids']
+        source = temp_root + os.path.sep
+
+        self.status(msg='Copying %(n)d files that may have changed',
+                    n=len(plan.files))
+        with tempfile.NamedTemporaryFile() as files_from:
+            for path in plan.files:
+                files_from.write('%s\n' % path)
+            files_from.flush()
+            cliapp.runcmd(rsync + ['--checksum',
+                                   '--files-from=%s' % files_from.name,
+                                   source, new_orig])
+
+        self.status(msg='Copying the rest of the system')
+        cliapp.runcmd(rsync + ['--delete', source, new_orig])
+
+        if self.get_environment_boolean('UPGRADE_VERIFY'):
+            self.status(msg='Verifying upgraded system')
+            differences = cliapp.runcmd(
+                rsync + ['--checksum', '--delete', '--dry-run',
+                         '--itemize-changes', source, new_orig])
+            if differences.strip():
+                raise cliapp.AppException(
+                    'Upgraded system differs from the new system:\n%s' %
+                    differences)
+
     def create_run(self, version_root):
         '''Create the 'run' snapshot.'''
 
@@ -582,6 +633,82 @@ class WriteExtension(cliapp.Application):
             raise cliapp.AppException(
                 'Unable to SSH to %s: %s' % (ssh_host, e))
 
+    # How many times to try sending a disk image into a file, resuming
+    # what was sent the time before.
+    transfer_attempts = 3
+
+    def transfer_disk_image(self, raw_disk, ssh_host, receive_args,
+                            resume_path=None):
+        '''Send a sparse disk image to another host over ssh.
+
+        ``receive_args`` are the arguments for sparsetransfer on the
+        receiving host, which is run there with Python. If
+        ``resume_path`` is given, it is the file the image is received
+        into, and a transfer that is interrupted is resumed, up to
+        ``transfer_attempts`` tries in all. If it still fails, the file
+        is removed, since the next deployment makes a new disk image,
+        which would be sent afresh anyway.
+
+        The extents of the image are compressed on the way if
+        TRANSFER_COMPRESS is set.
+
+        '''
+
+        attempts = 1 if resume_path is None else self.transfer_attempts
+        try:
+            for attempt in xrange(1, attempts + 1):
+                try:
+                    self._send_disk_image(
+                        raw_disk, ssh_host, receive_args,
+                        resume_path if attempt > 1 else None)
+                    return
+                except cliapp.AppException as e:
+                    if attempt == attempts:
+                        raise
+                    logging.warning('Transfer failed: %s' % e)
+                    self.status(msg='Transfer failed, resuming it')
+        except BaseException:
+            if resume_path is not None:
+                self._remove_partial_transfer(ssh_host, resume_path)
+            raise
+
+    def _send_disk_image(self, raw_disk, ssh_host, receive_args,
+                         resume_path):
+        script = morphlib.util.get_data('sparsetransfer.py')
+        send_cmd = ['python', morphlib.util.get_data_path('sparsetransfer.py'),
+                    'send']
+        if self.get_environment_boolean('TRANSFER_COMPRESS'):
+            send_cmd.append('--compress')
+
+        journal = None
+        if resume_path is not None:
+            text = cliapp.ssh_runcmd(
+                ssh_host, ['python', '-c', script, 'journal', resume_path])
+            if text:
+                fd, journal = tempfile.mkstemp()
+                with os.fdopen(fd, 'w') as f:
+                    f.write(text)
+                send_cmd += ['--resume', journal]
+
+        receive_cmd = ['python', '-c', script] + receive_args
+        try:
+            cliapp.runcmd(
+                send_cmd + [raw_disk],
+                ['ssh', ssh_host] + map(cliapp.shell_quote, receive_cmd),
+                stdout=None, stderr=None)
+        finally:
+            if journal is not None:
+                os.remove(journal)
+
+    def _remove_partial_transfer(self, ssh_host, path):
+        journal = path + morphlib.sparsetransfer.JOURNAL_SUFFIX
+        try:
+            cliapp.ssh_runcmd(ssh_host, ['rm', '-f', path, journal])
+        except cliapp.AppException as e:
+            logging.warning('Failed to remove %s: %s' % (path, e))
+            self.status(msg='Could not remove %(path)s from %(host)s',
+                        path=path, host=ssh_host)
+
     def is_device(self, location):
         try:
             st = os.stat(location)
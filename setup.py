@@ -153,8 +153,6 @@ setup(name='morph',
                 'morphcacheserver'],
       package_data={
           'morphlib': [
-              'xfer-hole',
-              'recv-hole',
               'exts/*',
               'version',
               'commit',